@@ -0,0 +1,52 @@
+"""
+Module description: This module contains the main functionality for comparing two
+benchmark results files (e.g. of two commits) stage by stage.
+
+Usage:
+    python compare_benchmarks.py results/<baseline>.json results/<candidate>.json
+"""
+
+import json
+import argparse
+
+KEY_FIELDS = ("cameras", "duration", "settings", "stage")
+
+def load_records(results_file):
+    """
+    Load the records of a benchmark results file, indexed by their parameters and stage.
+
+    Args:
+        results_file (str): The path of the results file.
+
+    Returns:
+        dict: The records indexed by (cameras, duration, settings, stage).
+    """
+    with open(results_file, 'r', encoding='utf-8') as f:
+        results = json.load(f)
+    return {tuple(record[key] for key in KEY_FIELDS): record for record in results['records']}
+
+def main():
+    """
+    Print the wall time of each stage in both results files and flag the regressions.
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Compare two benchmark results files.')
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Relative slowdown reported as a regression')
+    args = parser.parse_args()
+
+    baseline = load_records(args.baseline)
+    candidate = load_records(args.candidate)
+    print(f"{'cameras':>7} {'duration':>8} {'settings':>8} {'stage':<18} {'baseline':>9} {'candidate':>9} {'change':>8}")
+    for key in sorted(set(baseline) & set(candidate), key=str):
+        before, after = baseline[key]['wall_time'], candidate[key]['wall_time']
+        change = (after - before) / before if before else 0.0
+        flag = '  REGRESSION' if change > args.threshold else ''
+        print(f"{key[0]:>7} {key[1]:>8} {key[2]:>8} {key[3]:<18} {before:>9.2f} {after:>9.2f} {change:>+8.1%}{flag}")
+
+if __name__ == "__main__":
+    main()
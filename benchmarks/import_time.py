@@ -0,0 +1,95 @@
+"""
+Module description: This module contains the main functionality for measuring the import
+time of the entry points and of the utility modules, and for checking that the heavy
+libraries (torch, moviepy, cv2, mediapipe, Pose2Sim, opensim) are not loaded at import time.
+
+Usage:
+    python import_time.py [--repeat 5] [--output results/import_time.json]
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+import statistics
+import ast
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CODE_DIR = os.path.join(REPO_DIR, 'code')
+
+MODULES = ['aa_pre_processing', 'bb_calibration', 'cc_processing', 'dd_comparison',
+           'utility.utils', 'utility.sync', 'utility.preprocess', 'utility.human_pose_estimation',
+           'utility.calibration', 'utility.processing', 'utility.kinematics', 'utility.comparison',
+           'stream_trial', 'utility.streaming', 'ingest_trial', 'utility.ingestion',
+           'gc_workspace', 'utility.retention', 'render_preview', 'utility.rendering',
+           'utility.association', 'utility.quality', 'utility.video_io', 'utility.metrics',
+           'utility.sub_setups']
+
+HEAVY_MODULES = ['torch', 'moviepy', 'cv2', 'av', 'mediapipe', 'Pose2Sim', 'opensim']
+
+# Run in a fresh interpreter: imports the module, then prints the heavy modules loaded
+PROBE = ("import sys, time\n"
+         "start = time.perf_counter()\n"
+         "import {module}\n"
+         "duration = time.perf_counter() - start\n"
+         "heavy = sorted({{name.split('.')[0] for name in sys.modules}} & set({heavy}))\n"
+         "print(repr((duration, heavy)))\n")
+
+def measure_import(module, repeat):
+    """
+    Measure the import time of a module in fresh interpreters.
+
+    Args:
+        module (str): The module name.
+        repeat (int): The number of measurements.
+
+    Returns:
+        dict: The median and minimum import times in seconds, the heavy modules loaded and
+            the error if the import failed.
+    """
+    durations = []
+    heavy = []
+    for _ in range(repeat):
+        completed = subprocess.run([sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                                   cwd=CODE_DIR, capture_output=True, text=True)
+        if completed.returncode != 0:
+            return {"module": module, "median": None, "min": None, "heavy_modules": None,
+                    "error": completed.stderr.strip().splitlines()[-1]}
+        duration, heavy = ast.literal_eval(completed.stdout.strip().splitlines()[-1])
+        durations.append(duration)
+    return {"module": module, "median": round(statistics.median(durations), 4), "min": round(min(durations), 4),
+            "heavy_modules": heavy, "error": None}
+
+def main():
+    """
+    Parse the command line, measure the import times and print them (and write them as JSON).
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Measure the import time of the entry points.')
+    parser.add_argument('--modules', nargs='+', default=MODULES)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default=None, help='The JSON results file')
+    args = parser.parse_args()
+
+    results = [measure_import(module, args.repeat) for module in args.modules]
+    failed = False
+    for result in results:
+        if result['error']:
+            print(f"{result['module']:35s} failed: {result['error']}")
+            continue
+        print(f"{result['module']:35s} {result['median'] * 1000:8.1f} ms (min {result['min'] * 1000:.1f} ms)"
+              f"{'  loads ' + ', '.join(result['heavy_modules']) if result['heavy_modules'] else ''}")
+        failed = failed or bool(result['heavy_modules'])
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"python": sys.version.split()[0], "results": results}, f, indent=4)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
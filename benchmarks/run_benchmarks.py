@@ -0,0 +1,180 @@
+"""
+Module description: This module contains the main functionality for benchmarking the
+pipeline stages on synthetic workspaces of growing size (cameras, duration, settings).
+
+Usage:
+    python run_benchmarks.py --cameras 2 3 4 --durations 5 10 --n-settings 1 2
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, 'code'))
+
+from synthetic import create_synthetic_workspace, write_synthetic_keypoints, write_ground_truth_calibrations
+from utility.utils import read_config
+from utility.profiling import profile_stage
+from utility.sync import sync_videos, get_folders_to_be_synced
+from utility.preprocess import preprocess_videos, create_sub_setups, get_videos_to_be_preprocessed, find_all_cams_folders
+from utility.calibration import calibrate, get_subproject_dirs as get_calibration_dirs
+from utility.processing import (get_subproject_dirs, prepare_processing_config_dict, run_person_association,
+                                run_triangulation, run_filtering)
+from utility.chunking import is_chunked, run_chunked_triangulation, run_chunked_filtering
+
+STAGES = ['sync_videos', 'preprocess_videos', 'create_sub_setups', 'calibration', 'triangulation', 'filtering']
+
+# Frame rates of the settings, the first n are used
+SETTINGS_FPS = [30, 15, 10, 5]
+
+def get_commit():
+    """
+    Get the current git commit of the repository.
+
+    Returns:
+        str or None: The commit hash.
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_stage(results, parameters, stage, items, func, *args):
+    """
+    Run and time a stage, appending its record to the results. A stage with nothing to
+    process would only time its checks, so it fails instead.
+
+    Args:
+        results (list): The benchmark records.
+        parameters (dict): The workspace parameters (cameras, duration, settings).
+        stage (str): The name of the stage.
+        items (int): The number of items (folders, videos, subprojects) the stage has to process.
+        func (callable): The function running the stage.
+        *args: The arguments of the function.
+
+    Returns:
+        object: The value returned by the function.
+    """
+    if not items:
+        raise RuntimeError(f"The {stage} stage has nothing to process in the {parameters} workspace")
+    with profile_stage(stage) as record:
+        value = func(*args)
+    results.append({**parameters, "items": items, **{key: record[key] for key in
+                                                     ("stage", "wall_time", "cpu_time", "children_cpu_time",
+                                                      "peak_rss_mb", "bytes_read", "bytes_written")}})
+    print(f"{parameters} {stage}: {items} items in {record['wall_time']:.2f} s", flush=True)
+    return value
+
+def process_subprojects(workspace, config, stage):
+    """
+    Run the triangulation (after the person association, as in the pipeline) or the
+    filtering (first filter) of every subproject, in chunks if processing.chunking is enabled.
+
+    Args:
+        workspace (str): The path of the workspace.
+        config (dict): The workspace config.
+        stage (str): 'triangulation' or 'filtering'.
+
+    Returns:
+        int: The number of subprojects processed.
+    """
+    chunking_configs = config['processing'].get('chunking', {})
+    subproject_folders = get_subproject_dirs(workspace)
+    for subproject_folder in subproject_folders:
+        config_dict = prepare_processing_config_dict(subproject_folder, config, 0, 0)
+        if stage == 'triangulation':
+            run_person_association(config_dict)
+            if is_chunked(chunking_configs):
+                run_chunked_triangulation(config_dict, chunking_configs)
+            else:
+                run_triangulation(config_dict)
+        elif is_chunked(chunking_configs, config_dict['filtering']['type']):
+            run_chunked_filtering(config_dict, chunking_configs)
+        else:
+            run_filtering(config_dict)
+    return len(subproject_folders)
+
+def benchmark_workspace(workspace, n_cameras, duration, n_settings, base_config, stages):
+    """
+    Generate a synthetic workspace and time the selected stages on it.
+
+    Args:
+        workspace (str): The path of the workspace.
+        n_cameras (int): The number of cameras.
+        duration (float): The duration of the trial in seconds.
+        n_settings (int): The number of preprocessing settings.
+        base_config (dict): The config the workspace config is derived from.
+        stages (list): The stages to time.
+
+    Returns:
+        list: The benchmark records.
+    """
+    settings = [{"fps": fps, "resolution": [None, None], "format": "mp4"} for fps in SETTINGS_FPS[:n_settings]]
+    parameters = {"cameras": n_cameras, "duration": duration, "settings": n_settings}
+    start = time.perf_counter()
+    synthetic = create_synthetic_workspace(workspace, n_cameras, duration, settings, base_config)
+    print(f"{parameters} workspace generated in {time.perf_counter() - start:.2f} s", flush=True)
+    config = synthetic['config']
+
+    results = []
+    # The stages depend on each other, so the earlier ones always run
+    run_stage(results, parameters, 'sync_videos', len(get_folders_to_be_synced(workspace)), sync_videos, workspace)
+    run_stage(results, parameters, 'preprocess_videos',
+              sum(len(get_videos_to_be_preprocessed(workspace, setting)) for setting in settings),
+              lambda: [preprocess_videos(workspace, setting) for setting in settings])
+    run_stage(results, parameters, 'create_sub_setups', len(find_all_cams_folders(workspace)),
+              create_sub_setups, workspace, config.get('sub_setups'))
+    write_synthetic_keypoints(workspace, synthetic['cameras'], duration)
+    if 'calibration' in stages:
+        run_stage(results, parameters, 'calibration', len(get_calibration_dirs(workspace)),
+                  calibrate, workspace, config['calibration_configs'])
+    write_ground_truth_calibrations(workspace, synthetic['cameras'])
+    for stage in ('triangulation', 'filtering'):
+        if stage in stages:
+            run_stage(results, parameters, stage, len(get_subproject_dirs(workspace)),
+                      process_subprojects, workspace, config, stage)
+    return [record for record in results if record['stage'] in stages]
+
+def main():
+    """
+    Parse the command line, run the benchmarks and write the results as JSON.
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic workspaces.')
+    parser.add_argument('--cameras', type=int, nargs='+', default=[2, 3, 4])
+    parser.add_argument('--durations', type=float, nargs='+', default=[5, 10])
+    parser.add_argument('--n-settings', type=int, nargs='+', default=[1, 2])
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--scratch', default=os.path.join(REPO_DIR, 'benchmarks', 'scratch'),
+                        help='The folder of the generated workspaces')
+    parser.add_argument('--output', default=None, help='The JSON results file')
+    args = parser.parse_args()
+
+    base_config = read_config(os.path.join(REPO_DIR, 'data', 'sessions'))
+
+    records = []
+    for n_cameras in args.cameras:
+        for duration in args.durations:
+            for n_settings in args.n_settings:
+                workspace = os.path.join(args.scratch, f"cams{n_cameras}_dur{duration:g}_set{n_settings}")
+                records += benchmark_workspace(workspace, n_cameras, duration, n_settings, base_config, args.stages)
+
+    commit = get_commit()
+    output = args.output or os.path.join(REPO_DIR, 'benchmarks', 'results',
+                                         f"{time.strftime('%Y%m%d_%H%M%S')}_{(commit or 'unknown')[:8]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({"commit": commit, "date": time.strftime('%Y-%m-%dT%H:%M:%S'), "python": platform.python_version(),
+                   "platform": platform.platform(), "cpu_count": os.cpu_count(), "records": records}, f, indent=4)
+    print(f"Results written to {output}")
+
+if __name__ == "__main__":
+    main()
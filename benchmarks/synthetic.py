@@ -0,0 +1,431 @@
+"""
+Module description: This module contains a set of utility functions for generating
+synthetic multi-camera workspaces (clap-synced videos, checkerboard calibration videos,
+stick-figure videos and their 2D keypoints) fully offline.
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+import cv2
+from moviepy.editor import VideoClip
+from moviepy.audio.AudioClip import AudioArrayClip
+
+BLAZEPOSE_KEYPOINTS = [
+    'nose', 'left_eye_inner', 'left_eye', 'left_eye_outer', 'right_eye_inner', 'right_eye', 'right_eye_outer',
+    'left_ear', 'right_ear', 'mouth_left', 'mouth_right', 'left_shoulder', 'right_shoulder', 'left_elbow',
+    'right_elbow', 'left_wrist', 'right_wrist', 'left_pinky', 'right_pinky', 'left_index', 'right_index',
+    'left_thumb', 'right_thumb', 'left_hip', 'right_hip', 'left_knee', 'right_knee', 'left_ankle',
+    'right_ankle', 'left_heel', 'right_heel', 'left_foot_index', 'right_foot_index',
+]
+
+# Rest pose of the stick figure in meters (x forward, y left, z up)
+REST_POSE = {
+    'nose': (0.10, 0.00, 1.62), 'left_eye_inner': (0.09, 0.02, 1.66), 'left_eye': (0.09, 0.03, 1.66),
+    'left_eye_outer': (0.08, 0.04, 1.66), 'right_eye_inner': (0.09, -0.02, 1.66), 'right_eye': (0.09, -0.03, 1.66),
+    'right_eye_outer': (0.08, -0.04, 1.66), 'left_ear': (0.00, 0.08, 1.63), 'right_ear': (0.00, -0.08, 1.63),
+    'mouth_left': (0.09, 0.02, 1.58), 'mouth_right': (0.09, -0.02, 1.58),
+    'left_shoulder': (0.00, 0.19, 1.45), 'right_shoulder': (0.00, -0.19, 1.45),
+    'left_elbow': (0.00, 0.22, 1.17), 'right_elbow': (0.00, -0.22, 1.17),
+    'left_wrist': (0.00, 0.24, 0.92), 'right_wrist': (0.00, -0.24, 0.92),
+    'left_pinky': (0.00, 0.26, 0.84), 'right_pinky': (0.00, -0.26, 0.84),
+    'left_index': (0.02, 0.25, 0.83), 'right_index': (0.02, -0.25, 0.83),
+    'left_thumb': (0.04, 0.23, 0.86), 'right_thumb': (0.04, -0.23, 0.86),
+    'left_hip': (0.00, 0.10, 0.95), 'right_hip': (0.00, -0.10, 0.95),
+    'left_knee': (0.02, 0.10, 0.52), 'right_knee': (0.02, -0.10, 0.52),
+    'left_ankle': (0.00, 0.10, 0.08), 'right_ankle': (0.00, -0.10, 0.08),
+    'left_heel': (-0.05, 0.10, 0.03), 'right_heel': (-0.05, -0.10, 0.03),
+    'left_foot_index': (0.15, 0.10, 0.02), 'right_foot_index': (0.15, -0.10, 0.02),
+}
+
+SKELETON = [
+    ('left_shoulder', 'right_shoulder'), ('left_shoulder', 'left_elbow'), ('left_elbow', 'left_wrist'),
+    ('right_shoulder', 'right_elbow'), ('right_elbow', 'right_wrist'), ('left_shoulder', 'left_hip'),
+    ('right_shoulder', 'right_hip'), ('left_hip', 'right_hip'), ('left_hip', 'left_knee'),
+    ('left_knee', 'left_ankle'), ('right_hip', 'right_knee'), ('right_knee', 'right_ankle'),
+    ('left_ankle', 'left_foot_index'), ('right_ankle', 'right_foot_index'), ('nose', 'left_ear'),
+    ('nose', 'right_ear'),
+]
+
+IMAGE_SIZE = (1280, 720)
+AUDIO_FPS = 22050
+
+def make_cameras(n_cameras, radius=4.0, height=2.5, target=(0.0, 0.0, 0.8), focal=1000.0):
+    """
+    Place cameras on a circle around the origin, all looking at the target.
+
+    Args:
+        n_cameras (int): The number of cameras.
+        radius (float): The radius of the circle in meters.
+        height (float): The height of the cameras in meters.
+        target (tuple): The point looked at.
+        focal (float): The focal length in pixels.
+
+    Returns:
+        list: One dictionary per camera with its 'name', 'K', 'R', 'rvec' and 't'.
+    """
+    width, height_px = IMAGE_SIZE
+    K = np.array([[focal, 0, width / 2], [0, focal, height_px / 2], [0, 0, 1]])
+    cameras = []
+    for i in range(n_cameras):
+        angle = 2 * np.pi * i / n_cameras + 0.3
+        center = np.array([radius * np.cos(angle), radius * np.sin(angle), height])
+        z_axis = np.asarray(target) - center
+        z_axis /= np.linalg.norm(z_axis)
+        x_axis = np.cross(z_axis, [0, 0, 1])
+        x_axis /= np.linalg.norm(x_axis)
+        y_axis = np.cross(z_axis, x_axis)
+        R = np.stack([x_axis, y_axis, z_axis])
+        t = -R @ center
+        cameras.append({"name": f"cam{i + 1}", "K": K, "R": R, "rvec": cv2.Rodrigues(R)[0].ravel(), "t": t})
+    return cameras
+
+def project(camera, points):
+    """
+    Project 3D world points in a camera.
+
+    Args:
+        camera (dict): The camera (see make_cameras).
+        points (numpy.ndarray): The (n, 3) world points.
+
+    Returns:
+        numpy.ndarray: The (n, 2) pixel coordinates.
+    """
+    camera_points = points @ camera['R'].T + camera['t']
+    pixels = camera_points @ camera['K'].T
+    return pixels[:, :2] / pixels[:, 2:3]
+
+def stick_figure(time_stamp):
+    """
+    Get the 3D keypoints of the moving stick figure (swaying and swinging its arms).
+
+    Args:
+        time_stamp (float): The time in seconds.
+
+    Returns:
+        numpy.ndarray: The (33, 3) keypoints in meters.
+    """
+    points = np.array([REST_POSE[name] for name in BLAZEPOSE_KEYPOINTS])
+    points[:, 1] += 0.05 * np.sin(2 * np.pi * 0.5 * time_stamp)
+    swing = 0.25 * np.sin(2 * np.pi * 1.0 * time_stamp)
+    for i, name in enumerate(BLAZEPOSE_KEYPOINTS):
+        if any(part in name for part in ('elbow', 'wrist', 'pinky', 'index', 'thumb')) and 'foot' not in name:
+            sign = 1 if name.startswith('left') else -1
+            points[i, 0] += sign * swing * (1.45 - points[i, 2])
+    return points
+
+def make_audio(duration, clap_time, seed):
+    """
+    Make a quiet noise track with a loud clap.
+
+    Args:
+        duration (float): The duration in seconds.
+        clap_time (float): The time of the clap in seconds.
+        seed (int): The random seed.
+
+    Returns:
+        numpy.ndarray: The (samples, 2) audio track.
+    """
+    rng = np.random.default_rng(seed)
+    audio = 0.01 * rng.standard_normal((int(duration * AUDIO_FPS), 2))
+    clap = audio[int(clap_time * AUDIO_FPS):int((clap_time + 0.03) * AUDIO_FPS)]
+    clap[:] = 0.9 * rng.standard_normal(clap.shape)
+    return np.clip(audio, -1, 1)
+
+def render_stick_figure_video(camera, video_path, duration, fps, clap_time, seed):
+    """
+    Render the stick figure seen by a camera, with a clap in the audio track.
+    The figure starts moving at the clap, so the synced videos all see the same motion.
+
+    Args:
+        camera (dict): The camera (see make_cameras).
+        video_path (str): The path of the video.
+        duration (float): The duration in seconds.
+        fps (int): The frame rate.
+        clap_time (float): The time of the clap in the video.
+        seed (int): The random seed of the audio noise.
+
+    Returns:
+        None
+    """
+    def make_frame(time_stamp):
+        frame = np.full((IMAGE_SIZE[1], IMAGE_SIZE[0], 3), 40, dtype=np.uint8)
+        pixels = project(camera, stick_figure(max(0.0, time_stamp - clap_time)))
+        index = {name: i for i, name in enumerate(BLAZEPOSE_KEYPOINTS)}
+        for start, end in SKELETON:
+            cv2.line(frame, tuple(int(v) for v in pixels[index[start]]), tuple(int(v) for v in pixels[index[end]]),
+                     (230, 230, 230), 3)
+        return frame
+
+    clip = VideoClip(make_frame, duration=duration)
+    clip = clip.set_audio(AudioArrayClip(make_audio(duration, clap_time, seed), fps=AUDIO_FPS))
+    clip.write_videofile(video_path, fps=fps, codec='libx264', audio_codec='aac', logger=None)
+    clip.close()
+
+def render_board(camera, board_R, board_t, corners_nb, square_size):
+    """
+    Render a checkerboard seen by a camera.
+
+    Args:
+        camera (dict): The camera (see make_cameras).
+        board_R (numpy.ndarray): The rotation of the board in the world.
+        board_t (numpy.ndarray): The position of the board origin in the world.
+        corners_nb (list): The number of inner corners per row and column.
+        square_size (float): The size of a square in meters.
+
+    Returns:
+        numpy.ndarray: The rendered image.
+    """
+    pixels_per_square = 40
+    squares = (corners_nb[0] + 1, corners_nb[1] + 1)
+    texture = np.full(((squares[1] + 2) * pixels_per_square, (squares[0] + 2) * pixels_per_square), 255, np.uint8)
+    for i in range(squares[0]):
+        for j in range(squares[1]):
+            if (i + j) % 2 == 0:
+                texture[(j + 1) * pixels_per_square:(j + 2) * pixels_per_square,
+                        (i + 1) * pixels_per_square:(i + 2) * pixels_per_square] = 0
+    # Texture corners in the board frame (the first inner corner is the board origin)
+    h, w = texture.shape
+    scale = square_size / pixels_per_square
+    offset = 2 * square_size
+    texture_corners = np.array([[0, 0], [w, 0], [w, h], [0, h]], dtype=np.float64)
+    board_corners = np.column_stack([texture_corners * scale - offset, np.zeros(4)])
+    image_corners = project(camera, board_corners @ board_R.T + board_t)
+    H = cv2.getPerspectiveTransform(texture_corners.astype(np.float32), image_corners.astype(np.float32))
+    image = cv2.warpPerspective(texture, H, IMAGE_SIZE, borderValue=120)
+    return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+def render_calibration_videos(cameras, calibration_folder, corners_nb, square_size, extrinsics_square_size,
+                              n_views=12, fps=30, view_duration=0.5, seed=0):
+    """
+    Render the intrinsics (moving board) and extrinsics (board on the floor) calibration
+    videos of every camera. Each board pose is held for view_duration seconds (the
+    extract_every_N_sec of the config), at the frame rate of the trials so that every
+    setting can be reached by the preprocessing.
+
+    Args:
+        cameras (list): The cameras (see make_cameras).
+        calibration_folder (str): The Calibration folder of the workspace.
+        corners_nb (list): The number of inner corners per row and column.
+        square_size (float): The size of a square of the intrinsics board in meters.
+        extrinsics_square_size (float): The size of a square of the (larger) extrinsics board in meters.
+        n_views (int): The number of board poses in the intrinsics videos.
+        fps (int): The frame rate of the videos.
+        view_duration (float): The time each board pose is held, in seconds.
+        seed (int): The random seed of the board poses.
+
+    Returns:
+        None
+    """
+    rng = np.random.default_rng(seed)
+    hold = max(1, round(fps * view_duration))
+    board_size = np.array([corners_nb[0] - 1, corners_nb[1] - 1, 0]) * square_size
+    for camera in cameras:
+        # Intrinsics: the board faces the camera at various distances and tilts
+        frames = []
+        for _ in range(n_views):
+            tilt = cv2.Rodrigues(rng.uniform(-0.4, 0.4, 3))[0]
+            board_R = camera['R'].T @ tilt
+            center = -camera['R'].T @ camera['t'] + camera['R'].T @ np.array(
+                [rng.uniform(-0.2, 0.2), rng.uniform(-0.1, 0.1), rng.uniform(1.2, 2.0)])
+            frames += [render_board(camera, board_R, center - board_R @ board_size / 2, corners_nb, square_size)] * hold
+        folder = os.path.join(calibration_folder, 'intrinsics', f"int_{camera['name']}_img")
+        os.makedirs(folder, exist_ok=True)
+        write_image_video(os.path.join(folder, f"int_{camera['name']}.mp4"), frames, fps)
+
+        # Extrinsics: the board lies on the floor at the origin
+        floor_size = np.array([corners_nb[0] - 1, corners_nb[1] - 1, 0]) * extrinsics_square_size
+        floor = render_board(camera, np.eye(3), -floor_size / 2, corners_nb, extrinsics_square_size)
+        folder = os.path.join(calibration_folder, 'extrinsics', f"ext_{camera['name']}_img")
+        os.makedirs(folder, exist_ok=True)
+        write_image_video(os.path.join(folder, f"ext_{camera['name']}.mp4"), [floor] * (4 * hold), fps)
+
+def write_image_video(video_path, frames, fps):
+    """
+    Write a list of BGR images as a video.
+
+    Args:
+        video_path (str): The path of the video.
+        frames (list): The BGR images.
+        fps (int): The frame rate.
+
+    Returns:
+        None
+    """
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, IMAGE_SIZE)
+    for frame in frames:
+        writer.write(frame)
+    writer.release()
+
+def write_calibration_toml(cameras, toml_path):
+    """
+    Write the ground-truth calibration of the cameras in the Pose2Sim Calib_board.toml format.
+
+    Args:
+        cameras (list): The cameras (see make_cameras).
+        toml_path (str): The path of the toml file.
+
+    Returns:
+        None
+    """
+    def vector(values):
+        return '[ ' + ', '.join(f"{float(v)!r}" for v in values) + ']'
+
+    lines = []
+    for i, camera in enumerate(cameras):
+        lines += [
+            f"[cam_{i + 1}]",
+            f'name = "{camera["name"]}"',
+            f"size = {vector(IMAGE_SIZE)}",
+            "matrix = [ " + ', '.join(vector(row) for row in camera['K']) + "]",
+            f"distortions = {vector([0, 0, 0, 0])}",
+            f"rotation = {vector(camera['rvec'])}",
+            f"translation = {vector(camera['t'])}",
+            "fisheye = false",
+            "",
+        ]
+    lines += ["[metadata]", "adjusted = false", "error = 0.0", ""]
+    os.makedirs(os.path.dirname(toml_path), exist_ok=True)
+    with open(toml_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines))
+
+def write_keypoints(camera, json_folder, duration, fps, noise=1.0, seed=0):
+    """
+    Write the 2D keypoints of the stick figure seen by a camera, as the OpenPose-like JSON
+    files written by the BlazePose pose estimation (one file per frame).
+
+    Args:
+        camera (dict): The camera (see make_cameras).
+        json_folder (str): The output folder (pose/blaze_<cam>_json).
+        duration (float): The duration in seconds (time 0 is the clap).
+        fps (float): The frame rate.
+        noise (float): The standard deviation of the pixel noise.
+        seed (int): The random seed of the noise.
+
+    Returns:
+        int: The number of frames written.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(json_folder, exist_ok=True)
+    n_frames = int(duration * fps)
+    for frame in range(n_frames):
+        pixels = project(camera, stick_figure(frame / fps)) + rng.normal(0, noise, (len(BLAZEPOSE_KEYPOINTS), 2))
+        keypoints = np.column_stack([pixels, np.full(len(pixels), 0.9)]).ravel().tolist()
+        data = {"version": 1.3, "people": [{"person_id": [-1], "pose_keypoints_2d": keypoints,
+                                             "face_keypoints_2d": [], "hand_left_keypoints_2d": [],
+                                             "hand_right_keypoints_2d": [], "pose_keypoints_3d": [],
+                                             "face_keypoints_3d": [], "hand_left_keypoints_3d": [],
+                                             "hand_right_keypoints_3d": []}]}
+        with open(os.path.join(json_folder, f"{camera['name']}.{frame:06d}.json"), 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+    return n_frames
+
+def create_synthetic_workspace(workspace, n_cameras, duration, settings, base_config, corners_nb=(7, 10),
+                               square_size=0.05, extrinsics_square_size=0.12, max_clap_offset=1.0, seed=0):
+    """
+    Create a synthetic workspace with one session, participant and trial recorded by
+    n_cameras cameras, each clapping-synced with a known offset.
+
+    Args:
+        workspace (str): The path of the workspace (removed first if it exists).
+        n_cameras (int): The number of cameras.
+        duration (float): The duration of the trial after the clap, in seconds.
+        settings (list): The preprocessing settings of the config.
+        base_config (dict): The config the benchmark config is derived from.
+        corners_nb (tuple): The number of inner corners of the checkerboard.
+        square_size (float): The size of a square of the intrinsics checkerboard in meters.
+        extrinsics_square_size (float): The size of a square of the extrinsics checkerboard in meters.
+        max_clap_offset (float): The maximum time of the clap in the raw videos.
+        seed (int): The random seed.
+
+    Returns:
+        dict: The cameras, the clap offsets and the config of the workspace.
+    """
+    if os.path.exists(workspace):
+        shutil.rmtree(workspace)
+    setup_folder = os.path.join(workspace, 'S1', 'original', 'all_cams', 'unset_unset_unset_unset')
+    raw_folder = os.path.join(setup_folder, 'P1', 'T1', 'raw')
+    os.makedirs(raw_folder)
+
+    rng = np.random.default_rng(seed)
+    cameras = make_cameras(n_cameras)
+    clap_offsets = rng.uniform(0.2, max_clap_offset, n_cameras).round(3).tolist()
+    for i, (camera, clap_time) in enumerate(zip(cameras, clap_offsets)):
+        render_stick_figure_video(camera, os.path.join(raw_folder, f"{camera['name']}.mp4"),
+                                  clap_time + duration, 30, clap_time, seed + i)
+    render_calibration_videos(cameras, os.path.join(setup_folder, 'Calibration'), corners_nb, square_size,
+                              extrinsics_square_size, seed=seed)
+
+    config = json.loads(json.dumps(base_config))
+    config['settings'] = settings
+    config['pose_estimation_configs'] = config['pose_estimation_configs'][:1]
+    config['processing'] = {**config.get('processing', {}), "max_workers": 1}
+    config['kinematics'] = {**config.get('kinematics', {}), "enabled": False}
+    config['filtering']['display_figures'] = False
+    config['triangulation']['show_interp_indices'] = False
+    calibration_configs = config['calibration_configs']
+    calibration_configs['intrinsics'].update({"show_detection_intrinsics": False, "intrinsics_extension": "mp4",
+                                              "intrinsics_corners_nb": list(corners_nb),
+                                              "intrinsics_square_size": square_size * 1000})
+    calibration_configs['extrinsics'].update({"show_reprojection_error": False, "extrinsics_extension": "mp4",
+                                              "extrinsics_corners_nb": list(corners_nb),
+                                              "extrinsics_square_size": extrinsics_square_size * 1000})
+    with open(os.path.join(workspace, 'config.json'), 'w', encoding='utf-8') as f:
+        json.dump(config, f, indent=2)
+    return {"cameras": cameras, "clap_offsets": clap_offsets, "config": config}
+
+def write_synthetic_keypoints(workspace, cameras, duration, noise=1.0):
+    """
+    Write the 2D keypoints of every camera in every synced task folder of the workspace,
+    in place of the pose estimation.
+
+    Args:
+        workspace (str): The path of the workspace.
+        cameras (list): The cameras (see make_cameras).
+        duration (float): The duration of the trial after the clap, in seconds.
+        noise (float): The standard deviation of the pixel noise.
+
+    Returns:
+        int: The number of task folders written.
+    """
+    count = 0
+    for root, dirs, _ in os.walk(workspace):
+        if (os.path.basename(root) != 'raw' or f"{os.sep}__synced__{os.sep}" not in root or
+            f"{os.sep}unset_unset_unset_unset{os.sep}" in root):
+            continue
+        task_folder = os.path.dirname(root)
+        setting = os.path.basename(os.path.dirname(os.path.dirname(task_folder)))
+        fps = 30 if setting.split('_')[0] == 'unset' else int(setting.split('_')[0])
+        names = {os.path.splitext(file)[0] for file in os.listdir(root)}
+        for i, camera in enumerate(cameras):
+            if camera['name'] in names:
+                write_keypoints(camera, os.path.join(task_folder, 'pose', f"blaze_{camera['name']}_json"),
+                                duration, fps, noise, seed=i)
+        count += 1
+    return count
+
+def write_ground_truth_calibrations(workspace, cameras):
+    """
+    Write the ground-truth Calib_board.toml of every synced sub-setup whose calibration
+    is missing, with only the cameras of the sub-setup.
+
+    Args:
+        workspace (str): The path of the workspace.
+        cameras (list): The cameras (see make_cameras).
+
+    Returns:
+        int: The number of calibration files written.
+    """
+    count = 0
+    for root, dirs, _ in os.walk(workspace):
+        if "Calibration" not in dirs or f"{os.sep}__synced__{os.sep}" not in root:
+            continue
+        toml_path = os.path.join(root, 'Calibration', 'Calib_board.toml')
+        if os.path.exists(toml_path):
+            continue
+        sub_setup = os.path.basename(os.path.dirname(root))
+        names = [camera['name'] for camera in cameras] if sub_setup == 'all_cams' else sub_setup.split('_')
+        write_calibration_toml([camera for camera in cameras if camera['name'] in names], toml_path)
+        count += 1
+    return count
@@ -0,0 +1,166 @@
+"""
+Module description: This module contains the main functionality for benchmarking the video
+I/O layer (utility.video_io, with each available backend) against the moviepy path the
+stages used before, on synthetic videos: probing, reading the audio, syncing (trimming
+before the spike and to a common duration), preprocessing (resampling and resizing) and
+decoding.
+
+Usage:
+    python video_io_benchmark.py --durations 10 30 --fps 30
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import traceback
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, 'code'))
+
+from synthetic import IMAGE_SIZE, make_cameras, render_stick_figure_video
+from run_benchmarks import get_commit
+from utility.sync import find_audio_spike
+from utility.video_io import BACKENDS, get_backend, get_video_info, read_audio, transcode_video, VideoReader
+
+OPERATIONS = ['probe', 'audio', 'sync', 'preprocess', 'decode']
+CLAP_TIME = 1.0
+
+def run_moviepy(operation, video_file, output_file, duration, fps):
+    """
+    Run an operation the way the stages did with moviepy.
+
+    Returns:
+        int: The number of frames written or decoded.
+    """
+    import cv2
+    from moviepy.editor import VideoFileClip
+
+    if operation == 'probe':
+        clip = VideoFileClip(video_file)
+        clip.close()
+        capture = cv2.VideoCapture(video_file)
+        capture.read()
+        capture.release()
+        return 0
+    if operation == 'audio':
+        clip = VideoFileClip(video_file)
+        find_audio_spike(clip.audio.to_soundarray(fps=clip.audio.fps), clip.audio.fps)
+        clip.close()
+        return 0
+    if operation == 'sync':
+        # Trimmed before the spike, then to the common duration, encoded each time
+        untrimmed_file = f"{os.path.splitext(output_file)[0]}_untrimmed.mp4"
+        clip = VideoFileClip(video_file).subclip(CLAP_TIME)
+        clip.write_videofile(untrimmed_file, codec='libx264', audio=False, logger=None)
+        clip.close()
+        clip = VideoFileClip(untrimmed_file).subclip(0, duration - CLAP_TIME - 0.5)
+        clip.write_videofile(output_file, codec='libx264', audio=False, logger=None)
+        os.remove(untrimmed_file)
+        return int(clip.duration * clip.fps)
+    if operation == 'preprocess':
+        clip = VideoFileClip(video_file)
+        new_clip = clip.set_fps(fps / 2).resize([IMAGE_SIZE[0] // 2, IMAGE_SIZE[1] // 2])
+        new_clip.write_videofile(output_file, codec='libx264', logger=None)
+        clip.close()
+        return int(new_clip.duration * new_clip.fps)
+    clip = VideoFileClip(video_file)
+    n_frames = sum(1 for _ in clip.iter_frames())
+    clip.close()
+    return n_frames
+
+def run_video_io(operation, video_file, output_file, duration, fps, video_io_configs):
+    """
+    Run an operation with the video I/O layer, as the stages do now.
+
+    Returns:
+        int: The number of frames written or decoded.
+    """
+    if operation == 'probe':
+        get_video_info(video_file, video_io_configs)
+        return 0
+    if operation == 'audio':
+        find_audio_spike(*read_audio(video_file, video_io_configs))
+        return 0
+    if operation == 'sync':
+        return transcode_video(video_file, output_file, start=CLAP_TIME, end=duration - 0.5,
+                               video_io_configs=video_io_configs)
+    if operation == 'preprocess':
+        return transcode_video(video_file, output_file, fps=fps / 2, size=(IMAGE_SIZE[0] // 2, IMAGE_SIZE[1] // 2),
+                               video_io_configs=video_io_configs)
+    with VideoReader(video_file, video_io_configs=video_io_configs) as reader:
+        return sum(1 for _ in reader)
+
+def benchmark_video(video_file, duration, fps, implementations, operations, scratch):
+    """
+    Time each operation with each implementation on a video.
+
+    Returns:
+        list: The benchmark records.
+    """
+    records = []
+    for operation in operations:
+        for implementation in implementations:
+            output_file = os.path.join(scratch, f"{operation}_{implementation}.mp4")
+            record = {"duration": duration, "fps": fps, "operation": operation, "implementation": implementation}
+            start = time.perf_counter()
+            cpu_start = time.process_time()
+            try:
+                if implementation == 'moviepy':
+                    frames = run_moviepy(operation, video_file, output_file, duration, fps)
+                else:
+                    frames = run_video_io(operation, video_file, output_file, duration, fps,
+                                          {"backend": implementation})
+                record.update({"wall_time": round(time.perf_counter() - start, 4),
+                               "cpu_time": round(time.process_time() - cpu_start, 4), "frames": frames,
+                               "error": None})
+            except Exception as e:
+                traceback.print_exc()
+                record.update({"wall_time": None, "cpu_time": None, "frames": None,
+                               "error": f"{type(e).__name__}: {e}"})
+            records.append(record)
+            print(f"{duration:g} s {operation} {implementation}: "
+                  f"{record['wall_time'] if record['error'] is None else record['error']}", flush=True)
+    return records
+
+def main():
+    """
+    Parse the command line, run the benchmarks and write the results as JSON.
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the video I/O layer against moviepy.')
+    parser.add_argument('--durations', type=float, nargs='+', default=[10, 30])
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--operations', nargs='+', default=OPERATIONS, choices=OPERATIONS)
+    parser.add_argument('--scratch', default=os.path.join(REPO_DIR, 'benchmarks', 'scratch', 'video_io'),
+                        help='The folder of the generated videos')
+    parser.add_argument('--output', default=None, help='The JSON results file')
+    args = parser.parse_args()
+
+    backends = [backend for backend in BACKENDS if backend != 'av' or get_backend({}) == 'av']
+    implementations = ['moviepy'] + backends
+    os.makedirs(args.scratch, exist_ok=True)
+    camera = make_cameras(1)[0]
+    records = []
+    for duration in args.durations:
+        video_file = os.path.join(args.scratch, f"input_{duration:g}s_{args.fps}fps.mp4")
+        if not os.path.exists(video_file):
+            render_stick_figure_video(camera, video_file, duration, args.fps, CLAP_TIME, seed=0)
+        records += benchmark_video(video_file, duration, args.fps, implementations, args.operations, args.scratch)
+
+    commit = get_commit()
+    output = args.output or os.path.join(REPO_DIR, 'benchmarks', 'results',
+                                         f"video_io_{time.strftime('%Y%m%d_%H%M%S')}_{(commit or 'unknown')[:8]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({"commit": commit, "date": time.strftime('%Y-%m-%dT%H:%M:%S'), "python": platform.python_version(),
+                   "platform": platform.platform(), "cpu_count": os.cpu_count(), "image_size": IMAGE_SIZE,
+                   "records": records}, f, indent=4)
+    print(f"Results written to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -5,20 +5,29 @@ and pre-processing videos and extracting human pose.
 
 import logging
 import logging.handlers
-from utility.utils import get_workspace, read_config, move_logs_to_workspace, setup_logging
+from utility.utils import get_arguments, read_config, move_logs_to_workspace, setup_logging
+from utility.profiling import start_run_report, write_run_report
+from utility.metrics import start_metrics_server
+from utility.journal import start_journal
 from utility.sync import sync_videos
 from utility.preprocess import preprocess_videos, create_sub_setups
-from utility.human_pose_estimation import extract_pose_from_videos
+from utility.human_pose_estimation import extract_pose_from_videos, derive_subsampled_poses
+from utility.video_io import configure_video_io
 
 if __name__ == "__main__":
     # Read workspace
-    workspace = get_workspace()
+    arguments = get_arguments()
+    workspace = arguments.workspace
 
     # Read the configuration file
     config = read_config(workspace)
 
     # Setup logging
     setup_logging(workspace, 'preprocessing')
+    start_run_report(workspace, 'preprocessing', config.get('profiling'))
+    start_metrics_server('preprocessing', config.get('metrics'))
+    configure_video_io(config.get('video_io'))
+    start_journal(workspace, 'preprocessing', resume=arguments.resume)
 
     # Sync the videos
     logging.info('Sync the videos...')
@@ -31,14 +40,21 @@ if __name__ == "__main__":
 
     # Create sub_setups
     logging.info('Creating sub setups...')
-    create_sub_setups(workspace)
+    create_sub_setups(workspace, config.get('sub_setups'))
 
     # Extract human pose from videos
     logging.info('Extracting human pose from videos...')
     for pose_estimation_config in config['pose_estimation_configs']:
-        extract_pose_from_videos(workspace, pose_estimation_config)
+        extract_pose_from_videos(workspace, pose_estimation_config, config.get('rendering'))
+
+    # Derive the poses of the subsampled settings
+    logging.info('Deriving the poses of the subsampled settings...')
+    derive_subsampled_poses(workspace, config['settings'])
 
     # Organizing the logs by OpenSim
     move_logs_to_workspace(workspace, 'preprocessing')
 
+    # Writing the run report
+    write_run_report('preprocessing')
+
     logging.info('Done!')
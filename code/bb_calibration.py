@@ -6,6 +6,8 @@ for performing camera calibration.
 import logging
 import logging.handlers
 from utility.utils import get_workspace, read_config, move_logs_to_workspace, setup_logging
+from utility.profiling import start_run_report, write_run_report
+from utility.metrics import start_metrics_server
 from utility.calibration import calibrate
 
 if __name__ == "__main__":
@@ -18,6 +20,8 @@ if __name__ == "__main__":
 
     # Setup logging
     setup_logging(workspace, 'calibration')
+    start_run_report(workspace, 'calibration', config.get('profiling'))
+    start_metrics_server('calibration', config.get('metrics'))
 
     # Calibration
     logging.info("Calibration...")
@@ -26,4 +30,7 @@ if __name__ == "__main__":
     # Organizing the logs by OpenSim
     move_logs_to_workspace(workspace, 'calibration')
 
+    # Writing the run report
+    write_run_report('calibration')
+
     logging.info("Done!")
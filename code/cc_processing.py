@@ -6,6 +6,8 @@ for processing the videos (triangulation, association, filtering, etc).
 import logging
 import logging.handlers
 from utility.utils import get_workspace, read_config, move_logs_to_workspace, setup_logging
+from utility.profiling import start_run_report, write_run_report
+from utility.metrics import start_metrics_server
 from utility.processing import process
 
 if __name__ == "__main__":
@@ -17,14 +19,22 @@ if __name__ == "__main__":
 
     # Setup logging
     setup_logging(workspace, 'processing')
+    start_run_report(workspace, 'processing', config.get('profiling'))
+    start_metrics_server('processing', config.get('metrics'))
 
     # Processing
     logging.info("Processing...")
-    process(workspace, config)
+    summary = process(workspace, config)
+    if summary['counts'].get('failed') or summary['counts'].get('skipped'):
+        logging.error(f"Some processing tasks did not succeed: {summary['counts']}, "
+                      f"see run_summary_processing.json in the workspace.")
 
     # Organizing the logs by OpenSim
     move_logs_to_workspace(workspace, 'processing')
 
+    # Writing the run report
+    write_run_report('processing')
+
     logging.info("Done!")
 
 
@@ -0,0 +1,30 @@
+"""
+Module description: This module contains the main functionality 
+for comparing the results of the settings, sub setups and filters.
+"""
+
+import os
+import logging
+import logging.handlers
+from utility.utils import get_workspace, read_config, setup_logging
+from utility.comparison import compare_results, write_comparison
+
+if __name__ == "__main__":
+    # Read workspace
+    workspace = get_workspace()
+
+    # Read the configuration file
+    config = read_config(workspace)
+
+    # Setup logging
+    setup_logging(workspace, 'comparison')
+
+    # Comparison
+    logging.info("Comparing the results...")
+    comparison_configs = config.get('comparison', {})
+    rows = compare_results(workspace, comparison_configs)
+    output_file = os.path.join(workspace, comparison_configs.get('output_file', '../../results/comparison.csv'))
+    write_comparison(rows, output_file)
+    logging.info(f"{len(rows)} comparison rows written to {output_file}")
+
+    logging.info("Done!")
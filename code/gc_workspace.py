@@ -0,0 +1,43 @@
+"""
+Module description: This module contains the main functionality for reporting the space used
+by each stage of the workspace and pruning the intermediates that can be regenerated
+(temporary files, annotated pose images and videos, sub setup, preprocessed and synced
+videos) until the workspace fits in a byte budget.
+
+Usage:
+    python gc_workspace.py --workspace ../data/sessions --budget 200G [--dry-run]
+    python gc_workspace.py --workspace ../data/sessions --restore
+"""
+
+import logging
+import logging.handlers
+import argparse
+from utility.utils import read_config, setup_logging
+from utility.retention import collect_garbage, restore_pruned
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Report and prune the workspace under a disk budget.')
+    parser.add_argument('--workspace', help='The path to the workspace directory')
+    parser.add_argument('--budget', default=None,
+                        help='The budget in bytes or with a K, M, G or T suffix, the retention budget of the config by default')
+    parser.add_argument('--dry-run', action='store_true', help='Only report what would be pruned')
+    parser.add_argument('--restore', action='store_true',
+                        help='Forget the pruned files, so that the next runs of the stages make them again')
+    arguments = parser.parse_args()
+    workspace = arguments.workspace
+
+    # Read the configuration file
+    config = read_config(workspace)
+
+    # Setup logging
+    setup_logging(workspace, 'gc')
+
+    if arguments.restore:
+        restore_pruned(workspace)
+    else:
+        logging.info("Collecting garbage...")
+        report = collect_garbage(workspace, config.get('retention', {}), arguments.budget, arguments.dry_run)
+        logging.info(f"{len(report['pruned'])} items {'would be ' if arguments.dry_run else ''}pruned, "
+                     f"{report['total_bytes'] - report['remaining_bytes']} bytes freed.")
+
+    logging.info("Done!")
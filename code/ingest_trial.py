@@ -0,0 +1,53 @@
+"""
+Module description: This module contains the main functionality for ingesting a trial from
+live sources (cameras, RTSP streams, or files replayed at real-time rate) straight into the
+__synced__ layout of the workspace.
+
+Usage:
+    python ingest_trial.py --workspace ../data/sessions --participant P1 --trial T1 \
+        --source cam1=rtsp://192.168.1.10/stream --source cam2=rtsp://192.168.1.11/stream
+"""
+
+import logging
+import logging.handlers
+import argparse
+from utility.utils import read_config, setup_logging
+from utility.profiling import start_run_report, write_run_report
+from utility.metrics import start_metrics_server
+from utility.journal import start_journal
+from utility.ingestion import get_synced_trial_folder, ingest_trial
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Ingest a trial from live sources.')
+    parser.add_argument('--workspace', help='The path to the workspace directory')
+    parser.add_argument('--session', default='S1')
+    parser.add_argument('--sub-setup', default='all_cams')
+    parser.add_argument('--participant', required=True)
+    parser.add_argument('--trial', required=True)
+    parser.add_argument('--source', action='append', default=[], metavar='NAME=URL',
+                        help='A camera name and its device, RTSP URL or file, the ingestion sources of the config by default')
+    arguments = parser.parse_args()
+    workspace = arguments.workspace
+
+    # Read the configuration file
+    config = read_config(workspace)
+    ingestion_configs = config.get('ingestion', {})
+    sources = dict(source.split('=', 1) for source in arguments.source) or ingestion_configs.get('sources', {})
+
+    # Setup logging
+    setup_logging(workspace, 'ingestion')
+    start_run_report(workspace, 'ingestion', config.get('profiling'))
+    start_metrics_server('ingestion', config.get('metrics'))
+    start_journal(workspace, 'ingestion')
+
+    # Ingestion
+    logging.info("Ingesting...")
+    trial_folder = get_synced_trial_folder(workspace, arguments.session, arguments.sub_setup,
+                                           arguments.participant, arguments.trial)
+    stats = ingest_trial(sources, trial_folder, ingestion_configs)
+    logging.info(f"Ingestion stats: {stats}")
+
+    # Writing the run report
+    write_run_report('ingestion')
+
+    logging.info("Done!")
@@ -0,0 +1,49 @@
+"""
+Module description: This module contains the main functionality for rendering the annotated
+images and videos of a trial from its stored keypoints, on demand (with the rendering mode
+'later', the pose estimation only writes the keypoints).
+
+Usage:
+    python render_preview.py --workspace ../data/sessions \
+        --trial ../data/sessions/S1/__synced__/all_cams/<setting>/P1/T1 [--camera cam1] [--images]
+"""
+
+import logging
+import logging.handlers
+import os
+import argparse
+from utility.utils import read_config, setup_logging, is_video_file
+from utility.rendering import render_video
+from utility.video_io import configure_video_io
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Render the annotated videos of a trial from its keypoints.')
+    parser.add_argument('--workspace', help='The path to the workspace directory')
+    parser.add_argument('--trial', required=True, help='The trial folder under __synced__')
+    parser.add_argument('--camera', action='append', default=[], help='The cameras to render, all by default')
+    parser.add_argument('--images', action='store_true', help='Also write the annotated images')
+    arguments = parser.parse_args()
+    workspace = arguments.workspace
+
+    # Read the configuration file
+    config = read_config(workspace)
+
+    # Setup logging
+    setup_logging(workspace, 'rendering')
+    configure_video_io(config.get('video_io'))
+
+    # Rendering
+    logging.info("Rendering...")
+    output_folder = os.path.join(arguments.trial, 'pose')
+    for file_name in sorted(os.listdir(os.path.join(arguments.trial, 'raw'))):
+        camera = os.path.splitext(file_name)[0]
+        json_folder = os.path.join(output_folder, f"blaze_{camera}_json")
+        if not is_video_file(file_name) or (arguments.camera and camera not in arguments.camera):
+            continue
+        if not os.path.isdir(json_folder):
+            logging.warning(f"No keypoints for {camera}, its pose has not been estimated yet.")
+            continue
+        render_video(os.path.join(arguments.trial, 'raw', file_name), json_folder, output_folder,
+                     save_images=arguments.images, save_video=True, rendering_configs=config.get('rendering'))
+
+    logging.info("Done!")
@@ -0,0 +1,61 @@
+"""
+Module description: This module contains the main functionality for running the pipeline
+on several nodes sharing the workspace: one coordinator and any number of workers.
+
+Usage:
+    python run_distributed.py coordinator --workspace ../data/sessions
+    python run_distributed.py worker --workspace ../data/sessions   (on every node)
+"""
+
+import logging
+import logging.handlers
+import argparse
+import threading
+from utility.utils import read_config, move_logs_to_workspace, setup_logging
+from utility.profiling import start_run_report, write_run_report
+from utility.metrics import start_metrics_server
+from utility.journal import start_journal
+from utility.work_queue import get_queue
+from utility.distributed import STAGES, run_coordinator, run_worker
+from utility.video_io import configure_video_io
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the pipeline on several nodes sharing the workspace.')
+    parser.add_argument('role', choices=['coordinator', 'worker'])
+    parser.add_argument('--workspace', help='The path to the workspace directory')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=None, help='The stages run by the coordinator')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='The number of worker threads started next to the coordinator')
+    arguments = parser.parse_args()
+    workspace = arguments.workspace
+
+    # Read the configuration file
+    config = read_config(workspace)
+
+    # Setup logging
+    task = f"distributed_{arguments.role}"
+    setup_logging(workspace, task)
+    start_run_report(workspace, task, config.get('profiling'))
+    start_metrics_server(task, config.get('metrics'))
+    configure_video_io(config.get('video_io'))
+    start_journal(workspace, task)
+
+    queue = get_queue(workspace, config.get('distributed', {}))
+    if arguments.role == 'coordinator':
+        workers = [threading.Thread(target=run_worker, args=(queue, config, f"local_{i}"), daemon=True)
+                   for i in range(arguments.workers)]
+        for worker in workers:
+            worker.start()
+        run_coordinator(workspace, config, queue, arguments.stages)
+        for worker in workers:
+            worker.join()
+    else:
+        run_worker(queue, config)
+
+    # Organizing the logs by OpenSim
+    move_logs_to_workspace(workspace, task)
+
+    # Writing the run report
+    write_run_report(task)
+
+    logging.info("Done!")
@@ -0,0 +1,49 @@
+"""
+Module description: This module contains the main functionality for streaming a single
+trial from its original videos to a filtered TRC file, without running the batch stages.
+
+Usage:
+    python stream_trial.py --workspace ../data/sessions --trial <trial folder under original/>
+"""
+
+import logging
+import logging.handlers
+import argparse
+from utility.utils import read_config, move_logs_to_workspace, setup_logging
+from utility.profiling import start_run_report, write_run_report
+from utility.metrics import start_metrics_server
+from utility.streaming import stream_trial
+from utility.video_io import configure_video_io
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Stream a single trial to a filtered TRC file.')
+    parser.add_argument('--workspace', help='The path to the workspace directory')
+    parser.add_argument('--trial', required=True,
+                        help='The trial folder under original/, e.g. <workspace>/S1/original/<sub_setup>/'
+                             'unset_unset_unset_unset/P1/T1')
+    parser.add_argument('--calibration', default=None,
+                        help='The Calib_board.toml file, the full resolution calibration of the sub setup by default')
+    arguments = parser.parse_args()
+    workspace = arguments.workspace
+
+    # Read the configuration file
+    config = read_config(workspace)
+
+    # Setup logging
+    setup_logging(workspace, 'streaming')
+    start_run_report(workspace, 'streaming', config.get('profiling'))
+    start_metrics_server('streaming', config.get('metrics'))
+    configure_video_io(config.get('video_io'))
+
+    # Streaming
+    logging.info("Streaming...")
+    stats = stream_trial(arguments.trial, config, arguments.calibration)
+    logging.info(f"Streaming stats: {stats}")
+
+    # Organizing the logs by OpenSim
+    move_logs_to_workspace(workspace, 'streaming')
+
+    # Writing the run report
+    write_run_report('streaming')
+
+    logging.info("Done!")
@@ -0,0 +1,336 @@
+"""
+Module description: This module contains a set of utility functions for associating the
+people detected by each camera: the detections of all the cameras are scored against each
+other for a block of frames at once (symmetric epipolar distances), grouped into people,
+and their identities are carried across frames by a light tracker. The associated
+keypoints are written to pose-associated/, where the triangulation reads them.
+"""
+
+import logging
+import logging.handlers
+import os
+import json
+import warnings
+import numpy as np
+from utility.utils import atomic_output
+from utility.cameras import read_calibration, undistort_points, triangulate_points
+from utility.streaming import BLAZEPOSE_KEYPOINTS
+
+# The keypoints two detections must share for their distance to count
+MIN_COMMON_KEYPOINTS = 3
+
+def read_camera_keypoints(json_folder):
+    """
+    Read the people detected by a camera, one OpenPose-like JSON file per frame.
+
+    Args:
+        json_folder (str): The folder of the JSON files (pose/blaze_<cam>_json).
+
+    Returns:
+        tuple: The file names and, for each frame, the list of the people (JSON dictionaries).
+    """
+    file_names = sorted(file_name for file_name in os.listdir(json_folder) if file_name.endswith('.json'))
+    frames = []
+    for file_name in file_names:
+        with open(os.path.join(json_folder, file_name), 'r', encoding='utf-8') as f:
+            frames.append([person for person in json.load(f).get('people', []) if person.get('pose_keypoints_2d')])
+    return file_names, frames
+
+def pad_detections(frames_by_camera, start, stop, n_keypoints):
+    """
+    Stack the detections of a block of frames of all the cameras into one array, padded
+    with NaN up to the largest number of people.
+
+    Args:
+        frames_by_camera (list): For each camera, the people of each frame (see read_camera_keypoints).
+        start (int): The first frame of the block.
+        stop (int): The frame after the block.
+        n_keypoints (int): The number of keypoints.
+
+    Returns:
+        numpy.ndarray: The (x, y, likelihood) keypoints, shape (cameras, frames, people, keypoints, 3).
+    """
+    n_people = max([len(people) for frames in frames_by_camera for people in frames[start:stop]] + [1])
+    detections = np.full((len(frames_by_camera), stop - start, n_people, n_keypoints, 3), np.nan)
+    for c, frames in enumerate(frames_by_camera):
+        for t, people in enumerate(frames[start:stop]):
+            for p, person in enumerate(people):
+                detections[c, t, p] = np.reshape(person['pose_keypoints_2d'], (-1, 3))[:n_keypoints]
+    return detections
+
+def get_essential_matrix(camera_a, camera_b):
+    """
+    Get the essential matrix mapping the normalized points of camera a to their epipolar
+    lines in camera b (x_b^T E x_a = 0).
+    """
+    rotation = camera_b['R'] @ camera_a['R'].T
+    translation = camera_b['t'] - rotation @ camera_a['t']
+    skew = np.array([[0, -translation[2], translation[1]],
+                     [translation[2], 0, -translation[0]],
+                     [-translation[1], translation[0], 0]])
+    return skew @ rotation
+
+def get_epipolar_distances(points_a, points_b, valid_a, valid_b, essential_matrix, focal_a, focal_b):
+    """
+    Score every detection of camera a against every detection of camera b, for all the
+    frames of a block at once: the symmetric distance of the keypoints to the epipolar
+    lines, in pixels, averaged over the keypoints both detections see.
+
+    Args:
+        points_a (numpy.ndarray): The homogeneous normalized keypoints of camera a, shape (frames, people_a, keypoints, 3).
+        points_b (numpy.ndarray): The same for camera b, shape (frames, people_b, keypoints, 3).
+        valid_a (numpy.ndarray): Whether each keypoint of camera a is reliable, shape (frames, people_a, keypoints).
+        valid_b (numpy.ndarray): The same for camera b.
+        essential_matrix (numpy.ndarray): The essential matrix from a to b.
+        focal_a (float): The focal length of camera a in pixels.
+        focal_b (float): The focal length of camera b in pixels.
+
+    Returns:
+        numpy.ndarray: The distances, shape (frames, people_a, people_b), inf where they
+            share less than MIN_COMMON_KEYPOINTS keypoints.
+    """
+    lines_b = np.einsum('ij,tpkj->tpki', essential_matrix, points_a)
+    lines_a = np.einsum('ji,tqkj->tqki', essential_matrix, points_b)
+    residuals = np.abs(np.einsum('tqki,tpki->tpqk', points_b, lines_b))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        distances = 0.5 * residuals * (focal_b / np.linalg.norm(lines_b[..., :2], axis=-1)[:, :, None, :] +
+                                       focal_a / np.linalg.norm(lines_a[..., :2], axis=-1)[:, None, :, :])
+    common = valid_a[:, :, None, :] & valid_b[:, None, :, :]
+    counts = common.sum(axis=-1)
+    with np.errstate(invalid='ignore'):
+        mean_distances = np.where(common, np.nan_to_num(distances, nan=np.inf, posinf=np.inf), 0).sum(axis=-1) / counts
+    return np.where(counts >= MIN_COMMON_KEYPOINTS, mean_distances, np.inf)
+
+def group_detections(distances, n_people, threshold):
+    """
+    Group the detections of one frame into people: the pairs of detections are merged from
+    the closest, as long as a group holds at most one detection per camera and the mean
+    distance between the detections of the two merged groups stays under the threshold
+    (so that a third camera can reject a pair that is only consistent by chance). Groups
+    seen by one camera only cannot be triangulated and are dropped.
+
+    Args:
+        distances (dict): For each camera pair (a, b), the distances of the frame, shape (people_a, people_b).
+        n_people (list): The number of people detected by each camera.
+        threshold (float): The largest distance in pixels.
+
+    Returns:
+        list: The groups, each with its 'members' (the detection of each camera) and its
+            'score' (the mean distance of its pairs).
+    """
+    group_of = {}
+    groups = {}
+    edges = sorted((distance, a, i, b, j) for (a, b), pair_distances in distances.items()
+                   for i, j in zip(*np.nonzero(pair_distances[:n_people[a], :n_people[b]] <= threshold))
+                   for distance in [pair_distances[i, j]])
+    for distance, a, i, b, j in edges:
+        group_a, group_b = group_of.get((a, i)), group_of.get((b, j))
+        if group_a is not None and group_a == group_b:
+            groups[group_a]['distances'].append(distance)
+            continue
+        members_a = groups[group_a]['members'] if group_a is not None else {a: i}
+        members_b = groups[group_b]['members'] if group_b is not None else {b: j}
+        if set(members_a) & set(members_b):
+            continue
+        cross_distances = [distances[(min(c, d), max(c, d))][(p, q) if c < d else (q, p)]
+                           for c, p in members_a.items() for d, q in members_b.items()]
+        if np.mean(cross_distances) > threshold:
+            continue
+        merged = {"members": {**members_a, **members_b},
+                  "distances": (groups.pop(group_a)['distances'] if group_a is not None else []) +
+                               (groups.pop(group_b)['distances'] if group_b is not None else []) + cross_distances}
+        groups[(a, i)] = merged
+        for member in merged['members'].items():
+            group_of[member] = (a, i)
+    return [{"members": group['members'], "score": float(np.mean(group['distances']))} for group in groups.values()]
+
+def locate_groups(detections, groups, cameras, tracked_index, likelihood_threshold):
+    """
+    Triangulate the groups of a block of frames at once and locate each at its tracked
+    keypoint (the mean of its keypoints when the tracked one cannot be triangulated).
+
+    Args:
+        detections (numpy.ndarray): The keypoints of the block (see pad_detections).
+        groups (list): For each frame of the block, its groups (see group_detections).
+        cameras (list): The cameras, in the order of the detections.
+        tracked_index (int): The index of the tracked keypoint.
+        likelihood_threshold (float): The keypoints below are ignored.
+
+    Returns:
+        list: For each frame, the 3D position of each group, shape (groups, 3).
+    """
+    n_cameras, _, _, n_keypoints, _ = detections.shape
+    index = [(t, g) for t, frame_groups in enumerate(groups) for g in range(len(frame_groups))]
+    if not index:
+        return [np.empty((0, 3)) for _ in groups]
+    pixels = np.full((n_cameras, len(index), n_keypoints, 3), np.nan)
+    for n, (t, g) in enumerate(index):
+        for c, p in groups[t][g]['members'].items():
+            pixels[c, n] = detections[c, t, p]
+    likelihoods = np.nan_to_num(pixels[..., 2])
+    weights = np.where(likelihoods >= likelihood_threshold, likelihoods, 0.0).reshape(n_cameras, -1)
+    normalized_points = np.array([undistort_points(pixels[c, ..., :2], camera).reshape(-1, 2)
+                                  for c, camera in enumerate(cameras)])
+    points = triangulate_points(normalized_points, weights, cameras).reshape(len(index), n_keypoints, 3)
+    points[((weights > 0).sum(axis=0) < 2).reshape(len(index), n_keypoints)] = np.nan
+    with warnings.catch_warnings():
+        # The mean of a group without any triangulated keypoint is NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        positions = np.where(np.isnan(points[:, tracked_index]).any(axis=-1, keepdims=True),
+                             np.nanmean(points, axis=1), points[:, tracked_index])
+    located = [[] for _ in groups]
+    for n, (t, _) in enumerate(index):
+        located[t].append(positions[n])
+    return [np.array(frame_positions).reshape(-1, 3) for frame_positions in located]
+
+class PersonTracker(object):
+    """
+    Carries the identities of the people across frames: the groups of a frame are matched
+    to the tracks by their 3D distance (Hungarian assignment, gated by max_distance), the
+    unmatched groups seen by at least min_cameras cameras start new tracks (two cameras
+    agree by chance more often), and a track unseen for more than max_gap frames ends.
+    In single person mode, only one track is kept.
+    """
+
+    def __init__(self, max_distance, max_gap, single_person, min_cameras=2):
+        self.max_distance = max_distance
+        self.max_gap = max_gap
+        self.single_person = single_person
+        self.min_cameras = min_cameras
+        self.tracks = {}
+        self.next_identity = 0
+
+    def update(self, frame_index, positions, groups):
+        """
+        Assign the groups of a frame to identities.
+
+        Args:
+            frame_index (int): The frame.
+            positions (numpy.ndarray): The 3D positions of the groups, shape (groups, 3).
+            groups (list): The groups (see group_detections).
+
+        Returns:
+            dict: The identity of each assigned group, by group index.
+        """
+        from scipy.optimize import linear_sum_assignment  # deferred, scipy is slow to import
+
+        self.tracks = {identity: track for identity, track in self.tracks.items()
+                       if frame_index - track['frame'] <= self.max_gap}
+        identities = list(self.tracks)
+        valid = np.flatnonzero(~np.isnan(positions).any(axis=-1))
+        assigned = {}
+        if identities and len(valid):
+            costs = np.linalg.norm(np.array([self.tracks[identity]['position'] for identity in identities])[:, None]
+                                   - positions[valid][None], axis=-1)
+            for row, column in zip(*linear_sum_assignment(np.where(costs <= self.max_distance, costs, 1e9))):
+                if costs[row, column] <= self.max_distance:
+                    assigned[valid[column]] = identities[row]
+        # The groups seen by the most cameras, then the most consistent, start the tracks
+        unmatched = sorted((g for g in valid if g not in assigned and len(groups[g]['members']) >= self.min_cameras),
+                           key=lambda g: (-len(groups[g]['members']), groups[g]['score']))
+        if self.single_person:
+            # The person is found again once its track ended
+            unmatched = unmatched[:1] if not self.tracks else []
+            self.next_identity = 1
+        for g in unmatched:
+            assigned[g] = 0 if self.single_person else self.next_identity
+            self.next_identity += 0 if self.single_person else 1
+        for g, identity in assigned.items():
+            self.tracks[identity] = {"position": positions[g], "frame": frame_index}
+        return assigned
+
+def get_missing_person(n_keypoints):
+    """
+    Get the placeholder of a person a camera does not see (zero likelihoods).
+    """
+    return {"person_id": [-1], "pose_keypoints_2d": [0.0] * (3 * n_keypoints)}
+
+def associate_people(project_dir, pose_model, association_configs, excluded_frames=None):
+    """
+    Associate the people seen by the cameras of a subproject and write the associated
+    keypoints to pose-associated/blaze_<cam>_json, person k of every camera being the
+    same person. In single person mode, only the person tracked from the start is kept.
+    The excluded frames of a camera are left out, as if nobody was detected.
+
+    Args:
+        project_dir (str): The subproject folder (containing pose/).
+        pose_model (str): The pose model ('BLAZEPOSE').
+        association_configs (dict): The personAssociation section of the subproject config.
+        excluded_frames (dict, optional): For each camera, whether each frame is excluded
+            (see utility.quality.assess_subproject).
+
+    Returns:
+        dict: The number of frames, people and frames with each person found.
+    """
+    if pose_model != 'BLAZEPOSE':
+        raise ValueError("The specified model has not been integrated, yet.")
+    calibration_file = os.path.join(project_dir, '..', '..', 'Calibration', 'Calib_board.toml')
+    cameras_by_name = {camera['name']: camera for camera in read_calibration(calibration_file)}
+    pose_folder = os.path.join(project_dir, 'pose')
+    camera_names = sorted(folder[len('blaze_'):-len('_json')] for folder in os.listdir(pose_folder)
+                          if folder.startswith('blaze_') and folder.endswith('_json') and
+                          folder[len('blaze_'):-len('_json')] in cameras_by_name)
+    if len(camera_names) < 2:
+        raise ValueError(f"Less than two cameras of {project_dir} are in {calibration_file}.")
+    cameras = [cameras_by_name[name] for name in camera_names]
+    keypoints = [read_camera_keypoints(os.path.join(pose_folder, f"blaze_{name}_json")) for name in camera_names]
+    for name, (_, frames) in zip(camera_names, keypoints):
+        for t in np.flatnonzero((excluded_frames or {}).get(name, [])):
+            if t < len(frames):
+                frames[t] = []
+    n_frames = min(len(frames) for _, frames in keypoints)
+    n_keypoints = len(BLAZEPOSE_KEYPOINTS)
+    tracked_index = BLAZEPOSE_KEYPOINTS.index(association_configs.get('tracked_keypoint', 'left_shoulder'))
+    likelihood_threshold = association_configs.get('likelihood_threshold_association', 0.1)
+    threshold = association_configs.get('reproj_error_threshold_association', 10)
+    block_size = association_configs.get('block_size', 256)
+    tracker = PersonTracker(association_configs.get('max_tracking_distance', 0.5),
+                            association_configs.get('max_gap', 15),
+                            association_configs.get('single_person', True), min(3, len(cameras)))
+    pairs = [(a, b) for a in range(len(cameras)) for b in range(a + 1, len(cameras))]
+    essential_matrices = {(a, b): get_essential_matrix(cameras[a], cameras[b]) for a, b in pairs}
+    focals = [np.mean(np.diag(camera['K'])[:2]) for camera in cameras]
+    # For each frame, the detection of each camera assigned to each identity
+    assignments = []
+    for start in range(0, n_frames, block_size):
+        stop = min(start + block_size, n_frames)
+        detections = pad_detections([frames for _, frames in keypoints], start, stop, n_keypoints)
+        valid = np.nan_to_num(detections[..., 2]) >= likelihood_threshold
+        valid &= ~np.isnan(detections[..., :2]).any(axis=-1)
+        points = [np.concatenate([np.nan_to_num(undistort_points(detections[c, ..., :2], camera)),
+                                  np.ones(detections.shape[1:4] + (1,))], axis=-1)
+                  for c, camera in enumerate(cameras)]
+        distances = {(a, b): get_epipolar_distances(points[a], points[b], valid[a], valid[b],
+                                                    essential_matrices[(a, b)], focals[a], focals[b])
+                     for a, b in pairs}
+        groups = [group_detections({pair: pair_distances[t] for pair, pair_distances in distances.items()},
+                                   [len(frames[start + t]) for _, frames in keypoints], threshold)
+                  for t in range(stop - start)]
+        positions = locate_groups(detections, groups, cameras, tracked_index, likelihood_threshold)
+        for t, frame_groups in enumerate(groups):
+            identities = tracker.update(start + t, positions[t], frame_groups)
+            assignments.append({identity: frame_groups[g]['members'] for g, identity in identities.items()})
+
+    # The identities are numbered in order of appearance
+    n_people = tracker.next_identity
+    found = [sum(identity in frame_assignments for frame_assignments in assignments) for identity in range(n_people)]
+    output_folder = os.path.join(project_dir, 'pose-associated')
+    with atomic_output(output_folder) as partial_folder:
+        for c, name in enumerate(camera_names):
+            camera_folder = os.path.join(partial_folder, f"blaze_{name}_json")
+            os.makedirs(camera_folder)
+            file_names, frames = keypoints[c]
+            for t in range(n_frames):
+                people = []
+                for identity in range(max(n_people, 1)):
+                    detection = assignments[t].get(identity, {}).get(c)
+                    person = dict(frames[t][detection]) if detection is not None else get_missing_person(n_keypoints)
+                    people.append({**person, "person_id": [identity]})
+                with open(os.path.join(camera_folder, file_names[t]), 'w', encoding='utf-8') as f:
+                    # dumps encodes in C, dump does not
+                    f.write(json.dumps({"version": 1.3, "people": people}))
+    logging.info(f"Associated {n_people} people over {n_frames} frames of {project_dir} "
+                 f"(frames found per person: {found})")
+    if not any(found):
+        raise RuntimeError(f"No person seen by two cameras in {project_dir}.")
+    return {"frames": n_frames, "people": n_people, "found": found}
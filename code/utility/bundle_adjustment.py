@@ -0,0 +1,663 @@
+"""
+Module description: This module contains a set of utility functions for refining a camera
+calibration by sparse bundle adjustment: the checkerboard corners of every intrinsics and
+extrinsics view of every camera are detected again, and the intrinsics, extrinsics and
+board poses are optimized jointly to minimize the reprojection errors, with a sparse
+Jacobian (each corner only depends on its camera and its board pose).
+"""
+
+import logging
+import logging.handlers
+import os
+import glob
+import json
+import time
+import shutil
+import collections
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from utility.utils import atomic_output, is_video_file
+from utility.cameras import read_calibration, write_calibration, rodrigues
+from utility.video_io import VideoReader
+
+REPORT_FILE = 'refinement_report.json'
+INITIAL_CALIBRATION_FILE = 'Calib_board_initial.toml'
+# fx, fy, cx, cy, k1, k2, p1, p2
+N_INTRINSICS = 8
+N_POSE = 6
+DETECTION_THREADS = os.cpu_count() or 1
+
+def get_board_points(corners_nb, square_size):
+    """
+    Get the corners of a checkerboard in its own frame, in the order of cv2.findChessboardCorners.
+
+    Args:
+        corners_nb (list): The number of inner corners per row and column.
+        square_size (float): The size of a square in millimeters.
+
+    Returns:
+        numpy.ndarray: The corners in meters, shape (corners, 3).
+    """
+    points = np.zeros((corners_nb[0] * corners_nb[1], 3))
+    points[:, :2] = np.mgrid[0:corners_nb[0], 0:corners_nb[1]].T.reshape(-1, 2)
+    return points * square_size / 1000
+
+def detect_board_corners(image, corners_nb):
+    """
+    Detect the inner corners of a checkerboard in a grayscale image, to a subpixel accuracy.
+    The subpixel search window is kept within a third of the smallest spacing of the corners,
+    since a window reaching the neighbouring corners biases them on distant or tilted boards.
+
+    Returns:
+        numpy.ndarray or None: The corners, shape (corners, 2), None if the board is not found.
+    """
+    import cv2  # deferred, cv2 is slow to import
+
+    found, corners = cv2.findChessboardCorners(image, tuple(corners_nb), None,
+                                               cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_NORMALIZE_IMAGE +
+                                               cv2.CALIB_CB_FAST_CHECK)
+    if not found:
+        return None
+    grid = corners.reshape(corners_nb[1], corners_nb[0], 2)
+    spacing = min(np.linalg.norm(np.diff(grid, axis=0), axis=2).min(), np.linalg.norm(np.diff(grid, axis=1), axis=2).min())
+    window = int(np.clip(spacing / 3, 2, 11))
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+    return cv2.cornerSubPix(image, corners, (window, window), (-1, -1), criteria).reshape(-1, 2).astype(float)
+
+def read_board_images(folder, extension, every_n_sec):
+    """
+    Read the grayscale images of a calibration folder: its images, or one frame every
+    every_n_sec seconds of its videos.
+
+    Yields:
+        numpy.ndarray: The images.
+    """
+    import cv2  # deferred, cv2 is slow to import
+
+    for file in sorted(glob.glob(os.path.join(glob.escape(folder), f"*.{extension}"))):
+        if is_video_file(file):
+            with VideoReader(file, fps=1 / every_n_sec if every_n_sec else None) as reader:
+                for _, frame in reader:
+                    yield cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        else:
+            image = cv2.imread(file, cv2.IMREAD_GRAYSCALE)
+            if image is not None:
+                yield image
+
+def detect_folder_boards(folder, extension, every_n_sec, corners_nb, executor):
+    """
+    Detect the checkerboard in the images of a calibration folder, on a thread pool. At most
+    twice as many images as threads are held at once.
+
+    Returns:
+        list: The corners of the images where the board is found.
+    """
+    futures = collections.deque()
+    detections = []
+    for image in read_board_images(folder, extension, every_n_sec):
+        futures.append(executor.submit(detect_board_corners, image, corners_nb))
+        if len(futures) > 2 * DETECTION_THREADS:
+            detections.append(futures.popleft().result())
+    detections += [future.result() for future in futures]
+    return [corners for corners in detections if corners is not None]
+
+def detect_first_board(folder, extension, corners_nb):
+    """
+    Detect the checkerboard in the first image of a calibration folder where it is found.
+
+    Returns:
+        numpy.ndarray or None: The corners, None if the board is not found.
+    """
+    for image in read_board_images(folder, extension, 0):
+        corners = detect_board_corners(image, corners_nb)
+        if corners is not None:
+            return corners
+    return None
+
+def get_camera_folders(calibration_folder, kind, n_cameras):
+    """
+    Get the folders of the intrinsics or extrinsics views of each camera, sorted as the
+    cameras of the calibration file (Pose2Sim writes them in the order of their folders).
+
+    Returns:
+        list or None: The folders, None if their number is not the number of cameras.
+    """
+    kind_folder = os.path.join(calibration_folder, kind)
+    folders = sorted(os.path.join(kind_folder, folder) for folder in os.listdir(kind_folder)
+                     if os.path.isdir(os.path.join(kind_folder, folder))) if os.path.isdir(kind_folder) else []
+    return folders if len(folders) == n_cameras else None
+
+def solve_board_pose(board_points, corners, camera):
+    """
+    Estimate the pose of a board in a camera frame from its corners.
+
+    Returns:
+        numpy.ndarray or None: The rotation vector and translation, shape (6,).
+    """
+    import cv2  # deferred, cv2 is slow to import
+
+    found, rvec, tvec = cv2.solvePnP(board_points, corners, camera['K'], camera['dist'])
+    return np.concatenate([rvec.ravel(), tvec.ravel()]) if found else None
+
+def collect_observations(calibration_folder, cameras, calibration_configs):
+    """
+    Detect the boards of every view of every camera and estimate their initial poses:
+    each intrinsics view gets its own pose in its camera frame, and the extrinsics board
+    one pose in the world frame, averaged over the cameras. The corners of a board can be
+    found in the reverse order by a camera, so the order reprojecting best is kept.
+
+    Args:
+        calibration_folder (str): The Calibration folder of the subproject.
+        cameras (list): The cameras of the initial calibration (see utility.cameras.read_calibration).
+        calibration_configs (dict): The calibration configurations.
+
+    Returns:
+        dict: 'camera', 'view' (-1 for the extrinsics board), 'points' (in the board frame)
+            and 'pixels' of each corner, the initial 'views' poses, the 'board_pose' in the
+            world frame and the number of 'intrinsics_views' per camera.
+
+    Raises:
+        ValueError: If the views cannot constrain every camera.
+    """
+    intrinsics_configs = calibration_configs['intrinsics']
+    extrinsics_configs = calibration_configs['extrinsics']
+    intrinsics_folders = get_camera_folders(calibration_folder, 'intrinsics', len(cameras))
+    extrinsics_folders = get_camera_folders(calibration_folder, 'extrinsics', len(cameras))
+    if intrinsics_folders is None or extrinsics_folders is None:
+        raise ValueError(f"The intrinsics and extrinsics folders of {calibration_folder} do not match "
+                         f"the {len(cameras)} cameras of the calibration.")
+    intrinsics_points = get_board_points(intrinsics_configs['intrinsics_corners_nb'],
+                                         intrinsics_configs['intrinsics_square_size'])
+    extrinsics_points = get_board_points(extrinsics_configs['extrinsics_corners_nb'],
+                                         extrinsics_configs['extrinsics_square_size'])
+    with ThreadPoolExecutor(max_workers=DETECTION_THREADS) as executor:
+        intrinsics_corners = [detect_folder_boards(folder, intrinsics_configs['intrinsics_extension'],
+                                                   intrinsics_configs['extract_every_N_sec'],
+                                                   intrinsics_configs['intrinsics_corners_nb'], executor)
+                              for folder in intrinsics_folders]
+    extrinsics_corners = [detect_first_board(folder, extrinsics_configs['extrinsics_extension'],
+                                             extrinsics_configs['extrinsics_corners_nb'])
+                          for folder in extrinsics_folders]
+    missing = [camera['name'] for camera, corners in zip(cameras, extrinsics_corners) if corners is None]
+    if missing:
+        raise ValueError(f"The extrinsics board is not found by {', '.join(missing)}.")
+
+    # The extrinsics board in the world frame, from the first camera, then averaged
+    board_poses = []
+    for c, camera in enumerate(cameras):
+        if board_poses:
+            candidates = [extrinsics_corners[c], extrinsics_corners[c][::-1]]
+            errors = [np.linalg.norm(project_board(extrinsics_points, board_poses[0], camera) - candidate, axis=1).mean()
+                      for candidate in candidates]
+            extrinsics_corners[c] = candidates[int(np.argmin(errors))]
+        pose = solve_board_pose(extrinsics_points, extrinsics_corners[c], camera)
+        if pose is None:
+            raise ValueError(f"The extrinsics board pose cannot be estimated from {camera['name']}.")
+        board_poses.append((camera['R'].T @ rodrigues(pose[:3]), camera['R'].T @ (pose[3:] - camera['t'])))
+    u, _, vt = np.linalg.svd(np.mean([rotation for rotation, _ in board_poses], axis=0))
+    board_pose = (u @ vt, np.mean([translation for _, translation in board_poses], axis=0))
+
+    observations = {"camera": [], "view": [], "points": [], "pixels": []}
+    views = []
+    intrinsics_views = []
+    for c, (camera, corners_list) in enumerate(zip(cameras, intrinsics_corners)):
+        n_views = 0
+        for corners in corners_list:
+            pose = solve_board_pose(intrinsics_points, corners, camera)
+            if pose is None:
+                continue
+            observations['camera'].append(np.full(len(corners), c))
+            observations['view'].append(np.full(len(corners), len(views)))
+            observations['points'].append(intrinsics_points)
+            observations['pixels'].append(corners)
+            views.append(pose)
+            n_views += 1
+        intrinsics_views.append(n_views)
+        observations['camera'].append(np.full(len(extrinsics_points), c))
+        observations['view'].append(np.full(len(extrinsics_points), -1))
+        observations['points'].append(extrinsics_points)
+        observations['pixels'].append(extrinsics_corners[c])
+    observations = {key: np.concatenate(values) for key, values in observations.items()}
+    observations.update({"views": np.array(views).reshape(-1, N_POSE), "board_pose": board_pose,
+                         "intrinsics_views": intrinsics_views})
+    return observations
+
+def project_board(points, board_pose, camera):
+    """
+    Project the corners of a board posed in the world frame to the pixels of a camera.
+    """
+    import cv2  # deferred, cv2 is slow to import
+
+    world_points = points @ board_pose[0].T + board_pose[1]
+    pixels, _ = cv2.projectPoints(world_points, camera['rvec'], camera['t'], camera['K'], camera['dist'])
+    return pixels.reshape(-1, 2)
+
+def get_intrinsics(cameras):
+    """
+    Get the intrinsic parameters of the cameras: fx, fy, cx, cy, k1, k2, p1, p2.
+    """
+    return np.array([[camera['K'][0, 0], camera['K'][1, 1], camera['K'][0, 2], camera['K'][1, 2],
+                      *camera['dist'][:4]] for camera in cameras])
+
+def unpack_parameters(parameters, intrinsics, n_cameras, refine_intrinsics):
+    """
+    Split the parameter vector into the intrinsics (fixed ones if not refined) and the
+    extrinsics (rotation vector and translation) of each camera.
+    """
+    offset = 0
+    if refine_intrinsics:
+        intrinsics = parameters[:n_cameras * N_INTRINSICS].reshape(n_cameras, N_INTRINSICS)
+        offset = n_cameras * N_INTRINSICS
+    return intrinsics, parameters[offset:].reshape(n_cameras, N_POSE)
+
+def get_camera_points(extrinsics, view_poses, observations):
+    """
+    Get every observed corner in the frame of its camera: the corners of the intrinsics
+    views are posed in their camera frame (rotations and translations of view_poses), those
+    of the extrinsics board in the world frame.
+
+    Returns:
+        numpy.ndarray: The points, shape (corners, 3).
+    """
+    cameras = observations['camera']
+    view = observations['view']
+    on_board = view < 0
+    camera_points = np.empty_like(observations['points'])
+    view_rotations, view_translations = view_poses
+    camera_points[~on_board] = (np.einsum('nij,nj->ni', view_rotations[view[~on_board]],
+                                          observations['points'][~on_board]) + view_translations[view[~on_board]])
+    board_rotation, board_translation = observations['board_pose']
+    world_points = observations['points'][on_board] @ board_rotation.T + board_translation
+    camera_rotations = rodrigues(extrinsics[:, :3])
+    camera_points[on_board] = (np.einsum('nij,nj->ni', camera_rotations[cameras[on_board]], world_points)
+                               + extrinsics[cameras[on_board], 3:])
+    return camera_points
+
+def project_camera_points(intrinsics, camera_points, cameras, derivatives=False):
+    """
+    Project points in the frames of their cameras to pixels, with the radial and tangential
+    distortion of OpenCV, all at once.
+
+    Args:
+        intrinsics (numpy.ndarray): The intrinsics of the cameras (see get_intrinsics).
+        camera_points (numpy.ndarray): The points, shape (points, 3).
+        cameras (numpy.ndarray): The camera of each point.
+        derivatives (bool): Also return the derivatives of the pixels.
+
+    Returns:
+        numpy.ndarray or tuple: The pixels, shape (points, 2), and with derivatives, their
+            derivatives with respect to the points, shape (points, 2, 3), and to the
+            intrinsics, shape (points, 2, 8).
+    """
+    fx, fy, cx, cy, k1, k2, p1, p2 = intrinsics[cameras].T
+    x, y = camera_points[:, 0] / camera_points[:, 2], camera_points[:, 1] / camera_points[:, 2]
+    r2 = x ** 2 + y ** 2
+    radial = 1 + k1 * r2 + k2 * r2 ** 2
+    distorted_x = x * radial + 2 * p1 * x * y + p2 * (r2 + 2 * x ** 2)
+    distorted_y = y * radial + p1 * (r2 + 2 * y ** 2) + 2 * p2 * x * y
+    pixels = np.stack([distorted_x * fx + cx, distorted_y * fy + cy], axis=1)
+    if not derivatives:
+        return pixels
+
+    # Chain rule: pixels <- distorted coordinates <- normalized coordinates <- points
+    radial_slope = 2 * (k1 + 2 * k2 * r2)
+    distortion = np.empty((len(x), 2, 2))
+    distortion[:, 0, 0] = radial + x ** 2 * radial_slope + 2 * p1 * y + 6 * p2 * x
+    distortion[:, 0, 1] = x * y * radial_slope + 2 * p1 * x + 2 * p2 * y
+    distortion[:, 1, 0] = distortion[:, 0, 1]
+    distortion[:, 1, 1] = radial + y ** 2 * radial_slope + 6 * p1 * y + 2 * p2 * x
+    normalization = np.zeros((len(x), 2, 3))
+    normalization[:, 0, 0] = normalization[:, 1, 1] = 1 / camera_points[:, 2]
+    normalization[:, :, 2] = -np.stack([x, y], axis=1) / camera_points[:, 2:3]
+    point_derivatives = np.stack([fx, fy], axis=1)[:, :, None] * (distortion @ normalization)
+    intrinsics_derivatives = np.zeros((len(x), 2, N_INTRINSICS))
+    intrinsics_derivatives[:, 0, 0], intrinsics_derivatives[:, 1, 1] = distorted_x, distorted_y
+    intrinsics_derivatives[:, 0, 2] = intrinsics_derivatives[:, 1, 3] = 1
+    intrinsics_derivatives[:, 0, 4:] = fx[:, None] * np.stack([x * r2, x * r2 ** 2, 2 * x * y, r2 + 2 * x ** 2], axis=1)
+    intrinsics_derivatives[:, 1, 4:] = fy[:, None] * np.stack([y * r2, y * r2 ** 2, r2 + 2 * y ** 2, 2 * x * y], axis=1)
+    return pixels, point_derivatives, intrinsics_derivatives
+
+def project_observations(intrinsics, extrinsics, view_poses, observations):
+    """
+    Project every observed corner with the given parameters, all at once.
+
+    Returns:
+        numpy.ndarray: The pixels, shape (corners, 2).
+    """
+    return project_camera_points(intrinsics, get_camera_points(extrinsics, view_poses, observations),
+                                 observations['camera'])
+
+def apply_loss(residuals, loss, f_scale):
+    """
+    Apply a robust loss to residuals as scipy's least_squares does (to the squared residuals
+    scaled by f_scale).
+
+    Returns:
+        tuple: The loss of each residual, in squared pixels, and its derivative, the weight of
+            the residual in the Gauss-Newton steps.
+    """
+    z = (residuals / f_scale) ** 2
+    if loss == 'huber':
+        values, weights = np.where(z <= 1, z, 2 * np.sqrt(z) - 1), 1 / np.sqrt(np.maximum(z, 1))
+    elif loss == 'soft_l1':
+        values, weights = 2 * (np.sqrt(1 + z) - 1), 1 / np.sqrt(1 + z)
+    elif loss == 'cauchy':
+        values, weights = np.log1p(z), 1 / (1 + z)
+    else:
+        values, weights = z, np.ones_like(z)
+    return values * f_scale ** 2, weights
+
+def get_view_derivatives(rotations, view, points, point_derivatives):
+    """
+    Get the derivatives of the pixels of intrinsics views corners with respect to a small
+    rotation (applied after the rotation of their view) and translation of their views.
+
+    Returns:
+        numpy.ndarray: The derivatives, shape (corners, 2, 6).
+    """
+    rotated = np.einsum('nij,nj->ni', rotations[view], points)
+    # d(exp(w) R p) / dw = -[R p]x
+    cross = np.zeros((len(rotated), 3, 3))
+    cross[:, 0, 1], cross[:, 0, 2], cross[:, 1, 2] = rotated[:, 2], -rotated[:, 1], rotated[:, 0]
+    cross[:, 1, 0], cross[:, 2, 0], cross[:, 2, 1] = -rotated[:, 2], rotated[:, 1], -rotated[:, 0]
+    return np.concatenate([point_derivatives @ cross, point_derivatives], axis=2)
+
+def sum_per_view(values, view):
+    """
+    Sum per-corner values over the corners of each intrinsics view (they are consecutive), by
+    a reshape when the views have as many corners (they all show the intrinsics board).
+    """
+    n_views = view[-1] + 1
+    if len(view) % n_views == 0 and np.array_equal(view[::len(view) // n_views], np.arange(n_views)):
+        return values.reshape(n_views, -1, *values.shape[1:]).sum(axis=1)
+    return np.add.reduceat(values, np.flatnonzero(np.r_[True, np.diff(view) != 0]), axis=0)
+
+def project_views(intrinsics, view_poses, observations, derivatives=False):
+    """
+    Project the corners of the intrinsics views (see project_camera_points).
+    """
+    on_view = observations['view'] >= 0
+    rotations, translations = view_poses
+    view = observations['view'][on_view]
+    camera_points = np.einsum('nij,nj->ni', rotations[view], observations['points'][on_view]) + translations[view]
+    return project_camera_points(intrinsics, camera_points, observations['camera'][on_view], derivatives)
+
+def linearize_views(intrinsics, view_poses, observations, loss, f_scale):
+    """
+    Linearize the projection of the intrinsics views corners around their views.
+
+    Returns:
+        tuple: The loss of each view, the gradients and Gauss-Newton matrices of the losses
+            with respect to the views, the transposed derivatives of the residuals with
+            respect to the views weighted by the loss, and their derivatives with respect to
+            the views (see get_view_derivatives) and to the intrinsics.
+    """
+    on_view = observations['view'] >= 0
+    view = observations['view'][on_view]
+    pixels, point_derivatives, intrinsics_derivatives = project_views(intrinsics, view_poses, observations,
+                                                                      derivatives=True)
+    residuals = pixels - observations['pixels'][on_view]
+    losses, weights = apply_loss(residuals, loss, f_scale)
+    view_derivatives = get_view_derivatives(view_poses[0], view, observations['points'][on_view], point_derivatives)
+    weighted_derivatives = np.swapaxes(view_derivatives * weights[:, :, None], 1, 2)
+    return (sum_per_view(losses.sum(axis=1), view),
+            sum_per_view((weighted_derivatives @ residuals[:, :, None])[:, :, 0], view),
+            sum_per_view(weighted_derivatives @ view_derivatives, view), weighted_derivatives, view_derivatives,
+            intrinsics_derivatives)
+
+def refine_view_poses(intrinsics, view_poses, observations, loss, f_scale, iterations=10, tolerance=1e-5):
+    """
+    Refine the pose of every intrinsics view for the given intrinsics, by Levenberg-Marquardt
+    steps weighted by the robust loss, all the views at once, until the total loss decreases
+    by less than tolerance (relative). The views are independent of each other and of the
+    extrinsics, so the bundle adjustment only optimizes the cameras and gets the views from
+    here (variable projection).
+
+    Returns:
+        tuple: The rotations and translations of the views.
+    """
+    if not len(view_poses[0]):
+        return view_poses
+    on_view = observations['view'] >= 0
+    view = observations['view'][on_view]
+    rotations, translations = view_poses
+    damping = np.full(len(rotations), 1e-3)
+    for _ in range(iterations):
+        losses, gradients, hessians = linearize_views(intrinsics, (rotations, translations), observations, loss,
+                                                      f_scale)[:3]
+        damped = hessians + damping[:, None, None] * np.eye(N_POSE) * np.diagonal(hessians, axis1=1, axis2=2)[:, None]
+        steps = -np.linalg.solve(damped, gradients[:, :, None])[:, :, 0]
+        trial = (rodrigues(steps[:, :3]) @ rotations, translations + steps[:, 3:])
+        trial_residuals = project_views(intrinsics, trial, observations) - observations['pixels'][on_view]
+        trial_losses = sum_per_view(apply_loss(trial_residuals, loss, f_scale)[0].sum(axis=1), view)
+        improved = trial_losses < losses
+        rotations = np.where(improved[:, None, None], trial[0], rotations)
+        translations = np.where(improved[:, None], trial[1], translations)
+        damping = np.where(improved, damping / 10, damping * 10)
+        if losses.sum() - np.minimum(trial_losses, losses).sum() <= tolerance * losses.sum():
+            break
+    return rotations, translations
+
+def get_jacobian_structure(observations, n_cameras, refine_intrinsics):
+    """
+    Get the structure of the sparse Jacobian of the residuals with respect to the cameras:
+    the two residuals of a corner of the extrinsics board depend on the intrinsics and
+    extrinsics of its camera, those of the intrinsics views on its intrinsics only.
+
+    Returns:
+        tuple: The row and column of each nonzero (the extrinsics board corners first, the
+            intrinsics before the extrinsics), the shape (2 * corners, parameters) and the
+            (start, end) corners of the extrinsics board of each camera.
+    """
+    cameras = observations['camera']
+    on_board = observations['view'] < 0
+    offset = n_cameras * N_INTRINSICS if refine_intrinsics else 0
+    intrinsics_columns = cameras[:, None] * N_INTRINSICS + np.arange(N_INTRINSICS)
+    if not refine_intrinsics:
+        intrinsics_columns = intrinsics_columns[:, :0]
+    board_columns = np.hstack([intrinsics_columns[on_board],
+                               offset + cameras[on_board, None] * N_POSE + np.arange(N_POSE)])
+    view_columns = intrinsics_columns[~on_board]
+    rows = np.concatenate([np.repeat(np.flatnonzero(np.repeat(on_board, 2)), board_columns.shape[1]),
+                           np.repeat(np.flatnonzero(np.repeat(~on_board, 2)), view_columns.shape[1])])
+    columns = np.concatenate([np.repeat(board_columns, 2, axis=0).ravel(), np.repeat(view_columns, 2, axis=0).ravel()])
+    board_corners = np.flatnonzero(on_board)
+    boundaries = np.flatnonzero((np.diff(board_corners) != 1) | (np.diff(cameras[board_corners]) != 0)) + 1
+    segments = [(corners[0], corners[-1] + 1) for corners in np.split(board_corners, boundaries) if len(corners)]
+    return rows, columns, (2 * len(cameras), offset + n_cameras * N_POSE), segments
+
+def get_reduced_jacobian(intrinsics, extrinsics, view_poses, observations, structure, refine_intrinsics,
+                         loss, f_scale):
+    """
+    Get the Jacobian of the residuals with respect to the cameras, the views following them
+    (see refine_view_poses): the derivatives of the intrinsics views corners with respect to
+    the intrinsics are reduced by the change of their views (Schur complement), those of the
+    extrinsics board corners come from OpenCV's projection derivatives.
+
+    Returns:
+        tuple: The Jacobian (see get_jacobian_structure), a scipy.sparse.csr_matrix, and the
+            change of each view per change of the intrinsics of its camera, shape
+            (views, 6, 8) (None if the intrinsics are fixed).
+    """
+    import cv2  # deferred, cv2 is slow to import
+    from scipy.sparse import csr_matrix  # deferred, scipy is slow to import
+
+    rows, columns, shape, segments = structure
+    board_rotation, board_translation = observations['board_pose']
+    # OpenCV orders the derivatives as rotation, translation, focals, principal point, distortion
+    order = np.r_[N_POSE:N_POSE + N_INTRINSICS, 0:N_POSE] if refine_intrinsics else np.arange(N_POSE)
+    values = []
+    view_changes = None
+    for start, end in segments:
+        c = observations['camera'][start]
+        fx, fy, cx, cy = intrinsics[c, :4]
+        _, jacobian = cv2.projectPoints(observations['points'][start:end] @ board_rotation.T + board_translation,
+                                        extrinsics[c, :3], extrinsics[c, 3:],
+                                        np.array([[fx, 0.0, cx], [0.0, fy, cy], [0.0, 0.0, 1.0]]), intrinsics[c, 4:])
+        values.append(jacobian[:, order].ravel())
+    if refine_intrinsics and len(view_poses[0]):
+        view = observations['view'][observations['view'] >= 0]
+        _, _, hessians, weighted_derivatives, view_derivatives, intrinsics_derivatives = linearize_views(
+            intrinsics, view_poses, observations, loss, f_scale)
+        couplings = sum_per_view(weighted_derivatives @ intrinsics_derivatives, view)
+        view_changes = np.linalg.solve(hessians, couplings)
+        values.append((intrinsics_derivatives - view_derivatives @ view_changes[view]).ravel())
+    return csr_matrix((np.concatenate(values), (rows, columns)), shape=shape), view_changes
+
+def get_reprojection_statistics(errors, observations, cameras):
+    """
+    Summarize the reprojection errors (in pixels) of the corners of each camera.
+
+    Returns:
+        dict: For each camera name, its corners, RMS, median, 95th percentile and maximum error.
+    """
+    statistics = {}
+    for c, camera in enumerate(cameras):
+        camera_errors = errors[observations['camera'] == c]
+        statistics[camera['name']] = {"corners": int(len(camera_errors)),
+                                      "rms": round(float(np.sqrt(np.mean(camera_errors ** 2))), 4),
+                                      "median": round(float(np.median(camera_errors)), 4),
+                                      "p95": round(float(np.percentile(camera_errors, 95)), 4),
+                                      "max": round(float(np.max(camera_errors)), 4)}
+    return statistics
+
+def bundle_adjust(cameras, observations, refinement_configs):
+    """
+    Refine the cameras by minimizing the reprojection errors of every corner over the
+    intrinsics (unless 'refine_intrinsics' is false), the extrinsics and the poses of the
+    intrinsics views, with a robust loss ('loss' with 'f_scale' pixels), after a coarse pass
+    at the scale of the initial errors. scipy's trust region reflective solver optimizes the
+    cameras on the sparse reduced Jacobian, the views being refined with them (see
+    refine_view_poses), so the cost of a step grows linearly with the number of views.
+    'max_nfev' bounds the evaluations of both passes.
+
+    Args:
+        cameras (list): The cameras of the initial calibration (see utility.cameras.read_calibration).
+        observations (dict): The corners and initial board poses (see collect_observations).
+        refinement_configs (dict): The 'refinement' section of the calibration configurations.
+
+    Returns:
+        tuple: The refined cameras and the report (solver outcome and statistics per camera
+            before and after).
+    """
+    from scipy.optimize import least_squares  # deferred, scipy is slow to import
+
+    refine_intrinsics = refinement_configs.get('refine_intrinsics', True)
+    n_cameras = len(cameras)
+    intrinsics = get_intrinsics(cameras)
+    extrinsics = np.array([np.concatenate([camera['rvec'], camera['t']]) for camera in cameras])
+    initial = np.concatenate(([intrinsics.ravel()] if refine_intrinsics else []) + [extrinsics.ravel()])
+    structure = get_jacobian_structure(observations, n_cameras, refine_intrinsics)
+    on_view = observations['view'] >= 0
+    view_cameras = np.zeros(len(observations['views']), dtype=int)
+    view_cameras[observations['view'][on_view]] = observations['camera'][on_view]
+    initial_views = (rodrigues(observations['views'][:, :3]), observations['views'][:, 3:])
+    # The views of the last parameters evaluated, for the Jacobian at the same parameters
+    solved = {"parameters": None, "views": None}
+
+    def get_anchor(parameters, views, loss, f_scale):
+        # The views at the start of a pass and their first-order change with the intrinsics
+        parameters_intrinsics, parameters_extrinsics = unpack_parameters(parameters, intrinsics, n_cameras,
+                                                                         refine_intrinsics)
+        views = refine_view_poses(parameters_intrinsics, views, observations, loss, f_scale)
+        view_changes = get_reduced_jacobian(parameters_intrinsics, parameters_extrinsics, views, observations,
+                                            structure, refine_intrinsics, loss, f_scale)[1]
+        return parameters_intrinsics, views, view_changes
+
+    def solve_views(parameters, anchor, loss, f_scale):
+        # A function of the parameters only: the views start from their first-order change
+        # since the anchor of the pass, whatever the parameters evaluated before
+        if not np.array_equal(parameters, solved['parameters']):
+            parameters_intrinsics = unpack_parameters(parameters, intrinsics, n_cameras, refine_intrinsics)[0]
+            anchor_intrinsics, views, view_changes = anchor
+            if view_changes is not None:
+                steps = -(view_changes @ (parameters_intrinsics - anchor_intrinsics)[view_cameras, :, None])[:, :, 0]
+                views = (rodrigues(steps[:, :3]) @ views[0], views[1] + steps[:, 3:])
+            solved['views'] = refine_view_poses(parameters_intrinsics, views, observations, loss, f_scale)
+            solved['parameters'] = parameters.copy()
+        return solved['views']
+
+    def residuals(parameters, anchor, loss, f_scale):
+        parameters_intrinsics, parameters_extrinsics = unpack_parameters(parameters, intrinsics, n_cameras,
+                                                                         refine_intrinsics)
+        views = solve_views(parameters, anchor, loss, f_scale)
+        return (project_observations(parameters_intrinsics, parameters_extrinsics, views, observations)
+                - observations['pixels']).ravel()
+
+    def jacobian(parameters, anchor, loss, f_scale):
+        parameters_intrinsics, parameters_extrinsics = unpack_parameters(parameters, intrinsics, n_cameras,
+                                                                         refine_intrinsics)
+        views = solve_views(parameters, anchor, loss, f_scale)
+        return get_reduced_jacobian(parameters_intrinsics, parameters_extrinsics, views, observations, structure,
+                                    refine_intrinsics, loss, f_scale)[0]
+
+    start = time.time()
+    initial_errors = np.linalg.norm((project_observations(intrinsics, extrinsics, initial_views, observations)
+                                     - observations['pixels']), axis=1)
+    loss, f_scale = refinement_configs.get('loss', 'huber'), refinement_configs.get('f_scale', 1.0)
+    max_nfev = refinement_configs.get('max_nfev', 200)
+    # A coarse pass at the scale of the initial errors first: with a loss flattening the residuals
+    # beyond f_scale (huber, cauchy), a poor initial calibration makes every corner an outlier
+    coarse_scale = max(f_scale, float(np.median(initial_errors)))
+    anchor = get_anchor(initial, initial_views, 'soft_l1', coarse_scale)
+    coarse = least_squares(residuals, initial, jac=jacobian, args=(anchor, 'soft_l1', coarse_scale), method='trf',
+                           x_scale='jac', loss='soft_l1', f_scale=coarse_scale, ftol=1e-6, max_nfev=max_nfev)
+    anchor = get_anchor(coarse.x, solve_views(coarse.x, anchor, 'soft_l1', coarse_scale), loss, f_scale)
+    result = least_squares(residuals, coarse.x, jac=jacobian, args=(anchor, loss, f_scale), method='trf',
+                           x_scale='jac', loss=loss, f_scale=f_scale, ftol=1e-6,
+                           max_nfev=max(max_nfev - coarse.nfev, 1))
+    result.nfev += coarse.nfev
+    errors = np.linalg.norm(residuals(result.x, anchor, loss, f_scale).reshape(-1, 2), axis=1)
+    refined_intrinsics, refined_extrinsics = unpack_parameters(result.x, intrinsics, n_cameras, refine_intrinsics)
+    refined = []
+    for camera, camera_intrinsics, camera_extrinsics in zip(cameras, refined_intrinsics, refined_extrinsics):
+        fx, fy, cx, cy = camera_intrinsics[:4]
+        refined.append({**camera, "K": np.array([[fx, 0.0, cx], [0.0, fy, cy], [0.0, 0.0, 1.0]]),
+                        "dist": np.array(camera_intrinsics[4:]), "rvec": camera_extrinsics[:3],
+                        "R": rodrigues(camera_extrinsics[:3]), "t": camera_extrinsics[3:]})
+    report = {"status": result.status, "message": result.message, "function_evaluations": int(result.nfev),
+              "duration": round(time.time() - start, 3), "parameters": int(len(initial)),
+              "views": int(len(observations['views'])), "corners": int(len(errors)),
+              "intrinsics_views": dict(zip([camera['name'] for camera in cameras], observations['intrinsics_views'])),
+              "rms_before": round(float(np.sqrt(np.mean(initial_errors ** 2))), 4),
+              "rms_after": round(float(np.sqrt(np.mean(errors ** 2))), 4),
+              "cameras_before": get_reprojection_statistics(initial_errors, observations, cameras),
+              "cameras_after": get_reprojection_statistics(errors, observations, cameras)}
+    return refined, report
+
+def refine_calibration(subproject_folder, calibration_configs):
+    """
+    Refine the calibration of a subproject by bundle adjustment. The initial calibration is
+    kept as Calibration/Calib_board_initial.toml, Calib_board.toml is replaced by the refined
+    one, and the reprojection statistics are written to Calibration/refinement_report.json
+    (with the error, if the refinement could not run).
+
+    Args:
+        subproject_folder (str): The subproject directory (sub setup and setting).
+        calibration_configs (dict): The calibration configurations.
+
+    Returns:
+        dict: The report.
+    """
+    calibration_folder = os.path.join(subproject_folder, 'Calibration')
+    calibration_file = os.path.join(calibration_folder, 'Calib_board.toml')
+    cameras = read_calibration(calibration_file)
+    try:
+        if any(camera['fisheye'] for camera in cameras):
+            raise ValueError("Fisheye cameras are not supported.")
+        observations = collect_observations(calibration_folder, cameras, calibration_configs)
+        refined, report = bundle_adjust(cameras, observations, calibration_configs.get('refinement', {}))
+    except Exception as e:
+        logging.warning(f"The calibration of {subproject_folder} is not refined: {e}")
+        report = {"error": f"{type(e).__name__}: {e}"}
+    else:
+        with atomic_output(os.path.join(calibration_folder, INITIAL_CALIBRATION_FILE)) as partial_file:
+            shutil.copyfile(calibration_file, partial_file)
+        with atomic_output(calibration_file) as partial_file:
+            write_calibration(refined, partial_file, metadata={"adjusted": True, "error": report['rms_after']})
+        logging.info(f"Refined the calibration of {subproject_folder}: RMS reprojection error "
+                     f"{report['rms_before']:.3f} -> {report['rms_after']:.3f} px in {report['duration']:.2f} s.")
+    with atomic_output(os.path.join(calibration_folder, REPORT_FILE)) as partial_file:
+        with open(partial_file, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+    return report
@@ -7,9 +7,12 @@ import os
 import time
 import logging
 import logging.handlers
-from Pose2Sim.calibration import calibrate_cams_all
-from Pose2Sim.Pose2Sim import setup_logging
+from utility.profiling import profiled
+from utility.metrics import add_total
+from utility.sub_setups import is_selected_sub_setup
+from utility.bundle_adjustment import REPORT_FILE, refine_calibration
 
+@profiled()
 def calibrate(workspace, calibration_configs):
     """
     Calibrates the workspace using the provided calibration configurations.
@@ -22,18 +25,43 @@ def calibrate(workspace, calibration_configs):
         None
     """
     subproject_folders = get_subproject_dirs(workspace)
+    add_total('calibrate_subproject', len(subproject_folders))
     for subproject_folder in subproject_folders:
-        calibration_results_file = os.path.join(subproject_folder, 'Calibration', 'Calib_board.toml')
-        if (not os.path.exists(calibration_results_file) or 
-            (os.path.exists(calibration_results_file) and calibration_configs['overwrite'])):
-            subproject_config_dict = prepare_subproject_config_dict(subproject_folder, calibration_configs)
-            try:
-                calibration(subproject_config_dict)
-            except Exception as e:
-                logging.error(e)
-                calibration_error_file = os.path.join(subproject_folder, 'Calibration', 'error.txt')
-                with open(calibration_error_file, 'w', encoding='utf-8') as f:
-                    f.write(str(e))
+        calibrate_subproject(subproject_folder, calibration_configs)
+
+@profiled()
+def calibrate_subproject(subproject_folder, calibration_configs):
+    """
+    Calibrates the cameras of a subproject, unless already done. Errors are logged and
+    written to Calibration/error.txt. If enabled, the calibration is then refined by bundle
+    adjustment (see utility.bundle_adjustment), once per calibration.
+
+    Args:
+        subproject_folder: The subproject directory (sub setup and setting).
+        calibration_configs: The calibration configurations to be used.
+
+    Returns:
+        None
+    """
+    calibration_results_file = os.path.join(subproject_folder, 'Calibration', 'Calib_board.toml')
+    refinement_report_file = os.path.join(subproject_folder, 'Calibration', REPORT_FILE)
+    if (not os.path.exists(calibration_results_file) or 
+        (os.path.exists(calibration_results_file) and calibration_configs['overwrite'])):
+        subproject_config_dict = prepare_subproject_config_dict(subproject_folder, calibration_configs)
+        try:
+            calibration(subproject_config_dict)
+        except Exception as e:
+            logging.error(e)
+            calibration_error_file = os.path.join(subproject_folder, 'Calibration', 'error.txt')
+            with open(calibration_error_file, 'w', encoding='utf-8') as f:
+                f.write(str(e))
+            return
+        # A new calibration is refined again
+        if os.path.exists(refinement_report_file):
+            os.remove(refinement_report_file)
+    if (calibration_configs.get('refinement', {}).get('enabled', False) and
+            os.path.exists(calibration_results_file) and not os.path.exists(refinement_report_file)):
+        refine_calibration(subproject_folder, calibration_configs)
                 
 def get_subproject_dirs(workspace):
     """
@@ -49,7 +77,8 @@ def get_subproject_dirs(workspace):
     for root, dirs, _ in os.walk(workspace):
         if ("Calibration" in dirs and 
             "__synced__" in root and 
-             not "unset_unset_unset_unset" in root):
+             not "unset_unset_unset_unset" in root and
+            is_selected_sub_setup(root)):
             subproject_folders.append(root)
     return subproject_folders
 
@@ -110,6 +139,10 @@ def calibration(config=None):
     Cameras calibration from checkerboards files. Adapted from Pose2Sim.calibration, 
     which wants the calibration script to be in the same directory of the data
     '''
+    # Deferred, Pose2Sim is slow to import
+    from Pose2Sim.calibration import calibrate_cams_all
+    from Pose2Sim.Pose2Sim import setup_logging
+
     session_dir = config['project']['project_dir']
     setup_logging(session_dir)      
     calib_dir = [os.path.join(session_dir, c) for c in os.listdir(session_dir) if ('Calib' or 'calib') in c][0]
@@ -0,0 +1,210 @@
+"""
+Module description: This module contains a set of utility functions for reading and
+writing the camera calibrations (Pose2Sim Calib_board.toml format) and for projecting
+and triangulating points with them.
+"""
+
+import os
+import numpy as np
+
+def rodrigues(rotation_vectors):
+    """
+    Convert rotation vectors to rotation matrices (Rodrigues formula).
+
+    Args:
+        rotation_vectors (numpy.ndarray): The rotation vectors, shape (..., 3).
+
+    Returns:
+        numpy.ndarray: The rotation matrices, shape (..., 3, 3).
+    """
+    rotation_vectors = np.asarray(rotation_vectors, dtype=float)
+    theta = np.linalg.norm(rotation_vectors, axis=-1)[..., None, None]
+    axis = rotation_vectors / np.where(theta[..., 0, 0] > 1e-12, theta[..., 0, 0], 1.0)[..., None]
+    x, y, z = axis[..., 0], axis[..., 1], axis[..., 2]
+    zeros = np.zeros_like(x)
+    cross = np.stack([np.stack([zeros, -z, y], -1), np.stack([z, zeros, -x], -1), np.stack([-y, x, zeros], -1)], -2)
+    outer = axis[..., :, None] * axis[..., None, :]
+    identity = np.broadcast_to(np.eye(3), cross.shape)
+    return np.cos(theta) * identity + np.sin(theta) * cross + (1 - np.cos(theta)) * outer
+
+def rotation_matrix_to_vector(rotation_matrix):
+    """
+    Convert a rotation matrix to a rotation vector (inverse of rodrigues).
+
+    Args:
+        rotation_matrix (numpy.ndarray): The rotation matrix, shape (3, 3).
+
+    Returns:
+        numpy.ndarray: The rotation vector, shape (3,).
+    """
+    cos_theta = np.clip((np.trace(rotation_matrix) - 1) / 2, -1.0, 1.0)
+    theta = np.arccos(cos_theta)
+    if theta < 1e-12:
+        return np.zeros(3)
+    if np.pi - theta < 1e-6:
+        # Near 180 degrees the axis is the main eigenvector of R + I
+        values, vectors = np.linalg.eigh((rotation_matrix + np.eye(3)) / 2)
+        return vectors[:, np.argmax(values)] * theta
+    axis = np.array([rotation_matrix[2, 1] - rotation_matrix[1, 2],
+                     rotation_matrix[0, 2] - rotation_matrix[2, 0],
+                     rotation_matrix[1, 0] - rotation_matrix[0, 1]]) / (2 * np.sin(theta))
+    return axis * theta
+
+def read_calibration(calibration_file):
+    """
+    Read a Pose2Sim calibration file.
+
+    Args:
+        calibration_file (str): The path of the Calib_board.toml file.
+
+    Returns:
+        list: One dictionary per camera with 'section', 'name', 'size', 'K' (3x3), 'dist'
+            (k1, k2, p1, p2), 'rvec', 'R' (3x3), 't' and 'fisheye'.
+    """
+    try:
+        import tomllib
+        with open(calibration_file, 'rb') as f:
+            calibration = tomllib.load(f)
+    except ImportError:
+        import toml
+        calibration = toml.load(calibration_file)
+    cameras = []
+    for section, values in calibration.items():
+        if section == 'metadata' or not isinstance(values, dict) or 'matrix' not in values:
+            continue
+        rvec = np.array(values['rotation'], dtype=float)
+        cameras.append({
+            "section": section,
+            "name": values['name'],
+            "size": [float(value) for value in values['size']],
+            "K": np.array(values['matrix'], dtype=float),
+            "dist": np.array(values['distortions'], dtype=float),
+            "rvec": rvec,
+            "R": rodrigues(rvec),
+            "t": np.array(values['translation'], dtype=float),
+            "fisheye": bool(values.get('fisheye', False)),
+        })
+    return cameras
+
+def write_calibration(cameras, calibration_file, metadata=None):
+    """
+    Write cameras in the Pose2Sim calibration format.
+
+    Args:
+        cameras (list): The cameras (see read_calibration).
+        calibration_file (str): The path of the Calib_board.toml file.
+        metadata (dict, optional): The values of the [metadata] section.
+
+    Returns:
+        None
+    """
+    def vector(values):
+        return '[ ' + ', '.join(f"{float(value)!r}" for value in values) + ']'
+
+    lines = []
+    for i, camera in enumerate(cameras):
+        lines += [
+            f"[{camera.get('section', f'cam_{i + 1}')}]",
+            f'name = "{camera["name"]}"',
+            f"size = {vector(camera['size'])}",
+            "matrix = [ " + ', '.join(vector(row) for row in camera['K']) + "]",
+            f"distortions = {vector(camera['dist'])}",
+            f"rotation = {vector(camera['rvec'])}",
+            f"translation = {vector(camera['t'])}",
+            f"fisheye = {'true' if camera.get('fisheye') else 'false'}",
+            "",
+        ]
+    lines.append("[metadata]")
+    for key, value in {"adjusted": False, "error": 0.0, **(metadata or {})}.items():
+        lines.append(f"{key} = {str(value).lower() if isinstance(value, bool) else repr(value)}")
+    os.makedirs(os.path.dirname(os.path.abspath(calibration_file)), exist_ok=True)
+    with open(calibration_file, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def get_camera_centers(cameras):
+    """
+    Get the positions of the camera centers in the world frame.
+
+    Args:
+        cameras (list): The cameras (see read_calibration).
+
+    Returns:
+        numpy.ndarray: The centers, shape (cameras, 3).
+    """
+    return np.array([-camera['R'].T @ camera['t'] for camera in cameras])
+
+def distort(normalized_points, dist):
+    """
+    Apply the radial (k1, k2) and tangential (p1, p2) distortion to normalized points.
+
+    Args:
+        normalized_points (numpy.ndarray): The points in normalized coordinates, shape (..., 2).
+        dist (numpy.ndarray): The distortion coefficients (k1, k2, p1, p2).
+
+    Returns:
+        numpy.ndarray: The distorted normalized points.
+    """
+    k1, k2, p1, p2 = dist[:4]
+    x, y = normalized_points[..., 0], normalized_points[..., 1]
+    r2 = x ** 2 + y ** 2
+    radial = 1 + k1 * r2 + k2 * r2 ** 2
+    return np.stack([x * radial + 2 * p1 * x * y + p2 * (r2 + 2 * x ** 2),
+                     y * radial + p1 * (r2 + 2 * y ** 2) + 2 * p2 * x * y], axis=-1)
+
+def project_points(points, camera):
+    """
+    Project world points to the pixels of a camera.
+
+    Args:
+        points (numpy.ndarray): The world points, shape (..., 3).
+        camera (dict): The camera (see read_calibration).
+
+    Returns:
+        numpy.ndarray: The pixel coordinates, shape (..., 2).
+    """
+    camera_points = points @ camera['R'].T + camera['t']
+    normalized_points = distort(camera_points[..., :2] / camera_points[..., 2:3], camera['dist'])
+    return normalized_points @ camera['K'][:2, :2].T + camera['K'][:2, 2]
+
+def undistort_points(pixels, camera, iterations=5):
+    """
+    Convert pixels to undistorted normalized coordinates (fixed-point inversion of distort).
+
+    Args:
+        pixels (numpy.ndarray): The pixel coordinates, shape (..., 2).
+        camera (dict): The camera (see read_calibration).
+        iterations (int): The number of fixed-point iterations.
+
+    Returns:
+        numpy.ndarray: The normalized coordinates, shape (..., 2).
+    """
+    distorted = (pixels - camera['K'][:2, 2]) @ np.linalg.inv(camera['K'][:2, :2]).T
+    if not np.any(camera['dist']):
+        return distorted
+    undistorted = distorted.copy()
+    for _ in range(iterations):
+        undistorted = undistorted + distorted - distort(undistorted, camera['dist'])
+    return undistorted
+
+def triangulate_points(normalized_points, weights, cameras):
+    """
+    Triangulate points seen by several cameras with a weighted DLT, for many points at once.
+
+    Args:
+        normalized_points (numpy.ndarray): The undistorted normalized coordinates, shape (cameras, points, 2).
+        weights (numpy.ndarray): The weight of each observation (0 to ignore it), shape (cameras, points).
+        cameras (list): The cameras (see read_calibration).
+
+    Returns:
+        numpy.ndarray: The world points, shape (points, 3).
+    """
+    projections = np.array([np.hstack([camera['R'], camera['t'][:, None]]) for camera in cameras])
+    normalized_points = np.nan_to_num(normalized_points)
+    # Two equations per camera: x * P3 - P1 and y * P3 - P2
+    rows_x = normalized_points[..., 0:1] * projections[:, None, 2, :] - projections[:, None, 0, :]
+    rows_y = normalized_points[..., 1:2] * projections[:, None, 2, :] - projections[:, None, 1, :]
+    rows = np.concatenate([rows_x * weights[..., None], rows_y * weights[..., None]], axis=0)
+    _, _, vt = np.linalg.svd(rows.transpose(1, 0, 2))
+    homogeneous = vt[:, -1, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return homogeneous[:, :3] / homogeneous[:, 3:4]
@@ -0,0 +1,351 @@
+"""
+Module description: This module contains a set of utility functions for triangulating and
+filtering long trials in chunks: a trial is split into time windows extended on both sides
+by margins as long as the support of the gap interpolation or of the filter, each window is
+processed on its own (on a thread pool), and the cores of the windows are stitched into one
+TRC file. The memory used is bounded by the windows, whatever the length of the trial.
+The windows are filtered by the filter functions of Pose2Sim, so the filtered files hold the
+same values as Pose2Sim's whole-trial filtering. Pose2Sim only triangulates whole trials, so
+the windows are triangulated as in the streaming mode instead: the triangulated files do not
+depend on the chunk size, but differ from those of Pose2Sim's triangulation.
+"""
+
+import logging
+import logging.handlers
+import os
+import glob
+import json
+import math
+import contextlib
+import collections
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from utility.cameras import read_calibration
+from utility.streaming import BLAZEPOSE_KEYPOINTS, triangulate_keypoints
+from utility.motion_files import ChunkedTrcWriter, load_motion_file
+from utility.profiling import profiled
+
+# Amplitude of the Butterworth transients, relative to the signal, left at the core of a window
+TRANSIENT_TOLERANCE = 1e-12
+# Knots past which a spline interpolation no longer depends on the data
+SPLINE_MARGIN = 32
+# The median filter is left out: scipy's running median carries the gaps forward, so its
+# output at a frame depends on all the frames before it
+CHUNKED_FILTERS = ('butterworth', 'gaussian', 'LOESS')
+
+def is_chunked(chunking_configs, filter_name=None):
+    """
+    Whether the triangulation, or the given filter, runs in chunks.
+
+    Args:
+        chunking_configs (dict): The 'processing' -> 'chunking' section of the config.
+        filter_name (str, optional): The filter.
+
+    Returns:
+        bool: True if chunking is enabled (and the filter has a chunked implementation).
+    """
+    return chunking_configs.get('enabled', False) and (filter_name is None or filter_name in CHUNKED_FILTERS)
+
+def get_chunks(n_frames, chunk_frames, margin):
+    """
+    Split the frames of a trial into consecutive cores of chunk_frames frames, each extended
+    by margin frames on both sides within the trial.
+
+    Args:
+        n_frames (int): The number of frames.
+        chunk_frames (int): The number of frames of a core.
+        margin (int): The number of frames added on each side.
+
+    Returns:
+        list: The (start, stop, core start, core stop) frames of each window.
+    """
+    return [(max(start - margin, 0), min(start + chunk_frames + margin, n_frames), start,
+             min(start + chunk_frames, n_frames)) for start in range(0, n_frames, chunk_frames)]
+
+def get_chunk_frames(chunking_configs, fps, n_frames):
+    """
+    Get the number of frames of a core from the chunk duration in seconds.
+    """
+    return max(1, min(int(round(chunking_configs.get('chunk_duration', 60) * fps)), n_frames))
+
+def map_chunks(func, windows, workers):
+    """
+    Run a function on each window on a thread pool, yielding the results in order. At most
+    twice as many windows as threads are in flight.
+
+    Yields:
+        The result of each window.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = collections.deque()
+        for window in windows:
+            futures.append(executor.submit(func, window))
+            if len(futures) > 2 * workers:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+def get_runs(valid):
+    """
+    Get the runs of consecutive valid values.
+
+    Args:
+        valid (numpy.ndarray): Whether each value is valid.
+
+    Returns:
+        list: The (start, stop) of each run.
+    """
+    edges = np.flatnonzero(np.diff(np.r_[0, valid.astype(np.int8), 0]))
+    return list(zip(edges[::2], edges[1::2]))
+
+def get_interpolation_margin(triangulation_configs):
+    """
+    Get the margin a window needs for its gaps to be interpolated as in the whole trial: a
+    gap of at most interp_if_gap_smaller_than frames and its two neighbours, and for the
+    quadratic and cubic splines, SPLINE_MARGIN more frames.
+    """
+    kind = triangulation_configs.get('interpolation', 'linear')
+    max_gap = triangulation_configs.get('interp_if_gap_smaller_than', 10)
+    if kind == 'none' or max_gap == 0:
+        return 0
+    return max_gap + 1 + (SPLINE_MARGIN if kind in ('quadratic', 'cubic') else 0)
+
+def interpolate_gaps(points, first_frame, kind, max_gap):
+    """
+    Interpolate the gaps of at most max_gap frames between triangulated frames of each
+    keypoint, in place.
+
+    Args:
+        points (numpy.ndarray): The 3D keypoints, shape (frames, keypoints, 3), NaN where missing.
+        first_frame (int): The frame number of the first row.
+        kind (str): The interpolation of scipy.interpolate.interp1d, or 'none'.
+        max_gap (int): The longest gap interpolated.
+
+    Returns:
+        numpy.ndarray: The points.
+    """
+    from scipy.interpolate import interp1d  # deferred, scipy is slow to import
+
+    if kind == 'none' or max_gap == 0:
+        return points
+    frames = first_frame + np.arange(len(points))
+    min_points = {"quadratic": 3, "cubic": 4}.get(kind, 2)
+    for k in range(points.shape[1]):
+        valid = ~np.isnan(points[:, k]).any(axis=-1)
+        if valid.sum() < min_points:
+            continue
+        gaps = [(start, stop) for start, stop in get_runs(~valid)
+                if 0 < start and stop < len(points) and stop - start <= max_gap]
+        if gaps:
+            missing = np.concatenate([np.arange(start, stop) for start, stop in gaps])
+            points[missing, k] = interp1d(frames[valid], points[valid, k], kind=kind, axis=0)(frames[missing])
+    return points
+
+def read_keypoints(json_files, start, stop, n_people, n_keypoints):
+    """
+    Read the associated keypoints of a block of frames of all the cameras.
+
+    Args:
+        json_files (list): For each camera, its JSON files, one per frame.
+        start (int): The first frame of the block.
+        stop (int): The frame after the block.
+        n_people (int): The number of people.
+        n_keypoints (int): The number of keypoints.
+
+    Returns:
+        numpy.ndarray: The (x, y, likelihood) keypoints, shape (cameras, frames, people, keypoints, 3).
+    """
+    keypoints = np.full((len(json_files), stop - start, n_people, n_keypoints, 3), np.nan)
+    for c, files in enumerate(json_files):
+        for t, file in enumerate(files[start:stop]):
+            with open(file, 'r', encoding='utf-8') as f:
+                people = json.load(f).get('people', [])
+            for p, person in enumerate(people[:n_people]):
+                keypoints[c, t, p] = np.reshape(person['pose_keypoints_2d'], (-1, 3))[:n_keypoints]
+    return keypoints
+
+def triangulate_window(window, json_files, cameras, n_people, triangulation_configs, fps):
+    """
+    Triangulate the frames of a window, interpolate their gaps and keep its core.
+
+    Args:
+        window (tuple): The (start, stop, core start, core stop) frames (see get_chunks).
+        json_files (list): For each camera, its JSON files in pose-associated/.
+        cameras (list): The cameras, in the same order (see utility.cameras.read_calibration).
+        n_people (int): The number of people.
+        triangulation_configs (dict): The 'triangulation' section of the subproject config.
+        fps (float): The frame rate.
+
+    Returns:
+        list: For each person, the TRC rows of the core (frame number, time, then X, Y, Z
+            per keypoint, Y up).
+    """
+    start, stop, core_start, core_stop = window
+    n_keypoints = len(BLAZEPOSE_KEYPOINTS)
+    keypoints = read_keypoints(json_files, start, stop, n_people, n_keypoints)
+    frames = np.arange(core_start, core_stop)
+    rows = []
+    for p in range(n_people):
+        points = triangulate_keypoints(keypoints[:, :, p].reshape(len(cameras), -1, 3), cameras, triangulation_configs)
+        points = interpolate_gaps(points.reshape(stop - start, n_keypoints, 3), start,
+                                  triangulation_configs.get('interpolation', 'linear'),
+                                  triangulation_configs.get('interp_if_gap_smaller_than', 10))
+        # Z-up world to the Y-up convention of OpenSim, as Pose2Sim does
+        core = points[core_start - start:core_stop - start][:, :, [1, 2, 0]]
+        rows.append(np.hstack([frames[:, None], frames[:, None] / fps, core.reshape(len(frames), -1)]))
+    return rows
+
+@profiled()
+def run_chunked_triangulation(config_dict, chunking_configs):
+    """
+    Triangulate the associated keypoints of a subproject (pose-associated/) in chunks of
+    chunking_configs['chunk_duration'] seconds, on chunking_configs['workers'] threads,
+    each frame as in the streaming mode (see utility.streaming.triangulate_keypoints), then
+    interpolate the gaps. One TRC file per person is written to pose-3d/, named as by
+    Pose2Sim; their values differ from those of Pose2Sim's triangulation.
+
+    Args:
+        config_dict (dict): The subproject config dictionary.
+        chunking_configs (dict): The 'processing' -> 'chunking' section of the config.
+
+    Returns:
+        list: The TRC files.
+
+    Raises:
+        RuntimeError: If no keypoint is triangulated.
+    """
+    project_dir = config_dict['project']['project_dir']
+    if config_dict['pose']['pose_model'] != 'BLAZEPOSE':
+        raise ValueError("The specified model has not been integrated, yet.")
+    calibration_file = os.path.join(project_dir, '..', '..', 'Calibration', 'Calib_board.toml')
+    cameras_by_name = {camera['name']: camera for camera in read_calibration(calibration_file)}
+    associated_folder = os.path.join(project_dir, 'pose-associated')
+    camera_names = sorted(folder[len('blaze_'):-len('_json')] for folder in os.listdir(associated_folder)
+                          if folder.startswith('blaze_') and folder.endswith('_json') and
+                          folder[len('blaze_'):-len('_json')] in cameras_by_name)
+    triangulation_configs = config_dict['triangulation']
+    if len(camera_names) < max(2, triangulation_configs.get('min_cameras_for_triangulation', 2)):
+        raise ValueError(f"Not enough cameras of {project_dir} are in {calibration_file}.")
+    cameras = [cameras_by_name[name] for name in camera_names]
+    json_files = [sorted(glob.glob(os.path.join(associated_folder, f"blaze_{name}_json", '*.json')))
+                  for name in camera_names]
+    n_frames = min(len(files) for files in json_files)
+    if n_frames == 0:
+        raise RuntimeError(f"No associated keypoints in {project_dir}.")
+    # The association writes the same number of people in every frame
+    with open(json_files[0][0], 'r', encoding='utf-8') as f:
+        n_people = max(len(json.load(f).get('people', [])), 1)
+    fps = config_dict['project']['frame_rate']
+    windows = get_chunks(n_frames, get_chunk_frames(chunking_configs, fps, n_frames),
+                         get_interpolation_margin(triangulation_configs))
+
+    trial = os.path.basename(os.path.realpath(project_dir))
+    output_folder = os.path.join(project_dir, 'pose-3d')
+    os.makedirs(output_folder, exist_ok=True)
+    output_files = [os.path.join(output_folder, f"{trial}_0-{n_frames}.trc" if n_people == 1 else
+                                 f"{trial}_P{p + 1}_0-{n_frames}.trc") for p in range(n_people)]
+    triangulated = 0
+    with contextlib.ExitStack() as stack:
+        writers = [stack.enter_context(ChunkedTrcWriter(output_file, n_frames, BLAZEPOSE_KEYPOINTS, fps))
+                   for output_file in output_files]
+        for rows in map_chunks(lambda window: triangulate_window(window, json_files, cameras, n_people,
+                                                                 triangulation_configs, fps),
+                               windows, chunking_configs.get('workers', 1)):
+            for writer, person_rows in zip(writers, rows):
+                writer.write(person_rows)
+                triangulated += int((~np.isnan(person_rows[:, 2:])).sum())
+        if not triangulated:
+            raise RuntimeError(f"No keypoint of {project_dir} could be triangulated.")
+    logging.info(f"Triangulated {n_frames} frames of {project_dir} in {len(windows)} chunks")
+    return output_files
+
+def get_filter_margin(filter_name, parameters, fps):
+    """
+    Get the margin a window needs for its core to be filtered by Pose2Sim as in the whole
+    trial, with the parameters as Pose2Sim reads them: the truncated Gaussian kernel, the
+    neighbours of a LOESS fit, and for the Butterworth filter, its padding and the time its
+    transients take to decay below TRANSIENT_TOLERANCE.
+
+    Args:
+        filter_name (str): The filter (see CHUNKED_FILTERS).
+        parameters (dict): The parameters of the filter.
+        fps (float): The frame rate.
+
+    Returns:
+        int: The margin in frames.
+    """
+    if filter_name == 'butterworth':
+        from scipy.signal import butter  # deferred, scipy is slow to import
+        b, a = butter(int(parameters.get('order', 4)) / 2, int(parameters.get('cut_off_frequency', 6)) / (fps / 2),
+                      'low')
+        pole = np.abs(np.roots(a)).max() if len(a) > 1 else 0
+        decay = math.ceil(math.log(TRANSIENT_TOLERANCE) / math.log(pole)) if 0 < pole < 1 else 0
+        return 3 * max(len(a), len(b)) + 1 + decay
+    if filter_name == 'gaussian':
+        # scipy truncates the kernel at 4 sigma
+        return int(4 * int(parameters.get('sigma_kernel', 2)) + 0.5)
+    if filter_name == 'LOESS':
+        return int(parameters.get('nb_values_used', 5))
+    raise ValueError(f"The {filter_name} filter cannot run in chunks, use one of {', '.join(CHUNKED_FILTERS)}.")
+
+def get_frame_rate(times):
+    """
+    Get the frame rate of a TRC file from its time column, as Pose2Sim's filtering does.
+    """
+    return float(np.round(1 / np.diff(times).mean()))
+
+def filter_window(window, data, config_dict, frame_rate):
+    """
+    Filter the positions of a window of a TRC data array column by column with the filter
+    function of Pose2Sim (Pose2Sim.filtering.filter1d), and keep its core.
+
+    Returns:
+        numpy.ndarray: The TRC rows of the core.
+    """
+    import pandas as pd  # deferred, pandas is slow to import
+    from Pose2Sim.filtering import filter1d  # deferred, Pose2Sim is slow to import
+
+    start, stop, core_start, core_stop = window
+    coordinates = pd.DataFrame(np.array(data[start:stop, 2:]))
+    filtered = coordinates.apply(filter1d, axis=0, args=[config_dict, config_dict['filtering']['type'], frame_rate])
+    return np.hstack([data[core_start:core_stop, :2],
+                      filtered.to_numpy(dtype=float)[core_start - start:core_stop - start]])
+
+@profiled()
+def run_chunked_filtering(config_dict, chunking_configs):
+    """
+    Filter the triangulated TRC files of a subproject in chunks with the filter of
+    config_dict['filtering']['type'], each window by Pose2Sim's own filter (see filter_window).
+    The TRC files are memory-mapped (see utility.motion_files.load_motion_file) and the
+    filtered ones are written next to them with a _filt_<filter> suffix and the full
+    precision, as by Pose2Sim, so they hold the same values as Pose2Sim's whole-trial filtering.
+
+    Args:
+        config_dict (dict): The subproject config dictionary.
+        chunking_configs (dict): The 'processing' -> 'chunking' section of the config.
+
+    Returns:
+        list: The filtered TRC files.
+    """
+    filter_name = config_dict['filtering']['type']
+    parameters = config_dict['filtering'].get(filter_name, {})
+    fps = config_dict['project']['frame_rate']
+    output_folder = os.path.join(config_dict['project']['project_dir'], 'pose-3d')
+    output_files = []
+    for trc_file in sorted(glob.glob(os.path.join(output_folder, '*.trc'))):
+        if '_filt_' in os.path.basename(trc_file):
+            continue
+        header, data = load_motion_file(trc_file)
+        n_frames = len(data)
+        frame_rate = get_frame_rate(data[:, 1]) if n_frames > 1 else fps
+        margin = get_filter_margin(filter_name, parameters, frame_rate)
+        windows = get_chunks(n_frames, get_chunk_frames(chunking_configs, fps, n_frames), margin) if n_frames else []
+        output_file = f"{os.path.splitext(trc_file)[0]}_filt_{filter_name}.trc"
+        with ChunkedTrcWriter(output_file, n_frames, header['markers'], fps,
+                              first_frame=int(data[0, 0]) if n_frames else 0, float_format=None) as writer:
+            for rows in map_chunks(lambda window: filter_window(window, data, config_dict, frame_rate),
+                                   windows, chunking_configs.get('workers', 1)):
+                writer.write(rows)
+        output_files.append(output_file)
+    logging.info(f"Filtered {len(output_files)} files of {output_folder} with {filter_name} in chunks")
+    return output_files
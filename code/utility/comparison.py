@@ -0,0 +1,341 @@
+"""
+Module description: This module contains a set of utility functions for comparing the
+results (3D trajectories and joint angles) of the different settings, camera sub-setups
+and filters against a reference setup.
+"""
+
+import logging
+import logging.handlers
+import os
+import re
+import csv
+import numpy as np
+from utility.utils import find_unique_base_names
+from utility.motion_files import load_motion_file, get_times, get_marker_positions
+from utility.sub_setups import is_selected_sub_setup, get_sub_setup_cameras
+
+RESULT_FIELDS = ["session", "trial", "kind", "filter", "sub_setup", "setting", "n_cameras", "fps",
+                 "is_reference", "reference_sub_setup", "reference_setting", "variable", "metric", "value", "file"]
+
+def parse_result_path(file_path):
+    """
+    Parse the session, sub-setup, setting and trial of a result file from its path, e.g.
+    <session>/__synced__/<sub_setup>/<setting>/<participant>/<trial>/pose-3d/<file>.trc.
+
+    Args:
+        file_path (str): The path to a TRC or MOT result file.
+
+    Returns:
+        dict: The parsed path components, the kind ('trc' or 'mot') and the filter name.
+    """
+    parts = os.path.normpath(file_path).split(os.sep)
+    i = parts.index('__synced__')
+    stem, extension = os.path.splitext(parts[-1])
+    match = re.search(r'_filt_(.+)$', stem)
+    return {
+        "session": os.sep.join(parts[:i]),
+        "sub_setup": parts[i + 1],
+        "setting": parts[i + 2],
+        "trial": os.sep.join(parts[i + 3:-2]),
+        "kind": extension.lstrip('.').lower(),
+        "filter": match.group(1) if match else None,
+        "file": file_path,
+    }
+
+def find_result_files(workspace):
+    """
+    Find every filtered TRC file (in 'pose-3d' folders) and joint-angle MOT file
+    (in 'kinematics' folders) of the synced sessions of the workspace.
+
+    Args:
+        workspace (str): The path to the workspace.
+
+    Returns:
+        list: The parsed result files (see parse_result_path).
+    """
+    results = []
+    for root, _, files in os.walk(workspace):
+        if f"{os.sep}__synced__{os.sep}" not in root:
+            continue
+        folder = os.path.basename(root)
+        for file in files:
+            if ((folder == 'pose-3d' and file.endswith('.trc')) or
+                (folder == 'kinematics' and file.endswith('.mot'))):
+                result = parse_result_path(os.path.join(root, file))
+                if result['filter'] is not None and is_selected_sub_setup(result['file']):
+                    results.append(result)
+    return sorted(results, key=lambda result: result['file'])
+
+def get_setting_fps(setting):
+    """
+    Get the frame rate of a setting folder name (fps_x_y_format).
+
+    Args:
+        setting (str): The setting folder name.
+
+    Returns:
+        int or None: The frame rate, or None if it is unset.
+    """
+    fps = setting.split('_')[0]
+    return None if fps == 'unset' else int(fps)
+
+def count_cameras(session, sub_setup, reference_cameras=None):
+    """
+    Count the cameras of a sub-setup of a session (see utility.sub_setups.get_sub_setup_cameras).
+
+    Args:
+        session (str): The session folder.
+        sub_setup (str): The sub-setup folder name.
+        reference_cameras (int, optional): The number of cameras of 'all_cams'.
+
+    Returns:
+        int or None: The number of cameras.
+    """
+    if sub_setup == 'all_cams':
+        return reference_cameras
+    return len(get_sub_setup_cameras(os.path.join(session, '__synced__'), sub_setup))
+
+def select_reference(candidates, reference_sub_setup, reference_setting):
+    """
+    Select the reference among the results of a trial. The configured reference is used if
+    it exists, otherwise (or without a configured setting) the reference sub-setup with the
+    highest frame rate.
+
+    Args:
+        candidates (list): The parsed result files of a trial, kind and filter.
+        reference_sub_setup (str): The reference sub-setup, e.g. 'all_cams'.
+        reference_setting (str or None): The reference setting, e.g. '30_unset_unset_mp4'.
+
+    Returns:
+        dict or None: The reference result file.
+    """
+    for candidate in candidates:
+        if candidate['sub_setup'] == reference_sub_setup and candidate['setting'] == reference_setting:
+            return candidate
+    fallbacks = [candidate for candidate in candidates if candidate['sub_setup'] == reference_sub_setup]
+    if not fallbacks:
+        return None
+    return max(fallbacks, key=lambda candidate: get_setting_fps(candidate['setting']) or 0)
+
+def align_to_reference(times, data, reference_times):
+    """
+    Linearly interpolate a (frames, ...) array onto the reference time stamps. Reference
+    time stamps outside of the recorded range get NaN.
+
+    Args:
+        times (numpy.ndarray): The time stamps of the data.
+        data (numpy.ndarray): The data, one row per time stamp.
+        reference_times (numpy.ndarray): The reference time stamps.
+
+    Returns:
+        numpy.ndarray: The aligned data, one row per reference time stamp.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    flat = np.asarray(data, dtype=np.float64).reshape(len(times), -1)
+    if len(times) < 2:
+        return np.full((len(reference_times),) + data.shape[1:], np.nan)
+    idx = np.clip(np.searchsorted(times, reference_times, side='right') - 1, 0, len(times) - 2)
+    weights = ((reference_times - times[idx]) / (times[idx + 1] - times[idx]))[:, None]
+    aligned = flat[idx] * (1 - weights) + flat[idx + 1] * weights
+    aligned[(reference_times < times[0]) | (reference_times > times[-1])] = np.nan
+    return aligned.reshape((len(reference_times),) + data.shape[1:])
+
+def compute_jitter(times, positions):
+    """
+    Compute the jitter of each marker as the mean norm of its acceleration.
+
+    Args:
+        times (numpy.ndarray): The time stamps.
+        positions (numpy.ndarray): The (frames, markers, 3) positions.
+
+    Returns:
+        numpy.ndarray: The jitter of each marker (position units / s^2).
+    """
+    dt = np.median(np.diff(times))
+    acceleration = np.diff(positions, n=2, axis=0) / dt ** 2
+    return nanmean_or_nan(np.linalg.norm(acceleration, axis=-1), axis=0)
+
+def compute_missing_rate(positions):
+    """
+    Compute the fraction of frames where each marker is missing.
+
+    Args:
+        positions (numpy.ndarray): The (frames, markers, 3) positions.
+
+    Returns:
+        numpy.ndarray: The missing rate of each marker.
+    """
+    return np.isnan(positions).any(axis=-1).mean(axis=0)
+
+def nanmean_or_nan(values, axis):
+    """
+    Compute the mean ignoring NaN, returning NaN (without warning) for all-NaN slices.
+
+    Args:
+        values (numpy.ndarray): The values.
+        axis (int): The axis to average.
+
+    Returns:
+        numpy.ndarray: The means.
+    """
+    counts = np.sum(~np.isnan(values), axis=axis)
+    sums = np.nansum(values, axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+def compare_trc_group(reference, candidates):
+    """
+    Compare the TRC files of a trial and filter with the reference, in one vectorized pass
+    over the candidates aligned to the reference time stamps.
+
+    Args:
+        reference (dict): The parsed reference result file.
+        candidates (list): The parsed result files to compare (including the reference).
+
+    Returns:
+        list: One (candidate, variable, metric, value) tuple per computed metric.
+    """
+    reference_header, reference_data = load_motion_file(reference['file'])
+    reference_times = np.asarray(get_times(reference_header, reference_data))
+    markers = reference_header['markers']
+    reference_positions = get_marker_positions(reference_header, reference_data)
+
+    rows, aligned, compared = [], [], []
+    for candidate in candidates:
+        header, data = load_motion_file(candidate['file'])
+        times = np.asarray(get_times(header, data))
+        positions = get_marker_positions(header, data)
+        for name, values in (("jitter", compute_jitter(times, positions)),
+                             ("missing_rate", compute_missing_rate(positions))):
+            rows.extend((candidate, marker, name, value) for marker, value in zip(header['markers'], values))
+            rows.append((candidate, 'all', name, float(np.nanmean(values))))
+        if header['markers'] != markers:
+            logging.warning(f"{candidate['file']} does not have the markers of the reference, not compared.")
+            continue
+        aligned.append(align_to_reference(times, positions, reference_times))
+        compared.append(candidate)
+
+    if compared:
+        # (candidates, frames, markers)
+        errors = np.linalg.norm(np.stack(aligned) - reference_positions[None], axis=-1)
+        rmse = np.sqrt(nanmean_or_nan(errors ** 2, axis=1))
+        mean_error = nanmean_or_nan(errors, axis=1)
+        overall_rmse = np.sqrt(nanmean_or_nan((errors ** 2).reshape(len(compared), -1), axis=1))
+        for k, candidate in enumerate(compared):
+            rows.extend((candidate, marker, "rmse", value) for marker, value in zip(markers, rmse[k]))
+            rows.extend((candidate, marker, "mean_error", value) for marker, value in zip(markers, mean_error[k]))
+            rows.append((candidate, 'all', "rmse", overall_rmse[k]))
+    return rows
+
+def compare_mot_group(reference, candidates):
+    """
+    Compare the MOT files of a trial and filter with the reference, in one vectorized pass
+    over the candidates aligned to the reference time stamps.
+
+    Args:
+        reference (dict): The parsed reference result file.
+        candidates (list): The parsed result files to compare (including the reference).
+
+    Returns:
+        list: One (candidate, variable, metric, value) tuple per computed metric.
+    """
+    reference_header, reference_data = load_motion_file(reference['file'])
+    reference_times = np.asarray(get_times(reference_header, reference_data))
+    coordinates = [column for column in reference_header['columns'] if column != 'time']
+    reference_columns = [reference_header['columns'].index(column) for column in coordinates]
+    reference_angles = np.asarray(reference_data[:, reference_columns])
+
+    rows, aligned, compared = [], [], []
+    for candidate in candidates:
+        header, data = load_motion_file(candidate['file'])
+        if not set(coordinates).issubset(header['columns']):
+            logging.warning(f"{candidate['file']} does not have the coordinates of the reference, not compared.")
+            continue
+        columns = [header['columns'].index(column) for column in coordinates]
+        aligned.append(align_to_reference(get_times(header, data), data[:, columns], reference_times))
+        compared.append(candidate)
+
+    if compared:
+        # (candidates, frames, coordinates)
+        errors = np.stack(aligned) - reference_angles[None]
+        rmse = np.sqrt(nanmean_or_nan(errors ** 2, axis=1))
+        mean_absolute_error = nanmean_or_nan(np.abs(errors), axis=1)
+        for k, candidate in enumerate(compared):
+            rows.extend((candidate, coordinate, "angle_rmse", value) for coordinate, value in zip(coordinates, rmse[k]))
+            rows.extend((candidate, coordinate, "angle_mae", value)
+                        for coordinate, value in zip(coordinates, mean_absolute_error[k]))
+            rows.append((candidate, 'all', "angle_rmse", float(np.nanmean(rmse[k]))))
+    return rows
+
+def compare_results(workspace, comparison_configs):
+    """
+    Compare the results of every trial of the workspace with their reference setup.
+
+    Args:
+        workspace (str): The path to the workspace.
+        comparison_configs (dict): The comparison configurations ('reference_sub_setup',
+            'reference_setting').
+
+    Returns:
+        list: The tidy rows of the comparison (see RESULT_FIELDS).
+    """
+    reference_sub_setup = comparison_configs.get('reference_sub_setup', 'all_cams')
+    reference_setting = comparison_configs.get('reference_setting')
+
+    groups = {}
+    for result in find_result_files(workspace):
+        groups.setdefault((result['session'], result['trial'], result['kind'], result['filter']), []).append(result)
+
+    rows = []
+    for (session, trial, kind, filter_name), candidates in sorted(groups.items()):
+        reference = select_reference(candidates, reference_sub_setup, reference_setting)
+        if reference is None:
+            logging.warning(f"No {reference_sub_setup} reference for {session} {trial} ({kind}, {filter_name}).")
+            continue
+        if reference_setting is None:
+            logging.info(f"Using {reference['setting']}, the {reference_sub_setup} setting with the highest fps, "
+                         f"as reference for {session} {trial} ({kind}, {filter_name}).")
+        elif reference['setting'] != reference_setting:
+            logging.warning(f"No {reference_setting} results for {session} {trial} ({kind}, {filter_name}), using "
+                            f"{reference['setting']}, the {reference_sub_setup} setting with the highest fps, as reference.")
+        reference_cameras = len(find_unique_base_names(os.path.dirname(os.path.dirname(reference['file'])))) or None
+        compare = compare_trc_group if kind == 'trc' else compare_mot_group
+        try:
+            group_rows = compare(reference, candidates)
+        except Exception as e:
+            logging.error(f"Comparison of {session} {trial} ({kind}, {filter_name}) failed: {e}")
+            continue
+        for candidate, variable, metric, value in group_rows:
+            rows.append({
+                **{key: candidate[key] for key in ("session", "trial", "kind", "filter", "sub_setup", "setting", "file")},
+                "n_cameras": count_cameras(session, candidate['sub_setup'], reference_cameras),
+                "fps": get_setting_fps(candidate['setting']),
+                "is_reference": candidate is reference,
+                "reference_sub_setup": reference['sub_setup'],
+                "reference_setting": reference['setting'],
+                "variable": variable,
+                "metric": metric,
+                "value": float(value),
+            })
+    return rows
+
+def write_comparison(rows, output_file):
+    """
+    Write the comparison rows as CSV, or as Parquet if the output file ends with '.parquet'.
+
+    Args:
+        rows (list): The tidy rows of the comparison.
+        output_file (str): The path of the output file.
+
+    Returns:
+        None
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    if output_file.endswith('.parquet'):
+        import pandas as pd
+        pd.DataFrame(rows, columns=RESULT_FIELDS).to_parquet(output_file, index=False)
+        return
+    with open(output_file, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
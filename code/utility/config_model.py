@@ -0,0 +1,420 @@
+"""
+Module description: This module contains the model of the workspace config.json: the type,
+default and allowed values of every option, the validation of the whole config up front
+(so that a typo fails at start-up instead of as a KeyError hours into a run), and the
+canonical hashing of config subsets and the stage stamps built on it, which let a stage
+tell in a file read whether its outputs were made with the current config.
+"""
+
+import logging
+import logging.handlers
+import os
+import copy
+import json
+import time
+import difflib
+import hashlib
+
+REQUIRED = object()
+NUMBER = (int, float)
+NONE = type(None)
+
+class ConfigError(ValueError):
+    """
+    Raised when config.json does not match the model, with one line per problem.
+    """
+
+class Option(object):
+    """
+    An option of the config.
+
+    Attributes:
+        types (tuple): The allowed types (bool is only allowed if listed).
+        default: The value used when the option is missing, REQUIRED if it must be set.
+        choices (list, optional): The allowed values.
+        minimum (float, optional): The smallest allowed value.
+        length (int, optional): The length of a list value.
+        items (optional): The model of the items of a list value (an Option or a section dict).
+        values (optional): The model of the values of a dict value: an Option applied to all
+            the values, or a dict of the allowed keys and their models.
+    """
+    def __init__(self, types, default=REQUIRED, choices=None, minimum=None, length=None, items=None, values=None):
+        self.types = types if isinstance(types, tuple) else (types,)
+        self.default = default
+        self.choices = choices
+        self.minimum = minimum
+        self.length = length
+        self.items = items
+        self.values = values
+
+    def validate(self, value, path, errors):
+        """
+        Validate a value, appending the problems to errors.
+
+        Returns:
+            The value, with the defaults of its nested sections filled in.
+        """
+        if value is None and NONE in self.types:
+            return None
+        if not isinstance(value, self.types) or (isinstance(value, bool) and bool not in self.types):
+            expected = ' or '.join('null' if t is NONE else t.__name__ for t in self.types)
+            errors.append(f"{path}: expected {expected}, got {json.dumps(value)}")
+            return value
+        if self.choices is not None and value not in self.choices:
+            errors.append(f"{path}: {json.dumps(value)} is not one of {json.dumps(self.choices)}")
+        if self.minimum is not None and isinstance(value, NUMBER) and value < self.minimum:
+            errors.append(f"{path}: {value} is smaller than {self.minimum}")
+        if self.length is not None and len(value) != self.length:
+            errors.append(f"{path}: expected {self.length} values, got {len(value)}")
+        if self.items is not None:
+            return [validate_value(item, self.items, f"{path}[{k}]", errors) for k, item in enumerate(value)]
+        if isinstance(self.values, dict):
+            unknown = [key for key in value if key not in self.values]
+            report_unknown_keys(unknown, self.values, path, errors)
+            return {key: validate_value(item, self.values[key], f"{path}.{key}", errors)
+                    for key, item in value.items() if key in self.values}
+        if self.values is not None:
+            return {key: validate_value(item, self.values, f"{path}.{key}", errors) for key, item in value.items()}
+        return value
+
+def report_unknown_keys(keys, known_keys, path, errors):
+    """
+    Append an error per unknown key, suggesting the closest known key.
+    """
+    for key in keys:
+        matches = difflib.get_close_matches(key, list(known_keys), n=1)
+        suggestion = f", did you mean '{matches[0]}'?" if matches else ""
+        errors.append(f"{path}.{key}: unknown option{suggestion}".lstrip('.'))
+
+def validate_value(value, model, path, errors):
+    """
+    Validate a value against an Option or a section (a dict of option names and models).
+
+    Returns:
+        The value, with the defaults filled in.
+    """
+    if isinstance(model, Option):
+        return model.validate(value, path, errors)
+    return validate_section(value, model, path, errors)
+
+def validate_section(values, section, path, errors):
+    """
+    Validate a section: unknown options and missing required options are errors, and the
+    missing optional options get their default.
+
+    Returns:
+        dict: The section, with the defaults filled in.
+    """
+    if not isinstance(values, dict):
+        errors.append(f"{path}: expected an object, got {json.dumps(values)}")
+        return values
+    report_unknown_keys([key for key in values if key not in section], section, path, errors)
+    validated = {}
+    for key, model in section.items():
+        key_path = f"{path}.{key}".lstrip('.')
+        if key in values:
+            validated[key] = validate_value(values[key], model, key_path, errors)
+        elif not isinstance(model, Option):
+            validated[key] = validate_section({}, model, key_path, errors)
+        elif model.default is REQUIRED:
+            errors.append(f"{key_path}: missing")
+        else:
+            validated[key] = copy.deepcopy(model.default)
+    return validated
+
+FILTERS = {
+    "butterworth": {
+        "order": Option(int, 4, minimum=1),
+        "cut_off_frequency": Option(NUMBER, 6, minimum=0),
+    },
+    "kalman": {
+        "trust_ratio": Option(NUMBER, 100, minimum=0),
+        "smooth": Option(bool, True),
+    },
+    "butterworth_on_speed": {
+        "order": Option(int, 4, minimum=1),
+        "cut_off_frequency": Option(NUMBER, 10, minimum=0),
+    },
+    "gaussian": {
+        "sigma_kernel": Option(NUMBER, 2, minimum=0),
+    },
+    "LOESS": {
+        "nb_values_used": Option(int, 30, minimum=1),
+    },
+    "median": {
+        "kernel_size": Option(int, 9, minimum=1),
+    },
+}
+
+CONFIG_MODEL = {
+    "settings": Option(list, items={
+        "fps": Option((int, NONE), None, minimum=1),
+        "resolution": Option(list, [None, None], length=2, items=Option((int, NONE), minimum=1)),
+        "format": Option((str, NONE), None),
+        "subsample_pose": Option(bool, False),
+    }),
+    "pose_estimation_configs": Option(list, items={
+        "pose_framework": Option(str, "mediapipe", choices=["mediapipe"]),
+        "pose_model": Option(str, "BLAZEPOSE", choices=["BLAZEPOSE"]),
+        "to_csv": Option(bool, False),
+        "to_h5": Option(bool, False),
+        "display": Option(bool, False),
+        "save_images": Option(bool, False),
+        "save_video": Option(bool, False),
+        "model_complexity": Option(int, 2, choices=[0, 1, 2]),
+    }),
+    "sub_setups": {
+        "policy": Option(str, "exhaustive", choices=["exhaustive", "size", "budget", "geometry"]),
+        "sizes": Option(list, [], items=Option(int, minimum=2)),
+        "max_combinations": Option(int, 20, minimum=1),
+    },
+    "calibration_configs": {
+        "calibration_type": Option(str, "calculate", choices=["calculate", "convert"]),
+        "overwrite": Option(bool, False),
+        "intrinsics": {
+            "overwrite_intrinsics": Option(bool, False),
+            "show_detection_intrinsics": Option(bool, True),
+            "intrinsics_extension": Option(str, "mp4"),
+            "extract_every_N_sec": Option(NUMBER, 0.5, minimum=0),
+            "intrinsics_corners_nb": Option(list, [7, 10], length=2, items=Option(int, minimum=2)),
+            "intrinsics_square_size": Option(NUMBER, 50, minimum=0),
+        },
+        "extrinsics": {
+            "calculate_extrinsics": Option(bool, True),
+            "show_reprojection_error": Option(bool, True),
+            "extrinsics_extension": Option(str, "mp4"),
+            "extrinsics_corners_nb": Option(list, [7, 10], length=2, items=Option(int, minimum=2)),
+            "extrinsics_square_size": Option(NUMBER, 50, minimum=0),
+        },
+        "refinement": {
+            "enabled": Option(bool, False),
+            "refine_intrinsics": Option(bool, True),
+            "loss": Option(str, "huber", choices=["linear", "huber", "soft_l1", "cauchy"]),
+            "f_scale": Option(NUMBER, 1.0, minimum=0),
+            "max_nfev": Option(int, 200, minimum=1),
+        },
+    },
+    "processing": {
+        "max_workers": Option((int, NONE), None, minimum=1),
+        "max_triangulation_retries": Option(int, 10, minimum=0),
+        "chunking": {
+            "enabled": Option(bool, False),
+            "chunk_duration": Option(NUMBER, 60, minimum=0),
+            "workers": Option(int, 1, minimum=1),
+        },
+    },
+    "person_association": {
+        "tracked_keypoint": Option(str, "left_shoulder"),
+        "reproj_error_threshold_association": Option(NUMBER, 10, minimum=0),
+        "likelihood_threshold_association": Option(NUMBER, 0.1, minimum=0),
+        "single_person": Option(bool, True),
+        "block_size": Option(int, 256, minimum=1),
+        "max_tracking_distance": Option(NUMBER, 0.5, minimum=0),
+        "max_gap": Option(int, 15, minimum=0),
+    },
+    "triangulation": {
+        "reproj_error_threshold_triangulation": Option(NUMBER, 20, minimum=0),
+        "likelihood_threshold_triangulation": Option(NUMBER, 0.3, minimum=0),
+        "min_cameras_for_triangulation": Option(int, 2, minimum=2),
+        "interpolation": Option(str, "linear", choices=["linear", "slinear", "quadratic", "cubic", "none"]),
+        "interp_if_gap_smaller_than": Option(int, 10, minimum=0),
+        "show_interp_indices": Option(bool, True),
+        "handle_LR_swap": Option(bool, False),
+        "undistort_points": Option(bool, False),
+    },
+    "filtering": {
+        "display_figures": Option(bool, False),
+        # The listed filters are the ones run, so only their parameters get defaults
+        "filters": Option(dict, {"butterworth": {"order": 4, "cut_off_frequency": 6}}, values=FILTERS),
+    },
+    "kinematics": {
+        "enabled": Option(bool, False),
+        "opensim_setup_dir": Option(str, "../opensim_setup"),
+        "subject_mass": Option((NUMBER, NONE), None, minimum=0),
+        "scaling_time_range": Option((list, NONE), None, length=2, items=Option(NUMBER)),
+    },
+    "comparison": {
+        "reference_sub_setup": Option(str, "all_cams"),
+        # None: the processed setting with the highest frame rate (the unset setting is not processed)
+        "reference_setting": Option((str, NONE), None),
+        "output_file": Option(str, "../../results/comparison.csv"),
+    },
+    "profiling": {
+        "report_dir": Option(str, "run_reports"),
+        "profile_stage": Option((str, NONE), None),
+        "profiler": Option(str, "cprofile", choices=["cprofile", "pyinstrument"]),
+    },
+    "metrics": {
+        "enabled": Option(bool, False),
+        "host": Option(str, "127.0.0.1"),
+        "port": Option(int, 9108, minimum=0),
+    },
+    "distributed": {
+        "queue": Option(str, "file", choices=["file", "memory"]),
+        "queue_dir": Option(str, "work_queue"),
+        "lease_timeout": Option(NUMBER, 600, minimum=0),
+        "max_attempts": Option(int, 3, minimum=1),
+        "poll_interval": Option(NUMBER, 5, minimum=0),
+        "progress_interval": Option(NUMBER, 30, minimum=0),
+    },
+    "streaming": {
+        "filter": Option(str, "butterworth", choices=["butterworth", "kalman"]),
+        "queue_size": Option(int, 16, minimum=1),
+    },
+    "ingestion": {
+        "sources": Option(dict, {}, values=Option(str)),
+        "replay": Option(bool, False),
+        "alignment": Option(str, "audio", choices=["audio", "timestamp"]),
+        "max_duration": Option((NUMBER, NONE), None, minimum=0),
+        "queue_size": Option(int, 64, minimum=1),
+        "buffer": Option(NUMBER, 2, minimum=0),
+        "warmup": Option(NUMBER, 0.5, minimum=0),
+        "spike_factor": Option(NUMBER, 10, minimum=0),
+        "spike_timeout": Option(NUMBER, 30, minimum=0),
+        "audio_sample_rate": Option(int, 16000, minimum=1),
+        "fourcc": Option(str, "mp4v", length=4),
+    },
+    "rendering": {
+        "mode": Option(str, "async", choices=["async", "later"]),
+        "workers": Option(int, 2, minimum=1),
+        "queue_size": Option(int, 16, minimum=1),
+        "pending_videos": Option(int, 4, minimum=1),
+        "likelihood_threshold": Option(NUMBER, 0.3, minimum=0),
+    },
+    "retention": {
+        "budget": Option((int, str, NONE), None),
+        "min_age": Option(NUMBER, 3600, minimum=0),
+        "prune_order": Option(list, ["temp", "pose_dumps", "sub_setups", "preprocessed", "synced"],
+                              items=Option(str, choices=["temp", "pose_dumps", "sub_setups", "preprocessed", "synced"])),
+    },
+    "video_io": {
+        "backend": Option(str, "auto", choices=["auto", "av", "opencv"]),
+        "decode_threads": Option(int, 0, minimum=0),
+        "encode_threads": Option(int, 0, minimum=0),
+        "codec": Option(str, "libx264"),
+        "preset": Option(str, "medium", choices=["ultrafast", "superfast", "veryfast", "faster", "fast", "medium",
+                                                 "slow", "slower", "veryslow"]),
+        "crf": Option(int, 23, minimum=0),
+        "queue_size": Option(int, 8, minimum=1),
+    },
+    "quality": {
+        "enabled": Option(bool, True),
+        "min_keypoints": Option(int, 5, minimum=1),
+        "max_jitter": Option(NUMBER, 0.5, minimum=0),
+        "min_usable_rate": Option(NUMBER, 0.2, minimum=0),
+        "min_triangulable_rate": Option(NUMBER, 0.05, minimum=0),
+    },
+}
+
+def validate_config(config):
+    """
+    Validate a whole config against CONFIG_MODEL and fill in the defaults.
+
+    Args:
+        config (dict): The contents of config.json.
+
+    Returns:
+        dict: The validated config, with every section and option of the model.
+
+    Raises:
+        ConfigError: If the config has unknown, missing or invalid options, listing all of them.
+    """
+    errors = []
+    validated = validate_section(config, CONFIG_MODEL, '', errors)
+    if errors:
+        raise ConfigError("Invalid config.json:\n" + '\n'.join(f"  - {error}" for error in errors))
+    return validated
+
+def get_filter_parameters(filter_name):
+    """
+    Get the default parameters of a filter.
+
+    Args:
+        filter_name (str): The filter type.
+
+    Returns:
+        dict: The default parameters.
+    """
+    return validate_section({}, FILTERS[filter_name], filter_name, [])
+
+def canonicalize(value):
+    """
+    Convert a config value to a canonical form: keys sorted by json, tuples as lists, and
+    integral floats as integers, so that equivalent configs hash the same.
+    """
+    if isinstance(value, dict):
+        return {str(key): canonicalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [canonicalize(item) for item in value]
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def get_config_hash(values):
+    """
+    Get the canonical hash of a config subset.
+
+    Args:
+        values (dict): The config subset.
+
+    Returns:
+        str: The hash, 16 hexadecimal characters.
+    """
+    canonical = json.dumps(canonicalize(values), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:16]
+
+def get_stamp_file(output_folder, stage):
+    """
+    Get the path of the stamp of a stage in its output folder.
+    """
+    return os.path.join(output_folder, f"{stage}_stamp.json")
+
+def read_stage_stamp(output_folder, stage, config_hash):
+    """
+    Read the stamp of a stage, if its outputs are current: the stamp exists, was written
+    with the same config hash, and its output files still exist.
+
+    Args:
+        output_folder (str): The output folder of the stage.
+        stage (str): The name of the stage (e.g. 'triangulation_BLAZEPOSE').
+        config_hash (str): The hash of the current config subset (see get_config_hash).
+
+    Returns:
+        dict or None: The stamp, None if the stage has to run.
+    """
+    try:
+        with open(get_stamp_file(output_folder, stage), 'r', encoding='utf-8') as f:
+            stamp = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if stamp.get('config_hash') != config_hash:
+        logging.info(f"The config of {stage} changed, {output_folder} is out of date.")
+        return None
+    if not all(os.path.exists(os.path.join(output_folder, file_name)) for file_name in stamp.get('outputs', [])):
+        logging.info(f"Outputs of {stage} are missing in {output_folder}.")
+        return None
+    return stamp
+
+def write_stage_stamp(output_folder, stage, config_hash, config, outputs=(), result=None):
+    """
+    Write the stamp of a stage once its outputs are complete.
+
+    Args:
+        output_folder (str): The output folder of the stage.
+        stage (str): The name of the stage.
+        config_hash (str): The hash of the config subset.
+        config (dict): The config subset, for reference.
+        outputs (iterable): The output files, relative to the output folder.
+        result (optional): A JSON-serializable result returned by the stage when it is skipped.
+
+    Returns:
+        None
+    """
+    from utility.utils import atomic_output  # utils imports this module
+
+    stamp = {"stage": stage, "config_hash": config_hash, "time": time.strftime('%Y-%m-%dT%H:%M:%S'),
+             "outputs": sorted(outputs), "result": result, "config": config}
+    os.makedirs(output_folder, exist_ok=True)
+    with atomic_output(get_stamp_file(output_folder, stage)) as partial_file:
+        with open(partial_file, 'w', encoding='utf-8') as f:
+            json.dump(stamp, f, indent=4)
@@ -0,0 +1,252 @@
+"""
+Module description: This module contains the main functionality of the distributed mode.
+A coordinator builds the work items of each stage (per-folder sync, per-video preprocessing
+and pose estimation, per-subproject calibration and processing) and puts them in a work
+queue; workers on any node sharing the workspace claim and run them.
+"""
+
+import logging
+import logging.handlers
+import os
+import time
+import socket
+import threading
+import contextlib
+from utility.utils import is_video_file
+from utility.scheduler import add_task, execute_task, write_run_summary
+from utility.metrics import add_total, set_progress, register_gauge, unregister_gauge
+from utility.work_queue import make_item, load_function
+from utility.sync import get_folders_to_be_synced, sync_folder, copy_calibration_files
+from utility.preprocess import get_videos_to_be_preprocessed, preprocess_setting_video, create_sub_setups
+from utility.human_pose_estimation import get_tasks_to_extract_pose, estimate_video_pose, derive_subsampled_poses
+from utility.calibration import calibrate_subproject, get_subproject_dirs as get_calibration_subproject_dirs
+from utility.processing import build_processing_graph
+
+STAGES = ['sync', 'preprocess', 'pose', 'calibration', 'processing']
+
+def build_stage_graph(workspace, config, stage):
+    """
+    Build the task graph of a stage from the current state of the workspace.
+
+    Args:
+        workspace (str): The workspace directory.
+        config (dict): The workspace config.
+        stage (str): One of STAGES.
+
+    Returns:
+        dict: The task graph (see utility.scheduler.add_task).
+    """
+    graph = {}
+    if stage == 'sync':
+        # The videos of a folder are trimmed to a common duration, so a folder is one item
+        for folder in get_folders_to_be_synced(workspace):
+            add_task(graph, f"sync:{folder}", sync_folder, (folder,), metadata={"stage": stage, "folder": folder})
+    elif stage == 'preprocess':
+        for setting in config['settings']:
+            for video_file in get_videos_to_be_preprocessed(workspace, setting):
+                add_task(graph, f"preprocess:{video_file}:{setting['fps']}_{setting['resolution']}_{setting['format']}",
+                         preprocess_setting_video, (video_file, setting),
+                         metadata={"stage": stage, "video": video_file, "setting": setting})
+    elif stage == 'pose':
+        for i, pose_estimation_config in enumerate(config['pose_estimation_configs']):
+            for task_folder in get_tasks_to_extract_pose([workspace]):
+                for file_name in sorted(os.listdir(os.path.join(task_folder, 'raw'))):
+                    if is_video_file(os.path.join(task_folder, 'raw', file_name)):
+                        add_task(graph, f"pose:{task_folder}:{file_name}:{i}", estimate_video_pose,
+                                 (task_folder, file_name, pose_estimation_config, config.get('rendering')),
+                                 metadata={"stage": stage, "video": os.path.join(task_folder, 'raw', file_name),
+                                           "pose_model": pose_estimation_config['pose_model']})
+    elif stage == 'calibration':
+        for subproject_folder in get_calibration_subproject_dirs(workspace):
+            add_task(graph, f"calibration:{subproject_folder}", calibrate_subproject,
+                     (subproject_folder, config['calibration_configs']),
+                     metadata={"stage": stage, "subproject": subproject_folder})
+    elif stage == 'processing':
+        graph = build_processing_graph(workspace, config)
+    else:
+        raise ValueError(f"Unknown stage {stage}, expected one of {', '.join(STAGES)}.")
+    return graph
+
+def finish_stage(workspace, config, stage):
+    """
+    Run the quick steps following a stage on the coordinator.
+
+    Args:
+        workspace (str): The workspace directory.
+        config (dict): The workspace config.
+        stage (str): One of STAGES.
+
+    Returns:
+        None
+    """
+    if stage == 'sync':
+        copy_calibration_files(workspace)
+    elif stage == 'preprocess':
+        create_sub_setups(workspace, config.get('sub_setups'))
+    elif stage == 'pose':
+        derive_subsampled_poses(workspace, config['settings'])
+
+def log_progress(queue, stage, start, total):
+    """
+    Log the progress of the items of a stage, with the estimated remaining time.
+
+    Args:
+        queue (FileQueue): The work queue.
+        stage (str): The stage being run.
+        start (float): The start time of the stage.
+        total (int): The number of items of the stage.
+
+    Returns:
+        dict: The counts of the items per sub-stage and state.
+    """
+    progress = queue.get_progress()
+    finished = sum(counts['succeeded'] + counts['failed'] for counts in progress.values())
+    elapsed = time.time() - start
+    eta = f", ETA {elapsed / finished * (total - finished):.0f} s" if finished else ""
+    logging.info(f"{stage}: {finished}/{total} items finished in {elapsed:.0f} s{eta} {progress}")
+    return progress
+
+def run_coordinator(workspace, config, queue, stages=None):
+    """
+    Run the stages one after the other: the items of a stage are put in the queue, and
+    the next stage starts once the workers finished all of them. The quick steps between
+    stages (copying the calibration files, creating the sub setups, deriving the subsampled
+    poses) run on the coordinator. The items finished are counted in the live metrics at
+    every poll, and the items of the stage not finished yet are the 'work_queue' queue.
+
+    Args:
+        workspace (str): The workspace directory.
+        config (dict): The workspace config.
+        queue (FileQueue): The work queue, reset at the start.
+        stages (list, optional): The stages to run, all by default.
+
+    Returns:
+        dict: The run summary.
+    """
+    distributed_configs = config.get('distributed', {})
+    poll_interval = distributed_configs.get('poll_interval', 5)
+    progress_interval = distributed_configs.get('progress_interval', 30)
+    queue.reset()
+    graph = {}
+    outcomes = {}
+    start = time.time()
+    unfinished = {}
+    register_gauge('work_queue', lambda: dict(unfinished))
+    for stage in stages or STAGES:
+        stage_graph = build_stage_graph(workspace, config, stage)
+        logging.info(f"{stage}: {len(stage_graph)} items queued.")
+        items = [make_item(task_id, task['func'], task['args'], task['depends_on'], task['metadata']['stage'])
+                 for task_id, task in stage_graph.items()]
+        for item in items:
+            queue.put(item)
+        add_total(stage, len(items))
+        stage_start = last_report = time.time()
+        while True:
+            stage_outcomes = {item['id']: queue.get_outcome(item) for item in items}
+            finished = [outcome for outcome in stage_outcomes.values() if outcome is not None]
+            succeeded = sum(outcome['status'] == 'succeeded' for outcome in finished)
+            set_progress(stage, succeeded, len(finished) - succeeded)
+            unfinished[stage] = len(items) - len(finished)
+            if all(outcome is not None for outcome in stage_outcomes.values()):
+                break
+            if time.time() - last_report >= progress_interval:
+                log_progress(queue, stage, stage_start, len(items))
+                last_report = time.time()
+            time.sleep(poll_interval)
+        log_progress(queue, stage, stage_start, len(items))
+        graph.update(stage_graph)
+        outcomes.update(stage_outcomes)
+        finish_stage(workspace, config, stage)
+    queue.close()
+    unregister_gauge('work_queue')
+    summary = write_run_summary(os.path.join(workspace, 'run_summary_distributed.json'), graph, outcomes,
+                                extra={"workspace": os.path.abspath(workspace),
+                                       "duration": round(time.time() - start, 3)})
+    logging.info(f"Distributed run summary: {summary['counts']}")
+    return summary
+
+@contextlib.contextmanager
+def keep_lease(queue, item, lease_timeout):
+    """
+    Context manager renewing the lease of an item in a background thread while it runs.
+
+    Args:
+        queue (FileQueue): The work queue.
+        item (dict): The claimed item.
+        lease_timeout (float): The lease timeout; the lease is renewed three times per timeout.
+
+    Yields:
+        None
+    """
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(lease_timeout / 3):
+            queue.renew_lease(item['key'])
+
+    thread = threading.Thread(target=renew, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+def get_worker_id():
+    """
+    Get an id identifying the worker across the nodes.
+
+    Returns:
+        str: The host name and process id.
+    """
+    return f"{socket.gethostname()}_{os.getpid()}_{threading.get_ident()}"
+
+def run_worker(queue, config, worker_id=None):
+    """
+    Claim and run items until the coordinator closes the queue. The closed file of a run
+    the worker did not see open is ignored: a worker started before the coordinator reset
+    the queue waits for the new run, up to lease_timeout seconds.
+
+    Args:
+        queue (FileQueue): The work queue.
+        config (dict): The workspace config ('distributed' section: 'poll_interval' and 'lease_timeout').
+        worker_id (str, optional): The id of the worker.
+
+    Returns:
+        dict: The number of items that succeeded and failed on this worker.
+    """
+    distributed_configs = config.get('distributed', {})
+    poll_interval = distributed_configs.get('poll_interval', 5)
+    worker_id = worker_id or get_worker_id()
+    counts = {"succeeded": 0, "failed": 0}
+    logging.info(f"Worker {worker_id} started.")
+    start = time.time()
+    # The runs seen open or worked for by this worker
+    runs = set()
+    while True:
+        # Closed file first: reset writes the new run id before removing it
+        closed_run = queue.get_closed_run()
+        run_id = queue.get_run_id() or ''
+        if closed_run != run_id:
+            runs.add(run_id)
+        claimed = queue.claim(worker_id)
+        if claimed is None:
+            if closed_run is not None and closed_run in runs:
+                break
+            if not runs and time.time() - start > queue.lease_timeout:
+                logging.warning(f"Worker {worker_id} found no open run in {queue.lease_timeout} s.")
+                break
+            time.sleep(poll_interval)
+            continue
+        runs.add(run_id)
+        item, dependencies = claimed
+        logging.info(f"Worker {worker_id} runs {item['id']}")
+        with keep_lease(queue, item, queue.lease_timeout):
+            outcome = execute_task(load_function(item['func']), item['args'], dependencies, item['id'])
+        outcome['worker'] = worker_id
+        queue.finish(item, outcome)
+        counts['succeeded' if outcome['status'] == 'succeeded' else 'failed'] += 1
+        if outcome['status'] != 'succeeded':
+            logging.error(f"{item['id']} failed on {worker_id}: {outcome['error']}")
+    logging.info(f"Worker {worker_id} stopped: {counts}")
+    return counts
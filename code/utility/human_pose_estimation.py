@@ -3,24 +3,42 @@ Module description: This module contains a set of utility functions for extracti
 human pose from videos.
 """
 
+import logging
+import logging.handlers
 import os
-from Pose2Sim.Utilities.Blazepose_runsave import blazepose_detec_func
-from utility.utils import find_video_files, is_video_file
+import re
+import glob
+import shutil
+import numpy as np
+from utility.utils import (find_video_files, is_video_file, log_context, get_partial_path, remove_output,
+                           atomic_output)
+from utility.journal import is_pending, mark_completed
+from utility.profiling import profiled, add_frames
+from utility.metrics import add_total
+from utility.rendering import RenderSink, render_video
+from utility.preprocess import get_fps, get_setting_folder_name
+from utility.quality import build_quality_index
+from utility.sub_setups import is_selected_sub_setup
 
-def extract_pose_from_videos(workspace, settings):
+def extract_pose_from_videos(workspace, settings, rendering_configs=None):
     """
-    Extracts pose from videos using the provided workspace and settings.
+    Extracts pose from videos using the provided workspace and settings. The annotated
+    images and videos are rendered on a background sink while the next videos are processed.
 
     Args:
         workspace: The workspace where the videos are located.
         settings: The settings for the pose extraction.
+        rendering_configs (dict, optional): The 'rendering' section of the config.
 
     Returns:
         None
     """
     task_folders = get_tasks_to_extract_pose([workspace])
-    for task_folder in task_folders:
-        my_human_pose_estimation(task_folder, settings)
+    add_total('estimate_video_pose', sum(len(os.listdir(os.path.join(task_folder, "raw")))
+                                         for task_folder in task_folders))
+    with RenderSink(rendering_configs) as render_sink:
+        for task_folder in task_folders:
+            my_human_pose_estimation(task_folder, settings, rendering_configs, render_sink)
 
 def get_tasks_to_extract_pose(list_of_folders):
     """
@@ -33,7 +51,8 @@ def get_tasks_to_extract_pose(list_of_folders):
         '__synced__' in file and
         not (f'{os.sep}Calibration{os.sep}' in file or 
              f'{os.sep}pose{os.sep}' in file or 
-             f'{os.sep}unset_unset_unset_unset{os.sep}' in file)
+             f'{os.sep}unset_unset_unset_unset{os.sep}' in file) and
+        is_selected_sub_setup(file)
     ]
 
     folders = set()
@@ -50,13 +69,15 @@ def get_tasks_to_extract_pose(list_of_folders):
     sorted_folders = sorted(list(folders))
     return sorted_folders
 
-def my_human_pose_estimation(task_folder, settings):
+def my_human_pose_estimation(task_folder, settings, rendering_configs=None, render_sink=None):
     """
     Performs human pose estimation based on the specified task folder and settings.
 
     Args:
         task_folder (str): The folder containing the task.
         settings (dict): The settings for the pose estimation.
+        rendering_configs (dict, optional): The 'rendering' section of the config.
+        render_sink (RenderSink, optional): The sink rendering the annotated outputs.
 
     Raises:
         Exception: If the specified model has not been integrated.
@@ -64,21 +85,199 @@ def my_human_pose_estimation(task_folder, settings):
     Returns:
         None
     """
-    output_folder = os.path.join(task_folder, "pose")
     for file_name in os.listdir(os.path.join(task_folder, "raw")):
-        file_path = os.path.join(task_folder, "raw", file_name)
-        if is_video_file(file_path):
-            if settings['pose_framework'] == 'mediapipe' and settings['pose_model'] == 'BLAZEPOSE':
-                json_output_folder = os.path.join(output_folder, 
-                                                  f"blaze_{os.path.splitext(file_name)[0]}_json")
-                if not os.path.exists(json_output_folder):
-                    args = {
-                        'input_file': file_path,
-                        'to_csv': settings['to_csv'], 'to_h5': settings['to_h5'], 'to_json': True,
-                        'display': settings['display'], 'save_images': settings['save_images'],
-                        'save_video': settings['save_video'],
-                        'model_complexity': f'{settings["model_complexity"]}',  # can be 0 (fast), 1, 2 (slow)
-                        'output_folder': output_folder}
-                    blazepose_detec_func(**args)
-            else:
-                raise ValueError("The specified model has not been integrated, yet.")
+        estimate_video_pose(task_folder, file_name, settings, rendering_configs, render_sink)
+
+@profiled()
+def estimate_video_pose(task_folder, file_name, settings, rendering_configs=None, render_sink=None):
+    """
+    Performs human pose estimation on one video of a task folder, and indexes the quality
+    of its keypoints (see utility.quality). The annotated images
+    and video (save_images, save_video) are rendered from the keypoints once the inference
+    is done: on the render sink if given, here otherwise, or not at all if the rendering
+    mode is 'later' (see render_preview.py).
+
+    Args:
+        task_folder (str): The folder containing the task.
+        file_name (str): The name of the video in the raw folder of the task.
+        settings (dict): The settings for the pose estimation.
+        rendering_configs (dict, optional): The 'rendering' section of the config.
+        render_sink (RenderSink, optional): The sink rendering the annotated outputs.
+
+    Raises:
+        Exception: If the specified model has not been integrated.
+
+    Returns:
+        None
+    """
+    output_folder = os.path.join(task_folder, "pose")
+    file_path = os.path.join(task_folder, "raw", file_name)
+    if is_video_file(file_path):
+        if settings['pose_framework'] == 'mediapipe' and settings['pose_model'] == 'BLAZEPOSE':
+            json_output_folder = os.path.join(output_folder, 
+                                              f"blaze_{os.path.splitext(file_name)[0]}_json")
+            if is_pending('pose', json_output_folder, os.path.exists(json_output_folder)):
+                # The pose is estimated in a partial folder, moved to the pose folder once complete
+                partial_folder = get_partial_path(os.path.join(output_folder, os.path.splitext(file_name)[0]))
+                remove_output(partial_folder)
+                os.makedirs(partial_folder)
+                try:
+                    run_blazepose(file_path, settings, partial_folder, task_folder)
+                    # The JSON folder, checked by the next runs, is moved last
+                    for output_name in sorted(os.listdir(partial_folder), key=lambda name: name.endswith('_json')):
+                        output_path = os.path.join(output_folder, output_name)
+                        remove_output(output_path)
+                        os.replace(os.path.join(partial_folder, output_name), output_path)
+                finally:
+                    remove_output(partial_folder)
+                add_frames(len(os.listdir(json_output_folder)))
+                mark_completed('pose', json_output_folder, frames=len(os.listdir(json_output_folder)))
+                build_quality_index(json_output_folder)
+                render_pose_outputs(file_path, json_output_folder, output_folder, settings, rendering_configs,
+                                    render_sink)
+        else:
+            raise ValueError("The specified model has not been integrated, yet.")
+
+def render_pose_outputs(file_path, json_folder, output_folder, settings, rendering_configs=None, render_sink=None):
+    """
+    Render the annotated images and video of a video from its keypoints, if enabled.
+
+    Args:
+        file_path (str): The path to the video.
+        json_folder (str): The folder of its keypoints.
+        output_folder (str): The pose folder.
+        settings (dict): The settings for the pose estimation ('save_images', 'save_video').
+        rendering_configs (dict, optional): The 'rendering' section of the config.
+        render_sink (RenderSink, optional): The sink rendering the annotated outputs.
+
+    Returns:
+        None
+    """
+    rendering_configs = rendering_configs or {}
+    if not (settings['save_images'] or settings['save_video']) or rendering_configs.get('mode') == 'later':
+        return
+    if render_sink is not None:
+        render_sink.submit(file_path, json_folder, output_folder, settings['save_images'], settings['save_video'])
+    else:
+        render_video(file_path, json_folder, output_folder, settings['save_images'], settings['save_video'],
+                     rendering_configs)
+
+def run_blazepose(file_path, settings, output_folder, task_folder):
+    """
+    Run BlazePose on a video. Only the keypoints are written, the annotated outputs are
+    rendered from them (see render_pose_outputs).
+
+    Args:
+        file_path (str): The path to the video.
+        settings (dict): The settings for the pose estimation.
+        output_folder (str): The folder the outputs are written to.
+        task_folder (str): The folder containing the task.
+
+    Returns:
+        None
+    """
+    args = {
+        'input_file': file_path,
+        'to_csv': settings['to_csv'], 'to_h5': settings['to_h5'], 'to_json': True,
+        'display': settings['display'], 'save_images': False, 'save_video': False,
+        'model_complexity': f'{settings["model_complexity"]}',  # can be 0 (fast), 1, 2 (slow)
+        'output_folder': output_folder}
+    # Deferred, mediapipe is slow to import
+    from Pose2Sim.Utilities.Blazepose_runsave import blazepose_detec_func
+    with log_context(trial=task_folder, camera=os.path.splitext(os.path.basename(file_path))[0]):
+        blazepose_detec_func(**args)
+
+def get_pose_source_setting(setting, settings):
+    """
+    Get the setting whose poses a subsampled setting is derived from: a setting with the
+    same resolution and format that is not subsampled itself, at the native frame rate if
+    there is one, at the highest frame rate otherwise.
+
+    Args:
+        setting (dict): The subsampled setting.
+        settings (list): The settings of the config.
+
+    Returns:
+        dict: The source setting.
+    """
+    candidates = [other for other in settings if
+                  not other.get('subsample_pose') and other['resolution'] == setting['resolution'] and
+                  other['format'] == setting['format'] and setting['fps'] is not None and
+                  (other['fps'] is None or other['fps'] >= setting['fps'])]
+    if not candidates:
+        raise ValueError(f"No setting to subsample the poses of {setting} from: a setting with the same "
+                         f"resolution and format and a higher fps is needed.")
+    return max(candidates, key=lambda other: np.inf if other['fps'] is None else other['fps'])
+
+def subsample_keypoints(source_folder, output_folder, source_fps, target_fps):
+    """
+    Derive the keypoints of a lower frame rate from those of a video: frame i of the
+    target rate takes the source frame shown at time i / target_fps, as the frame rate
+    conversion of the preprocessing does.
+
+    Args:
+        source_folder (str): The source JSON folder (pose/blaze_<cam>_json).
+        output_folder (str): The derived JSON folder.
+        source_fps (float): The frame rate of the source video.
+        target_fps (float): The derived frame rate.
+
+    Returns:
+        int: The number of frames derived.
+    """
+    file_names = sorted(file_name for file_name in os.listdir(source_folder) if file_name.endswith('.json'))
+    n_frames = int(np.ceil(len(file_names) * target_fps / source_fps - 1e-6))
+    source_frames = np.minimum(np.floor(np.arange(n_frames) * source_fps / target_fps + 1e-5).astype(int),
+                               len(file_names) - 1)
+    with atomic_output(output_folder) as partial_folder:
+        os.makedirs(partial_folder)
+        for frame, source_frame in enumerate(source_frames):
+            # The frame number of the file name is the derived one, with the same width
+            file_name = re.sub(r'\d+(?=\.json$)', lambda match: f"{frame:0{len(match.group())}d}",
+                               file_names[source_frame])
+            shutil.copyfile(os.path.join(source_folder, file_names[source_frame]),
+                            os.path.join(partial_folder, file_name))
+    return n_frames
+
+def derive_subsampled_poses(workspace, settings):
+    """
+    Derive the poses of the subsampled settings ('subsample_pose') from those of their
+    source setting, in every sub setup, instead of transcoding the videos and running the
+    pose estimation again.
+
+    Args:
+        workspace (str): The workspace directory.
+        settings (list): The settings of the config.
+
+    Returns:
+        int: The number of JSON folders derived.
+    """
+    derived = 0
+    for setting in settings:
+        if not setting.get('subsample_pose'):
+            continue
+        source_setting = get_pose_source_setting(setting, settings)
+        source_name = get_setting_folder_name(source_setting['fps'], source_setting['resolution'],
+                                              source_setting['format'])
+        target_name = get_setting_folder_name(setting['fps'], setting['resolution'], setting['format'])
+        pattern = os.path.join(glob.escape(workspace), '*', '__synced__', '*', source_name, '*', '*', 'pose',
+                               'blaze_*_json')
+        for source_folder in sorted(filter(is_selected_sub_setup, glob.glob(pattern))):
+            output_folder = source_folder.replace(f"{os.sep}{source_name}{os.sep}", f"{os.sep}{target_name}{os.sep}")
+            if not is_pending('pose', output_folder, os.path.exists(output_folder)):
+                continue
+            source_fps = source_setting['fps']
+            if source_fps is None:
+                camera = os.path.basename(source_folder)[len('blaze_'):-len('_json')]
+                raw_folder = os.path.join(os.path.dirname(os.path.dirname(source_folder)), 'raw')
+                video_files = [file for file in glob.glob(os.path.join(glob.escape(raw_folder), f"{glob.escape(camera)}.*"))
+                               if is_video_file(file)]
+                if not video_files:
+                    logging.warning(f"No video to read the frame rate of {source_folder} from, skipping it.")
+                    continue
+                source_fps = get_fps(video_files[0])
+            n_frames = subsample_keypoints(source_folder, output_folder, source_fps, setting['fps'])
+            mark_completed('pose', output_folder, frames=n_frames, source=source_folder)
+            build_quality_index(output_folder)
+            derived += 1
+        logging.info(f"Derived the poses of {target_name} from {source_name}.")
+    return derived
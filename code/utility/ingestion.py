@@ -0,0 +1,394 @@
+"""
+Module description: This module contains the main functionality of the live ingestion:
+several sources (cameras or RTSP streams, or files replayed at real-time rate in their
+place) are read by one thread each, every frame is timestamped, the sources are aligned
+online on their audio spike (read with the video through one PyAV demuxer, so that both
+share the timestamps of the source) or on their capture timestamps, and the synced videos
+are written directly to the __synced__ layout, without the offline trimming and re-encoding.
+"""
+
+import logging
+import logging.handlers
+import os
+import time
+import queue
+import threading
+import contextlib
+import collections
+import importlib.util
+import numpy as np
+from utility.utils import atomic_output, log_context
+from utility.journal import mark_completed
+from utility.profiling import profile_stage, add_frames
+
+class OnlineSpikeDetector(object):
+    """
+    Detect the first audio spike (e.g. a clap) of a stream fed chunk by chunk. The energy
+    of short windows is compared to the background energy measured at the start of the
+    stream, so the clap must come after the warm-up.
+
+    Attributes:
+        fps (float): The audio sample rate.
+        start_time (float): The time of the first sample in seconds.
+        spike_time (float or None): The time of the spike in seconds, once found.
+    """
+    def __init__(self, fps, warmup=0.5, spike_factor=10, window=0.01):
+        self.fps = fps
+        self.start_time = 0.0
+        self.window_size = max(1, int(window * fps))
+        self.warmup_windows = max(2, int(warmup / window))
+        self.spike_factor = spike_factor
+        self.background = []
+        self.pending = np.empty(0)
+        self.samples = 0
+        self.spike_time = None
+
+    def update(self, audio_frames):
+        """
+        Feed audio samples.
+
+        Args:
+            audio_frames (numpy.ndarray): The audio samples, one row per sample and one column per channel.
+
+        Returns:
+            float or None: The time of the spike in seconds, None until it is found.
+        """
+        if self.spike_time is not None:
+            return self.spike_time
+        self.pending = np.concatenate([self.pending, (audio_frames ** 2).sum(axis=1)])
+        n_windows = len(self.pending) // self.window_size
+        for i in range(n_windows):
+            window = self.pending[i * self.window_size:(i + 1) * self.window_size]
+            if len(self.background) < self.warmup_windows:
+                self.background.append(window.sum())
+                continue
+            if window.sum() > np.mean(self.background) + self.spike_factor * np.std(self.background, ddof=1):
+                # The spike starts at the first loud sample of the window
+                first = int(np.flatnonzero(window > window.mean())[0])
+                self.spike_time = self.start_time + (self.samples + i * self.window_size + first) / self.fps
+                return self.spike_time
+        self.samples += n_windows * self.window_size
+        self.pending = self.pending[n_windows * self.window_size:]
+        return None
+
+class LiveSource(object):
+    """
+    A live source read by a thread putting (source time, capture time, frame) items in a
+    bounded queue, then None. For the audio alignment, the thread reads the audio and the
+    video through one PyAV demuxer, so that the audio spike and the frames share the
+    timestamps of the source (a second reader of the device would start at another time,
+    and many devices cannot be opened twice). Otherwise the video is read through OpenCV.
+
+    Attributes:
+        name (str): The camera name, used as the name of the synced video.
+        url (str): The device, RTSP URL or file of the source.
+        replay (bool): Whether the source is a file replayed at real-time rate.
+        frames (queue.Queue): The queue of the frames.
+        fps (float or None): The frame rate, once the source is opened.
+        dropped (int): The number of frames dropped because the queue was full.
+        detector (OnlineSpikeDetector or None): The audio spike detector.
+        audio_ended (bool): Whether the audio is no longer read.
+    """
+    def __init__(self, name, url, replay=False, queue_size=64):
+        self.name = name
+        self.url = url
+        self.replay = replay
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.fps = None
+        self.dropped = 0
+        self.detector = None
+        self.audio_ended = False
+        self.threads = []
+
+    def start(self, stop_event, ingestion_configs):
+        """
+        Start the reader thread.
+
+        Args:
+            stop_event (threading.Event): Set to stop reading.
+            ingestion_configs (dict): The 'ingestion' section of the config.
+
+        Returns:
+            None
+
+        Raises:
+            ImportError: If the audio alignment is set and PyAV is not installed.
+        """
+        if ingestion_configs.get('alignment', 'audio') == 'audio':
+            if importlib.util.find_spec('av') is None:
+                raise ImportError("The audio alignment of live sources needs PyAV (pip install av), "
+                                  "use the timestamp alignment otherwise.")
+            sample_rate = ingestion_configs.get('audio_sample_rate', 16000)
+            self.detector = OnlineSpikeDetector(sample_rate, ingestion_configs.get('warmup', 0.5),
+                                                ingestion_configs.get('spike_factor', 10))
+            self.threads = [threading.Thread(target=self.read_av, args=(stop_event, ingestion_configs.get('spike_timeout', 30)),
+                                             daemon=True)]
+        else:
+            self.threads = [threading.Thread(target=self.read_video, args=(stop_event,), daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def put_frame(self, stop_event, item):
+        """
+        Queue a (source time, capture time, frame) item: the frames of live sources are
+        dropped if the queue is full, those of replayed files wait for room.
+        """
+        if not self.replay:
+            try:
+                self.frames.put_nowait(item)
+            except queue.Full:
+                self.dropped += 1
+            return
+        while not stop_event.is_set():
+            try:
+                self.frames.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def read_video(self, stop_event):
+        """
+        Read and timestamp the frames until the source ends or stop_event is set. Files are
+        paced at their frame rate; frames of live sources are dropped if the queue is full.
+        """
+        import cv2  # deferred, cv2 is slow to import
+
+        capture = cv2.VideoCapture(self.url)
+        try:
+            with log_context(camera=self.name):
+                if not capture.isOpened():
+                    raise IOError(f"Cannot open {self.url}")
+                self.fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+                start = time.time()
+                frame_index = 0
+                while not stop_event.is_set():
+                    success, frame = capture.read()
+                    if not success:
+                        break
+                    # Live streams do not always carry timestamps
+                    source_time = capture.get(cv2.CAP_PROP_POS_MSEC) / 1000
+                    if source_time <= 0 and frame_index > 0:
+                        source_time = frame_index / self.fps
+                    frame_index += 1
+                    if self.replay:
+                        time.sleep(max(0.0, start + source_time - time.time()))
+                    self.put_frame(stop_event, (source_time, time.time(), frame))
+        except Exception as e:
+            logging.error(f"Reading {self.url} failed: {e}")
+        finally:
+            capture.release()
+            self.frames.put(None)
+
+    def read_av(self, stop_event, spike_timeout):
+        """
+        Read the video and the audio of the source through one PyAV demuxer until the
+        source ends or stop_event is set, timestamping the frames as read_video does and
+        feeding the audio to the spike detector until the spike is found or spike_timeout
+        seconds of audio were read. Both use the timestamps of the source.
+        """
+        import av  # deferred, av is slow to import
+
+        try:
+            with log_context(camera=self.name), av.open(self.url) as container:
+                video_stream = container.streams.video[0]
+                audio_stream = container.streams.audio[0] if container.streams.audio else None
+                if audio_stream is None:
+                    logging.error(f"{self.url} has no audio track.")
+                    self.audio_ended = True
+                self.fps = float(video_stream.average_rate or 30.0)
+                resampler = av.AudioResampler(format='flt', layout='mono', rate=int(self.detector.fps))
+                start = time.time()
+                frame_index = 0
+                read_samples = 0
+                streams = [video_stream] + ([audio_stream] if audio_stream is not None else [])
+                for packet in container.demux(*streams):
+                    if stop_event.is_set():
+                        break
+                    if packet.stream.type == 'audio':
+                        if self.audio_ended:
+                            continue
+                        for frame in packet.decode():
+                            if read_samples == 0 and frame.time is not None:
+                                self.detector.start_time = frame.time
+                            for resampled in resampler.resample(frame):
+                                samples = resampled.to_ndarray().reshape(-1, 1)
+                                read_samples += len(samples)
+                                if self.detector.update(samples) is not None:
+                                    logging.info(f"Audio spike of {self.name} at {self.detector.spike_time:.3f} s")
+                                    self.audio_ended = True
+                                    break
+                        if read_samples >= spike_timeout * self.detector.fps:
+                            self.audio_ended = True
+                        continue
+                    for frame in packet.decode():
+                        source_time = frame.time if frame.time is not None else frame_index / self.fps
+                        frame_index += 1
+                        if self.replay:
+                            time.sleep(max(0.0, start + source_time - time.time()))
+                        self.put_frame(stop_event, (source_time, time.time(), frame.to_ndarray(format='bgr24')))
+        except Exception as e:
+            logging.error(f"Reading {self.url} failed: {e}")
+        finally:
+            self.audio_ended = True
+            self.frames.put(None)
+
+    def join(self):
+        """
+        Stop waiting on the queue and join the reader threads (stop_event must be set).
+        """
+        for thread in self.threads:
+            while thread.is_alive():
+                # Unblock the reader waiting for room in the queue
+                with contextlib.suppress(queue.Empty):
+                    self.frames.get_nowait()
+                thread.join(timeout=0.1)
+
+def get_synced_trial_folder(workspace, session, sub_setup, participant, trial):
+    """
+    Get the folder of a trial in the __synced__ layout, at the original setting.
+
+    Returns:
+        str: The trial folder (its videos go to raw/).
+    """
+    return os.path.join(workspace, session, '__synced__', sub_setup, 'unset_unset_unset_unset', participant, trial)
+
+def get_offsets(sources, pending, alignment):
+    """
+    Get the offsets aligning the sources, once they can be known.
+
+    Args:
+        sources (list): The sources.
+        pending (list): The frames received from each source.
+        alignment (str): 'audio' (the sources start at their audio spike) or 'timestamp'
+            (the sources start when the last one delivered its first frame).
+
+    Returns:
+        list or None: For each source, the offset subtracted from the time of its frames
+            (source time for 'audio', capture time for 'timestamp'), None if not known yet.
+    """
+    if alignment == 'audio':
+        for source in sources:
+            if source.detector.spike_time is None and source.audio_ended:
+                raise RuntimeError(f"No audio spike found in {source.url}, use the timestamp alignment.")
+        if any(source.detector.spike_time is None for source in sources):
+            return None
+        return [source.detector.spike_time for source in sources]
+    if alignment == 'timestamp':
+        if any(not frames for frames in pending):
+            return None
+        common_start = max(frames[0][1] for frames in pending)
+        return [common_start] * len(sources)
+    raise ValueError(f"Unknown alignment {alignment}, expected 'audio' or 'timestamp'.")
+
+def ingest_trial(sources, trial_folder, ingestion_configs):
+    """
+    Ingest the live sources of a trial: the frames of each source are aligned online and
+    written in synced time order to raw/<name>.mp4 in the trial folder, so the videos start
+    together and end at the same time (within a frame) when a source ends, after
+    'max_duration' seconds or on Ctrl-C.
+
+    Args:
+        sources (dict): The device, RTSP URL or file of each camera name.
+        trial_folder (str): The trial folder in the __synced__ layout (see get_synced_trial_folder).
+        ingestion_configs (dict): The 'ingestion' section of the config ('replay', 'alignment',
+            'max_duration', 'queue_size', 'buffer', 'warmup', 'spike_factor', 'spike_timeout', 'fourcc').
+
+    Returns:
+        dict: The output files, the offsets, and the frames written and dropped per source.
+    """
+    import cv2  # deferred, cv2 is slow to import
+
+    alignment = ingestion_configs.get('alignment', 'audio')
+    max_duration = ingestion_configs.get('max_duration')
+    buffer_duration = ingestion_configs.get('buffer', 2)
+    fourcc = cv2.VideoWriter_fourcc(*ingestion_configs.get('fourcc', 'mp4v'))
+    live_sources = [LiveSource(name, url, ingestion_configs.get('replay', False), ingestion_configs.get('queue_size', 64))
+                    for name, url in sorted(sources.items())]
+    output_files = [os.path.join(trial_folder, 'raw', f"{source.name}.mp4") for source in live_sources]
+    os.makedirs(os.path.join(trial_folder, 'raw'), exist_ok=True)
+    pending = [collections.deque() for _ in live_sources]
+    ended = [False] * len(live_sources)
+    written = [0] * len(live_sources)
+    writers = [None] * len(live_sources)
+    offsets = None
+    stop_event = threading.Event()
+    # Index of the time used for the alignment in the (source time, capture time, frame) items
+    time_index = 0 if alignment == 'audio' else 1
+
+    with profile_stage('ingestion', trial_folder), contextlib.ExitStack() as outputs:
+        partial_files = [outputs.enter_context(atomic_output(output_file)) for output_file in output_files]
+        for source in live_sources:
+            source.start(stop_event, ingestion_configs)
+        logging.info(f"Ingesting {', '.join(source.url for source in live_sources)} to {trial_folder}")
+        try:
+            stopped = False
+            while not stopped:
+                received = False
+                for c, source in enumerate(live_sources):
+                    while not ended[c]:
+                        try:
+                            item = source.frames.get_nowait()
+                        except queue.Empty:
+                            break
+                        received = True
+                        if item is None:
+                            ended[c] = True
+                        else:
+                            pending[c].append(item)
+                if offsets is None:
+                    offsets = get_offsets(live_sources, pending, alignment)
+                    if offsets is None:
+                        if any(ended[c] and not pending[c] for c in range(len(live_sources))):
+                            raise RuntimeError("A source ended before the sources could be aligned.")
+                        # Keep the last few seconds only while waiting for the alignment
+                        for frames in pending:
+                            while frames and frames[-1][1] - frames[0][1] > buffer_duration:
+                                frames.popleft()
+                        if not received:
+                            time.sleep(0.005)
+                        continue
+                    logging.info(f"Sources aligned with the offsets {offsets}")
+                # The audio may run ahead of the video, so frames before the offset can still come
+                for c, frames in enumerate(pending):
+                    while not written[c] and frames and frames[0][time_index] - offsets[c] < -1e-3:
+                        frames.popleft()
+                # Write the frames in synced time order while every source has one
+                while all(pending):
+                    synced_times = [frames[0][time_index] - offsets[c] for c, frames in enumerate(pending)]
+                    c = int(np.argmin(synced_times))
+                    if max_duration is not None and synced_times[c] >= max_duration:
+                        stopped = True
+                        break
+                    frame = pending[c].popleft()[2]
+                    if writers[c] is None:
+                        writers[c] = cv2.VideoWriter(partial_files[c], fourcc, live_sources[c].fps,
+                                                     (frame.shape[1], frame.shape[0]))
+                    writers[c].write(frame)
+                    written[c] += 1
+                # A source that ended sets the common end
+                if any(ended[c] and not pending[c] for c in range(len(live_sources))):
+                    stopped = True
+                elif not received:
+                    time.sleep(0.005)
+        except KeyboardInterrupt:
+            logging.info("Ingestion stopped by the user.")
+        finally:
+            stop_event.set()
+            for source in live_sources:
+                source.join()
+            for writer in writers:
+                if writer is not None:
+                    writer.release()
+        if not all(written):
+            raise RuntimeError(f"No synced frames were written for some of the sources of {trial_folder}.")
+        add_frames(sum(written))
+
+    duration = min(count / source.fps for count, source in zip(written, live_sources))
+    for source in live_sources:
+        if source.dropped:
+            logging.warning(f"{source.dropped} frames of {source.name} were dropped, the writer did not keep up.")
+    mark_completed('ingestion', trial_folder, duration=duration)
+    logging.info(f"Ingested {duration:.2f} s of {len(live_sources)} sources to {trial_folder}")
+    return {"output_files": output_files, "offsets": offsets, "duration": duration,
+            "frames": {source.name: count for source, count in zip(live_sources, written)},
+            "dropped": {source.name: source.dropped for source in live_sources}}
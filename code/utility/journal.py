@@ -0,0 +1,162 @@
+"""
+Module description: This module contains a set of utility functions for keeping an
+append-only journal of the completed work items of the workspace, so that an interrupted
+run can be resumed (--resume) skipping exactly the finished items.
+"""
+
+import logging
+import logging.handlers
+import os
+import json
+import time
+
+# Environment variables, so that the worker processes write to the same journal
+JOURNAL_FILE_VARIABLE = 'MBA_JOURNAL_FILE'
+RESUME_VARIABLE = 'MBA_RESUME'
+
+# Completed items of the journal, read once per process
+_COMPLETED = {}
+
+def start_journal(workspace, task, resume=False):
+    """
+    Start journaling the completed work items of a script invocation.
+
+    Args:
+        workspace (str): The workspace directory.
+        task (str): The task name (e.g. 'preprocessing').
+        resume (bool): Whether the finished items of earlier runs are skipped. Otherwise,
+            the stages decide from their outputs as before.
+
+    Returns:
+        str: The path of the journal.
+    """
+    journal_file = os.path.abspath(os.path.join(workspace, 'journal.jsonl'))
+    os.environ[JOURNAL_FILE_VARIABLE] = journal_file
+    os.environ[RESUME_VARIABLE] = '1' if resume else ''
+    _COMPLETED.pop(journal_file, None)
+    if resume:
+        logging.info(f"Resuming {task}: {len(get_completed_items(journal_file))} items already completed.")
+    return journal_file
+
+def read_journal(journal_file):
+    """
+    Read the entries of a journal. A line cut by a crash is ignored.
+
+    Args:
+        journal_file (str): The path of the journal.
+
+    Returns:
+        list: The journal entries.
+    """
+    entries = []
+    if not os.path.exists(journal_file):
+        return entries
+    with open(journal_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                logging.warning(f"Ignoring an incomplete line of {journal_file}.")
+    return entries
+
+def get_completed_items(journal_file):
+    """
+    Get the (stage, item) pairs completed according to a journal.
+
+    Args:
+        journal_file (str): The path of the journal.
+
+    Returns:
+        set: The completed (stage, item) pairs.
+    """
+    if journal_file not in _COMPLETED:
+        _COMPLETED[journal_file] = {(entry['stage'], entry['item']) for entry in read_journal(journal_file)}
+    return _COMPLETED[journal_file]
+
+def get_item_key(journal_file, item):
+    """
+    Get the key of an item in a journal: paths are stored relative to the workspace,
+    so that the workspace can be moved.
+
+    Args:
+        journal_file (str): The path of the journal.
+        item (str): The item, usually the path of its output.
+
+    Returns:
+        str: The key of the item.
+    """
+    if os.path.isabs(item):
+        return os.path.relpath(item, os.path.dirname(journal_file))
+    return item
+
+def is_completed(stage, item):
+    """
+    Check if a work item is recorded as completed in the journal of the current run.
+
+    Args:
+        stage (str): The name of the stage.
+        item (str): The item.
+
+    Returns:
+        bool: True if the item is completed.
+    """
+    journal_file = os.environ.get(JOURNAL_FILE_VARIABLE)
+    if not journal_file:
+        return False
+    return (stage, get_item_key(journal_file, item)) in get_completed_items(journal_file)
+
+def is_pending(stage, item, output_exists):
+    """
+    Check if a work item has to be (re)done. When resuming, the items recorded in the
+    journal are done. The others are done too if their outputs exist: the outputs are only
+    renamed to their final paths once complete (see utility.utils.atomic_output), so these
+    items were finished by a run without the journal (or interrupted before recording
+    them), and they are recorded now. Otherwise, the existence of the outputs decides.
+
+    Args:
+        stage (str): The name of the stage.
+        item (str): The item.
+        output_exists (bool): Whether the outputs of the item exist.
+
+    Returns:
+        bool: True if the item has to be done.
+    """
+    if os.environ.get(RESUME_VARIABLE):
+        if is_completed(stage, item):
+            return False
+        if output_exists:
+            mark_completed(stage, item, backfilled=True)
+        return not output_exists
+    return not output_exists
+
+def mark_completed(stage, item, **details):
+    """
+    Append a completed work item to the journal of the current run, if any. The line is
+    flushed to disk before returning, and single small appends are atomic, so worker
+    processes can share the journal.
+
+    Args:
+        stage (str): The name of the stage.
+        item (str): The item.
+        **details: Extra information recorded with the item.
+
+    Returns:
+        None
+    """
+    journal_file = os.environ.get(JOURNAL_FILE_VARIABLE)
+    if not journal_file:
+        return
+    key = get_item_key(journal_file, item)
+    entry = {"time": time.strftime('%Y-%m-%dT%H:%M:%S'), "pid": os.getpid(), "stage": stage, "item": key, **details}
+    line = json.dumps(entry) + '\n'
+    # A line cut by a crash is terminated, so that this entry is not appended to it
+    if os.path.exists(journal_file) and os.path.getsize(journal_file):
+        with open(journal_file, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                line = '\n' + line
+    with open(journal_file, 'a', encoding='utf-8') as f:
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+    get_completed_items(journal_file).add((stage, key))
@@ -0,0 +1,282 @@
+"""
+Module description: This module contains a set of utility functions for computing
+the OpenSim kinematics (scaling and inverse kinematics) of the filtered 3D results.
+"""
+
+import logging
+import logging.handlers
+import os
+import glob
+import csv
+import json
+import time
+import hashlib
+from utility.opensim_setup import SCALING_FIELDS, IK_FIELDS, load_opensim_tool
+from utility.motion_files import load_motion_file, get_times
+from utility.utils import atomic_output
+
+# Pose model -> (model name, setup name) of the files shipped in data/opensim_setup
+OPENSIM_SETUP_NAMES = {
+    'BLAZEPOSE': ('BlazePose', 'Blazepose'),
+    'BODY_25': ('Body25', 'Body25'),
+    'BODY_25B': ('Body25b', 'Body25b'),
+    'BODY_135': ('Body135', 'Body135'),
+    'COCO_18': ('Coco18', 'Coco18'),
+    'COCO_133': ('Coco133', 'Coco133'),
+    'HALPE_26': ('Halpe26', 'Halpe26'),
+    'HALPE_68': ('Halpe68_136', 'Halpe68_136'),
+    'HALPE_136': ('Halpe68_136', 'Halpe68_136'),
+}
+
+# Per-process cache of the parsed OpenSim models. Each worker of the pool fills it on
+# its first trial and copies them for all the following ones.
+_OPENSIM_CACHE = {}
+
+def import_opensim():
+    """
+    Import the OpenSim Python bindings.
+
+    Returns:
+        module: The opensim module.
+
+    Raises:
+        ImportError: If the OpenSim bindings are not installed.
+    """
+    try:
+        import opensim
+    except ImportError as e:
+        raise ImportError("The kinematics stage needs the OpenSim Python bindings "
+                          "(conda install -c opensim-org opensim).") from e
+    return opensim
+
+def get_opensim_setup_files(opensim_setup_dir, pose_model):
+    """
+    Get the generic model, scaling setup and IK setup files for a pose model.
+
+    Args:
+        opensim_setup_dir (str): The folder containing the OpenSim models and setup files.
+        pose_model (str): The pose model, e.g. 'BLAZEPOSE'.
+
+    Returns:
+        tuple: The paths of the model, the scaling setup and the IK setup files.
+    """
+    if pose_model.upper() not in OPENSIM_SETUP_NAMES:
+        raise ValueError(f"No OpenSim setup available for the pose model {pose_model}.")
+    model_name, setup_name = OPENSIM_SETUP_NAMES[pose_model.upper()]
+    return (os.path.join(opensim_setup_dir, f"Model_Pose2Sim_{model_name}.osim"),
+            os.path.join(opensim_setup_dir, f"Scaling_Setup_Pose2Sim_{setup_name}.xml"),
+            os.path.join(opensim_setup_dir, f"IK_Setup_Pose2Sim_{setup_name}.xml"))
+
+def get_cached_opensim_objects(opensim_setup_dir, pose_model):
+    """
+    Get the generic model of a pose model, parsing it only the first time it is requested
+    in the current process. It is shared by all the trials of the process, so the callers
+    work on copies.
+
+    Args:
+        opensim_setup_dir (str): The folder containing the OpenSim models and setup files.
+        pose_model (str): The pose model, e.g. 'BLAZEPOSE'.
+
+    Returns:
+        dict: A dictionary with the 'model' object.
+    """
+    key = (os.path.abspath(opensim_setup_dir), pose_model.upper())
+    if key not in _OPENSIM_CACHE:
+        opensim = import_opensim()
+        model_file = get_opensim_setup_files(opensim_setup_dir, pose_model)[0]
+        geometry_dir = os.path.join(opensim_setup_dir, 'Geometry')
+        if os.path.isdir(geometry_dir):
+            opensim.ModelVisualizer.addDirToGeometrySearchPaths(geometry_dir)
+        opensim.Logger.setLevelString('error')
+        _OPENSIM_CACHE[key] = {
+            'model': opensim.Model(model_file),
+        }
+    return _OPENSIM_CACHE[key]
+
+def read_trc_time_range(trc_file):
+    """
+    Read the first and last time stamps of a TRC file.
+
+    Args:
+        trc_file (str): The path to the TRC file.
+
+    Returns:
+        tuple: The start and end times in seconds.
+    """
+    header, data = load_motion_file(trc_file)
+    times = get_times(header, data)
+    return float(times[0]), float(times[-1])
+
+def compute_file_digest(file_path, extra=None):
+    """
+    Compute the SHA-1 digest of a file, optionally combined with extra JSON-serializable data.
+
+    Args:
+        file_path (str): The path to the file.
+        extra (object, optional): Extra data (e.g. the relevant configuration) to include.
+
+    Returns:
+        str: The hexadecimal digest.
+    """
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    if extra is not None:
+        digest.update(json.dumps(extra, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+def get_filtered_trc_files(subproject_folder, filter_name):
+    """
+    Get the TRC files written by the filtering with the given filter.
+
+    Args:
+        subproject_folder (str): The subproject folder.
+        filter_name (str): The filter type.
+
+    Returns:
+        list: The sorted list of filtered TRC files.
+    """
+    return sorted(glob.glob(os.path.join(subproject_folder, 'pose-3d', f"*_filt_{filter_name}.trc")))
+
+def scale_and_run_ik(trc_file, output_folder, pose_model, opensim_setup_dir, kinematics_configs):
+    """
+    Scale the generic model to a filtered TRC file and run the inverse kinematics on it.
+
+    Args:
+        trc_file (str): The filtered TRC file.
+        output_folder (str): The folder receiving the scaled model and the .mot file.
+        pose_model (str): The pose model, e.g. 'BLAZEPOSE'.
+        opensim_setup_dir (str): The folder containing the OpenSim models and setup files.
+        kinematics_configs (dict): The kinematics configurations.
+
+    Returns:
+        dict: The timings of the scaling and IK steps and the output files.
+    """
+    opensim = import_opensim()
+    cached = get_cached_opensim_objects(opensim_setup_dir, pose_model)
+    model_file, scaling_setup_file, ik_setup_file = get_opensim_setup_files(opensim_setup_dir, pose_model)
+    trc_file = os.path.abspath(trc_file)
+    output_folder = os.path.abspath(output_folder)
+    trial_name = os.path.splitext(os.path.basename(trc_file))[0]
+    scaled_model_file = os.path.join(output_folder, f"{trial_name}_scaled.osim")
+    mot_file = os.path.join(output_folder, f"{trial_name}.mot")
+
+    start_time, end_time = read_trc_time_range(trc_file)
+    scaling_time_range = kinematics_configs.get('scaling_time_range') or [start_time, end_time]
+    scaling_time_range = [max(start_time, scaling_time_range[0]), min(end_time, scaling_time_range[1])]
+    mass = {'mass': kinematics_configs['subject_mass']} if kinematics_configs.get('subject_mass') is not None else {}
+
+    # The tools are built from the trial-specific setups, which are kept next to the
+    # results so that the run can be reproduced in OpenSim
+    scale_tool = load_opensim_tool(opensim.ScaleTool, scaling_setup_file, SCALING_FIELDS,
+                                   dict(mass, model_file=os.path.abspath(model_file), marker_file=trc_file,
+                                        time_range=scaling_time_range, output_model_file=scaled_model_file),
+                                   os.path.join(output_folder, f"{trial_name}_Scaling_Setup.xml"))
+    ik_tool = load_opensim_tool(opensim.InverseKinematicsTool, ik_setup_file, IK_FIELDS,
+                                dict(results_directory=output_folder, model_file=scaled_model_file,
+                                     marker_file=trc_file, time_range=[start_time, end_time],
+                                     output_motion_file=mot_file),
+                                os.path.join(output_folder, f"{trial_name}_IK_Setup.xml"))
+
+    # Scaling: work on a copy of the cached generic model
+    start = time.time()
+    model = opensim.Model(cached['model'])
+    model.initSystem()
+    model_scaler = scale_tool.getModelScaler()
+    if model_scaler.getApply():
+        model_scaler.processModel(model, "", scale_tool.getSubjectMass())
+    marker_placer = scale_tool.getMarkerPlacer()
+    if marker_placer.getApply():
+        marker_placer.processModel(model)
+    else:
+        model.printToXML(scaled_model_file)
+    scaling_duration = time.time() - start
+
+    # Inverse kinematics
+    start = time.time()
+    # Referenced by the tool, it must live until the end of the run
+    scaled_model = opensim.Model(scaled_model_file)
+    ik_tool.setModel(scaled_model)
+    ik_tool.run()
+    ik_duration = time.time() - start
+
+    return {"scaled_model_file": scaled_model_file, "mot_file": mot_file,
+            "scaling_duration": round(scaling_duration, 3), "ik_duration": round(ik_duration, 3)}
+
+def run_kinematics(subproject_folder, pose_model, filter_name, opensim_setup_dir, kinematics_configs,
+                   dependencies=None):
+    """
+    Run scaling and inverse kinematics for every filtered TRC file of a subproject,
+    skipping the files whose content, and the generic model and setup templates and
+    configs they are processed with, did not change since their last run.
+
+    Args:
+        subproject_folder (str): The subproject folder.
+        pose_model (str): The pose model, e.g. 'BLAZEPOSE'.
+        filter_name (str): The filter type of the TRC files to process.
+        opensim_setup_dir (str): The folder containing the OpenSim models and setup files.
+        kinematics_configs (dict): The kinematics configurations.
+        dependencies (dict, optional): The results of the upstream tasks (unused).
+
+    Returns:
+        list: One timing record per TRC file.
+    """
+    output_folder = os.path.join(subproject_folder, 'kinematics')
+    os.makedirs(output_folder, exist_ok=True)
+    records = []
+    templates = {os.path.basename(file): compute_file_digest(file)
+                 for file in get_opensim_setup_files(opensim_setup_dir, pose_model)}
+    for trc_file in get_filtered_trc_files(subproject_folder, filter_name):
+        trial_name = os.path.splitext(os.path.basename(trc_file))[0]
+        state_file = os.path.join(output_folder, f"{trial_name}_kinematics.json")
+        digest = compute_file_digest(trc_file, extra={"pose_model": pose_model, "configs": kinematics_configs,
+                                                      "templates": templates})
+        record = {"subproject": subproject_folder, "trc_file": trc_file, "pose_model": pose_model,
+                  "filter": filter_name}
+
+        if os.path.exists(state_file):
+            with open(state_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            if state.get('digest') == digest and os.path.exists(state.get('mot_file', '')):
+                records.append({**record, **state, "status": "up_to_date"})
+                continue
+
+        start = time.time()
+        result = scale_and_run_ik(trc_file, output_folder, pose_model, opensim_setup_dir, kinematics_configs)
+        state = {**result, "digest": digest, "total_duration": round(time.time() - start, 3)}
+        with atomic_output(state_file) as partial_file:
+            with open(partial_file, 'w', encoding='utf-8') as f:
+                json.dump(state, f, indent=4)
+        logging.info(f"Kinematics of {trc_file} took {state['total_duration']:.2f} s")
+        records.append({**record, **state, "status": "computed"})
+    return records
+
+def write_kinematics_report(report_file, graph, outcomes):
+    """
+    Write the per-trial timing report of the kinematics tasks of a processing run as CSV.
+
+    Args:
+        report_file (str): The path of the CSV report.
+        graph (dict): The processing task graph.
+        outcomes (dict): The outcomes returned by run_task_graph.
+
+    Returns:
+        list: The rows of the report.
+    """
+    fields = ["subproject", "pose_model", "filter", "trc_file", "status",
+              "scaling_duration", "ik_duration", "total_duration", "mot_file", "error"]
+    rows = []
+    for task_id, task in graph.items():
+        if task['metadata'].get('stage') != 'kinematics' or task_id not in outcomes:
+            continue
+        outcome = outcomes[task_id]
+        if outcome['status'] == 'succeeded':
+            rows.extend(outcome['result'])
+        else:
+            rows.append({**task['metadata'], "status": outcome['status'], "error": outcome['error']})
+    with open(report_file, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
@@ -0,0 +1,245 @@
+"""
+Module description: This module contains a set of utility functions for exposing the live
+progress of a run: the stages count their items (planned, running, done, failed) and frames,
+queue depths are sampled, and an optional local HTTP endpoint serves them in the Prometheus
+text format (/metrics) and as a JSON status page (/status), with the throughput and an
+estimate of the remaining time of each stage. The counters are those of the process serving
+the endpoint: the items and frames of the stages it runs, and the tasks it hands out to
+worker processes, whose frames are not counted.
+"""
+
+import logging
+import logging.handlers
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = 'mba'
+
+# The counters of the current process
+_LOCK = threading.Lock()
+_METRICS = {"task": None, "start": time.time(), "current_stage": None, "stages": {}, "gauges": {}}
+_SERVER = {}
+
+def get_stage(stage):
+    """
+    Get the counters of a stage, created on first use. Call with the lock held.
+    """
+    if stage not in _METRICS['stages']:
+        _METRICS['stages'][stage] = {"total": None, "done": 0, "failed": 0, "running": 0, "frames": 0,
+                                     "first_start": None, "last_progress": None}
+    return _METRICS['stages'][stage]
+
+def add_total(stage, count):
+    """
+    Add items to the planned items of a stage, e.g. once its work list is known.
+
+    Args:
+        stage (str): The name of the stage.
+        count (int): The number of items.
+
+    Returns:
+        None
+    """
+    with _LOCK:
+        counters = get_stage(stage)
+        counters['total'] = (counters['total'] or 0) + count
+        _METRICS['current_stage'] = stage
+
+def item_started(stage):
+    """
+    Count an item of a stage as running.
+    """
+    with _LOCK:
+        counters = get_stage(stage)
+        counters['running'] += 1
+        if counters['first_start'] is None:
+            counters['first_start'] = time.time()
+        _METRICS['current_stage'] = stage
+
+def item_finished(stage, status='succeeded', frames=None, started=True):
+    """
+    Count an item of a stage as finished.
+
+    Args:
+        stage (str): The name of the stage.
+        status (str): 'succeeded', or 'failed' or 'skipped' (counted as failed).
+        frames (int, optional): The frames processed by the item.
+        started (bool): False if the item was not counted as running (see item_started).
+
+    Returns:
+        None
+    """
+    with _LOCK:
+        counters = get_stage(stage)
+        if started:
+            counters['running'] = max(0, counters['running'] - 1)
+        if counters['first_start'] is None:
+            counters['first_start'] = time.time()
+        counters['done' if status == 'succeeded' else 'failed'] += 1
+        counters['frames'] += int(frames or 0)
+        counters['last_progress'] = time.time()
+
+def set_progress(stage, done, failed, running=0):
+    """
+    Set the finished items of a stage whose items run elsewhere (e.g. on the workers of the
+    distributed mode).
+    """
+    with _LOCK:
+        counters = get_stage(stage)
+        if (done, failed) != (counters['done'], counters['failed']):
+            counters['last_progress'] = time.time()
+        if counters['first_start'] is None:
+            counters['first_start'] = time.time()
+        counters.update({"done": done, "failed": failed, "running": running})
+        _METRICS['current_stage'] = stage
+
+def register_gauge(name, func):
+    """
+    Register a queue depth (or any other gauge) sampled when the metrics are read.
+
+    Args:
+        name (str): The name of the gauge.
+        func (callable): Returns a number, or a dictionary of numbers by label.
+
+    Returns:
+        None
+    """
+    with _LOCK:
+        _METRICS['gauges'][name] = func
+
+def unregister_gauge(name):
+    """
+    Remove a gauge registered with register_gauge.
+    """
+    with _LOCK:
+        _METRICS['gauges'].pop(name, None)
+
+def get_status():
+    """
+    Get the progress of the run: the counters of each stage with their throughput (items
+    and frames per second since the stage started) and estimated remaining time, and the
+    gauges.
+
+    Returns:
+        dict: The status.
+    """
+    now = time.time()
+    with _LOCK:
+        stages = {stage: dict(counters) for stage, counters in _METRICS['stages'].items()}
+        gauges = dict(_METRICS['gauges'])
+        status = {"task": _METRICS['task'], "uptime": round(now - _METRICS['start'], 3),
+                  "current_stage": _METRICS['current_stage']}
+    for counters in stages.values():
+        finished = counters['done'] + counters['failed']
+        end = now if counters['running'] or finished < (counters['total'] or 0) else counters['last_progress']
+        elapsed = (end or now) - counters['first_start'] if counters['first_start'] else 0.0
+        counters['remaining'] = None if counters['total'] is None else max(0, counters['total'] - finished)
+        counters['elapsed'] = round(elapsed, 3)
+        counters['items_per_second'] = round(finished / elapsed, 4) if elapsed > 0 else None
+        counters['frames_per_second'] = round(counters['frames'] / elapsed, 2) if elapsed > 0 else None
+        counters['eta'] = (round(counters['remaining'] * elapsed / finished, 1)
+                           if finished and counters['remaining'] is not None else None)
+    queues = {}
+    for name, func in gauges.items():
+        try:
+            queues[name] = func()
+        except Exception as e:
+            logging.debug(f"Gauge {name} failed: {e}")
+    progress = [counters['last_progress'] for counters in stages.values() if counters['last_progress']]
+    status.update({"last_progress": max(progress) if progress else None, "stages": stages, "queues": queues})
+    return status
+
+def format_prometheus(status):
+    """
+    Format a status (see get_status) in the Prometheus text exposition format.
+
+    Returns:
+        str: The metrics.
+    """
+    metrics = [
+        ("stage_items_total", "gauge", "Planned items of the stage", 'total'),
+        ("stage_items_done", "counter", "Items of the stage that succeeded", 'done'),
+        ("stage_items_failed", "counter", "Items of the stage that failed", 'failed'),
+        ("stage_items_running", "gauge", "Items of the stage started and not finished", 'running'),
+        ("stage_items_remaining", "gauge", "Items of the stage not finished", 'remaining'),
+        ("stage_frames", "counter", "Frames processed by the stage", 'frames'),
+        ("stage_frames_per_second", "gauge", "Frames per second since the stage started", 'frames_per_second'),
+        ("stage_eta_seconds", "gauge", "Estimated remaining time of the stage", 'eta'),
+        ("stage_last_progress_timestamp_seconds", "gauge", "Time an item of the stage last finished",
+         'last_progress'),
+    ]
+    lines = []
+    for name, metric_type, description, key in metrics:
+        lines += [f"# HELP {PREFIX}_{name} {description}.", f"# TYPE {PREFIX}_{name} {metric_type}"]
+        lines += [f'{PREFIX}_{name}{{stage="{stage}"}} {counters[key]}'
+                  for stage, counters in status['stages'].items() if counters[key] is not None]
+    lines += [f"# HELP {PREFIX}_queue_depth Items waiting in the queues.", f"# TYPE {PREFIX}_queue_depth gauge"]
+    for name, value in status['queues'].items():
+        values = value if isinstance(value, dict) else {None: value}
+        for label, number in values.items():
+            labels = f'queue="{name}"' + (f',state="{label}"' if label is not None else '')
+            lines.append(f"{PREFIX}_queue_depth{{{labels}}} {number}")
+    lines += [f"# HELP {PREFIX}_uptime_seconds Time since the run started.", f"# TYPE {PREFIX}_uptime_seconds gauge",
+              f"{PREFIX}_uptime_seconds {status['uptime']}"]
+    if status['current_stage'] is not None:
+        lines += [f"# HELP {PREFIX}_current_stage The stage running.", f"# TYPE {PREFIX}_current_stage gauge",
+                  f'{PREFIX}_current_stage{{task="{status["task"]}",stage="{status["current_stage"]}"}} 1']
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serves the metrics (/metrics) and the status page (/status).
+    """
+
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        if path == '/metrics':
+            body = format_prometheus(get_status()).encode()
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif path in ('', '/status'):
+            body = json.dumps(get_status(), indent=2).encode()
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # The scrapes would flood the logs
+        return
+
+def start_metrics_server(task, metrics_configs=None):
+    """
+    Name the run and, if enabled, serve its metrics on a local HTTP endpoint from a
+    background thread. The run goes on without it if the port is taken.
+
+    Args:
+        task (str): The task of the run, e.g. 'preprocessing'.
+        metrics_configs (dict, optional): The 'metrics' section of the config ('enabled',
+            'host' and 'port').
+
+    Returns:
+        ThreadingHTTPServer or None: The server, None if disabled or not started.
+    """
+    metrics_configs = metrics_configs or {}
+    with _LOCK:
+        _METRICS['task'] = task
+    if not metrics_configs.get('enabled', False) or 'server' in _SERVER:
+        return _SERVER.get('server')
+    address = (metrics_configs.get('host', '127.0.0.1'), metrics_configs.get('port', 9108))
+    try:
+        server = ThreadingHTTPServer(address, MetricsHandler)
+    except OSError as e:
+        logging.warning(f"Cannot serve the metrics on {address[0]}:{address[1]} ({e}), going on without them.")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    _SERVER['server'] = server
+    logging.info(f"Serving the metrics on http://{address[0]}:{server.server_address[1]}/metrics and /status")
+    return server
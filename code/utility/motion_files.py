@@ -0,0 +1,457 @@
+"""
+Module description: This module contains a set of utility functions for reading and
+writing TRC (3D marker trajectories) and MOT (OpenSim motion) files through a binary
+memory-mapped sidecar.
+"""
+
+import os
+import json
+import threading
+import numpy as np
+
+SIDECAR_VERSION = 1
+
+def get_sidecar_paths(file_path):
+    """
+    Get the paths of the binary sidecar of a TRC/MOT file.
+
+    Args:
+        file_path (str): The path to the TRC/MOT file.
+
+    Returns:
+        tuple: The paths of the .npy data file and of the .json header file.
+    """
+    return f"{file_path}.npy", f"{file_path}.json"
+
+def get_temp_path(file_path):
+    """
+    Get a temporary path for a file, unique to the current process and thread, so that
+    concurrent writers of the same file do not write to the same temporary file.
+
+    Args:
+        file_path (str): The path of the file.
+
+    Returns:
+        str: The temporary path.
+    """
+    return f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+def get_file_format(file_path):
+    """
+    Get the format of a motion file from its extension.
+
+    Args:
+        file_path (str): The path to the TRC/MOT file.
+
+    Returns:
+        str: 'trc' or 'mot'.
+    """
+    extension = os.path.splitext(file_path)[1].lower().lstrip('.')
+    if extension not in ('trc', 'mot'):
+        raise ValueError(f"{file_path} is neither a TRC nor a MOT file.")
+    return extension
+
+def parse_rows(lines):
+    """
+    Parse the numeric rows of a TRC/MOT file. Empty fields (missing markers) become NaN.
+
+    Args:
+        lines (list): The data lines of the file.
+
+    Returns:
+        numpy.ndarray: A 2D float64 array with one row per line.
+    """
+    lines = [line.rstrip('\r\n') for line in lines if line.strip()]
+    if not lines:
+        return np.empty((0, 0))
+    if '\t' in lines[0]:
+        rows = [line.split('\t') for line in lines]
+    else:
+        rows = [line.split() for line in lines]
+    try:
+        # Fast path: rectangular rows without missing values
+        return np.array(rows, dtype=np.float64)
+    except ValueError:
+        pass
+    n_columns = max(len(row) for row in rows)
+    data = np.full((len(rows), n_columns), np.nan)
+    for i, row in enumerate(rows):
+        data[i, :len(row)] = [float(value) if value.strip() else np.nan for value in row]
+    return data
+
+def parse_trc(file_path):
+    """
+    Parse a TRC file.
+
+    Args:
+        file_path (str): The path to the TRC file.
+
+    Returns:
+        tuple: The header dictionary and the data array (frame number, time, then X, Y, Z per marker).
+    """
+    with open(file_path, 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+    header_lines = [line.rstrip('\r\n') for line in lines[:5]]
+    keys = header_lines[1].split('\t')
+    values = header_lines[2].split('\t')
+    markers = [marker for marker in header_lines[3].split('\t')[2:] if marker.strip()]
+    columns = ['Frame#', 'Time'] + [f"{marker}_{axis}" for marker in markers for axis in 'XYZ']
+    data = parse_rows(lines[5:])
+    header = {
+        "format": "trc",
+        "header_lines": header_lines,
+        "info": dict(zip(keys, values)),
+        "markers": markers,
+        "columns": columns,
+    }
+    return header, data[:, :len(columns)]
+
+def parse_mot(file_path):
+    """
+    Parse a MOT file.
+
+    Args:
+        file_path (str): The path to the MOT file.
+
+    Returns:
+        tuple: The header dictionary and the data array (time, then one column per coordinate).
+    """
+    with open(file_path, 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+    end_of_header = next(i for i, line in enumerate(lines) if line.strip().lower() == 'endheader')
+    header_lines = [line.rstrip('\r\n') for line in lines[:end_of_header + 1]]
+    columns = lines[end_of_header + 1].split()
+    data = parse_rows(lines[end_of_header + 2:])
+    header = {
+        "format": "mot",
+        "header_lines": header_lines,
+        "columns": columns,
+    }
+    return header, data
+
+def write_sidecar(file_path, header, data):
+    """
+    Write the binary sidecar of a TRC/MOT file. Both files are written to temporary
+    paths first and renamed, so a sidecar is never seen half-written.
+
+    Args:
+        file_path (str): The path to the TRC/MOT file.
+        header (dict): The header dictionary.
+        data (numpy.ndarray): The data array.
+
+    Returns:
+        None
+    """
+    npy_path, json_path = get_sidecar_paths(file_path)
+    stat = os.stat(file_path)
+    header = {
+        **header,
+        "version": SIDECAR_VERSION,
+        "source_size": stat.st_size,
+        "source_mtime_ns": stat.st_mtime_ns,
+        "shape": list(data.shape),
+    }
+    npy_temp_path, json_temp_path = get_temp_path(npy_path), get_temp_path(json_path)
+    with open(npy_temp_path, 'wb') as f:
+        np.save(f, np.ascontiguousarray(data))
+    with open(json_temp_path, 'w', encoding='utf-8') as f:
+        json.dump(header, f)
+    os.replace(npy_temp_path, npy_path)
+    os.replace(json_temp_path, json_path)
+
+def read_sidecar_header(file_path):
+    """
+    Read the header of the sidecar of a TRC/MOT file, if it is up to date.
+
+    Args:
+        file_path (str): The path to the TRC/MOT file.
+
+    Returns:
+        dict or None: The header, or None if the sidecar is missing or stale.
+    """
+    npy_path, json_path = get_sidecar_paths(file_path)
+    if not (os.path.exists(npy_path) and os.path.exists(json_path)):
+        return None
+    with open(json_path, 'r', encoding='utf-8') as f:
+        header = json.load(f)
+    stat = os.stat(file_path)
+    if (header.get('version') != SIDECAR_VERSION or
+        header.get('source_size') != stat.st_size or
+        header.get('source_mtime_ns') != stat.st_mtime_ns):
+        return None
+    return header
+
+def load_motion_file(file_path, mmap_mode='r'):
+    """
+    Load a TRC/MOT file. The text file is parsed only the first time (or after it changed),
+    and a binary sidecar is written next to it; later loads memory-map the sidecar.
+
+    Args:
+        file_path (str): The path to the TRC/MOT file.
+        mmap_mode (str or None): The numpy memory-map mode ('r' for zero-copy read-only
+            access, None to load the data in memory).
+
+    Returns:
+        tuple: The header dictionary and the data array.
+    """
+    header = read_sidecar_header(file_path)
+    if header is None:
+        parse = parse_trc if get_file_format(file_path) == 'trc' else parse_mot
+        header, data = parse(file_path)
+        write_sidecar(file_path, header, data)
+        header = read_sidecar_header(file_path)
+    data = np.load(get_sidecar_paths(file_path)[0], mmap_mode=mmap_mode)
+    return header, data
+
+def get_times(header, data):
+    """
+    Get the time column of a loaded TRC/MOT file.
+
+    Args:
+        header (dict): The header dictionary.
+        data (numpy.ndarray): The data array.
+
+    Returns:
+        numpy.ndarray: The time stamps in seconds.
+    """
+    return data[:, header['columns'].index('Time' if header['format'] == 'trc' else 'time')]
+
+def get_marker_positions(header, data):
+    """
+    Get the marker positions of a loaded TRC file as a (frames, markers, 3) view.
+
+    Args:
+        header (dict): The header dictionary of a TRC file.
+        data (numpy.ndarray): The data array.
+
+    Returns:
+        numpy.ndarray: The marker positions, without copying the data.
+    """
+    if header['format'] != 'trc':
+        raise ValueError("Marker positions are only available in TRC files.")
+    return data[:, 2:].reshape(data.shape[0], len(header['markers']), 3)
+
+def format_rows(data, float_format):
+    """
+    Format the rows of a data array as tab-separated lines, leaving NaN fields empty.
+
+    Args:
+        data (numpy.ndarray): The data array.
+        float_format (str): The format of the values, None for their shortest exact
+            representation (as pandas writes them).
+
+    Returns:
+        list: The formatted lines.
+    """
+    if float_format is None:
+        return ['\t'.join('' if np.isnan(value) else repr(float(value)) for value in row) for row in data]
+    return ['\t'.join('' if np.isnan(value) else float_format % value for value in row) for row in data]
+
+def get_trc_header_lines(file_path, n_frames, first_frame, markers, data_rate, units='m', orig_data_start_frame=None):
+    """
+    Get the five header lines of a TRC file.
+
+    Args:
+        file_path (str): The path of the TRC file.
+        n_frames (int): The number of frames.
+        first_frame (int): The first frame number.
+        markers (list): The marker names.
+        data_rate (float): The frame rate.
+        units (str): The units of the positions.
+        orig_data_start_frame (int, optional): The first frame number in the original data.
+
+    Returns:
+        list: The header lines.
+    """
+    return [
+        f"PathFileType\t4\t(X/Y/Z)\t{os.path.basename(file_path)}",
+        "DataRate\tCameraRate\tNumFrames\tNumMarkers\tUnits\tOrigDataRate\tOrigDataStartFrame\tOrigNumFrames",
+        '\t'.join(str(value) for value in [data_rate, data_rate, n_frames, len(markers), units, data_rate,
+                                            first_frame if orig_data_start_frame is None else orig_data_start_frame,
+                                            n_frames]),
+        '\t'.join(['Frame#', 'Time'] + [f"{marker}\t\t" for marker in markers]),
+        '\t\t' + '\t'.join(f"X{i}\tY{i}\tZ{i}" for i in range(1, len(markers) + 1)),
+    ]
+
+def format_trc_rows(data, float_format='%.6f'):
+    """
+    Format the rows of a TRC data array (frame number, time, then X, Y, Z per marker).
+
+    Args:
+        data (numpy.ndarray): The data array.
+        float_format (str): The format of the positions (see format_rows).
+
+    Returns:
+        list: The formatted lines.
+    """
+    times = [repr(float(time)) for time in data[:, 1]] if float_format is None else [f"{time:.6f}" for time in data[:, 1]]
+    return [f"{int(row[0])}\t{time}\t{line}" for row, time, line in zip(data, times, format_rows(data[:, 2:], float_format))]
+
+def write_trc(file_path, data, markers, data_rate, units='m', orig_data_start_frame=None):
+    """
+    Write a TRC file readable by OpenSim.
+
+    Args:
+        file_path (str): The path of the TRC file.
+        data (numpy.ndarray): The data array (frame number, time, then X, Y, Z per marker).
+        markers (list): The marker names.
+        data_rate (float): The frame rate.
+        units (str): The units of the positions.
+        orig_data_start_frame (int, optional): The first frame number in the original data.
+
+    Returns:
+        None
+    """
+    n_frames = data.shape[0]
+    first_frame = int(data[0, 0]) if n_frames else 0
+    header_lines = get_trc_header_lines(file_path, n_frames, first_frame, markers, data_rate, units,
+                                        orig_data_start_frame)
+    with open(file_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(header_lines + format_trc_rows(data)) + '\n')
+
+class ChunkedTrcWriter(object):
+    """
+    Writes a TRC file from consecutive blocks of rows, holding one block at a time, together
+    with its binary sidecar (see load_motion_file), so that it is memory-mapped later without
+    being parsed. Everything is written to temporary paths and renamed when the writer is
+    closed after exactly n_frames rows, and removed if the block of a with statement fails.
+    The positions are written with float_format (see format_rows).
+
+    Attributes:
+        file_path (str): The path of the TRC file.
+        n_frames (int): The number of frames.
+        header (dict): The header dictionary of the sidecar.
+        rows (int): The number of rows written so far.
+    """
+    def __init__(self, file_path, n_frames, markers, data_rate, first_frame=0, units='m', float_format='%.6f'):
+        header_lines = get_trc_header_lines(file_path, n_frames, first_frame, markers, data_rate, units)
+        self.file_path = file_path
+        self.n_frames = n_frames
+        self.float_format = float_format
+        self.header = {
+            "format": "trc",
+            "header_lines": header_lines,
+            "info": dict(zip(header_lines[1].split('\t'), header_lines[2].split('\t'))),
+            "markers": list(markers),
+            "columns": ['Frame#', 'Time'] + [f"{marker}_{axis}" for marker in markers for axis in 'XYZ'],
+        }
+        self.rows = 0
+        self.temp_paths = {path: get_temp_path(path) for path in (file_path, *get_sidecar_paths(file_path))}
+        self.sidecar = np.lib.format.open_memmap(self.temp_paths[get_sidecar_paths(file_path)[0]], mode='w+',
+                                                 shape=(n_frames, len(self.header['columns'])))
+        self.file = open(self.temp_paths[file_path], 'w', encoding='utf-8')
+        self.file.write('\n'.join(header_lines) + '\n')
+
+    def write(self, data):
+        """
+        Append a block of rows (frame number, time, then X, Y, Z per marker).
+
+        Args:
+            data (numpy.ndarray): The data array of the block.
+
+        Returns:
+            None
+        """
+        if self.rows + len(data) > self.n_frames:
+            raise ValueError(f"More than {self.n_frames} frames written to {self.file_path}.")
+        if len(data):
+            lines = format_trc_rows(data, self.float_format)
+            self.file.write('\n'.join(lines) + '\n')
+            # The values as read back from the text, as when the sidecar is made by parsing it
+            self.sidecar[self.rows:self.rows + len(data)] = parse_rows(lines)
+        self.rows += len(data)
+
+    def close(self):
+        """
+        Rename the TRC file and its sidecar to their final paths.
+
+        Returns:
+            None
+        """
+        npy_path, json_path = get_sidecar_paths(self.file_path)
+        self.file.close()
+        self.sidecar.flush()
+        self.sidecar = None
+        if self.rows != self.n_frames:
+            self.abort()
+            raise ValueError(f"{self.rows} frames written to {self.file_path} instead of {self.n_frames}.")
+        os.replace(self.temp_paths[self.file_path], self.file_path)
+        stat = os.stat(self.file_path)
+        header = {
+            **self.header,
+            "version": SIDECAR_VERSION,
+            "source_size": stat.st_size,
+            "source_mtime_ns": stat.st_mtime_ns,
+            "shape": [self.n_frames, len(self.header['columns'])],
+        }
+        with open(self.temp_paths[json_path], 'w', encoding='utf-8') as f:
+            json.dump(header, f)
+        os.replace(self.temp_paths[npy_path], npy_path)
+        os.replace(self.temp_paths[json_path], json_path)
+
+    def abort(self):
+        """
+        Remove the temporary files.
+
+        Returns:
+            None
+        """
+        self.file.close()
+        self.sidecar = None
+        for temp_path in self.temp_paths.values():
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def write_mot(file_path, data, columns, name=None, in_degrees=True):
+    """
+    Write a MOT file readable by OpenSim.
+
+    Args:
+        file_path (str): The path of the MOT file.
+        data (numpy.ndarray): The data array (time, then one column per coordinate).
+        columns (list): The column names, starting with 'time'.
+        name (str, optional): The name written on the first header line.
+        in_degrees (bool): Whether the angles are in degrees.
+
+    Returns:
+        None
+    """
+    header_lines = [
+        name or os.path.splitext(os.path.basename(file_path))[0],
+        "version=1",
+        f"nRows={data.shape[0]}",
+        f"nColumns={data.shape[1]}",
+        f"inDegrees={'yes' if in_degrees else 'no'}",
+        "endheader",
+    ]
+    with open(file_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(header_lines + ['\t'.join(columns)] + format_rows(data, '%.8f')) + '\n')
+
+def write_motion_file(file_path, header, data):
+    """
+    Write a TRC/MOT file from a header and a data array, e.g. as returned by load_motion_file.
+
+    Args:
+        file_path (str): The path of the TRC/MOT file.
+        header (dict): The header dictionary.
+        data (numpy.ndarray): The data array.
+
+    Returns:
+        None
+    """
+    if header['format'] == 'trc':
+        info = header.get('info', {})
+        write_trc(file_path, data, header['markers'], info.get('DataRate', round(1 / np.median(np.diff(data[:, 1])))),
+                  units=info.get('Units', 'm'), orig_data_start_frame=info.get('OrigDataStartFrame'))
+    else:
+        write_mot(file_path, data, header['columns'], name=header['header_lines'][0],
+                  in_degrees=any(line.strip().lower() == 'indegrees=yes' for line in header['header_lines']))
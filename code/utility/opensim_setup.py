@@ -0,0 +1,172 @@
+"""
+Module description: This module contains a set of utility functions for producing
+trial-specific variants of the OpenSim scaling and inverse kinematics setup files.
+"""
+
+import os
+import tempfile
+import threading
+from lxml import etree
+
+# Cached templates: absolute setup path -> {'tree', 'elements', 'defaults', 'lock'}
+_TEMPLATES = {}
+_TEMPLATES_LOCK = threading.Lock()
+
+# Fields that are rewritten per trial, with the path of their element(s) in each tool
+SCALING_FIELDS = {
+    'mass': ['ScaleTool/mass'],
+    'model_file': ['ScaleTool/GenericModelMaker/model_file'],
+    'marker_file': ['ScaleTool/ModelScaler/marker_file', 'ScaleTool/MarkerPlacer/marker_file'],
+    'time_range': ['ScaleTool/ModelScaler/time_range', 'ScaleTool/MarkerPlacer/time_range'],
+    'output_model_file': ['ScaleTool/ModelScaler/output_model_file', 'ScaleTool/MarkerPlacer/output_model_file'],
+}
+
+IK_FIELDS = {
+    'results_directory': ['InverseKinematicsTool/results_directory'],
+    'model_file': ['InverseKinematicsTool/model_file'],
+    'marker_file': ['InverseKinematicsTool/marker_file'],
+    'time_range': ['InverseKinematicsTool/time_range'],
+    'output_motion_file': ['InverseKinematicsTool/output_motion_file'],
+}
+
+def get_template(setup_file, fields):
+    """
+    Get the cached template of a setup file, parsing it on first use. Trial-specific
+    variants only update the text of the field elements of this tree.
+
+    Args:
+        setup_file (str): The path to the setup XML file.
+        fields (dict): The fields that can be updated (e.g. SCALING_FIELDS or IK_FIELDS).
+
+    Returns:
+        dict: The template with the parsed tree, the elements of each field, their default
+            values and the lock protecting the tree.
+    """
+    key = (os.path.abspath(setup_file), tuple(sorted(fields)))
+    with _TEMPLATES_LOCK:
+        if key not in _TEMPLATES:
+            tree = etree.parse(setup_file)
+            root = tree.getroot()
+            elements = {}
+            for field, paths in fields.items():
+                elements[field] = [element for path in paths for element in root.findall(path)]
+                if not elements[field]:
+                    raise ValueError(f"Field {field} ({', '.join(paths)}) not found in {setup_file}.")
+            _TEMPLATES[key] = {
+                'tree': tree,
+                'elements': elements,
+                'defaults': {field: [element.text for element in els] for field, els in elements.items()},
+                'lock': threading.Lock(),
+            }
+    return _TEMPLATES[key]
+
+def format_value(value):
+    """
+    Format a value the way OpenSim setup files expect it.
+
+    Args:
+        value: A string, a number or a sequence of numbers (e.g. a time range).
+
+    Returns:
+        str: The formatted value.
+    """
+    if isinstance(value, (list, tuple)):
+        return ' '.join(format_value(v) for v in value)
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def render_setup(setup_file, fields, updates):
+    """
+    Render a trial-specific variant of a setup file.
+
+    Args:
+        setup_file (str): The path to the setup XML file.
+        fields (dict): The fields that can be updated (e.g. SCALING_FIELDS or IK_FIELDS).
+        updates (dict): The new value of each updated field. Fields that are not
+            given keep the value of the original setup file.
+
+    Returns:
+        bytes: The serialized XML document.
+    """
+    unknown = set(updates) - set(fields)
+    if unknown:
+        raise ValueError(f"Unknown setup fields: {', '.join(sorted(unknown))}.")
+    template = get_template(setup_file, fields)
+    with template['lock']:
+        for field, elements in template['elements'].items():
+            for element, default in zip(elements, template['defaults'][field]):
+                element.text = format_value(updates[field]) if field in updates else default
+        return etree.tostring(template['tree'], xml_declaration=True, encoding='UTF-8')
+
+def write_setup(setup_file, fields, updates, output_file=None):
+    """
+    Write a trial-specific variant of a setup file.
+
+    Args:
+        setup_file (str): The path to the setup XML file.
+        fields (dict): The fields that can be updated (e.g. SCALING_FIELDS or IK_FIELDS).
+        updates (dict): The new value of each updated field.
+        output_file (str, optional): The path of the variant. If not given, the variant
+            is written to a new file in the temporary directory.
+
+    Returns:
+        str: The path of the written variant.
+    """
+    content = render_setup(setup_file, fields, updates)
+    if output_file is None:
+        handle, output_file = tempfile.mkstemp(suffix='.xml', prefix=os.path.splitext(os.path.basename(setup_file))[0])
+        os.close(handle)
+    with open(output_file, 'wb') as f:
+        f.write(content)
+    return output_file
+
+def write_scaling_setup(setup_file, output_file=None, **updates):
+    """
+    Write a trial-specific variant of a scaling setup file.
+
+    Args:
+        setup_file (str): The path to the Scaling_Setup_*.xml file.
+        output_file (str, optional): The path of the variant (a temporary file if not given).
+        **updates: The values of the SCALING_FIELDS to update.
+
+    Returns:
+        str: The path of the written variant.
+    """
+    return write_setup(setup_file, SCALING_FIELDS, updates, output_file)
+
+def write_ik_setup(setup_file, output_file=None, **updates):
+    """
+    Write a trial-specific variant of an inverse kinematics setup file.
+
+    Args:
+        setup_file (str): The path to the IK_Setup_*.xml file.
+        output_file (str, optional): The path of the variant (a temporary file if not given).
+        **updates: The values of the IK_FIELDS to update.
+
+    Returns:
+        str: The path of the written variant.
+    """
+    return write_setup(setup_file, IK_FIELDS, updates, output_file)
+
+def load_opensim_tool(tool_class, setup_file, fields, updates, output_file=None):
+    """
+    Build an OpenSim tool from a trial-specific variant of a setup file.
+
+    Args:
+        tool_class: The OpenSim tool class, e.g. opensim.ScaleTool or opensim.InverseKinematicsTool.
+        setup_file (str): The path to the setup XML file.
+        fields (dict): The fields that can be updated (e.g. SCALING_FIELDS or IK_FIELDS).
+        updates (dict): The new value of each updated field.
+        output_file (str, optional): The path where the variant is kept. If not given, the
+            variant goes through a temporary file, which is removed once the tool is built.
+
+    Returns:
+        object: The OpenSim tool.
+    """
+    variant_file = write_setup(setup_file, fields, updates, output_file)
+    try:
+        return tool_class(variant_file)
+    finally:
+        if output_file is None:
+            os.remove(variant_file)
@@ -6,12 +6,15 @@ Module description: This module contains a set of utility functions for preproce
 import logging
 import logging.handlers
 import os
-import itertools
-import shutil
-import cv2
 import numpy as np
-from moviepy.editor import VideoFileClip
-from utility.utils import find_video_files, remove_directory, find_unique_base_names, is_video_file
+from utility.utils import (find_video_files, remove_directory, find_unique_base_names, is_video_file, log_context,
+                           atomic_output, copy_file_atomically)
+from utility.journal import is_pending, mark_completed
+from utility.profiling import profiled, add_frames
+from utility.metrics import add_total
+from utility.retention import is_pruned
+from utility.sub_setups import plan_sub_setups, uses_camera
+from utility.video_io import get_video_info, transcode_video
 
 def get_first_frame_dimensions_and_orientation(video_path):
     """
@@ -23,30 +26,14 @@ def get_first_frame_dimensions_and_orientation(video_path):
     Returns:
         tuple: A tuple containing the height, width, and orientation of the frame.
     """
-    # Open the video file
-    cap = cv2.VideoCapture(video_path)
-
-    # Check if the video was opened successfully
-    if not cap.isOpened():
-        raise IOError(f"Cannot open video file {video_path}")
-
-    # Read the first frame
-    ret, frame = cap.read()
-
-    # Close the video file
-    cap.release()
-
-    if not ret:
-        raise IOError("Cannot read the first frame of the video")
-
-    # Get dimensions of the frame
-    height, width = frame.shape[:2]
+    # Raises an IOError if the video cannot be opened or read
+    info = get_video_info(video_path)
 
     # Determine the orientation
-    orientation = "portrait" if height > width else "landscape"
+    orientation = "portrait" if info['height'] > info['width'] else "landscape"
 
     # Return the dimensions and orientation of the frame
-    return (height, width, orientation)
+    return (info['height'], info['width'], orientation)
 
 
 def get_videos_to_be_preprocessed(workspace, setting):
@@ -73,25 +60,26 @@ def get_videos_to_be_preprocessed(workspace, setting):
 
     files_to_be_preprocessed = [
         file for file in find_video_files([workspace]) if
+        # The poses of a subsampled setting are derived from another setting, only its calibration is transcoded
+        (not setting.get('subsample_pose') or f'{os.sep}Calibration{os.sep}' in file) and
         (f'{os.sep}__synced__{os.sep}' in file and 
             f'{os.sep}all_cams{os.sep}' in file and 
             f'{os.sep}unset_unset_unset_unset{os.sep}' in file and 
             setting["format"] is not 'unset' and 
-            not os.path.exists(file.replace('{os.sep}unset_unset_unset_unset{os.sep}', 
+            not os.path.exists(file.replace(f'{os.sep}unset_unset_unset_unset{os.sep}', 
                                             f'{os.sep}{my_fps}_{my_x}_{my_y}_{my_format}{os.sep}')[:-4] + f'.{my_format}')
         )
     ]
     return files_to_be_preprocessed
 
-def create_new_file_path(file_path, fps, resolution, my_format):
+def get_setting_folder_name(fps, resolution, my_format):
     """
-    Create a new file path based on the given file path, fps, resolution, and format.
+    Get the name of the folder of a setting (<fps>_<x>_<y>_<format>).
 
-    :param file_path: The original file path.
-    :param fps: Frames per second of the new file path.
-    :param resolution: The resolution of the new file path.
-    :param my_format: The format of the new file path.
-    :return: The new file path.
+    :param fps: Frames per second of the setting.
+    :param resolution: The resolution of the setting.
+    :param my_format: The format of the setting.
+    :return: The folder name.
     """
     x, y = resolution
 
@@ -102,9 +90,20 @@ def create_new_file_path(file_path, fps, resolution, my_format):
     fps = 'unset' if fps is None else fps
     x = 'unset' if x is None else x
     y = 'unset' if y is None else y
+    return f'{fps}_{x}_{y}_{my_format}'
 
+def create_new_file_path(file_path, fps, resolution, my_format):
+    """
+    Create a new file path based on the given file path, fps, resolution, and format.
+
+    :param file_path: The original file path.
+    :param fps: Frames per second of the new file path.
+    :param resolution: The resolution of the new file path.
+    :param my_format: The format of the new file path.
+    :return: The new file path.
+    """
     new_file_path = file_path.replace(f'{os.sep}unset_unset_unset_unset{os.sep}', 
-                                      f'{os.sep}{fps}_{x}_{y}_{my_format}{os.sep}')[:-4] + f'.{my_format}'
+                                      f'{os.sep}{get_setting_folder_name(fps, resolution, my_format)}{os.sep}')[:-4] + f'.{my_format}'
     return new_file_path
 
 def compute_new_resolution(current_height, current_width, current_orientation, new_resolution):
@@ -152,11 +151,9 @@ def get_fps(video_file):
     Returns:
         float: Frames per second of the video.
     """
-    video = VideoFileClip(video_file)
-    fps = video.fps
-    video.close()
-    return fps
+    return get_video_info(video_file)['fps']
 
+@profiled()
 def preprocess_video(video_file, target_fps, target_resolution, my_format):
     """
     Preprocesses a video file to the specified target frames per second and resolution.
@@ -172,7 +169,7 @@ def preprocess_video(video_file, target_fps, target_resolution, my_format):
     """
     output_file = create_new_file_path(video_file, target_fps, target_resolution, my_format)
     
-    if not os.path.exists(output_file):
+    if is_pending('preprocess', output_file, os.path.exists(output_file) or is_pruned(output_file)):
         directory_name = os.path.dirname(output_file)
         os.makedirs(directory_name, exist_ok=True)
 
@@ -198,11 +195,10 @@ def preprocess_video(video_file, target_fps, target_resolution, my_format):
                 f"Current resolution ({[current_height, current_width]}) in {video_file} is smaller than the target resolution ({[new_height, new_width]}).")
             raise ValueError(os.path.dirname(output_file))
 
-        video = VideoFileClip(video_file)
-        new_video = video.set_fps(new_fps).resize([new_width, new_height])
-        new_video.write_videofile(output_file, codec='libx264')
-        new_video.close()
-        video.close()
+        with atomic_output(output_file) as temp_output_file:
+            n_frames = transcode_video(video_file, temp_output_file, fps=new_fps, size=(new_width, new_height))
+        add_frames(n_frames)
+        mark_completed('preprocess', output_file)
     return
 
 def preprocess_videos(workspace, setting):
@@ -219,18 +215,35 @@ def preprocess_videos(workspace, setting):
     Returns:
         None
     """
-    fps = setting['fps']
-    resolution = setting['resolution']
-    my_format = setting['format']
     video_files = get_videos_to_be_preprocessed(workspace, setting)
-    for video_file in video_files:
-        try:
-            preprocess_video(video_file, fps, resolution, my_format)
-        except ValueError as e:
-            # logging.error(e)
-            remove_directory(str(e))
+    add_total('preprocess_video', len(video_files))
+    for i, video_file in enumerate(video_files):
+        if not preprocess_setting_video(video_file, setting):
+            # The other videos of the setting are not planned anymore
+            add_total('preprocess_video', i + 1 - len(video_files))
             break
 
+def preprocess_setting_video(video_file, setting):
+    """
+    Preprocesses a video with a setting. If the video cannot reach the setting (its fps or
+    resolution is lower), the output folder of the setting is removed.
+
+    Args:
+        video_file (str): The path to the video file.
+        setting (dict): The preprocessing setting ('fps', 'resolution' and 'format').
+
+    Returns:
+        bool: False if the setting cannot be reached.
+    """
+    try:
+        with log_context(trial=os.path.dirname(video_file), camera=os.path.splitext(os.path.basename(video_file))[0]):
+            preprocess_video(video_file, setting['fps'], setting['resolution'], setting['format'])
+    except ValueError as e:
+        # logging.error(e)
+        remove_directory(str(e))
+        return False
+    return True
+
 def find_all_cams_folders(root_path):
     """
     Find all folders named "all_cams" containing "__synced__" in the given root path.
@@ -248,21 +261,20 @@ def find_all_cams_folders(root_path):
 
     return all_cams_folders
 
-def create_sub_setups(workspace):
+def create_sub_setups(workspace, sub_setups_configs=None):
     """
     Create sub setups for the given workspace using the folders and files found in the workspace.
+    The camera combinations are selected with the 'sub_setups' policy of the config and
+    recorded (see utility.sub_setups).
     """
     folders = find_all_cams_folders(workspace)
     for folder in folders:
         files = [os.path.join(root, file) for root, dirs, files in os.walk(folder) for file in files if is_video_file(file)]
         cameras = find_unique_base_names(folder)
-        for i in range(len(cameras) - 1, 1, -1):
-            combinations = list(itertools.combinations(cameras, i))
-            for combo in combinations:
-                subfolder_name = '_'.join(sorted(combo))
-                for file in files:
-                    if any(camera in file for camera in combo):
-                        new_file = file.replace(f"{os.sep}all_cams{os.sep}", f"{os.sep}{subfolder_name}{os.sep}")
-                        if not os.path.exists(new_file):
-                            os.makedirs(os.path.dirname(new_file), exist_ok=True)
-                            shutil.copy(file, new_file)
\ No newline at end of file
+        sub_setups = plan_sub_setups(folder, cameras, sub_setups_configs or {})
+        for subfolder_name, combo in sub_setups.items():
+            for file in files:
+                if any(uses_camera(file, camera) for camera in combo):
+                    new_file = file.replace(f"{os.sep}all_cams{os.sep}", f"{os.sep}{subfolder_name}{os.sep}")
+                    if not os.path.exists(new_file) and not is_pruned(new_file):
+                        copy_file_atomically(file, new_file)
@@ -1,6 +1,6 @@
 """
 Module description: This module contains a set of utility functions for processing the videos
-(triangulation, person association, filtering, etc.).
+(triangulation, person association, filtering, kinematics, etc.).
 """
 
 import logging
@@ -8,51 +8,283 @@ import logging.handlers
 import os
 import glob
 import json
-from Pose2Sim import Pose2Sim
-from utility.utils import find_unique_base_names
+import time
+from utility.scheduler import add_task, run_task_graph, write_run_summary
+from utility.kinematics import run_kinematics, write_kinematics_report
+from utility.profiling import profiled
+from utility.association import associate_people
+from utility.quality import assess_subproject
+from utility.sub_setups import is_selected_sub_setup
+from utility.utils import atomic_output
+from utility.chunking import is_chunked, run_chunked_triangulation, run_chunked_filtering
+from utility.config_model import (FILTERS, get_config_hash, get_filter_parameters, get_stamp_file,
+                                  read_stage_stamp, write_stage_stamp)
 
 def process(workspace, configs):
     """
     Processes the workspace using the provided configurations.
 
+    Triangulation runs once per (subproject, pose config), filtering runs once per filter
+    as soon as the matching triangulation succeeded, and the kinematics (if enabled) run
+    on each filtered result. The tasks run on a process pool sized by
+    configs['processing']['max_workers'] and their outcomes are written to a run summary.
+
+    Args:
+        workspace: The workspace directory to be processed.
+        configs: The configurations to be used.
+
+    Returns:
+        dict: The run summary.
+    """
+    processing_configs = configs.get('processing', {})
+    max_workers = processing_configs.get('max_workers', 1)
+    graph = build_processing_graph(workspace, configs)
+    logging.info(f"Running {len(graph)} processing tasks with max_workers={max_workers}")
+
+    start = time.time()
+    outcomes = run_task_graph(graph, max_workers)
+    summary = write_run_summary(os.path.join(workspace, 'run_summary_processing.json'), graph, outcomes,
+                                extra={"workspace": os.path.abspath(workspace),
+                                       "max_workers": max_workers,
+                                       "duration": round(time.time() - start, 3)})
+    if configs.get('kinematics', {}).get('enabled', False):
+        write_kinematics_report(os.path.join(workspace, 'kinematics_timing_report.csv'), graph, outcomes)
+    logging.info(f"Processing summary: {summary['counts']}")
+    return summary
+
+def build_processing_graph(workspace, configs):
+    """
+    Build the processing task graph: one triangulation task per (subproject, pose config),
+    followed by one filtering task per filter type and, if enabled, one kinematics task
+    per filtering task.
+
+    Args:
+        workspace: The workspace directory to be processed.
+        configs: The configurations to be used.
+
+    Returns:
+        dict: The task graph (see utility.scheduler.add_task).
+    """
+    graph = {}
+    kinematics_configs = configs.get('kinematics', {})
+    opensim_setup_dir = os.path.join(workspace, kinematics_configs.get('opensim_setup_dir', '../opensim_setup'))
+    for subproject_folder in get_subproject_dirs(workspace):
+        for i, pose_estimation_config in enumerate(configs['pose_estimation_configs']):
+            pose_model = pose_estimation_config['pose_model']
+            triangulation_task_id = f"triangulation:{subproject_folder}:{pose_model}"
+            add_task(graph, triangulation_task_id, triangulate_subproject, (subproject_folder, configs, i),
+                     metadata={"stage": "triangulation", "subproject": subproject_folder, "pose_model": pose_model})
+            for j, filter_name in enumerate(configs['filtering']['filters']):
+                filtering_task_id = f"filtering:{subproject_folder}:{pose_model}:{filter_name}"
+                add_task(graph, filtering_task_id, filter_subproject, (subproject_folder, configs, i, j),
+                         depends_on=[triangulation_task_id],
+                         metadata={"stage": "filtering", "subproject": subproject_folder,
+                                   "pose_model": pose_model, "filter": filter_name})
+                if kinematics_configs.get('enabled', False):
+                    add_task(graph, f"kinematics:{subproject_folder}:{pose_model}:{filter_name}",
+                             run_kinematics,
+                             (subproject_folder, pose_model, filter_name, opensim_setup_dir, kinematics_configs),
+                             depends_on=[filtering_task_id],
+                             metadata={"stage": "kinematics", "subproject": subproject_folder,
+                                       "pose_model": pose_model, "filter": filter_name})
+    return graph
+
+def triangulate_subproject(subproject_folder, configs, i):
+    """
+    Associate the people of a subproject, then triangulate it with the i-th pose estimation
+    config, loosening the thresholds (see adapt_config) after every failed attempt of each
+    step. The frames and cameras whose keypoints cannot help are left out of the association
+    up front, and a subproject that cannot reach min_cameras_for_triangulation is skipped
+    (see utility.quality). With processing.chunking enabled, the trial is triangulated in
+    chunks (see utility.chunking). Nothing runs if the stamp of the triangulation shows
+    that its outputs were made with the same config and calibration.
+
+    Args:
+        subproject_folder: The subproject folder.
+        configs: The configurations to be used.
+        i: The index of the pose estimation config.
+
+    Returns:
+        dict: The triangulation section of the config that succeeded, None if the subproject
+            was skipped.
+    """
+    config_dict = prepare_processing_config_dict(subproject_folder, configs, i, 0)
+    model_name = config_dict['pose']['pose_model']
+    max_retries = configs['processing']['max_triangulation_retries']
+    quality_configs = configs.get('quality', {})
+    chunking_configs = configs['processing'].get('chunking', {})
+    output_folder = os.path.join(subproject_folder, 'pose-3d')
+    stage = f"triangulation_{model_name}"
+    stage_config = get_triangulation_config(config_dict, max_retries, quality_configs, is_chunked(chunking_configs))
+    config_hash = get_config_hash(stage_config)
+    stamp = read_stage_stamp(output_folder, stage, config_hash)
+    if stamp is not None:
+        return stamp['result']
+    if (not os.path.exists(get_stamp_file(output_folder, stage)) and
+            glob.glob(os.path.join(output_folder, f"actual_processing_config_{model_name}_*.json"))):
+        # Outputs of a version without stamps
+        logging.info(f"Adopting the existing triangulation of {subproject_folder}")
+        write_stage_stamp(output_folder, stage, config_hash, stage_config, get_triangulated_files(output_folder),
+                          config_dict['triangulation'])
+        return config_dict['triangulation']
+    excluded_frames = None
+    if quality_configs.get('enabled', True):
+        quality = assess_subproject(subproject_folder,
+                                    config_dict['triangulation']['likelihood_threshold_triangulation'],
+                                    config_dict['triangulation']['min_cameras_for_triangulation'], quality_configs)
+        os.makedirs(output_folder, exist_ok=True)
+        with atomic_output(os.path.join(output_folder, f"quality_{model_name}.json")) as partial_file:
+            with open(partial_file, 'w', encoding='utf-8') as f:
+                json.dump({key: value for key, value in quality.items() if key != 'excluded'}, f, indent=4)
+        if quality['hopeless']:
+            logging.warning(f"Skipping the triangulation of {subproject_folder}: {quality['hopeless']}")
+            return None
+        excluded_frames = quality['excluded']
+    for attempt in range(max_retries + 1):
+        try:
+            run_person_association(config_dict, excluded_frames)
+            break
+        except RuntimeError as e:
+            if attempt == max_retries:
+                raise
+            logging.warning(f"Person association of {subproject_folder} failed ({e}), retrying with adapted thresholds")
+            config_dict = adapt_config(config_dict, "person_association")
+
+    for attempt in range(max_retries + 1):
+        try:
+            if is_chunked(chunking_configs):
+                run_chunked_triangulation(config_dict, chunking_configs)
+            else:
+                run_triangulation(config_dict)
+            break
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            logging.warning(f"Triangulation of {subproject_folder} failed ({e}), retrying with adapted thresholds")
+            config_dict = adapt_config(config_dict, "triangulation")
+    write_stage_stamp(output_folder, stage, config_hash, stage_config, get_triangulated_files(output_folder),
+                      config_dict['triangulation'])
+    return config_dict['triangulation']
+
+def filter_subproject(subproject_folder, configs, i, j, dependencies):
+    """
+    Filter the triangulated results of a subproject with the j-th filter and save the
+    actual config that was used. With processing.chunking enabled, the filters that can run
+    in chunks do (see utility.chunking), the others run on the whole trial. Nothing runs if
+    the stamp of the filtering shows that its outputs were made from the same triangulation
+    with the same filter parameters.
+
     Args:
-        workspace: The workspace directory to be calibrated.
+        subproject_folder: The subproject folder.
         configs: The configurations to be used.
+        i: The index of the pose estimation config.
+        j: The index of the filter.
+        dependencies: The results of the triangulation task this one depends on.
 
     Returns:
         None
     """
-    subproject_folders = get_subproject_dirs(workspace)
-    for subproject_folder in subproject_folders:
-        for i in range(len(configs['pose_estimation_configs'])):
-            for j in range(len(configs['filtering']['filters'])):               
-                config_dict = prepare_processing_config_dict(subproject_folder, configs, i, j)
-                """
-                retry = True
-                while retry:
-                    try:
-                        run_person_association(config_dict)
-                        retry = False
-                    except Exception:
-                        config_dict = adapt_config(config_dict, "person_association")
-                """
-
-                retry = True
-                while retry:
-                    try:
-                        run_triangulation(config_dict)
-                        retry = False
-                    except Exception:
-                        config_dict = adapt_config(config_dict, "triangulation")
-
-                try: 
-                    run_filtering(config_dict)
-                except Exception as e:
-                    logging.error(f"Error in filtering with filter {config_dict['filtering']['type']}")
-                    # logging.error(e)
-                    
-                #run_kinematics(subproject_folder)
-                save_config(config_dict)                   
+    config_dict = prepare_processing_config_dict(subproject_folder, configs, i, j)
+    # Keep the thresholds that the triangulation actually succeeded with
+    config_dict['triangulation'] = next(iter(dependencies.values()))
+    if config_dict['triangulation'] is None:
+        logging.info(f"Nothing to filter in {subproject_folder}, its triangulation was skipped")
+        return
+    model_name = config_dict['pose']['pose_model']
+    filter_name = config_dict['filtering']['type']
+    output_folder = os.path.join(subproject_folder, 'pose-3d')
+    stage = f"filtering_{model_name}_{filter_name}"
+    chunking_configs = configs['processing'].get('chunking', {})
+    triangulation_config = get_triangulation_config(prepare_processing_config_dict(subproject_folder, configs, i, 0),
+                                                    configs['processing']['max_triangulation_retries'],
+                                                    configs.get('quality', {}), is_chunked(chunking_configs))
+    stage_config = get_filtering_config(config_dict, get_config_hash(triangulation_config))
+    config_hash = get_config_hash(stage_config)
+    config_file = f"actual_processing_config_{model_name}_{filter_name}.json"
+    if read_stage_stamp(output_folder, stage, config_hash) is not None:
+        return
+    if (not os.path.exists(get_stamp_file(output_folder, stage)) and
+            os.path.exists(os.path.join(output_folder, config_file))):
+        # Outputs of a version without stamps
+        logging.info(f"Adopting the existing {filter_name} filtering of {subproject_folder}")
+    else:
+        if is_chunked(chunking_configs, filter_name):
+            run_chunked_filtering(config_dict, chunking_configs)
+        else:
+            if is_chunked(chunking_configs):
+                logging.warning(f"The {filter_name} filter cannot run in chunks, filtering {subproject_folder} whole")
+            run_filtering(config_dict)
+        save_config(config_dict)
+    outputs = [os.path.basename(file) for file in glob.glob(os.path.join(output_folder, f"*_filt_{filter_name}.trc"))]
+    write_stage_stamp(output_folder, stage, config_hash, stage_config, outputs + [config_file])
+
+def get_triangulation_config(config_dict, max_retries, quality_configs=None, chunked=False):
+    """
+    Get the part of a subproject config dictionary the triangulation outputs depend on,
+    with the calibration file size and modification time, so that a new calibration
+    makes them out of date. The chunked triangulation is not Pose2Sim's (see
+    utility.chunking), its outputs are not comparable with the unchunked ones and are
+    stamped apart; the chunk size is left out, the outputs do not depend on it.
+
+    Args:
+        config_dict (dict): The subproject config dictionary.
+        max_retries (int): The number of retries with adapted thresholds.
+        quality_configs (dict, optional): The 'quality' section of the config.
+        chunked (bool): Whether the triangulation runs in chunks.
+
+    Returns:
+        dict: The config subset (see utility.config_model.get_config_hash).
+    """
+    calibration_file = os.path.join(config_dict['project']['project_dir'], '..', '..', 'Calibration', 'Calib_board.toml')
+    calibration_stat = os.stat(calibration_file) if os.path.exists(calibration_file) else None
+    return {
+        "frame_rate": config_dict['project']['frame_rate'],
+        "pose": config_dict['pose'],
+        "personAssociation": config_dict['personAssociation'],
+        "triangulation": config_dict['triangulation'],
+        "max_triangulation_retries": max_retries,
+        "quality": quality_configs or {},
+        "calibration": [calibration_stat.st_size, calibration_stat.st_mtime_ns] if calibration_stat else None,
+        # Only when set, so that the existing stamps stay valid
+        **({"chunked": True} if chunked else {}),
+    }
+
+def get_filtering_config(config_dict, triangulation_hash):
+    """
+    Get the part of a subproject config dictionary the outputs of a filter depend on: the
+    triangulation (its config hash and the thresholds it succeeded with) and the parameters
+    of that filter only.
+
+    Args:
+        config_dict (dict): The subproject config dictionary, with the triangulation section
+            returned by the triangulation.
+        triangulation_hash (str): The config hash of the triangulation.
+
+    Returns:
+        dict: The config subset (see utility.config_model.get_config_hash).
+    """
+    filter_name = config_dict['filtering']['type']
+    return {
+        "frame_rate": config_dict['project']['frame_rate'],
+        "pose": config_dict['pose'],
+        "triangulation_hash": triangulation_hash,
+        "triangulation": config_dict['triangulation'],
+        "filter": filter_name,
+        "parameters": config_dict['filtering'].get(filter_name, {}),
+    }
+
+def get_triangulated_files(output_folder):
+    """
+    Get the unfiltered TRC files of a pose-3d folder.
+
+    Args:
+        output_folder (str): The pose-3d folder.
+
+    Returns:
+        list: The file names.
+    """
+    return sorted(os.path.basename(file) for file in glob.glob(os.path.join(output_folder, '*.trc'))
+                  if '_filt_' not in os.path.basename(file))
 
 def save_config(config_dict):
     """
@@ -94,36 +326,24 @@ def adapt_config(config_dict, phase):
         )
     return config_dict
 
-def run_person_association(configs):
+@profiled()
+def run_person_association(configs, excluded_frames=None):
     """
-    Function to run person association using the provided configurations.
+    Function to run person association using the provided configurations. It runs before
+    every triangulation, whose stamp covers the association config (see
+    utility.association.associate_people).
 
     Args:
     - configs: A dictionary containing project configurations.
+    - excluded_frames: For each camera, whether each frame is left out (see utility.quality).
 
     Returns:
-    - None
+    - dict: The number of frames, people and frames with each person found.
     """
-    project_dir = configs['project']['project_dir']
-    pose_associated_path = os.path.join(project_dir, "pose-associated")   
-    if (os.path.exists(pose_associated_path) and 
-        os.path.isdir(pose_associated_path)):    
-        cameras = list(find_unique_base_names(project_dir))
-        count = 0
-        for camera in cameras:
-            pose_framework = configs['pose']['pose_framework']
-            pose_model = configs['pose']['pose_model']
-            camera_json_path = os.path.join(pose_associated_path, f"blaze_{camera}_json")         
-            if (pose_framework == 'mediapipe' and 
-                pose_model == 'BLAZEPOSE' and 
-                os.path.exists(camera_json_path)):
-                count += 1  
-        if count == len(cameras):
-            return           
-    # Person association
-    Pose2Sim.personAssociation(configs)
-    return
+    return associate_people(configs['project']['project_dir'], configs['pose']['pose_model'],
+                            configs['personAssociation'], excluded_frames)
 
+@profiled()
 def run_triangulation(config_dict):
     """
     A function to run triangulation using the provided configuration dictionary.
@@ -134,20 +354,11 @@ def run_triangulation(config_dict):
     Returns:
     None
     """
-    model_name = config_dict['pose']['pose_model']
-    project_dir = config_dict['project']['project_dir']
-    pattern = f"actual_processing_config_{model_name}_*.json"
-
-    # Search for any file that matches the pattern regardless of the filter_name
-    matching_files = glob.glob(os.path.join(project_dir, 'pose-3d', pattern))
-
-    # If there is at least one matching file, return
-    if matching_files:
-        return
-
     # Triangulation
+    from Pose2Sim import Pose2Sim  # deferred, Pose2Sim is slow to import
     Pose2Sim.triangulation(config_dict)
 
+@profiled()
 def run_filtering(config_dict):
     """
     A function to run filtering based on the provided configuration dictionary.
@@ -157,19 +368,7 @@ def run_filtering(config_dict):
         None
     """
     # Filtering
-
-    model_name = config_dict['pose']['pose_model']
-    filter_name = config_dict['filtering']['type']
-    project_dir = config_dict['project']['project_dir']
-    pattern = f"actual_processing_config_{model_name}_{filter_name}.json"
-
-    # Search for any file that matches the pattern regardless of the filter_name
-    matching_files = glob.glob(os.path.join(project_dir, 'pose-3d', pattern))
-
-    # If there is at least one matching file, return
-    if matching_files:
-        return
-
+    from Pose2Sim import Pose2Sim  # deferred, Pose2Sim is slow to import
     Pose2Sim.filtering(config_dict)
 
 def get_subproject_dirs(workspace):
@@ -186,7 +385,8 @@ def get_subproject_dirs(workspace):
     for root, dirs, _ in os.walk(workspace):
         if ("pose" in dirs and 
             ("__synced__" in root and not "unset_unset_unset_unset" in root) and 
-            os.path.exists(os.path.join(root, '..', '..', 'Calibration', 'Calib_board.toml'))):
+            os.path.exists(os.path.join(root, '..', '..', 'Calibration', 'Calib_board.toml')) and
+            is_selected_sub_setup(root)):
             subproject_folders.append(root)
     return subproject_folders
 
@@ -207,9 +407,13 @@ def prepare_processing_config_dict(subproject_folder, configs, i, j):
             "project_dir": subproject_folder,
             "frame_range": [], 
             "frame_rate": extract_fps(subproject_folder),
+            "multi_person": not configs['person_association']['single_person'],
         },
         "personAssociation": {
-            "single_person": True, 
+            "single_person": configs['person_association']['single_person'],
+            "block_size": configs['person_association']['block_size'],
+            "max_tracking_distance": configs['person_association']['max_tracking_distance'],
+            "max_gap": configs['person_association']['max_gap'],
             "tracked_keypoint": configs['person_association']['tracked_keypoint'], 
             "reproj_error_threshold_association": 
             configs['person_association']['reproj_error_threshold_association'], 
@@ -236,27 +440,9 @@ def prepare_processing_config_dict(subproject_folder, configs, i, j):
         "filtering": {
             "display_figures": configs['filtering']['display_figures'],
             "type": list(configs['filtering']['filters'])[j],
-            "butterworth": {
-                "order": configs['filtering']['filters']['butterworth']['order'],
-                "cut_off_frequency": configs['filtering']['filters']['butterworth']['cut_off_frequency'],
-            },
-            "kalman": {
-                "trust_ratio": configs['filtering']['filters']['kalman']['trust_ratio'],
-                "smooth": configs['filtering']['filters']['kalman']['smooth'],
-            },
-            "butterworth_on_speed": {
-                "order": configs['filtering']['filters']['butterworth_on_speed']['order'],
-                "cut_off_frequency": configs['filtering']['filters']['butterworth_on_speed']['cut_off_frequency'],
-            },
-            "gaussian": {
-                "sigma_kernel": configs['filtering']['filters']['gaussian']['sigma_kernel'],
-            },
-            "LOESS": {
-                "nb_values_used": configs['filtering']['filters']['LOESS']['nb_values_used'],
-            },
-            "median": {
-                "kernel_size": configs['filtering']['filters']['median']['kernel_size'],
-            },
+            # Pose2Sim expects the parameters of every filter, the listed ones are run
+            **{filter_name: configs['filtering']['filters'].get(filter_name, get_filter_parameters(filter_name))
+               for filter_name in FILTERS},
         }
     }
     
@@ -0,0 +1,339 @@
+"""
+Module description: This module contains a set of utility functions for timing the
+pipeline stages and writing a machine-readable run report.
+"""
+
+import logging
+import logging.handlers
+import os
+import csv
+import json
+import time
+import resource
+import functools
+import contextlib
+from utility.utils import log_context
+from utility.metrics import item_started, item_finished
+
+# Environment variables, so that the worker processes report to the same run
+REPORT_FILE_VARIABLE = 'MBA_RUN_REPORT_FILE'
+PROFILE_STAGE_VARIABLE = 'MBA_PROFILE_STAGE'
+PROFILER_VARIABLE = 'MBA_PROFILER'
+PROFILE_DIR_VARIABLE = 'MBA_PROFILE_DIR'
+
+RECORD_FIELDS = ["stage", "item", "pid", "status", "start", "wall_time", "cpu_time", "children_cpu_time",
+                 "peak_rss_mb", "process_peak_rss_mb", "children_peak_rss_mb", "bytes_read", "bytes_written", "frames", "fps", "error"]
+
+# Stack of the records of the stages running in the current process
+_ACTIVE_RECORDS = []
+# Peak RSS (kB) of each running stage before the peak was last reset by a nested stage
+_ACTIVE_PEAKS = []
+# Peak RSS (kB) of the process before the peak was last reset, which resets ru_maxrss too
+_PROCESS_PEAK = [0]
+
+def read_io_counters():
+    """
+    Read the storage I/O counters of the current process.
+
+    Returns:
+        tuple: The bytes read and written so far, or (None, None) if not available.
+    """
+    try:
+        with open('/proc/self/io', 'r', encoding='utf-8') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+def read_peak_rss():
+    """
+    Read the peak resident set size of the current process since it was last reset.
+
+    Returns:
+        int or None: The peak RSS in kilobytes, or None if not available.
+    """
+    try:
+        with open('/proc/self/status', 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of the current process to its current RSS.
+
+    Returns:
+        bool: Whether the peak could be reset.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='utf-8') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def start_peak_rss():
+    """
+    Start measuring the peak RSS of a stage, keeping the peaks of the running stages.
+
+    Returns:
+        bool: Whether the peak of the stage can be measured.
+    """
+    peak = read_peak_rss()
+    if peak is not None:
+        _PROCESS_PEAK[0] = max(_PROCESS_PEAK[0], peak)
+        _ACTIVE_PEAKS[:] = [max(p, peak) if p is not None else None for p in _ACTIVE_PEAKS]
+    measured = peak is not None and reset_peak_rss()
+    _ACTIVE_PEAKS.append(0 if measured else None)
+    return measured
+
+def stop_peak_rss():
+    """
+    Stop measuring the peak RSS of the innermost stage.
+
+    Returns:
+        float or None: The peak RSS of the stage in megabytes, or None if not available.
+    """
+    stage_peak = _ACTIVE_PEAKS.pop()
+    peak = read_peak_rss()
+    if stage_peak is None or peak is None:
+        return None
+    return round(max(stage_peak, peak) / 1024, 1)
+
+def add_frames(n_frames):
+    """
+    Add processed frames to the innermost stage running in the current process.
+
+    Args:
+        n_frames (int): The number of frames.
+
+    Returns:
+        None
+    """
+    if _ACTIVE_RECORDS:
+        _ACTIVE_RECORDS[-1]['frames'] = (_ACTIVE_RECORDS[-1]['frames'] or 0) + int(n_frames)
+
+def append_record(record):
+    """
+    Append a record to the run report file of the current run, if any.
+
+    Args:
+        record (dict): The stage record.
+
+    Returns:
+        None
+    """
+    report_file = os.environ.get(REPORT_FILE_VARIABLE)
+    if not report_file:
+        return
+    # Single small appends are atomic, so worker processes can share the file
+    with open(report_file, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record) + '\n')
+
+@contextlib.contextmanager
+def profile_stage(stage, item=None):
+    """
+    Context manager recording the wall time, CPU time, peak RSS, bytes read/written and
+    frames (see add_frames) of a stage for one item (the peak RSS of the process over the
+    stage, and over the life of the process in process_peak_rss_mb), appending the record to the run report
+    and counting the item in the live metrics (see utility.metrics).
+    If the stage is the one selected for profiling, a cProfile (or pyinstrument) dump is written too.
+
+    Args:
+        stage (str): The name of the stage.
+        item (str, optional): The item processed (video, folder, ...).
+
+    Yields:
+        dict: The record of the stage.
+    """
+    record = {"stage": stage, "item": item, "pid": os.getpid(), "status": "succeeded", "frames": None,
+              "error": None, "start": time.time()}
+    profiler = start_profiler(stage)
+    times = os.times()
+    read_bytes, written_bytes = read_io_counters()
+    start = time.perf_counter()
+    _ACTIVE_RECORDS.append(record)
+    start_peak_rss()
+    item_started(stage)
+    try:
+        with log_context(stage=stage, item=item):
+            yield record
+    except BaseException as e:
+        record['status'] = 'failed'
+        record['error'] = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _ACTIVE_RECORDS.pop()
+        record['peak_rss_mb'] = stop_peak_rss()
+        record['wall_time'] = round(time.perf_counter() - start, 4)
+        end_times = os.times()
+        record['cpu_time'] = round(end_times.user + end_times.system - times.user - times.system, 4)
+        record['children_cpu_time'] = round(end_times.children_user + end_times.children_system
+                                            - times.children_user - times.children_system, 4)
+        # ru_maxrss is in kilobytes on Linux
+        record['process_peak_rss_mb'] = round(max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                                  _PROCESS_PEAK[0]) / 1024, 1)
+        record['children_peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+        end_read_bytes, end_written_bytes = read_io_counters()
+        record['bytes_read'] = None if read_bytes is None else end_read_bytes - read_bytes
+        record['bytes_written'] = None if written_bytes is None else end_written_bytes - written_bytes
+        record['fps'] = round(record['frames'] / record['wall_time'], 2) if record['frames'] and record['wall_time'] else None
+        stop_profiler(profiler, stage, item)
+        append_record(record)
+        item_finished(stage, record['status'], record['frames'])
+        logging.info(f"{stage} ({item}) took {record['wall_time']:.2f} s")
+
+def describe_item(args):
+    """
+    Describe the item processed by a stage from its first argument.
+
+    Args:
+        args (tuple): The positional arguments of the stage.
+
+    Returns:
+        str or None: The item description.
+    """
+    if not args:
+        return None
+    if isinstance(args[0], dict) and 'project' in args[0]:
+        return args[0]['project'].get('project_dir')
+    return str(args[0])
+
+def profiled(stage=None):
+    """
+    Decorator recording each call of a function as a stage of the run report (see profile_stage).
+
+    Args:
+        stage (str, optional): The name of the stage, the function name by default.
+
+    Returns:
+        callable: The decorator.
+    """
+    def decorator(func):
+        name = stage or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile_stage(name, describe_item(args)):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def start_profiler(stage):
+    """
+    Start a profiler if the stage is the one selected for profiling.
+
+    Args:
+        stage (str): The name of the stage.
+
+    Returns:
+        object or None: The running profiler.
+    """
+    if os.environ.get(PROFILE_STAGE_VARIABLE) != stage:
+        return None
+    if os.environ.get(PROFILER_VARIABLE) == 'pyinstrument':
+        from pyinstrument import Profiler
+    else:
+        from cProfile import Profile as Profiler
+    profiler = Profiler()
+    if hasattr(profiler, 'enable'):
+        profiler.enable()
+    else:
+        profiler.start()
+    return profiler
+
+def stop_profiler(profiler, stage, item):
+    """
+    Stop a profiler and dump its results in the profile folder of the run.
+
+    Args:
+        profiler (object or None): The running profiler.
+        stage (str): The name of the stage.
+        item (str or None): The item processed.
+
+    Returns:
+        None
+    """
+    if profiler is None:
+        return
+    profile_dir = os.environ.get(PROFILE_DIR_VARIABLE, '.')
+    os.makedirs(profile_dir, exist_ok=True)
+    item_name = os.path.basename(os.path.normpath(str(item))) if item else 'item'
+    base_name = os.path.join(profile_dir, f"{stage}_{item_name}_{os.getpid()}_{int(time.time())}")
+    if hasattr(profiler, 'disable'):
+        profiler.disable()
+        profiler.dump_stats(f"{base_name}.prof")
+    else:
+        profiler.stop()
+        with open(f"{base_name}.html", 'w', encoding='utf-8') as f:
+            f.write(profiler.output_html())
+
+def start_run_report(workspace, task, profiling_configs=None):
+    """
+    Start the run report of a script invocation. Records of this process and of its
+    worker processes are appended to a JSON-lines file until write_run_report is called.
+
+    Args:
+        workspace (str): The workspace directory.
+        task (str): The task name (e.g. 'preprocessing').
+        profiling_configs (dict, optional): The profiling configurations ('profile_stage',
+            the stage to profile, and 'profiler', 'cprofile' or 'pyinstrument').
+
+    Returns:
+        str: The path of the run report, without extension.
+    """
+    profiling_configs = profiling_configs or {}
+    report_dir = os.path.abspath(os.path.join(workspace, profiling_configs.get('report_dir', 'run_reports')))
+    os.makedirs(report_dir, exist_ok=True)
+    report_base = os.path.join(report_dir, f"{task}_{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}")
+    os.environ[REPORT_FILE_VARIABLE] = f"{report_base}.jsonl"
+    os.environ[PROFILE_DIR_VARIABLE] = os.path.join(report_dir, 'profiles')
+    if profiling_configs.get('profile_stage'):
+        os.environ[PROFILE_STAGE_VARIABLE] = profiling_configs['profile_stage']
+        os.environ[PROFILER_VARIABLE] = profiling_configs.get('profiler', 'cprofile')
+    return report_base
+
+def write_run_report(task):
+    """
+    Write the JSON and CSV run reports of the current run from its records.
+
+    Args:
+        task (str): The task name (e.g. 'preprocessing').
+
+    Returns:
+        dict: The run report.
+    """
+    report_file = os.environ.get(REPORT_FILE_VARIABLE)
+    if not report_file:
+        return None
+    records = []
+    if os.path.exists(report_file):
+        with open(report_file, 'r', encoding='utf-8') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+
+    stages = {}
+    for record in records:
+        stage = stages.setdefault(record['stage'], {"items": 0, "failed": 0, "wall_time": 0.0, "cpu_time": 0.0,
+                                                    "frames": 0, "max_peak_rss_mb": 0.0})
+        stage['items'] += 1
+        stage['failed'] += record['status'] != 'succeeded'
+        stage['wall_time'] = round(stage['wall_time'] + record['wall_time'], 4)
+        stage['cpu_time'] = round(stage['cpu_time'] + record['cpu_time'] + record['children_cpu_time'], 4)
+        stage['frames'] += record['frames'] or 0
+        stage['max_peak_rss_mb'] = max(stage['max_peak_rss_mb'], record['peak_rss_mb'] or 0.0)
+    for stage in stages.values():
+        stage['fps'] = round(stage['frames'] / stage['wall_time'], 2) if stage['frames'] and stage['wall_time'] else None
+
+    report = {"task": task, "records": records, "stages": stages}
+    report_base = os.path.splitext(report_file)[0]
+    with open(f"{report_base}.json", 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4)
+    with open(f"{report_base}.csv", 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RECORD_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(records)
+    logging.info(f"Run report written to {report_base}.json")
+    return report
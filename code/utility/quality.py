@@ -0,0 +1,198 @@
+"""
+Module description: This module contains a set of utility functions for indexing the quality
+of the keypoints of each camera (likelihoods, detection dropouts and jitter, per frame and
+keypoint) once after the pose estimation, and for finding the frames and cameras of a
+subproject that cannot help the triangulation before running it.
+"""
+
+import logging
+import logging.handlers
+import os
+import json
+import warnings
+import numpy as np
+from utility.utils import atomic_output
+
+QUALITY_VERSION = 1
+
+def get_quality_file(json_folder):
+    """
+    Get the quality index of a JSON folder: pose/blaze_<cam>_json -> pose/blaze_<cam>_quality.npz.
+    """
+    return f"{os.path.normpath(json_folder)[:-len('_json')]}_quality.npz"
+
+def get_source_signature(json_folder):
+    """
+    Get the signature of a JSON folder (its modification time and number of files), which
+    changes when the pose estimation writes it again.
+    """
+    return np.array([os.stat(json_folder).st_mtime_ns, len(os.listdir(json_folder)), QUALITY_VERSION], dtype=np.int64)
+
+def compute_keypoint_quality(json_folder):
+    """
+    Compute the quality of the keypoints of a camera, for the most confident person of each
+    frame: its likelihoods, whether anybody was detected, and the jitter of each keypoint,
+    the change of its frame-to-frame velocity relative to the size of the person.
+
+    Args:
+        json_folder (str): The folder of the JSON files (pose/blaze_<cam>_json).
+
+    Returns:
+        dict: 'likelihood' (frames, keypoints), 'jitter' (frames, keypoints), 'detected'
+            (frames) and 'people' (frames).
+    """
+    file_names = sorted(file_name for file_name in os.listdir(json_folder) if file_name.endswith('.json'))
+    keypoints = None
+    people_counts = np.zeros(len(file_names), dtype=np.uint8)
+    for t, file_name in enumerate(file_names):
+        with open(os.path.join(json_folder, file_name), 'r', encoding='utf-8') as f:
+            people = [np.reshape(person['pose_keypoints_2d'], (-1, 3)) for person in json.load(f).get('people', [])
+                      if person.get('pose_keypoints_2d')]
+        people_counts[t] = min(len(people), 255)
+        if not people:
+            continue
+        best = max(people, key=lambda person: np.nanmean(person[:, 2]))
+        if keypoints is None:
+            keypoints = np.full((len(file_names), len(best), 3), np.nan)
+        keypoints[t, :, :] = best[:keypoints.shape[1]]
+    if keypoints is None:
+        keypoints = np.full((len(file_names), 0, 3), np.nan)
+    # Undetected keypoints are written with a null likelihood
+    keypoints[keypoints[..., 2] <= 0] = np.nan
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        scale = np.nanmax(keypoints[..., 1], axis=1) - np.nanmin(keypoints[..., 1], axis=1)
+        velocity = np.diff(keypoints[..., :2], axis=0)
+        jitter = np.full(keypoints.shape[:2], np.nan)
+        jitter[1:-1] = np.linalg.norm(np.diff(velocity, axis=0), axis=-1) / np.fmax(scale[1:-1, None], 1.0)
+    return {"likelihood": keypoints[..., 2], "jitter": jitter, "detected": people_counts > 0, "people": people_counts}
+
+def build_quality_index(json_folder):
+    """
+    Compute the quality of the keypoints of a camera and store it next to its JSON folder,
+    compactly (likelihoods on 8 bits, jitter on 16).
+
+    Args:
+        json_folder (str): The folder of the JSON files (pose/blaze_<cam>_json).
+
+    Returns:
+        dict: The quality (see compute_keypoint_quality).
+    """
+    quality = compute_keypoint_quality(json_folder)
+    likelihood = np.where(np.isnan(quality['likelihood']), 0, np.round(np.clip(quality['likelihood'], 0, 1) * 254) + 1)
+    with atomic_output(get_quality_file(json_folder)) as partial_file:
+        with open(partial_file, 'wb') as f:
+            np.savez_compressed(f, likelihood=likelihood.astype(np.uint8), jitter=quality['jitter'].astype(np.float16),
+                                detected=quality['detected'], people=quality['people'],
+                                source=get_source_signature(json_folder))
+    return quality
+
+def read_quality_index(json_folder):
+    """
+    Read the quality index of a JSON folder, building it if it is missing or older than
+    the JSON files.
+
+    Args:
+        json_folder (str): The folder of the JSON files (pose/blaze_<cam>_json).
+
+    Returns:
+        dict: The quality (see compute_keypoint_quality).
+    """
+    quality_file = get_quality_file(json_folder)
+    if os.path.exists(quality_file):
+        with np.load(quality_file) as index:
+            if np.array_equal(index['source'], get_source_signature(json_folder)):
+                likelihood = index['likelihood'].astype(float)
+                return {"likelihood": np.where(likelihood > 0, (likelihood - 1) / 254, np.nan),
+                        "jitter": index['jitter'].astype(float), "detected": index['detected'],
+                        "people": index['people']}
+    return build_quality_index(json_folder)
+
+def summarize_quality(quality, likelihood_threshold):
+    """
+    Summarize the quality of a camera for the logs and the run summaries.
+
+    Returns:
+        dict: The number of frames, the detection rate, the likelihood quartiles of the
+            detected keypoints, the rate of reliable keypoints and the median jitter.
+    """
+    likelihood = quality['likelihood'][~np.isnan(quality['likelihood'])]
+    jitter = quality['jitter'][~np.isnan(quality['jitter'])]
+    return {"frames": int(len(quality['detected'])),
+            "detection_rate": float(np.mean(quality['detected'])) if len(quality['detected']) else 0.0,
+            "likelihood_quartiles": np.percentile(likelihood, [25, 50, 75]).round(3).tolist() if len(likelihood) else None,
+            "reliable_rate": float(np.mean(np.nan_to_num(quality['likelihood']) >= likelihood_threshold))
+            if quality['likelihood'].size else 0.0,
+            "median_jitter": float(np.median(jitter)) if len(jitter) else None}
+
+def get_usable_frames(quality, likelihood_threshold, quality_configs):
+    """
+    Find the frames of a camera that can help the triangulation: somebody is detected with
+    at least 'min_keypoints' reliable keypoints, and a person alone does not jump (the
+    median jitter of the keypoints stays under 'max_jitter' times the size of the person, a
+    jump meaning a false detection).
+
+    Args:
+        quality (dict): The quality of the camera (see read_quality_index).
+        likelihood_threshold (float): The likelihood of a reliable keypoint.
+        quality_configs (dict): The 'quality' section of the config.
+
+    Returns:
+        numpy.ndarray: Whether each frame is usable.
+    """
+    reliable = np.nan_to_num(quality['likelihood']) >= likelihood_threshold
+    usable = quality['detected'] & (reliable.sum(axis=1) >= quality_configs.get('min_keypoints', 5))
+    jitter = np.where(reliable, quality['jitter'], np.nan)
+    counts = np.sum(~np.isnan(jitter), axis=1)
+    median_jitter = np.zeros(len(usable))
+    if counts.any():
+        median_jitter[counts > 0] = np.nanmedian(jitter[counts > 0], axis=1)
+    # With several people around, the most confident one changes and the jitter means nothing
+    alone = quality['people'] <= 1
+    alone[1:-1] &= alone[:-2] & alone[2:]
+    return usable & ~(alone & (median_jitter > quality_configs.get('max_jitter', 0.5)))
+
+def assess_subproject(project_dir, likelihood_threshold, min_cameras, quality_configs):
+    """
+    Find the frames and cameras of a subproject that cannot help the triangulation, from
+    the quality index of each camera. A camera with less than 'min_usable_rate' usable
+    frames is excluded, and the subproject is hopeless if less than min_cameras cameras
+    remain or less than 'min_triangulable_rate' of the frames are seen by min_cameras
+    usable cameras.
+
+    Args:
+        project_dir (str): The subproject folder (containing pose/).
+        likelihood_threshold (float): The likelihood of a reliable keypoint.
+        min_cameras (int): The number of cameras needed to triangulate.
+        quality_configs (dict): The 'quality' section of the config.
+
+    Returns:
+        dict: 'excluded' (for each camera, whether each frame is excluded), 'cameras' (the
+            summary of each camera), 'triangulable_rate' and 'hopeless' (the reason, or None).
+    """
+    pose_folder = os.path.join(project_dir, 'pose')
+    cameras = sorted(folder[len('blaze_'):-len('_json')] for folder in os.listdir(pose_folder)
+                     if folder.startswith('blaze_') and folder.endswith('_json'))
+    usable = {}
+    summaries = {}
+    for camera in cameras:
+        quality = read_quality_index(os.path.join(pose_folder, f"blaze_{camera}_json"))
+        usable[camera] = get_usable_frames(quality, likelihood_threshold, quality_configs)
+        usable_rate = float(np.mean(usable[camera])) if len(usable[camera]) else 0.0
+        summaries[camera] = {**summarize_quality(quality, likelihood_threshold), "usable_rate": usable_rate,
+                             "excluded": usable_rate < quality_configs.get('min_usable_rate', 0.2)}
+        if summaries[camera]['excluded']:
+            usable[camera][:] = False
+    n_frames = min(len(frames) for frames in usable.values()) if usable else 0
+    usable_counts = np.sum([frames[:n_frames] for frames in usable.values()], axis=0) if usable else np.zeros(0)
+    triangulable_rate = float(np.mean(usable_counts >= min_cameras)) if n_frames else 0.0
+    kept = [camera for camera in cameras if not summaries[camera]['excluded']]
+    hopeless = None
+    if len(kept) < min_cameras:
+        hopeless = f"{len(kept)} usable cameras ({', '.join(kept) or 'none'}) for {min_cameras} needed"
+    elif triangulable_rate < quality_configs.get('min_triangulable_rate', 0.05):
+        hopeless = f"{triangulable_rate:.1%} of the frames seen by {min_cameras} usable cameras"
+    excluded = {camera: ~frames for camera, frames in usable.items()}
+    logging.info(f"Quality of {project_dir}: {len(kept)}/{len(cameras)} cameras kept, "
+                 f"{triangulable_rate:.1%} of the frames triangulable")
+    return {"excluded": excluded, "cameras": summaries, "triangulable_rate": triangulable_rate, "hopeless": hopeless}
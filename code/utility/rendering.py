@@ -0,0 +1,206 @@
+"""
+Module description: This module contains a set of utility functions for rendering the
+annotated outputs of the pose estimation (skeleton images and videos) from the stored
+keypoints, on worker threads fed through bounded queues, so that the pose inference does
+not wait for the drawing and encoding.
+"""
+
+import logging
+import logging.handlers
+import os
+import json
+import queue
+import threading
+import collections
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from utility.utils import atomic_output, log_context
+from utility.video_io import VideoReader, VideoWriter
+from utility.metrics import register_gauge, unregister_gauge
+
+# Skeleton of BlazePose, the mediapipe POSE_CONNECTIONS
+BLAZEPOSE_CONNECTIONS = [
+    (0, 1), (1, 2), (2, 3), (3, 7), (0, 4), (4, 5), (5, 6), (6, 8), (9, 10), (11, 12), (11, 13), (13, 15),
+    (15, 17), (15, 19), (15, 21), (17, 19), (12, 14), (14, 16), (16, 18), (16, 20), (16, 22), (18, 20),
+    (11, 23), (12, 24), (23, 24), (23, 25), (24, 26), (25, 27), (26, 28), (27, 29), (28, 30), (29, 31),
+    (30, 32), (27, 31), (28, 32),
+]
+
+def get_render_outputs(output_folder, camera):
+    """
+    Get the annotated outputs of a camera in a pose folder.
+
+    Returns:
+        tuple: The image folder and the video file.
+    """
+    return (os.path.join(output_folder, f"{camera}_blaze_img"),
+            os.path.join(output_folder, f"{camera}_blaze.mp4"))
+
+def read_keypoints_folder(json_folder):
+    """
+    Read the keypoints of the OpenPose-like JSON files of a pose folder (one file per frame).
+
+    Args:
+        json_folder (str): The folder of the JSON files (pose/blaze_<cam>_json).
+
+    Returns:
+        list: For each frame, an array of shape (people, keypoints, 3) with x, y in pixels
+            and the likelihood.
+    """
+    frames = []
+    for file_name in sorted(os.listdir(json_folder)):
+        if file_name.endswith('.json'):
+            with open(os.path.join(json_folder, file_name), 'r', encoding='utf-8') as f:
+                people = json.load(f).get('people', [])
+            people = [np.reshape(person['pose_keypoints_2d'], (-1, 3)) for person in people
+                      if person.get('pose_keypoints_2d')]
+            frames.append(np.array(people, dtype=float) if people else np.empty((0, 0, 3)))
+    return frames
+
+def draw_keypoints(frame, people, likelihood_threshold=0.3):
+    """
+    Draw the skeletons of the people on a frame, in place.
+
+    Args:
+        frame (np.ndarray): The BGR frame.
+        people (np.ndarray): The keypoints of the people (see read_keypoints_folder).
+        likelihood_threshold (float): The keypoints below are not drawn.
+
+    Returns:
+        np.ndarray: The frame.
+    """
+    import cv2  # deferred, cv2 is slow to import
+
+    for person in people:
+        visible = (person[:, 2] >= likelihood_threshold) & np.isfinite(person[:, :2]).all(axis=1)
+        points = np.round(np.nan_to_num(person[:, :2])).astype(int)
+        for start, end in BLAZEPOSE_CONNECTIONS:
+            if end < len(person) and visible[start] and visible[end]:
+                cv2.line(frame, tuple(points[start]), tuple(points[end]), (255, 255, 255), 2, cv2.LINE_AA)
+        for point in points[visible]:
+            cv2.circle(frame, tuple(point), 3, (0, 0, 255), -1, cv2.LINE_AA)
+    return frame
+
+def render_frame(frame, people, image_file, likelihood_threshold):
+    """
+    Draw the skeletons on a frame and write it to an image file. Run on a worker thread.
+    """
+    import cv2  # deferred, cv2 is slow to import
+
+    draw_keypoints(frame, people, likelihood_threshold)
+    if image_file is not None:
+        cv2.imwrite(image_file, frame)
+    return frame
+
+def render_video(video_file, json_folder, output_folder, save_images=True, save_video=True, rendering_configs=None):
+    """
+    Render the annotated images and video of a camera from its stored keypoints. The
+    frames are decoded and encoded on their own threads (see utility.video_io) and drawn
+    by 'workers' threads with at most 'queue_size' frames in flight, written to the video
+    in order.
+
+    Args:
+        video_file (str): The video the pose was estimated on.
+        json_folder (str): The folder of its keypoints.
+        output_folder (str): The pose folder the outputs are written to.
+        save_images (bool): Whether the annotated images are written.
+        save_video (bool): Whether the annotated video is written.
+        rendering_configs (dict, optional): The 'rendering' section of the config.
+
+    Returns:
+        int: The number of frames rendered.
+    """
+    rendering_configs = rendering_configs or {}
+    if not (save_images or save_video):
+        return 0
+    camera = os.path.splitext(os.path.basename(video_file))[0]
+    image_folder, output_video = get_render_outputs(output_folder, camera)
+    keypoints = read_keypoints_folder(json_folder)
+    threshold = rendering_configs.get('likelihood_threshold', 0.3)
+    queue_size = rendering_configs.get('queue_size', 16)
+    n_frames = 0
+    with log_context(trial=os.path.dirname(output_folder), camera=camera), contextlib.ExitStack() as stack:
+        # The frames are drawn in the buffers of the reader, which keeps the ones in flight
+        reader = stack.enter_context(VideoReader(video_file, held_frames=queue_size))
+        partial_image_folder = stack.enter_context(atomic_output(image_folder)) if save_images else None
+        if save_images:
+            os.makedirs(partial_image_folder)
+        writer = None
+        if save_video:
+            writer = stack.enter_context(VideoWriter(stack.enter_context(atomic_output(output_video)),
+                                                     reader.fps, reader.size))
+        executor = stack.enter_context(ThreadPoolExecutor(rendering_configs.get('workers', 2)))
+        in_flight = collections.deque()
+        frames = iter(reader)
+        for index, people in enumerate(keypoints + [None]):
+            item = next(frames, None) if people is not None else None
+            if item is not None:
+                image_file = os.path.join(partial_image_folder, f"{camera}_blaze.{index:06d}.png") if save_images else None
+                in_flight.append(executor.submit(render_frame, item[1], people, image_file, threshold))
+            # The rendered frames are written in order, the oldest first
+            while in_flight and (len(in_flight) >= queue_size or item is None):
+                rendered = in_flight.popleft().result()
+                if writer is not None:
+                    writer.write(rendered)
+                n_frames += 1
+            if item is None:
+                break
+    if n_frames < len(keypoints):
+        logging.warning(f"{video_file} has {n_frames} frames for {len(keypoints)} keypoint files.")
+    logging.info(f"Rendered {n_frames} frames of {video_file}.")
+    return n_frames
+
+class RenderSink:
+    """
+    Renders the annotated outputs of the pose estimation on a background thread. The
+    rendering jobs go through a bounded queue, so the pose inference only waits when
+    'pending_videos' videos are already waiting to be rendered.
+    """
+
+    def __init__(self, rendering_configs=None):
+        self.rendering_configs = rendering_configs or {}
+        self.jobs = queue.Queue(maxsize=self.rendering_configs.get('pending_videos', 4))
+        self.failures = []
+        self.thread = threading.Thread(target=self.run, name='render-sink', daemon=True)
+        self.thread.start()
+        register_gauge('render_sink', self.jobs.qsize)
+
+    def submit(self, video_file, json_folder, output_folder, save_images, save_video):
+        """
+        Queue the rendering of a video, blocking while the queue is full.
+        """
+        self.jobs.put((video_file, json_folder, output_folder, save_images, save_video))
+
+    def run(self):
+        """
+        Render the queued videos until the sink is closed.
+        """
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            try:
+                render_video(*job, rendering_configs=self.rendering_configs)
+            except Exception:
+                # The keypoints are kept, the preview can be rendered later
+                logging.exception(f"Rendering {job[0]} failed.")
+                self.failures.append(job[0])
+
+    def close(self):
+        """
+        Wait for the queued videos to be rendered.
+
+        Returns:
+            list: The videos whose rendering failed.
+        """
+        self.jobs.put(None)
+        self.thread.join()
+        unregister_gauge('render_sink')
+        return self.failures
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
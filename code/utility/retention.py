@@ -0,0 +1,403 @@
+"""
+Module description: This module contains the main functionality of the workspace garbage
+collection: the artefacts of the workspace are sorted by the stage that made them, the
+space of each stage is reported, and the intermediates that can be regenerated and are not
+needed downstream anymore (temporary files, annotated pose images and videos, sub setup,
+preprocessed and synced videos) are pruned until the workspace fits in a byte budget.
+The pruned videos are recorded in pruned.json, so that the stages do not make them again
+while their downstream outputs exist.
+"""
+
+import logging
+import logging.handlers
+import os
+import re
+import glob
+import json
+import time
+from utility.utils import PARTIAL_SUFFIX, atomic_output, is_video_file, remove_output
+from utility.sub_setups import is_selected_sub_setup, uses_camera, get_sub_setup_cameras
+
+PRUNED_FILE = 'pruned.json'
+SETTING_UNSET = 'unset_unset_unset_unset'
+CATEGORIES = ['original', 'synced', 'preprocessed', 'sub_setups', 'calibration', 'pose_json', 'pose_dumps',
+              'pose_3d', 'kinematics', 'temp', 'logs', 'other']
+# Recorded in pruned.json, as the stages would make them again otherwise
+RECORDED_CATEGORIES = ['synced', 'preprocessed', 'sub_setups']
+LOG_ENTRIES = ['logs', 'run_reports', 'work_queue', 'journal.jsonl', PRUNED_FILE, 'gc_report.json']
+
+# Pruned files of each workspace, with the modification time of pruned.json
+_PRUNED = {}
+
+def parse_size(size):
+    """
+    Parse a size in bytes, with an optional K, M, G or T suffix (powers of 1024).
+
+    Args:
+        size (int or str): The size, e.g. 500000000 or '200G'.
+
+    Returns:
+        int or None: The size in bytes, None if size is None.
+    """
+    if size is None or isinstance(size, int):
+        return size
+    match = re.fullmatch(r'\s*([0-9.]+)\s*([KMGT]?)i?B?\s*', str(size), re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid size {size}, expected e.g. 500000000 or 200G.")
+    return int(float(match.group(1)) * 1024 ** ' KMGT'.index(match.group(2).upper() or ' '))
+
+def format_size(size):
+    """
+    Format a size in bytes for humans.
+    """
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+def get_workspace_of(path):
+    """
+    Get the workspace of a path of the session layout (<workspace>/<session>/__synced__/...).
+
+    Returns:
+        str or None: The workspace, None if the path is not in a __synced__ folder.
+    """
+    path = os.path.abspath(path)
+    marker = f"{os.sep}__synced__{os.sep}"
+    if marker not in path:
+        return None
+    return os.path.dirname(path.split(marker)[0])
+
+def read_pruned(workspace):
+    """
+    Read the files pruned from a workspace, cached until pruned.json changes.
+
+    Args:
+        workspace (str): The workspace directory.
+
+    Returns:
+        dict: The pruned files, relative to the workspace, with their category, size and time.
+    """
+    pruned_file = os.path.join(os.path.abspath(workspace), PRUNED_FILE)
+    try:
+        mtime = os.path.getmtime(pruned_file)
+    except FileNotFoundError:
+        return {}
+    if pruned_file not in _PRUNED or _PRUNED[pruned_file][0] != mtime:
+        with open(pruned_file, 'r', encoding='utf-8') as f:
+            _PRUNED[pruned_file] = (mtime, json.load(f))
+    return _PRUNED[pruned_file][1]
+
+def write_pruned(workspace, pruned):
+    """
+    Write the files pruned from a workspace (see read_pruned).
+    """
+    with atomic_output(os.path.join(workspace, PRUNED_FILE)) as partial_file:
+        with open(partial_file, 'w', encoding='utf-8') as f:
+            json.dump(pruned, f, indent=2, sort_keys=True)
+
+def is_pruned(path):
+    """
+    Check if a missing output was pruned by the garbage collection and is still not needed,
+    in which case the stage making it skips it.
+
+    Args:
+        path (str): The path of the output.
+
+    Returns:
+        bool: True if the output must not be made again.
+    """
+    workspace = get_workspace_of(path)
+    if workspace is None or os.path.exists(path):
+        return False
+    if os.path.relpath(os.path.abspath(path), workspace) not in read_pruned(workspace):
+        return False
+    return not is_needed(path)
+
+def is_available(path):
+    """
+    Check if an output exists, was pruned and is not needed, or is the video of a trial
+    whose poses exist without it (derived from another setting, see 'subsample_pose').
+    """
+    _, _, _, rest = split_synced_path(path)
+    if len(rest) >= 4 and rest[2] == 'raw':
+        json_folder = os.path.join(os.path.dirname(os.path.dirname(path)), 'pose',
+                                   f"blaze_{os.path.splitext(rest[-1])[0]}_json")
+        if not os.path.exists(path) and os.path.isdir(json_folder):
+            return True
+    return os.path.exists(path) or is_pruned(path)
+
+def split_synced_path(path):
+    """
+    Split a path of the __synced__ layout.
+
+    Returns:
+        tuple: The session folder, the sub setup, the setting and the remaining path parts.
+    """
+    session_folder, relative_path = os.path.abspath(path).split(f"{os.sep}__synced__{os.sep}", 1)
+    parts = relative_path.split(os.sep)
+    return session_folder, parts[0], parts[1] if len(parts) > 1 else None, parts[2:]
+
+def get_derived_files(path):
+    """
+    Get the files the pipeline derives from a video of the all_cams sub setup: its
+    preprocessed versions (for a video of the original setting) and its copies in the
+    other sub setups (see utility.preprocess.create_sub_setups).
+
+    Args:
+        path (str): The path of the video.
+
+    Returns:
+        list: The paths of the derived files.
+    """
+    session_folder, sub_setup, setting, rest = split_synced_path(path)
+    if sub_setup != 'all_cams':
+        return []
+    synced_folder = os.path.join(session_folder, '__synced__')
+    derived_files = []
+    if setting == SETTING_UNSET:
+        for other_setting in sorted(os.listdir(os.path.join(synced_folder, 'all_cams'))):
+            if other_setting != SETTING_UNSET and os.path.isdir(os.path.join(synced_folder, 'all_cams', other_setting)):
+                base = os.path.splitext(os.path.join(synced_folder, 'all_cams', other_setting, *rest))[0]
+                derived_files.append(f"{base}.{other_setting.split('_')[-1]}")
+    for other_sub_setup in sorted(os.listdir(synced_folder)):
+        other_folder = os.path.join(synced_folder, other_sub_setup)
+        # The same camera test as create_sub_setups
+        if (other_sub_setup != 'all_cams' and os.path.isdir(other_folder) and is_selected_sub_setup(other_folder) and
+                any(uses_camera(path, camera) for camera in get_sub_setup_cameras(synced_folder, other_sub_setup))):
+            derived_files.append(os.path.join(synced_folder, other_sub_setup, setting, *rest))
+    return derived_files
+
+def is_needed(path):
+    """
+    Check if a video of the __synced__ layout is still needed downstream: its own
+    consumer did not run yet (pose estimation for the videos of a trial, calibration for
+    the calibration videos) or one of the files derived from it is missing.
+
+    Args:
+        path (str): The path of the video.
+
+    Returns:
+        bool: True if the video is needed.
+    """
+    session_folder, sub_setup, setting, rest = split_synced_path(path)
+    setting_folder = os.path.join(session_folder, '__synced__', sub_setup, setting)
+    if 'Calibration' in rest:
+        if not os.path.exists(os.path.join(setting_folder, 'Calibration', 'Calib_board.toml')):
+            return True
+    elif len(rest) >= 4 and rest[2] == 'raw' and setting != SETTING_UNSET:
+        # The pose is not estimated on the videos of the original setting
+        camera = os.path.splitext(rest[-1])[0]
+        if not os.path.isdir(os.path.join(setting_folder, rest[0], rest[1], 'pose', f"blaze_{camera}_json")):
+            return True
+    return not all(is_available(derived_file) for derived_file in get_derived_files(path))
+
+def get_source(path):
+    """
+    Get the file a video of the __synced__ layout is made from.
+
+    Returns:
+        str or None: The source, None if it cannot be found.
+    """
+    session_folder, sub_setup, setting, rest = split_synced_path(path)
+    if sub_setup != 'all_cams':
+        return os.path.join(session_folder, '__synced__', 'all_cams', setting, *rest)
+    if setting == SETTING_UNSET:
+        return os.path.join(session_folder, 'original', 'all_cams', setting, *rest)
+    base = os.path.splitext(os.path.join(session_folder, '__synced__', 'all_cams', SETTING_UNSET, *rest))[0]
+    sources = [file for file in glob.glob(f"{glob.escape(base)}.*") if is_video_file(file)]
+    return sources[0] if sources else f"{base}.mp4"
+
+def is_regenerable(path):
+    """
+    Check if a video of the __synced__ layout can be made again from the original videos.
+    A video recorded by the live ingestion has no original and is never pruned.
+    """
+    source = get_source(path)
+    if f"{os.sep}original{os.sep}" in source:
+        return os.path.exists(source)
+    return os.path.exists(source) or is_regenerable(source)
+
+def get_category(path, workspace):
+    """
+    Get the category of an artefact of the workspace, the stage that made it.
+
+    Args:
+        path (str): The path of the file or folder.
+        workspace (str): The workspace directory.
+
+    Returns:
+        str: One of CATEGORIES.
+    """
+    relative_path = os.path.relpath(path, workspace)
+    parts = relative_path.split(os.sep)
+    name = os.path.basename(path)
+    if PARTIAL_SUFFIX in name or '_temp' in name or 'TEMP_MPY' in name:
+        return 'temp'
+    if parts[0] in LOG_ENTRIES or name.startswith('run_summary') or name.endswith('_report.csv'):
+        return 'logs'
+    if 'original' in parts:
+        return 'original'
+    if '__synced__' not in parts:
+        return 'other'
+    if 'pose' in parts:
+        inside = parts[parts.index('pose') + 1:]
+        if inside and (inside[0].endswith('_json') or os.path.splitext(inside[0])[1] in ('.csv', '.h5', '.npz')):
+            return 'pose_json'
+        return 'pose_dumps'
+    if 'pose-3d' in parts or 'pose-associated' in parts:
+        return 'pose_3d'
+    if 'kinematics' in parts:
+        return 'kinematics'
+    if not is_video_file(path):
+        return 'calibration' if 'Calibration' in parts else 'other'
+    _, sub_setup, setting, _ = split_synced_path(path)
+    if sub_setup != 'all_cams':
+        return 'sub_setups'
+    return 'synced' if setting == SETTING_UNSET else 'preprocessed'
+
+def get_size(path):
+    """
+    Get the size of a file or folder in bytes.
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(path) for file in files)
+
+def scan_workspace(workspace):
+    """
+    List the artefacts of a workspace. The annotated pose outputs and the partial folders
+    are listed as one artefact each.
+
+    Args:
+        workspace (str): The workspace directory.
+
+    Returns:
+        list: One dictionary per artefact with 'path', 'category', 'bytes' and 'mtime'.
+    """
+    artefacts = []
+    for root, dirs, files in os.walk(workspace):
+        units = [directory for directory in dirs
+                 if PARTIAL_SUFFIX in directory or
+                 (os.path.basename(root) == 'pose' and not directory.endswith('_json'))]
+        dirs[:] = sorted(directory for directory in dirs if directory not in units)
+        for name in units + files:
+            path = os.path.join(root, name)
+            artefacts.append({"path": path, "category": get_category(path, workspace), "bytes": get_size(path),
+                              "mtime": os.path.getmtime(path)})
+    return artefacts
+
+def is_prunable(artefact, min_age, now):
+    """
+    Check if an artefact can be pruned: a temporary file older than min_age seconds (younger
+    ones may belong to a running stage), an annotated pose output, or a video that can be
+    made again and is not needed downstream.
+    """
+    category = artefact['category']
+    if category == 'temp':
+        return now - artefact['mtime'] > min_age
+    if category == 'pose_dumps':
+        return True
+    if category in RECORDED_CATEGORIES:
+        return is_regenerable(artefact['path']) and not is_needed(artefact['path'])
+    return False
+
+def summarize_usage(artefacts, prunable_paths=()):
+    """
+    Sum the space of the artefacts per category.
+
+    Returns:
+        dict: For each category, the 'bytes' and 'files', and the 'prunable_bytes'.
+    """
+    prunable_paths = set(prunable_paths)
+    usage = {category: {"bytes": 0, "files": 0, "prunable_bytes": 0} for category in CATEGORIES}
+    for artefact in artefacts:
+        usage[artefact['category']]['bytes'] += artefact['bytes']
+        usage[artefact['category']]['files'] += 1
+        if artefact['path'] in prunable_paths:
+            usage[artefact['category']]['prunable_bytes'] += artefact['bytes']
+    return usage
+
+def collect_garbage(workspace, retention_configs, budget=None, dry_run=False):
+    """
+    Report the space used by each stage and prune the prunable artefacts, in the order of
+    'prune_order' and the largest first within a category, until the workspace fits in the
+    budget. Nothing is pruned without a budget.
+
+    Args:
+        workspace (str): The workspace directory.
+        retention_configs (dict): The 'retention' section of the config ('budget',
+            'prune_order' and 'min_age').
+        budget (int or str, optional): The budget in bytes, overriding the config.
+        dry_run (bool): Only report what would be pruned.
+
+    Returns:
+        dict: The report, also written to gc_report.json in the workspace.
+    """
+    workspace = os.path.abspath(workspace)
+    budget = parse_size(budget if budget is not None else retention_configs.get('budget'))
+    prune_order = retention_configs.get('prune_order', ['temp', 'pose_dumps', 'sub_setups', 'preprocessed', 'synced'])
+    min_age = retention_configs.get('min_age', 3600)
+    now = time.time()
+
+    artefacts = scan_workspace(workspace)
+    total = sum(artefact['bytes'] for artefact in artefacts)
+    candidates = [artefact for artefact in artefacts
+                  if artefact['category'] in prune_order and is_prunable(artefact, min_age, now)]
+    candidates.sort(key=lambda artefact: (prune_order.index(artefact['category']), -artefact['bytes']))
+    usage = summarize_usage(artefacts, [artefact['path'] for artefact in candidates])
+    for category in CATEGORIES:
+        if usage[category]['files']:
+            logging.info(f"{category:>14}: {format_size(usage[category]['bytes']):>10} in {usage[category]['files']} "
+                         f"items, {format_size(usage[category]['prunable_bytes'])} prunable")
+    logging.info(f"Workspace total: {format_size(total)}, budget: {format_size(budget) if budget else 'none'}")
+
+    pruned = []
+    remaining = total
+    pruned_files = dict(read_pruned(workspace))
+    for artefact in candidates:
+        if budget is None or remaining <= budget:
+            break
+        # Pruning a video can make its source prunable, but never needed again
+        if artefact['category'] in RECORDED_CATEGORIES and is_needed(artefact['path']):
+            continue
+        if not dry_run:
+            remove_output(artefact['path'])
+            if artefact['category'] in RECORDED_CATEGORIES:
+                pruned_files[os.path.relpath(artefact['path'], workspace)] = {
+                    "category": artefact['category'], "bytes": artefact['bytes'],
+                    "time": time.strftime('%Y-%m-%dT%H:%M:%S')}
+                write_pruned(workspace, pruned_files)
+        remaining -= artefact['bytes']
+        pruned.append(artefact)
+        logging.info(f"{'Would prune' if dry_run else 'Pruned'} {artefact['category']} "
+                     f"{os.path.relpath(artefact['path'], workspace)} ({format_size(artefact['bytes'])})")
+    if budget is not None and remaining > budget:
+        logging.warning(f"The workspace ({format_size(remaining)}) does not fit in the budget ({format_size(budget)}): "
+                        f"nothing else can be pruned without losing outputs still needed.")
+
+    report = {"workspace": workspace, "time": time.strftime('%Y-%m-%dT%H:%M:%S'), "dry_run": dry_run,
+              "budget": budget, "total_bytes": total, "remaining_bytes": remaining, "usage": usage,
+              "pruned": [{"path": os.path.relpath(artefact['path'], workspace), "category": artefact['category'],
+                          "bytes": artefact['bytes']} for artefact in pruned]}
+    with atomic_output(os.path.join(workspace, 'gc_report.json')) as partial_file:
+        with open(partial_file, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+def restore_pruned(workspace):
+    """
+    Forget the pruned files, so that the stages make them again on their next run (e.g.
+    after adding a setting).
+
+    Args:
+        workspace (str): The workspace directory.
+
+    Returns:
+        int: The number of files forgotten.
+    """
+    pruned_files = read_pruned(workspace)
+    remove_output(os.path.join(workspace, PRUNED_FILE))
+    logging.info(f"Forgot {len(pruned_files)} pruned files, the next runs will make them again.")
+    return len(pruned_files)
@@ -0,0 +1,210 @@
+"""
+Module description: This module contains a set of utility functions for running
+a graph of dependent tasks on a process pool and summarizing the run.
+"""
+
+import logging
+import logging.handlers
+import os
+import json
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from utility.utils import get_worker_initializer, log_context
+from utility.metrics import add_total, item_started, item_finished, register_gauge, unregister_gauge
+
+def add_task(graph, task_id, func, args=(), depends_on=(), metadata=None):
+    """
+    Add a task to the task graph.
+
+    Args:
+        graph (dict): The task graph, mapping task ids to task dictionaries.
+        task_id (str): The unique id of the task.
+        func (callable): A module-level (picklable) function to run.
+        args (tuple): The positional arguments passed to the function.
+        depends_on (iterable): The ids of the tasks that must succeed before this one.
+            The results of these tasks are passed to the function as the keyword
+            argument 'dependencies' (a dict mapping task ids to results).
+        metadata (dict, optional): Extra information reported in the run summary.
+
+    Returns:
+        dict: The task dictionary.
+    """
+    if task_id in graph:
+        raise ValueError(f"Task {task_id} is already in the graph.")
+    for dependency in depends_on:
+        if dependency not in graph:
+            raise ValueError(f"Task {task_id} depends on unknown task {dependency}.")
+    graph[task_id] = {
+        "id": task_id,
+        "func": func,
+        "args": tuple(args),
+        "depends_on": list(depends_on),
+        "metadata": metadata or {},
+    }
+    return graph[task_id]
+
+def execute_task(func, args, dependencies, task_id=None):
+    """
+    Run a single task and capture its outcome. This is the function executed by the workers.
+
+    Args:
+        func (callable): The function to run.
+        args (tuple): The positional arguments of the function.
+        dependencies (dict or None): The results of the upstream tasks, if any.
+        task_id (str, optional): The id of the task, added to the context of its log records.
+
+    Returns:
+        dict: The outcome with 'status', 'result', 'error', 'traceback' and 'duration' keys.
+    """
+    start = time.time()
+    try:
+        with log_context(task_id=task_id):
+            if dependencies is None:
+                result = func(*args)
+            else:
+                result = func(*args, dependencies=dependencies)
+        return {"status": "succeeded", "result": result, "error": None, "traceback": None,
+                "duration": time.time() - start}
+    except Exception as e:
+        return {"status": "failed", "result": None, "error": f"{type(e).__name__}: {e}",
+                "traceback": traceback.format_exc(), "duration": time.time() - start}
+
+def run_task_graph(graph, max_workers=1):
+    """
+    Run the task graph, starting every task as soon as all its dependencies succeeded.
+
+    Tasks whose dependencies failed are not run and are reported as 'skipped'.
+    With max_workers set to 1 the tasks run serially in the current process.
+    The tasks are counted in the live metrics under the 'stage' of their metadata, and
+    the tasks waiting for their dependencies or submitted to the workers are exposed as
+    the 'task_graph' queue.
+
+    Args:
+        graph (dict): The task graph built with add_task.
+        max_workers (int or None): The number of worker processes (None uses all the cores).
+
+    Returns:
+        dict: A dictionary mapping task ids to their outcome.
+    """
+    outcomes = {}
+    pending = dict(graph)
+    running = {}
+    for task in graph.values():
+        add_total(get_task_stage(task), 1)
+    register_gauge('task_graph', lambda: {"waiting": len(pending), "submitted": len(running)})
+
+    def ready_tasks():
+        ready, skipped = [], []
+        for task_id, task in pending.items():
+            if any(outcomes.get(dep, {}).get('status') in ('failed', 'skipped') for dep in task['depends_on']):
+                skipped.append(task_id)
+            elif all(outcomes.get(dep, {}).get('status') == 'succeeded' for dep in task['depends_on']):
+                ready.append(task_id)
+        for task_id in skipped:
+            failed = [dep for dep in pending[task_id]['depends_on'] if outcomes[dep]['status'] != 'succeeded']
+            outcomes[task_id] = {"status": "skipped", "result": None,
+                                 "error": f"Dependencies did not succeed: {', '.join(failed)}",
+                                 "traceback": None, "duration": 0.0}
+            item_finished(get_task_stage(pending.pop(task_id)), 'skipped', started=False)
+        return ready
+
+    def dependency_results(task):
+        if not task['depends_on']:
+            return None
+        return {dep: outcomes[dep]['result'] for dep in task['depends_on']}
+
+    def start(task_id):
+        task = pending.pop(task_id)
+        item_started(get_task_stage(task))
+        return task
+
+    def record(task_id, outcome):
+        outcomes[task_id] = outcome
+        item_finished(get_task_stage(graph[task_id]), outcome['status'])
+        if outcome['status'] == 'failed':
+            logging.error(f"Task {task_id} failed: {outcome['error']}")
+        else:
+            logging.info(f"Task {task_id} {outcome['status']} in {outcome['duration']:.2f} s")
+
+    if max_workers == 1:
+        while pending:
+            ready = ready_tasks()
+            if not ready and pending:
+                raise RuntimeError(f"The task graph has a cycle: {', '.join(pending)}")
+            for task_id in ready:
+                task = running[task_id] = start(task_id)
+                outcome = execute_task(task['func'], task['args'], dependency_results(task), task_id)
+                del running[task_id]
+                record(task_id, outcome)
+        unregister_gauge('task_graph')
+        return outcomes
+
+    # The workers send their log records to the listener of the main process
+    initializer, initargs = get_worker_initializer()
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=initializer, initargs=initargs) as executor:
+        while pending or running:
+            for task_id in ready_tasks():
+                task = start(task_id)
+                future = executor.submit(execute_task, task['func'], task['args'], dependency_results(task), task_id)
+                running[future] = task_id
+            if not running:
+                if pending:
+                    raise RuntimeError(f"The task graph has a cycle: {', '.join(pending)}")
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task_id = running.pop(future)
+                try:
+                    outcome = future.result()
+                except Exception as e:
+                    # The worker itself died (e.g. killed by the OS), the task could not report back
+                    outcome = {"status": "failed", "result": None, "error": f"{type(e).__name__}: {e}",
+                               "traceback": traceback.format_exc(), "duration": 0.0}
+                record(task_id, outcome)
+    unregister_gauge('task_graph')
+    return outcomes
+
+def get_task_stage(task):
+    """
+    Get the stage of a task from its metadata, the name of its function by default.
+    """
+    return task['metadata'].get('stage', task['func'].__name__)
+
+def write_run_summary(summary_file, graph, outcomes, extra=None):
+    """
+    Write a JSON summary of a task graph run.
+
+    Args:
+        summary_file (str): The path of the summary file.
+        graph (dict): The task graph that was run.
+        outcomes (dict): The outcomes returned by run_task_graph.
+        extra (dict, optional): Extra information stored at the top level of the summary.
+
+    Returns:
+        dict: The summary.
+    """
+    tasks = []
+    for task_id, task in graph.items():
+        outcome = outcomes.get(task_id, {"status": "not_run", "error": None, "traceback": None, "duration": 0.0})
+        tasks.append({
+            "id": task_id,
+            "depends_on": task['depends_on'],
+            **task['metadata'],
+            "status": outcome['status'],
+            "duration": round(outcome['duration'], 3),
+            "error": outcome['error'],
+            "traceback": outcome['traceback'],
+        })
+    counts = {}
+    for task in tasks:
+        counts[task['status']] = counts.get(task['status'], 0) + 1
+    summary = {
+        **(extra or {}),
+        "counts": counts,
+        "tasks": tasks,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(summary_file)), exist_ok=True)
+    with open(summary_file, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=4)
+    return summary
@@ -0,0 +1,422 @@
+"""
+Module description: This module contains the main functionality of the streaming mode for
+a single trial: the frames of all the cameras are decoded from the original videos from
+their audio spike on (without writing synced videos), flow through BlazePose, and each
+time step is triangulated and filtered causally as soon as all the cameras reached it.
+"""
+
+import logging
+import logging.handlers
+import os
+import glob
+import time
+import queue
+import threading
+import numpy as np
+from utility.utils import find_video_files, log_context
+from utility.sync import find_audio_spike
+from utility.cameras import read_calibration, project_points, undistort_points, triangulate_points
+from utility.motion_files import write_trc
+from utility.profiling import profile_stage, add_frames
+from utility.video_io import VideoReader, get_video_info, read_audio
+
+def find_calibration_file(trial_folder):
+    """
+    Find a calibration of the trial's sub setup made at full resolution, whatever its fps.
+
+    Args:
+        trial_folder (str): The trial folder (.../original/<sub_setup>/<setting>/<participant>/<trial>).
+
+    Returns:
+        str or None: The path of the Calib_board.toml file.
+    """
+    synced_trial_folder = trial_folder.replace(f'{os.sep}original{os.sep}', f'{os.sep}__synced__{os.sep}')
+    sub_setup_folder = os.path.dirname(os.path.dirname(os.path.dirname(os.path.normpath(synced_trial_folder))))
+    for calibration_file in sorted(glob.glob(os.path.join(sub_setup_folder, '*', 'Calibration', 'Calib_board.toml'))):
+        setting = os.path.basename(os.path.dirname(os.path.dirname(calibration_file))).split('_')
+        if setting[1:3] == ['unset', 'unset']:
+            return calibration_file
+    return None
+
+def get_sync_offsets(video_files):
+    """
+    Get the time of the audio spike of each video, where its synced stream starts.
+
+    Args:
+        video_files (list): The paths of the videos.
+
+    Returns:
+        list: The offsets in seconds (0 if a video has no spike).
+    """
+    offsets = []
+    for video_file in video_files:
+        audio_frames, audio_fps = read_audio(video_file)
+        spike_time = find_audio_spike(audio_frames, audio_fps) if audio_frames is not None else None
+        if spike_time is None:
+            logging.warning(f"No audio spike found in {video_file}, it is streamed from its start.")
+        offsets.append(spike_time or 0.0)
+    return offsets
+
+# Keypoints of BlazePose, in the order of the mediapipe landmarks
+BLAZEPOSE_KEYPOINTS = [
+    'nose', 'left_eye_inner', 'left_eye', 'left_eye_outer', 'right_eye_inner', 'right_eye', 'right_eye_outer',
+    'left_ear', 'right_ear', 'mouth_left', 'mouth_right', 'left_shoulder', 'right_shoulder', 'left_elbow',
+    'right_elbow', 'left_wrist', 'right_wrist', 'left_pinky', 'right_pinky', 'left_index', 'right_index',
+    'left_thumb', 'right_thumb', 'left_hip', 'right_hip', 'left_knee', 'right_knee', 'left_ankle',
+    'right_ankle', 'left_heel', 'right_heel', 'left_foot_index', 'right_foot_index',
+]
+
+def make_blazepose_estimator(settings):
+    """
+    Make a BlazePose estimator for one camera. It tracks the person across frames, so
+    each camera needs its own.
+
+    Args:
+        settings (dict): The pose estimation settings ('model_complexity').
+
+    Returns:
+        callable: A function mapping a BGR frame to the keypoints, an array of
+            (x, y, likelihood) rows in pixels, NaN if nobody is detected.
+    """
+    import cv2  # deferred, cv2 is slow to import
+    import mediapipe as mp  # deferred, mediapipe is slow to import
+
+    pose = mp.solutions.pose.Pose(static_image_mode=False, model_complexity=int(settings['model_complexity']))
+    n_keypoints = len(BLAZEPOSE_KEYPOINTS)
+
+    def estimate(frame):
+        height, width = frame.shape[:2]
+        results = pose.process(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        if results.pose_landmarks is None:
+            return np.full((n_keypoints, 3), np.nan)
+        return np.array([[landmark.x * width, landmark.y * height, landmark.visibility]
+                         for landmark in results.pose_landmarks.landmark])
+    return estimate
+
+def estimate_camera_stream(video_file, start_time, estimator_factory, output_queue, stop_event):
+    """
+    Decode a video from its sync offset and estimate the pose on each frame, putting
+    (time, keypoints) items in a bounded queue, then None at the end. Run in one thread
+    per camera.
+
+    Args:
+        video_file (str): The path of the video.
+        start_time (float): The sync offset in seconds.
+        estimator_factory (callable): Makes the pose estimator of the camera.
+        output_queue (queue.Queue): The queue of the keypoints.
+        stop_event (threading.Event): Set to stop early.
+
+    Returns:
+        None
+    """
+    reader = None
+    try:
+        with log_context(camera=os.path.splitext(os.path.basename(video_file))[0]):
+            estimate = estimator_factory()
+            # The next frames are decoded while the pose is estimated
+            reader = VideoReader(video_file, start_time)
+            for frame_time, frame in reader:
+                if stop_event.is_set():
+                    break
+                item = (frame_time - start_time, estimate(frame))
+                while not stop_event.is_set():
+                    try:
+                        output_queue.put(item, timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+    except Exception as e:
+        logging.error(f"Streaming {video_file} failed: {e}")
+    finally:
+        if reader is not None:
+            reader.close()
+        output_queue.put(None)
+
+def synchronize_streams(queues, fps):
+    """
+    Merge the keypoint streams of the cameras: for each frame of the first camera, take
+    the frame of every other camera closest in time.
+
+    Args:
+        queues (list): The keypoint queues of the cameras (see estimate_camera_stream).
+        fps (float): The frame rate of the first camera.
+
+    Yields:
+        tuple: The frame index, the time and the keypoints (cameras, keypoints, 3).
+    """
+    current = [None] * len(queues)
+    upcoming = [None] * len(queues)
+    ended = [False] * len(queues)
+    frame_index = 0
+    while True:
+        reference = queues[0].get()
+        if reference is None:
+            return
+        reference_time, reference_keypoints = reference
+        keypoints = [reference_keypoints]
+        for c in range(1, len(queues)):
+            # Advance while the next frame is at least as close to the reference time
+            while not ended[c]:
+                if upcoming[c] is None:
+                    upcoming[c] = queues[c].get()
+                    if upcoming[c] is None:
+                        ended[c] = True
+                        break
+                if (current[c] is not None and
+                    abs(upcoming[c][0] - reference_time) > abs(current[c][0] - reference_time)):
+                    break
+                current[c] = upcoming[c]
+                upcoming[c] = None
+            # A camera that ended more than a frame before the reference ends the stream
+            if current[c] is None or (ended[c] and abs(current[c][0] - reference_time) > 1.5 / fps):
+                return
+            keypoints.append(current[c][1])
+        yield frame_index, reference_time, np.array(keypoints)
+        frame_index += 1
+
+def triangulate_keypoints(keypoints, cameras, triangulation_configs):
+    """
+    Triangulate the keypoints of one time step. Observations below the likelihood threshold
+    are ignored, and the camera with the largest reprojection error is dropped while the
+    error exceeds the threshold and enough cameras remain.
+
+    Args:
+        keypoints (numpy.ndarray): The (x, y, likelihood) keypoints, shape (cameras, keypoints, 3).
+        cameras (list): The cameras, in the same order (see utility.cameras.read_calibration).
+        triangulation_configs (dict): The 'triangulation' section of the config.
+
+    Returns:
+        numpy.ndarray: The 3D keypoints, shape (keypoints, 3), NaN where they cannot be triangulated
+            (everywhere if there are fewer cameras than min_cameras_for_triangulation).
+    """
+    likelihood_threshold = triangulation_configs.get('likelihood_threshold_triangulation', 0.3)
+    error_threshold = triangulation_configs.get('reproj_error_threshold_triangulation', 20)
+    min_cameras = triangulation_configs.get('min_cameras_for_triangulation', 2)
+    if len(cameras) < min_cameras:
+        return np.full((keypoints.shape[1], 3), np.nan)
+
+    pixels = keypoints[..., :2]
+    likelihoods = np.nan_to_num(keypoints[..., 2])
+    weights = np.where((likelihoods >= likelihood_threshold) & ~np.isnan(pixels).any(axis=-1), likelihoods, 0.0)
+    normalized_points = np.array([undistort_points(pixels[c], camera) for c, camera in enumerate(cameras)])
+    for _ in range(len(cameras) - min_cameras + 1):
+        points = triangulate_points(normalized_points, weights, cameras)
+        errors = np.array([np.linalg.norm(project_points(points, camera) - pixels[c], axis=-1)
+                           for c, camera in enumerate(cameras)])
+        errors = np.where(weights > 0, np.nan_to_num(errors, nan=np.inf), -np.inf)
+        worst = np.argmax(errors, axis=0)
+        too_far = (errors.max(axis=0) > error_threshold) & ((weights > 0).sum(axis=0) > min_cameras)
+        if not too_far.any():
+            break
+        weights[worst[too_far], np.flatnonzero(too_far)] = 0.0
+    points[(weights > 0).sum(axis=0) < min_cameras] = np.nan
+    points[errors.max(axis=0) > error_threshold] = np.nan
+    return points
+
+class StreamingButterworth(object):
+    """
+    Causal low-pass Butterworth filter updated one sample at a time.
+
+    Attributes:
+        sos (numpy.ndarray): The second-order sections of the filter.
+        state (numpy.ndarray): The filter state of each channel.
+    """
+    def __init__(self, n_channels, fps, order=4, cut_off_frequency=6):
+        from scipy.signal import butter  # deferred, scipy is slow to import
+        self.sos = butter(order, cut_off_frequency / (fps / 2), output='sos')
+        self.state = None
+        self.last_input = np.full(n_channels, np.nan)
+
+    def update(self, values):
+        """
+        Filter a sample. Missing channels (NaN) hold their last value in the filter and
+        are returned as NaN.
+
+        Args:
+            values (numpy.ndarray): The sample, one value per channel.
+
+        Returns:
+            numpy.ndarray: The filtered sample.
+        """
+        from scipy.signal import sosfilt, sosfilt_zi  # deferred, scipy is slow to import
+        missing = np.isnan(values)
+        # Channels start from a steady state at their first value
+        first = ~missing & np.isnan(self.last_input)
+        if self.state is None:
+            self.state = np.zeros((self.sos.shape[0], 2, values.shape[0]))
+        if first.any():
+            self.state[:, :, first] = sosfilt_zi(self.sos)[:, :, None] * values[first]
+        self.last_input = np.where(missing, self.last_input, values)
+        filtered, self.state = sosfilt(self.sos, np.nan_to_num(self.last_input)[None, :], axis=0, zi=self.state)
+        return np.where(missing | np.isnan(self.last_input), np.nan, filtered[0])
+
+class StreamingKalman(object):
+    """
+    Constant-acceleration Kalman filter of independent channels, updated one sample at a
+    time, with the noise model of the single pass (smooth false) of the Pose2Sim kalman
+    filter: a measurement noise of MEASUREMENT_NOISE and a process noise of
+    MEASUREMENT_NOISE * trust_ratio, both squared into variances. As in Pose2Sim, a channel
+    restarts after each gap. Being causal, it starts with no velocity and acceleration,
+    where Pose2Sim estimates them from the next samples.
+
+    Attributes:
+        transition (numpy.ndarray): The state transition matrix.
+        process_noise (numpy.ndarray): The process noise covariance.
+        measurement_noise (float): The measurement noise variance.
+    """
+    MEASUREMENT_NOISE = 20
+
+    def __init__(self, n_channels, fps, trust_ratio=100):
+        dt = 1 / fps
+        self.transition = np.array([[1, dt, dt ** 2 / 2], [0, 1, dt], [0, 0, 1]])
+        # The discrete white noise of filterpy's Q_discrete_white_noise(3, dt), used by Pose2Sim
+        white_noise = np.array([[dt ** 2 / 2], [dt], [1]])
+        self.process_noise = white_noise @ white_noise.T * (self.MEASUREMENT_NOISE * int(trust_ratio)) ** 2
+        self.measurement_noise = self.MEASUREMENT_NOISE ** 2
+        self.state = np.full((n_channels, 3), np.nan)
+        self.covariance = np.zeros((n_channels, 3, 3))
+
+    def update(self, values):
+        """
+        Filter a sample. Missing channels (NaN) are returned as NaN and restart at their
+        next value.
+
+        Args:
+            values (numpy.ndarray): The sample, one value per channel.
+
+        Returns:
+            numpy.ndarray: The filtered sample.
+        """
+        missing = np.isnan(values)
+        self.state[missing] = np.nan
+        first = ~missing & np.isnan(self.state[:, 0])
+        self.state[first] = np.stack([values[first], np.zeros(first.sum()), np.zeros(first.sum())], axis=-1)
+        self.covariance[first] = np.eye(3) * self.MEASUREMENT_NOISE
+        # Prediction
+        self.state = self.state @ self.transition.T
+        self.covariance = self.transition @ self.covariance @ self.transition.T + self.process_noise
+        # Correction of the measured channels
+        measured = ~missing
+        innovation = values[measured] - self.state[measured, 0]
+        gain = self.covariance[measured, :, 0] / (self.covariance[measured, 0, 0] + self.measurement_noise)[:, None]
+        self.state[measured] += gain * innovation[:, None]
+        self.covariance[measured] -= gain[:, :, None] * self.covariance[measured, 0:1, :]
+        return np.where(missing, np.nan, self.state[:, 0])
+
+def make_streaming_filter(filter_name, filter_configs, n_channels, fps):
+    """
+    Make a causal filter from the filtering configs.
+
+    Args:
+        filter_name (str): 'butterworth' or 'kalman'.
+        filter_configs (dict): The 'filtering' -> 'filters' section of the config.
+        n_channels (int): The number of channels.
+        fps (float): The frame rate.
+
+    Returns:
+        StreamingButterworth or StreamingKalman: The filter.
+    """
+    parameters = filter_configs.get(filter_name, {})
+    if filter_name == 'butterworth':
+        return StreamingButterworth(n_channels, fps, parameters.get('order', 4), parameters.get('cut_off_frequency', 6))
+    if filter_name == 'kalman':
+        return StreamingKalman(n_channels, fps, parameters.get('trust_ratio', 100))
+    raise ValueError(f"The {filter_name} filter cannot run in streaming mode, use butterworth or kalman.")
+
+def stream_trial_poses(video_files, offsets, cameras, estimator_factory, fps, config):
+    """
+    Run the streaming pipeline: one decoding and pose estimation thread per camera feeding
+    bounded queues, merged per time step, triangulated and filtered causally.
+
+    Args:
+        video_files (list): The videos, in the order of the cameras.
+        offsets (list): The sync offset of each video in seconds.
+        cameras (list): The cameras (see utility.cameras.read_calibration).
+        estimator_factory (callable): Makes the pose estimator of a camera.
+        fps (float): The frame rate of the first video.
+        config (dict): The workspace config.
+
+    Yields:
+        tuple: The frame index, the time and the filtered 3D keypoints (keypoints, 3).
+    """
+    streaming_configs = config.get('streaming', {})
+    queues = [queue.Queue(maxsize=streaming_configs.get('queue_size', 16)) for _ in video_files]
+    stop_event = threading.Event()
+    threads = [threading.Thread(target=estimate_camera_stream,
+                                args=(video_file, offset, estimator_factory, camera_queue, stop_event), daemon=True)
+               for video_file, offset, camera_queue in zip(video_files, offsets, queues)]
+    for thread in threads:
+        thread.start()
+    stream_filter = None
+    try:
+        for frame_index, frame_time, keypoints in synchronize_streams(queues, fps):
+            points = triangulate_keypoints(keypoints, cameras, config['triangulation'])
+            if stream_filter is None:
+                stream_filter = make_streaming_filter(streaming_configs.get('filter', 'butterworth'),
+                                                      config['filtering']['filters'], points.size, fps)
+            yield frame_index, frame_time, stream_filter.update(points.ravel()).reshape(points.shape)
+    finally:
+        stop_event.set()
+        for camera_queue in queues:
+            # Unblock the threads waiting for room in the queues
+            while not camera_queue.empty():
+                camera_queue.get_nowait()
+        for thread in threads:
+            thread.join()
+
+def stream_trial(trial_folder, config, calibration_file=None, estimator_factory=None):
+    """
+    Stream a trial from its original videos to a filtered TRC file, written to the pose-3d
+    folder of the trial in the __synced__ layout.
+
+    Args:
+        trial_folder (str): The trial folder under original/ (containing raw/).
+        config (dict): The workspace config ('streaming' section: 'filter' and 'queue_size').
+        calibration_file (str, optional): The calibration, found with find_calibration_file by default.
+        estimator_factory (callable, optional): Makes the pose estimator of a camera (BlazePose
+            keypoints), BlazePose with the first pose estimation config by default.
+
+    Returns:
+        dict: The output file, the number of frames, the time to the first result and the duration.
+    """
+    start = time.time()
+    pose_settings = config['pose_estimation_configs'][0]
+    if pose_settings['pose_model'] != 'BLAZEPOSE':
+        raise ValueError("The specified model has not been integrated, yet.")
+    filter_name = config.get('streaming', {}).get('filter', 'butterworth')
+    calibration_file = calibration_file or find_calibration_file(trial_folder)
+    if calibration_file is None:
+        raise FileNotFoundError(f"No full resolution calibration found for {trial_folder}.")
+    cameras_by_name = {camera['name']: camera for camera in read_calibration(calibration_file)}
+    video_files = sorted(file for file in find_video_files([os.path.join(trial_folder, 'raw')])
+                         if os.path.splitext(os.path.basename(file))[0] in cameras_by_name)
+    if len(video_files) < 2:
+        raise ValueError(f"Less than two videos of {trial_folder} are in {calibration_file}.")
+    cameras = [cameras_by_name[os.path.splitext(os.path.basename(file))[0]] for file in video_files]
+    fps = get_video_info(video_files[0])['fps']
+    estimator_factory = estimator_factory or (lambda: make_blazepose_estimator(pose_settings))
+
+    rows = []
+    first_result_time = None
+    with profile_stage('streaming', trial_folder):
+        offsets = get_sync_offsets(video_files)
+        for frame_index, frame_time, points in stream_trial_poses(video_files, offsets, cameras,
+                                                                  estimator_factory, fps, config):
+            if first_result_time is None:
+                first_result_time = time.time() - start
+                logging.info(f"First streamed result after {first_result_time:.2f} s")
+            # Z-up world to the Y-up convention of OpenSim, as Pose2Sim does
+            rows.append(np.concatenate([[frame_index, frame_time], points[:, [1, 2, 0]].ravel()]))
+        add_frames(len(rows))
+
+    synced_trial_folder = trial_folder.replace(f'{os.sep}original{os.sep}', f'{os.sep}__synced__{os.sep}')
+    output_folder = os.path.join(synced_trial_folder, 'pose-3d')
+    os.makedirs(output_folder, exist_ok=True)
+    output_file = os.path.join(output_folder,
+                               f"{os.path.basename(os.path.normpath(trial_folder))}_streaming_filt_{filter_name}.trc")
+    data = np.array(rows) if rows else np.empty((0, 2 + 3 * len(BLAZEPOSE_KEYPOINTS)))
+    write_trc(output_file, data, BLAZEPOSE_KEYPOINTS, fps)
+    duration = time.time() - start
+    logging.info(f"Streamed {len(rows)} frames of {trial_folder} in {duration:.2f} s to {output_file}")
+    return {"output_file": output_file, "frames": len(rows), "time_to_first_result": first_result_time,
+            "duration": duration}
@@ -0,0 +1,265 @@
+"""
+Module description: This module contains a set of utility functions for selecting the camera
+combinations (sub setups) of a session: every combination, the combinations of some sizes,
+or at most a number of them, spread over the cameras and, with the 'geometry' policy,
+picked for the diversity of their viewpoints from the calibration of the whole rig. The
+selection is recorded in __synced__/sub_setups.json, and the stages ignore the sub setup
+folders it does not list.
+"""
+
+import logging
+import logging.handlers
+import os
+import re
+import json
+import glob
+import itertools
+import numpy as np
+from utility.utils import atomic_output
+from utility.cameras import read_calibration, get_camera_centers
+
+SUB_SETUPS_FILE = 'sub_setups.json'
+POLICIES = ['exhaustive', 'size', 'budget', 'geometry']
+# The options of the config a recorded selection depends on, with their defaults
+SELECTION_OPTIONS = {"policy": "exhaustive", "sizes": [], "max_combinations": 20}
+
+def get_sub_setup_name(cameras):
+    """
+    Get the folder name of a camera combination, e.g. ('cam2', 'cam1') -> 'cam1_cam2'.
+    """
+    return '_'.join(sorted(cameras))
+
+def uses_camera(path, camera):
+    """
+    Check if a file of a sub setup folder belongs to a camera: the camera name appears in
+    one of its folder or file names, delimited by underscores or the ends of the name, e.g.
+    raw/cam1.mp4, raw/cam_1.mp4 for the camera cam_1 or
+    Calibration/intrinsics/int_cam1_img/int_cam1.mp4, but not raw/cam10.mp4.
+
+    Args:
+        path (str): The path of the file, relative to its sub setup folder or under __synced__.
+        camera (str): The camera name.
+
+    Returns:
+        bool: True if the file belongs to the camera.
+    """
+    marker = f"{os.sep}__synced__{os.sep}"
+    if marker in path:
+        path = path.split(marker, 1)[1].split(os.sep, 1)[-1]
+    pattern = re.compile(f"(^|_){re.escape(camera)}(_|$)")
+    return any(pattern.search(os.path.splitext(part)[0]) for part in os.path.normpath(path).split(os.sep))
+
+def get_sizes(n_cameras, sub_setups_configs):
+    """
+    Get the sizes of the combinations to select from, largest first: the configured
+    'sizes' (all of them, 2 to n_cameras - 1, for the 'exhaustive' policy or if none is
+    configured), all_cams being the combination of every camera.
+    """
+    sizes = sub_setups_configs.get('sizes') or []
+    if sub_setups_configs.get('policy', 'exhaustive') == 'exhaustive' or not sizes:
+        sizes = range(2, n_cameras)
+    return sorted({size for size in sizes if 2 <= size < n_cameras}, reverse=True)
+
+def get_view_directions(calibration):
+    """
+    Get the direction from the center of the scene to each camera, the center being the
+    point closest to the optical axes of the cameras.
+
+    Args:
+        calibration (list): The cameras (see utility.cameras.read_calibration).
+
+    Returns:
+        numpy.ndarray: The unit directions, shape (cameras, 3).
+    """
+    centers = get_camera_centers(calibration)
+    axes = np.array([camera['R'].T @ np.array([0.0, 0.0, 1.0]) for camera in calibration])
+    projections = np.eye(3)[None] - axes[:, :, None] * axes[:, None, :]
+    scene_center = np.linalg.lstsq(projections.sum(axis=0), np.einsum('nij,nj->i', projections, centers),
+                                   rcond=None)[0]
+    directions = centers - scene_center
+    return directions / np.linalg.norm(directions, axis=1, keepdims=True)
+
+def score_combination(directions):
+    """
+    Score the viewpoints of a camera combination for triangulation: the sine of the angle
+    between two viewing directions is 0 for cameras seeing the scene from the same (or the
+    opposite) side and 1 for perpendicular ones. The score is the smallest sine over the
+    pairs of cameras, plus a hundredth of their mean to break the ties.
+
+    Args:
+        directions (numpy.ndarray): The view directions of the cameras (see get_view_directions).
+
+    Returns:
+        float: The score.
+    """
+    sines = [np.linalg.norm(np.cross(directions[i], directions[j]))
+             for i, j in itertools.combinations(range(len(directions)), 2)]
+    return float(np.min(sines) + np.mean(sines) / 100)
+
+def find_rig_calibration(synced_folder, cameras):
+    """
+    Find a calibration of every camera of a session: the all_cams calibration of one of
+    its settings, or else of another session of the workspace with the same camera names.
+
+    Args:
+        synced_folder (str): The __synced__ folder of the session.
+        cameras (list): The camera names.
+
+    Returns:
+        tuple: The calibration file and its cameras ordered as the names, or (None, None).
+    """
+    session_pattern = os.path.join('all_cams', '*', 'Calibration', 'Calib_board.toml')
+    calibration_files = sorted(glob.glob(os.path.join(glob.escape(synced_folder), session_pattern)))
+    workspace = os.path.dirname(os.path.dirname(os.path.normpath(synced_folder)))
+    calibration_files += sorted(glob.glob(os.path.join(glob.escape(workspace), '*', '__synced__', session_pattern)))
+    for calibration_file in calibration_files:
+        try:
+            calibration = {camera['name']: camera for camera in read_calibration(calibration_file)}
+        except Exception as e:
+            logging.warning(f"Cannot read {calibration_file}: {e}")
+            continue
+        if all(camera in calibration for camera in cameras):
+            return calibration_file, [calibration[camera] for camera in cameras]
+    return None, None
+
+def select_combinations(cameras, sub_setups_configs, calibration=None):
+    """
+    Select the camera combinations of a session with the configured policy:
+    - 'exhaustive': every combination of 2 to n - 1 cameras.
+    - 'size': every combination of the configured 'sizes'.
+    - 'budget': at most 'max_combinations' combinations of the 'sizes', taken in turn from
+      each size, each time one of those whose cameras were selected the least.
+    - 'geometry': as 'budget', preferring among those the combinations with the most
+      diverse viewpoints (see score_combination), if the calibration is given.
+
+    Args:
+        cameras (list): The camera names.
+        sub_setups_configs (dict): The 'sub_setups' section of the config.
+        calibration (list, optional): The cameras of the calibration, ordered as the names.
+
+    Returns:
+        list: The selected combinations (tuples of camera names) with their scores (None
+            without the calibration), largest combinations first.
+    """
+    cameras = sorted(cameras)
+    policy = sub_setups_configs.get('policy', 'exhaustive')
+    sizes = get_sizes(len(cameras), sub_setups_configs)
+    candidates = {size: list(itertools.combinations(range(len(cameras)), size)) for size in sizes}
+    if policy in ('exhaustive', 'size'):
+        return [(tuple(cameras[i] for i in combination), None) for size in sizes for combination in candidates[size]]
+
+    directions = get_view_directions(calibration) if policy == 'geometry' and calibration is not None else None
+    scores = {combination: score_combination(directions[list(combination)]) if directions is not None else 0.0
+              for size in sizes for combination in candidates[size]}
+    usage = np.zeros(len(cameras), dtype=int)
+    selected = []
+    max_combinations = sub_setups_configs.get('max_combinations', 20)
+    while len(selected) < max_combinations and any(candidates.values()):
+        for size in sizes:
+            if not candidates[size] or len(selected) >= max_combinations:
+                continue
+            best = min(candidates[size], key=lambda combination: (usage[list(combination)].max(), -scores[combination],
+                                                                  usage[list(combination)].sum(), combination))
+            candidates[size].remove(best)
+            usage[list(best)] += 1
+            selected.append(best)
+    selected.sort(key=lambda combination: (-len(combination), combination))
+    return [(tuple(cameras[i] for i in combination), scores[combination] if directions is not None else None)
+            for combination in selected]
+
+def read_sub_setups_record(synced_folder):
+    """
+    Read the sub setups selected for a session.
+
+    Args:
+        synced_folder (str): The __synced__ folder of the session.
+
+    Returns:
+        dict or None: The record, None if the sub setups were not selected yet.
+    """
+    record_file = os.path.join(synced_folder, SUB_SETUPS_FILE)
+    if not os.path.exists(record_file):
+        return None
+    with open(record_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def get_sub_setup_cameras(synced_folder, sub_setup):
+    """
+    Get the cameras of a sub setup of a session, as recorded, or else from its folder name
+    (workspaces made before the selection was recorded, camera names without underscores).
+
+    Args:
+        synced_folder (str): The __synced__ folder of the session.
+        sub_setup (str): The name of the sub setup folder.
+
+    Returns:
+        list: The camera names.
+    """
+    record = read_sub_setups_record(synced_folder)
+    if record is not None and sub_setup in record['sub_setups']:
+        return record['sub_setups'][sub_setup]['cameras']
+    return sub_setup.split('_')
+
+def is_selected_sub_setup(path):
+    """
+    Check if a path of the __synced__ layout belongs to all_cams or to a sub setup selected
+    for its session. Without a record, every sub setup is selected (workspaces made before
+    the selection was recorded).
+
+    Args:
+        path (str): A path under <session>/__synced__/<sub_setup>/.
+
+    Returns:
+        bool: True if the sub setup is selected.
+    """
+    marker = f"{os.sep}__synced__{os.sep}"
+    path = os.path.abspath(path)
+    if marker not in path:
+        return True
+    session_folder, relative_path = path.split(marker, 1)
+    sub_setup = relative_path.split(os.sep)[0]
+    if sub_setup == 'all_cams':
+        return True
+    record = read_sub_setups_record(os.path.join(session_folder, '__synced__'))
+    return record is None or sub_setup in record['sub_setups']
+
+def plan_sub_setups(all_cams_folder, cameras, sub_setups_configs):
+    """
+    Get the sub setups of a session, selecting them (and recording the selection) unless
+    the recorded selection was made from the same cameras and options. A recorded selection
+    is kept even if it was made by the 'geometry' policy before a calibration of the rig
+    existed, so that the sub setups (and everything made from them) do not change between
+    runs; removing the record selects them again.
+
+    Args:
+        all_cams_folder (str): The __synced__/all_cams folder of the session.
+        cameras (list): The camera names.
+        sub_setups_configs (dict): The 'sub_setups' section of the config.
+
+    Returns:
+        dict: The names of the selected sub setups mapped to their cameras.
+    """
+    synced_folder = os.path.dirname(os.path.normpath(all_cams_folder))
+    cameras = sorted(cameras)
+    options = {option: sub_setups_configs.get(option, default) for option, default in SELECTION_OPTIONS.items()}
+    record = read_sub_setups_record(synced_folder)
+    if record is not None and record['cameras'] == cameras and record['options'] == options:
+        return {name: sub_setup['cameras'] for name, sub_setup in record['sub_setups'].items()}
+
+    calibration_file, calibration = None, None
+    if options['policy'] == 'geometry':
+        calibration_file, calibration = find_rig_calibration(synced_folder, cameras)
+        if calibration is None:
+            logging.warning(f"No calibration of {', '.join(cameras)} in the workspace, selecting the sub setups "
+                            f"of {synced_folder} without their geometry. The selection is kept on the next runs; "
+                            f"remove {SUB_SETUPS_FILE} to select them again once a calibration exists.")
+    combinations = select_combinations(cameras, options, calibration)
+    record = {"cameras": cameras, "options": options, "calibration_file": calibration_file,
+              "sub_setups": {get_sub_setup_name(combination): {"cameras": list(combination), "score": score}
+                             for combination, score in combinations}}
+    with atomic_output(os.path.join(synced_folder, SUB_SETUPS_FILE)) as partial_file:
+        with open(partial_file, 'w', encoding='utf-8') as f:
+            json.dump(record, f, indent=4)
+    logging.info(f"Selected {len(combinations)} sub setups of {len(cameras)} cameras in {synced_folder} "
+                 f"({options['policy']}).")
+    return {name: sub_setup['cameras'] for name, sub_setup in record['sub_setups'].items()}
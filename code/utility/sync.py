@@ -4,11 +4,15 @@ Module description: This module contains a set of utility functions for synching
 
 import logging
 import logging.handlers
-import shutil
 import os
-import torch
-from moviepy.editor import VideoFileClip
-from utility.utils import find_folders_with_multiple_videos, find_video_files
+import numpy as np
+from utility.utils import (find_folders_with_multiple_videos, find_video_files, log_context, atomic_output,
+                           copy_file_atomically)
+from utility.journal import is_pending, mark_completed
+from utility.profiling import profiled, add_frames
+from utility.metrics import add_total
+from utility.retention import is_pruned
+from utility.video_io import get_video_info, read_audio, transcode_video
 
 def get_folders_to_be_synced(workspace):
     """
@@ -36,67 +40,68 @@ def get_synced_folders(workspace):
     """
     return [os.path.join(root, folder) for root, dirs, files in os.walk(workspace) for folder in dirs if '__synced__' in folder]
 
+def find_audio_spike(audio_frames, fps):
+    """
+    Find the first audio spike (e.g. a clap): the first sample whose energy exceeds the
+    mean energy by two standard deviations.
+
+    Args:
+        audio_frames (numpy.ndarray): The audio samples, one row per sample and one column per channel.
+        fps (float): The audio sample rate.
+
+    Returns:
+        float or None: The time of the spike in seconds, None if there is none.
+    """
+    energy = (audio_frames ** 2).sum(axis=1)
+    threshold = np.mean(energy) + 2 * np.std(energy, ddof=1)
+    spike_indices = np.flatnonzero(energy > threshold)
+    if len(spike_indices) == 0:
+        return None
+    return int(spike_indices[0]) / fps
 
-def trim_video_before_audio_spike(video_path):
+def get_video_audio_spike(video_path):
     """
-    Trims a video before an audio spike.
+    Get the time of the audio spike of a video, where its synced version starts.
 
     Args:
         video_path (str): The path to the video file.
 
     Returns:
-        float: The duration of the trimmed video.
+        tuple: The time of the spike (0 if there is none) and the duration of the video after it.
     """
-    clip = VideoFileClip(video_path)
-    audio = clip.audio
-
-    if not audio:
+    audio_frames, audio_fps = read_audio(video_path)
+    if audio_frames is None:
         raise FileNotFoundError(f"Video {video_path} doesn't have any audio.")
 
-    fps = audio.fps
-    audio_frames = audio.to_soundarray(fps=fps)
-    energy = torch.tensor(audio_frames ** 2).sum(dim=1)
-    threshold = torch.mean(energy) + 2 * torch.std(energy)
-    spike_indices = torch.where(energy > threshold)[0]
+    duration = get_video_info(video_path)['duration']
+    spike_time = find_audio_spike(audio_frames, audio_fps)
 
-    if len(spike_indices) == 0:
+    if spike_time is None:
         logging.info("No audio spike found exceeding the threshold. Skipping trimming.")
-        return clip.duration
-
-    spike_frame = spike_indices[0].item()
-    spike_time = spike_frame / fps
-    trimmed_clip = clip.subclip(spike_time)
+        return 0.0, duration
 
-    new_folder = os.path.split(video_path)[0].replace(f"{os.sep}original{os.sep}", f"{os.sep}__synced__{os.sep}")
-    os.makedirs(new_folder, exist_ok=True)
+    return spike_time, duration - spike_time
 
-    new_file_path = os.path.join(new_folder, os.path.split(video_path)[1])
-    trimmed_clip.write_videofile(new_file_path, codec="libx264", audio=False)
-
-    clip.close()
-    trimmed_clip.close()
-
-    return trimmed_clip.duration
-
-def trim_video_after_a_while(file_path, new_duration):
+def trim_video(video_path, start_time, new_duration):
     """
-    Trims a video file to the specified duration and replaces the original file with the trimmed version.
+    Write the synced version of a video, from its audio spike and for the common duration
+    of its folder, in a single pass.
 
     Args:
-        file_path (str): The path to the video file to be trimmed.
-        new_duration (float): The new duration in seconds to trim the video to.
+        video_path (str): The path to the original video file.
+        start_time (float): The time of the audio spike in seconds.
+        new_duration (float): The duration of the synced video in seconds.
 
     Returns:
-        str: The file path of the trimmed video.
+        str: The file path of the synced video.
     """
-    video = VideoFileClip(file_path).subclip(0, new_duration)
-    my_format = os.path.splitext(file_path)[1]
-    temp_file_path = file_path.replace(f'{my_format}', f'_temp{my_format}')
-    video.write_videofile(temp_file_path, codec='libx264', audio=False)
-    video.close()
-    os.remove(file_path)
-    os.rename(temp_file_path, file_path)
-    return file_path
+    new_file_path = video_path.replace(f"{os.sep}original{os.sep}", f"{os.sep}__synced__{os.sep}")
+    os.makedirs(os.path.dirname(new_file_path), exist_ok=True)
+    # The synced video appears in a single rename
+    with atomic_output(new_file_path) as temp_file_path:
+        n_frames = transcode_video(video_path, temp_file_path, start=start_time, end=start_time + new_duration)
+    add_frames(n_frames)
+    return new_file_path
 
 def copy_calibration_files(workspace):
     """
@@ -113,10 +118,10 @@ def copy_calibration_files(workspace):
             file_path = os.path.join(root, file)
             if f"{os.sep}original{os.sep}" in file_path:
                 new_file_path = file_path.replace(f"{os.sep}original{os.sep}", f"{os.sep}__synced__{os.sep}")
-                if not os.path.exists(new_file_path):
-                    os.makedirs(os.path.dirname(new_file_path), exist_ok=True)
-                    shutil.copy(file_path, new_file_path)
+                if not os.path.exists(new_file_path) and not is_pruned(new_file_path):
+                    copy_file_atomically(file_path, new_file_path)
 
+@profiled()
 def sync_videos(workspace):
     """
     Synchronizes video files in the given workspace.
@@ -128,17 +133,38 @@ def sync_videos(workspace):
         None
     """
     folders_to_be_synced = get_folders_to_be_synced(workspace)
+    add_total('sync_folder', len(folders_to_be_synced))
     for folder_to_be_synced in folders_to_be_synced:
-        files_to_be_synced = [
-            file for file in find_video_files([folder_to_be_synced])
-            if not (f'{os.sep}raw{os.sep}' in file and os.path.exists(
-                file.replace(f'{os.sep}original{os.sep}', f'{os.sep}__synced__{os.sep}')))
-        ]
-        if not files_to_be_synced:
-            continue
-        durations = [trim_video_before_audio_spike(file) for file in files_to_be_synced]
-        final_duration = min(durations)
-        for file in files_to_be_synced:
-            trimmed_file = file.replace(f'{os.sep}original{os.sep}', f'{os.sep}__synced__{os.sep}')
-            trim_video_after_a_while(trimmed_file, final_duration)
+        sync_folder(folder_to_be_synced)
     copy_calibration_files(workspace)
+
+@profiled()
+def sync_folder(folder_to_be_synced):
+    """
+    Synchronizes the videos of a folder. The folder is recorded in the journal once all
+    its videos are trimmed.
+
+    Args:
+        folder_to_be_synced (str): The path of the folder.
+
+    Returns:
+        float or None: The common duration of the synced videos, None if already synced.
+    """
+    files_to_be_synced = find_video_files([folder_to_be_synced])
+    # The videos of a folder are trimmed to a common duration, so they are synced together
+    synced_files_exist = all(
+        os.path.exists(synced_file) or is_pruned(synced_file)
+        for synced_file in [file.replace(f'{os.sep}original{os.sep}', f'{os.sep}__synced__{os.sep}')
+                            for file in files_to_be_synced])
+    if not is_pending('sync', folder_to_be_synced, synced_files_exist):
+        return None
+    spikes = {}
+    for file in files_to_be_synced:
+        with log_context(trial=folder_to_be_synced, camera=os.path.splitext(os.path.basename(file))[0]):
+            spikes[file] = get_video_audio_spike(file)
+    final_duration = min(duration for _, duration in spikes.values())
+    for file in files_to_be_synced:
+        with log_context(trial=folder_to_be_synced, camera=os.path.splitext(os.path.basename(file))[0]):
+            trim_video(file, spikes[file][0], final_duration)
+    mark_completed('sync', folder_to_be_synced, duration=final_duration)
+    return final_duration
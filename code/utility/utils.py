@@ -10,6 +10,14 @@ import shutil
 import argparse
 import json
 import sys
+import re
+import time
+import atexit
+import contextlib
+import contextvars
+import multiprocessing
+import threading
+from utility.config_model import validate_config
 
 def is_video_file(file_path):
     """
@@ -18,6 +26,9 @@ def is_video_file(file_path):
     :param file_path: str, the path to the file
     :return: bool, True if the file is a video file, False otherwise
     """
+    # Outputs being written (see atomic_output) are not videos yet
+    if PARTIAL_SUFFIX in file_path:
+        return False
     mime_type, _ = mimetypes.guess_type(file_path)
     return mime_type is not None and mime_type.startswith('video/')
 
@@ -81,19 +92,107 @@ def remove_directory(dir_path):
         logging.info(f"Directory '{dir_path}' has been removed successfully.")
     return
 
+# Marks the temporary outputs that are renamed to their final path once complete
+PARTIAL_SUFFIX = '.partial'
+
+def get_partial_path(output_path):
+    """
+    Get the temporary path an output is written to before being renamed, unique to the
+    current process and thread, so that two writers of the same output (e.g. a worker whose
+    lease expired and the one that took it over) do not write to the same partial path.
+
+    Args:
+        output_path (str): The final path of the output (file or folder).
+
+    Returns:
+        str: The temporary path, in the same folder and with the same extension.
+    """
+    base, extension = os.path.splitext(output_path)
+    return f"{base}{PARTIAL_SUFFIX}.{os.getpid()}.{threading.get_ident()}{extension}"
+
+@contextlib.contextmanager
+def atomic_output(output_path):
+    """
+    Context manager yielding a temporary path to write an output (file or folder) to.
+    The output is renamed to its final path only if the block completes, so an existing
+    output is always complete. Leftovers of an interrupted write are removed.
+
+    Args:
+        output_path (str): The final path of the output.
+
+    Yields:
+        str: The temporary path.
+    """
+    partial_path = get_partial_path(output_path)
+    remove_output(partial_path)
+    try:
+        yield partial_path
+        if os.path.isdir(partial_path):
+            remove_output(output_path)
+        os.replace(partial_path, output_path)
+    finally:
+        remove_output(partial_path)
+
+def remove_output(path):
+    """
+    Remove a file or a folder, if it exists.
+
+    Args:
+        path (str): The path of the file or folder.
+
+    Returns:
+        None
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def copy_file_atomically(file_path, new_file_path):
+    """
+    Copy a file, so that the copy only appears once complete.
+
+    Args:
+        file_path (str): The path of the file.
+        new_file_path (str): The path of the copy.
+
+    Returns:
+        None
+    """
+    os.makedirs(os.path.dirname(new_file_path), exist_ok=True)
+    with atomic_output(new_file_path) as partial_file_path:
+        shutil.copy(file_path, partial_file_path)
+
 def read_config(workspace):
     """
-    Read a configuration file and return its contents as a dictionary.
+    Read a configuration file, validate it and return its contents as a dictionary.
 
     Args:
         workspace (str): The directory where the configuration file is located.
 
     Returns:
-        dict: The contents of the configuration file as a dictionary.
+        dict: The contents of the configuration file as a dictionary, with the defaults
+            of the missing options (see utility.config_model).
+
+    Raises:
+        ConfigError: If the configuration does not match the config model.
     """
     config_path = os.path.join(workspace, 'config.json')
     with open(config_path, 'r', encoding='utf-8') as file:
-        return json.load(file)
+        return validate_config(json.load(file))
+
+def get_arguments():
+    """
+    Get the command line arguments of the scripts.
+
+    :return: The arguments: workspace (the path to the workspace directory) and resume
+        (whether to skip the work items completed by an interrupted run).
+    """
+    parser = argparse.ArgumentParser(description='Process and sync video files.')
+    parser.add_argument('--workspace', help='The path to the workspace directory')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip the work items recorded as completed in the journal of the workspace')
+    return parser.parse_args()
 
 def get_workspace():
     """
@@ -101,10 +200,7 @@ def get_workspace():
 
     :return: The path to the workspace directory.
     """
-    parser = argparse.ArgumentParser(description='Process and sync video files.')
-    parser.add_argument('--workspace', help='The path to the workspace directory')
-    args = parser.parse_args()
-    return args.workspace
+    return get_arguments().workspace
 
 def find_unique_base_names(folder_path):
     """
@@ -128,101 +224,252 @@ def find_unique_base_names(folder_path):
 
 def move_logs_to_workspace(workspace, task):
     """
-    Move the logs to the workspace directory.
+    Move the logs.txt files written by Pose2Sim in the workspace to the log folder of the
+    current run, named after the folder they were found in.
 
     Parameters:
     workspace (str): The path to the workspace directory.
     task (str): The name of the task being processed.
 
     Returns:
-    None
+    list: The new paths of the moved log files.
     """
-    
+    log_dir = os.environ.get(LOG_DIR_VARIABLE) or get_run_log_dir(workspace, task)
+    pose2sim_log_dir = os.path.join(log_dir, 'pose2sim')
+    moved = []
     for root, _, files in os.walk(workspace):
-        if 'logs.txt' in files:
-            # Construct the full path to the found logs.txt file
-            logs_path = os.path.join(root, 'logs.txt')
-            
-            # Define the new filename with the task-specific name
-            new_logs_path = os.path.join(root, f'logs_{task}.txt')
-            
-            # Move and rename the logs.txt to logs_{task}.txt
-            shutil.move(logs_path, new_logs_path)
-            
-            logging.info(f"logs.txt found and moved to {new_logs_path}")
-            break  # Stop the search after finding and moving the first logs.txt file
-    else:
-        # This part executes if the for loop completes without finding logs.txt
-        logging.error("logs.txt not found in the workspace.")
+        if 'logs.txt' in files and not os.path.abspath(root).startswith(os.path.abspath(log_dir)):
+            relative_folder = os.path.relpath(root, workspace)
+            name = 'workspace' if relative_folder == '.' else relative_folder.replace(os.sep, '__')
+            os.makedirs(pose2sim_log_dir, exist_ok=True)
+            new_logs_path = os.path.join(pose2sim_log_dir, f'{name}_logs_{task}.txt')
+            shutil.move(os.path.join(root, 'logs.txt'), new_logs_path)
+            moved.append(new_logs_path)
+    logging.info(f"{len(moved)} Pose2Sim logs.txt moved to {pose2sim_log_dir}")
+    return moved
+
+# Logging runs through a queue: the callers (including the worker processes) only enqueue
+# records, and a listener thread of the main process formats and writes them.
+LOG_DIR_VARIABLE = 'MBA_LOG_DIR'
+PROGRESS_PATTERN = re.compile(r'\d+%\||^\s*(chunk|t|frame_index):')
+# The count of a progress line (' 45%|####  | 45/100'), complete when both numbers are equal
+PROGRESS_COUNT_PATTERN = re.compile(r'\|\s*(\d+)/(\d+)')
+_LOG_CONTEXT = contextvars.ContextVar('log_context', default={})
+_LOG_QUEUE = None
+_LOG_LISTENER = None
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """
+    Context manager adding fields (e.g. stage, trial, camera) to the structured log records
+    emitted inside it.
+
+    Args:
+        **fields: The context fields.
+
+    Yields:
+        None
+    """
+    token = _LOG_CONTEXT.set({**_LOG_CONTEXT.get(), **fields})
+    try:
+        yield
+    finally:
+        _LOG_CONTEXT.reset(token)
+
+class ContextFilter(logging.Filter):
+    """
+    Logging filter attaching the current log context to the records, before they are queued.
+    """
+    def filter(self, record):
+        record.context = dict(_LOG_CONTEXT.get())
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """
+    Logging formatter writing each record as one JSON line with its context fields.
+    """
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "message": record.getMessage(),
+            **getattr(record, 'context', {}),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def is_progress_complete(line):
+    """
+    Whether a progress line shows a completed bar: its count reaches the total, or without
+    a count, it shows 100% (tqdm rounds 1990/2000 up to 100%).
+    """
+    count = PROGRESS_COUNT_PATTERN.search(line)
+    if count is not None:
+        return count.group(1) == count.group(2)
+    return '100%' in line
 
 class StreamToLogger(object):
     """
     Fake file-like stream object that redirects writes to a logger instance.
 
+    Progress-bar updates (moviepy/tqdm lines such as ' 45%|####  |') are collapsed: at most
+    one every progress_interval seconds is logged, plus the last one when the bar completes,
+    when another line follows it or when the stream is closed. flush() logs nothing, as
+    tqdm and moviepy call it after every update.
+
     Attributes:
         logger (Logger): The logger instance to redirect writes to.
         log_level (int): The log level to use for the redirected writes.
-        linebuf (str): Buffer to store partial lines of text.
+        progress_interval (float): The minimum time between two logged progress lines.
+    """
+    def __init__(self, logger, log_level=logging.INFO, progress_interval=5.0):
+        self.logger = logger
+        self.log_level = log_level
+        self.progress_interval = progress_interval
+        self.last_progress_time = 0.0
+        self.pending_progress = None
 
-    Methods:
-        write(buf): Writes the given buffer to the logger, splitting it into lines and logging each line separately.
-        flush(): Does nothing.
+    def write(self, buf):
+        """
+        Write the given buffer to the logger, one record per line.
+
+        Args:
+            buf: A string containing the buffer to be written to the logger.
+
+        Returns:
+            None
+        """
+        for line in re.split(r'[\r\n]+', buf):
+            line = line.rstrip()
+            if not line:
+                continue
+            if PROGRESS_PATTERN.search(line):
+                now = time.monotonic()
+                if now - self.last_progress_time < self.progress_interval and not is_progress_complete(line):
+                    self.pending_progress = line
+                    continue
+                self.last_progress_time = now
+                self.pending_progress = None
+            else:
+                # The bar stopped, its last state is logged before the line
+                self.close()
+            self.logger.log(self.log_level, line)
 
-    """ 
+    def flush(self):
+        """
+        Do nothing, the records are written by the logger.
+        """
+
+    def close(self):
+        """
+        Log the last collapsed progress line, if any.
+        """
+        if self.pending_progress is not None:
+            self.logger.log(self.log_level, self.pending_progress)
+            self.pending_progress = None
+
+    def isatty(self):
+        return False
+
+def get_run_log_dir(workspace, task):
     """
-    Initialize the class with a logger and a log level.
-    
-    Parameters:
-        logger: The logger object to be used for logging.
-        log_level: The log level for the logger, defaults to logging.INFO.
+    Get the log folder of a new run of a task: <workspace>/logs/<task>_<date>_<time>_<pid>.
+
+    Args:
+        workspace (str): The workspace directory.
+        task (str): The task name.
+
+    Returns:
+        str: The path of the log folder.
     """
-    def __init__(self, logger, log_level=logging.INFO):
-        self.logger = logger
-        self.log_level = log_level
-        self.linebuf = ''
+    return os.path.abspath(os.path.join(workspace, 'logs', f"{task}_{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}"))
 
+def configure_worker_logging(log_queue, context=None):
     """
-    Write the given buffer to the logger with the specified log level.
-    
+    Route the logging of a worker process to the queue of the main process.
+    Used as the initializer of the process pools.
+
     Args:
-        buf: A string containing the buffer to be written to the logger.
-    
+        log_queue (multiprocessing.Queue): The log queue of the main process.
+        context (dict, optional): Context fields added to all the records of the worker.
+
     Returns:
         None
     """
-    def write(self, buf):
-        for line in buf.rstrip().splitlines():
-            self.logger.log(self.log_level, line.rstrip())
+    handler = logging.handlers.QueueHandler(log_queue)
+    handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    for existing_handler in list(root.handlers):
+        root.removeHandler(existing_handler)
+    root.addHandler(handler)
+    root.setLevel(logging.DEBUG)
+    if context:
+        _LOG_CONTEXT.set(dict(context))
+
+def get_worker_initializer():
+    """
+    Get the initializer (and its arguments) that process pools should use so that their
+    workers log to the current run.
 
+    Returns:
+        tuple: The initializer function (or None if logging is not set up) and its arguments.
     """
-    Does nothing.
+    if _LOG_QUEUE is None:
+        return None, ()
+    return configure_worker_logging, (_LOG_QUEUE, dict(_LOG_CONTEXT.get()))
+
+def shutdown_logging():
     """
-    def flush(self):
-        pass
+    Stop the log listener, writing all the queued records.
+
+    Returns:
+        None
+    """
+    global _LOG_LISTENER
+    for stream in (sys.stdout, sys.stderr):
+        if isinstance(stream, StreamToLogger):
+            stream.close()
+    if _LOG_LISTENER is not None:
+        _LOG_LISTENER.stop()
+        _LOG_LISTENER = None
 
 def setup_logging(workspace, task):
     """
     Set up logging for the workspace and task.
 
+    Records are queued and written by a listener thread to <workspace>/logs/<run>/log.txt
+    (text) and events.jsonl (JSON lines with the stage/trial/camera context). stdout and
+    stderr are redirected to the logs, with the progress bars collapsed.
+
     Args:
         workspace (str): The workspace directory.
         task (str): The task name.
 
     Returns:
-        None
+        str: The log folder of the run.
     """
-    # Define the filename for the log file
-    log_filename = f"{workspace}/mylogs_{task}.txt"
-
-    logging.basicConfig(level=logging.DEBUG,
-                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                        filename=log_filename, 
-                        filemode='a')
+    global _LOG_QUEUE, _LOG_LISTENER
+    log_dir = get_run_log_dir(workspace, task)
+    os.makedirs(log_dir, exist_ok=True)
+    os.environ[LOG_DIR_VARIABLE] = log_dir
+
+    text_handler = logging.FileHandler(os.path.join(log_dir, 'log.txt'), encoding='utf-8')
+    text_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    json_handler = logging.FileHandler(os.path.join(log_dir, 'events.jsonl'), encoding='utf-8')
+    json_handler.setFormatter(JsonFormatter())
+
+    shutdown_logging()
+    _LOG_QUEUE = multiprocessing.Queue(-1)
+    _LOG_LISTENER = logging.handlers.QueueListener(_LOG_QUEUE, text_handler, json_handler)
+    _LOG_LISTENER.start()
+    atexit.register(shutdown_logging)
+    configure_worker_logging(_LOG_QUEUE, {"task": task})
 
     stdout_logger = logging.getLogger('STDOUT')
-    sl = StreamToLogger(stdout_logger, logging.INFO)
-    sys.stdout = sl
-
+    sys.stdout = StreamToLogger(stdout_logger, logging.INFO)
     stderr_logger = logging.getLogger('STDERR')
-    sl = StreamToLogger(stderr_logger, logging.ERROR)
-    sys.stderr = sl
\ No newline at end of file
+    sys.stderr = StreamToLogger(stderr_logger, logging.ERROR)
+    return log_dir
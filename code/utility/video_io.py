@@ -0,0 +1,494 @@
+"""
+Module description: This module contains the video I/O layer of the pipeline: reading the
+properties and audio track of a video, decoding its frames on a background thread (with
+seeking, frame-accurate subclips, frame rate resampling and resizing into preallocated
+buffers), and encoding frames with configurable encoder threads and preset. It runs on PyAV
+when it is installed, and on OpenCV for decoding and the ffmpeg executable shipped with
+moviepy for encoding otherwise.
+"""
+
+import logging
+import logging.handlers
+import os
+import json
+import queue
+import threading
+import fractions
+import itertools
+import subprocess
+import importlib.util
+import numpy as np
+
+# Environment variable, so that the worker processes use the same video I/O config
+VIDEO_IO_VARIABLE = 'MBA_VIDEO_IO'
+BACKENDS = ['av', 'opencv']
+# Sample rate and channels of the audio read through the ffmpeg executable, as moviepy does
+AUDIO_FPS = 44100
+AUDIO_CHANNELS = 2
+
+def configure_video_io(video_io_configs=None):
+    """
+    Set the video I/O config of this process and of the worker processes it starts.
+
+    Args:
+        video_io_configs (dict, optional): The 'video_io' section of the config.
+
+    Returns:
+        None
+    """
+    os.environ[VIDEO_IO_VARIABLE] = json.dumps(video_io_configs or {})
+
+def get_video_io_configs():
+    """
+    Get the video I/O config set by configure_video_io, empty (the defaults) if none was set.
+    """
+    return json.loads(os.environ.get(VIDEO_IO_VARIABLE) or '{}')
+
+def get_backend(video_io_configs=None):
+    """
+    Get the backend to use: 'av' if PyAV is installed, 'opencv' otherwise, unless the
+    config sets one.
+
+    Args:
+        video_io_configs (dict, optional): The 'video_io' section of the config, the
+            configured one (see configure_video_io) by default.
+
+    Returns:
+        str: One of BACKENDS.
+
+    Raises:
+        ImportError: If the backend 'av' is set and PyAV is not installed.
+    """
+    video_io_configs = get_video_io_configs() if video_io_configs is None else video_io_configs
+    backend = video_io_configs.get('backend', 'auto')
+    has_av = importlib.util.find_spec('av') is not None
+    if backend == 'auto':
+        return 'av' if has_av else 'opencv'
+    if backend == 'av' and not has_av:
+        raise ImportError("The video I/O backend 'av' needs PyAV (pip install av).")
+    return backend
+
+def get_ffmpeg_executable():
+    """
+    Get the ffmpeg executable shipped with moviepy (imageio-ffmpeg).
+    """
+    import imageio_ffmpeg  # deferred, shipped with moviepy
+
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+def get_rotation_code(rotation):
+    """
+    Get the cv2.rotate code displaying a frame stored with a rotation (degrees
+    counterclockwise, from the display matrix of the stream), None if it needs none.
+    """
+    import cv2  # deferred, cv2 is slow to import
+
+    return {1: cv2.ROTATE_90_COUNTERCLOCKWISE, 2: cv2.ROTATE_180,
+            3: cv2.ROTATE_90_CLOCKWISE}.get(int(round((rotation or 0) / 90)) % 4)
+
+def get_video_info(video_file, video_io_configs=None):
+    """
+    Get the properties of a video, as displayed (the size accounts for the rotation).
+
+    Args:
+        video_file (str): The path of the video.
+        video_io_configs (dict, optional): The 'video_io' section of the config.
+
+    Returns:
+        dict: 'fps', 'width', 'height', 'frames', 'duration', 'rotation' (degrees
+            counterclockwise) and 'has_audio' (None if unknown).
+
+    Raises:
+        IOError: If the video cannot be opened or has no frame.
+    """
+    if get_backend(video_io_configs) == 'av':
+        import av  # deferred, av is slow to import
+
+        try:
+            container = av.open(video_file)
+        except av.error.FFmpegError as e:
+            raise IOError(f"Cannot open video file {video_file}: {e}")
+        with container:
+            if not container.streams.video:
+                raise IOError(f"Cannot open video file {video_file}: no video stream")
+            stream = container.streams.video[0]
+            first_frame = next(container.decode(stream), None)
+            if first_frame is None:
+                raise IOError(f"Cannot read the first frame of {video_file}")
+            fps = float(stream.average_rate or stream.guessed_rate or 0)
+            if stream.duration is not None:
+                duration = float(stream.duration * stream.time_base)
+            else:
+                duration = container.duration / av.time_base if container.duration else 0.0
+            rotation = int(getattr(first_frame, 'rotation', 0) or 0) % 360
+            width, height = first_frame.width, first_frame.height
+            if get_rotation_code(rotation) not in (None, get_rotation_code(180)):
+                width, height = height, width
+            return {"fps": fps, "width": width, "height": height,
+                    "frames": stream.frames or int(round(duration * fps)), "duration": duration,
+                    "rotation": rotation, "has_audio": bool(container.streams.audio)}
+
+    import cv2  # deferred, cv2 is slow to import
+
+    capture = cv2.VideoCapture(video_file)
+    try:
+        if not capture.isOpened():
+            raise IOError(f"Cannot open video file {video_file}")
+        # OpenCV rotates the frames as displayed
+        success, frame = capture.read()
+        if not success:
+            raise IOError(f"Cannot read the first frame of {video_file}")
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        # OpenCV gives the rotation clockwise
+        return {"fps": fps, "width": frame.shape[1], "height": frame.shape[0], "frames": frames,
+                "duration": frames / fps if fps else 0.0,
+                "rotation": -int(capture.get(cv2.CAP_PROP_ORIENTATION_META)) % 360, "has_audio": None}
+    finally:
+        capture.release()
+
+def read_audio(video_file, video_io_configs=None):
+    """
+    Read the audio track of a video.
+
+    Args:
+        video_file (str): The path of the video.
+        video_io_configs (dict, optional): The 'video_io' section of the config.
+
+    Returns:
+        tuple: The samples (one row per sample and one column per channel, in [-1, 1]) and
+            the sample rate, (None, None) if the video has no audio.
+    """
+    if get_backend(video_io_configs) == 'av':
+        import av  # deferred, av is slow to import
+
+        with av.open(video_file) as container:
+            if not container.streams.audio:
+                return None, None
+            stream = container.streams.audio[0]
+            resampler = av.AudioResampler(format='fltp')
+            chunks = [resampled.to_ndarray() for frame in container.decode(stream)
+                      for resampled in resampler.resample(frame)]
+            chunks += [resampled.to_ndarray() for resampled in resampler.resample(None)]
+            if not chunks:
+                return None, None
+            return np.concatenate(chunks, axis=1).T, stream.rate
+
+    completed = subprocess.run([get_ffmpeg_executable(), '-loglevel', 'error', '-i', video_file, '-vn',
+                                '-f', 'f32le', '-acodec', 'pcm_f32le', '-ac', str(AUDIO_CHANNELS),
+                                '-ar', str(AUDIO_FPS), '-'], capture_output=True)
+    if completed.returncode != 0 or not completed.stdout:
+        return None, None
+    return np.frombuffer(completed.stdout, dtype=np.float32).reshape(-1, AUDIO_CHANNELS), AUDIO_FPS
+
+class VideoReader:
+    """
+    Decodes the frames of a video on a background thread, from 'start' to 'end' seconds,
+    as a moviepy subclip would: the frame shown at time start + i / fps is output for every
+    i, so a frame rate lower than the video's drops frames. The frames are converted to
+    BGR and resized into a ring of preallocated buffers: a frame stays valid until
+    'held_frames' more frames are read, so copy it to keep it longer.
+
+    Iterating yields (time, frame) pairs, the time being the output time in the video.
+    """
+
+    def __init__(self, video_file, start=0.0, end=None, fps=None, size=None, held_frames=1,
+                 video_io_configs=None):
+        """
+        Args:
+            video_file (str): The path of the video.
+            start (float): The start time in seconds.
+            end (float, optional): The end time in seconds (excluded), the end of the video by default.
+            fps (float, optional): The output frame rate, the frame rate of the video by default.
+            size (tuple, optional): The output (width, height), the size of the video by default.
+            held_frames (int): The number of frames the consumer holds at once.
+            video_io_configs (dict, optional): The 'video_io' section of the config.
+        """
+        self.video_io_configs = get_video_io_configs() if video_io_configs is None else video_io_configs
+        self.backend = get_backend(self.video_io_configs)
+        self.video_file = video_file
+        self.info = get_video_info(video_file, self.video_io_configs)
+        self.start = max(0.0, start)
+        self.end = end
+        self.fps = fps or self.info['fps']
+        self.size = tuple(size) if size else (self.info['width'], self.info['height'])
+        queue_size = self.video_io_configs.get('queue_size', 8)
+        # The queue, the frame being decoded and the held frames never share a buffer
+        self.buffers = [np.empty((self.size[1], self.size[0], 3), dtype=np.uint8)
+                        for _ in range(queue_size + held_frames + 1)]
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='video-reader', daemon=True)
+        self.thread.start()
+
+    def decode_av(self):
+        """
+        Decode the frames with PyAV from the keyframe before the start: yields (time, convert)
+        pairs, convert writing the frame to a buffer.
+        """
+        import av  # deferred, av is slow to import
+
+        with av.open(self.video_file) as container:
+            stream = container.streams.video[0]
+            stream.thread_type = 'AUTO'
+            stream.codec_context.thread_count = self.video_io_configs.get('decode_threads', 0)
+            if self.start > 0:
+                container.seek(int(self.start / stream.time_base) + (stream.start_time or 0), stream=stream,
+                               backward=True)
+            start_time = float((stream.start_time or 0) * stream.time_base)
+            rotation_code = get_rotation_code(self.info['rotation'])
+            stored_size = self.size if rotation_code in (None, get_rotation_code(180)) else self.size[::-1]
+
+            def convert(frame, buffer):
+                import cv2  # deferred, cv2 is slow to import
+
+                frame = frame.reformat(width=stored_size[0], height=stored_size[1], format='bgr24')
+                plane = frame.planes[0]
+                # The rows of the plane may be padded
+                image = np.frombuffer(plane, dtype=np.uint8).reshape(stored_size[1], plane.line_size)
+                image = image[:, :stored_size[0] * 3].reshape(stored_size[1], stored_size[0], 3)
+                if rotation_code is None:
+                    np.copyto(buffer, image)
+                else:
+                    cv2.rotate(image, rotation_code, dst=buffer)
+
+            for frame in container.decode(stream):
+                if frame.time is not None:
+                    yield frame.time - start_time, lambda buffer, frame=frame: convert(frame, buffer)
+
+    def decode_opencv(self):
+        """
+        Decode the frames with OpenCV from a little before the start: yields (time, convert)
+        pairs, convert writing the frame to a buffer.
+        """
+        import cv2  # deferred, cv2 is slow to import
+
+        capture = cv2.VideoCapture(self.video_file, cv2.CAP_FFMPEG,
+                                   [cv2.CAP_PROP_N_THREADS, self.video_io_configs.get('decode_threads', 0)])
+        # A frame is converted after the next one is decoded, so they alternate between two arrays
+        decoded = [None, None]
+        try:
+            if self.start > 0:
+                capture.set(cv2.CAP_PROP_POS_MSEC, max(0.0, self.start - 2 / self.info['fps']) * 1000)
+            for index in itertools.count():
+                success, decoded[index % 2] = capture.read(decoded[index % 2])
+                if not success:
+                    return
+
+                def convert(buffer, image=decoded[index % 2]):
+                    if image.shape[:2] == buffer.shape[:2]:
+                        np.copyto(buffer, image)
+                    else:
+                        cv2.resize(image, self.size, dst=buffer, interpolation=cv2.INTER_AREA)
+                yield capture.get(cv2.CAP_PROP_POS_MSEC) / 1000, convert
+        finally:
+            capture.release()
+
+    def run(self):
+        """
+        Decode the frames and put the output ones in the queue, then None at the end.
+        """
+        frames = self.decode_av() if self.backend == 'av' else self.decode_opencv()
+        source_fps = self.info['fps'] or self.fps
+        tolerance = 0.01 / source_fps
+        index = 0
+        previous = None
+
+        def emit_until(time_limit):
+            # Output the previous frame for the output times before time_limit
+            nonlocal index
+            while True:
+                output_time = self.start + index / self.fps
+                if output_time >= time_limit - tolerance:
+                    return True
+                if self.end is not None and output_time >= self.end - 1e-6:
+                    return False
+                buffer = self.buffers[index % len(self.buffers)]
+                previous[1](buffer)
+                if not self.put((output_time, buffer)):
+                    return False
+                index += 1
+
+        try:
+            for frame_time, convert in frames:
+                if previous is not None and not emit_until(frame_time):
+                    break
+                previous = (frame_time, convert)
+            else:
+                if previous is not None:
+                    emit_until(previous[0] + 1 / source_fps)
+        except Exception as e:
+            self.error = e
+        finally:
+            frames.close()
+            self.put(None)
+
+    def put(self, item):
+        """
+        Put an item in the queue, waiting while it is full, unless the reader is closed.
+
+        Returns:
+            bool: False if the reader was closed.
+        """
+        while not self.stop_event.is_set():
+            try:
+                self.frames.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        while True:
+            item = self.frames.get()
+            if item is None:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield item
+
+    def close(self):
+        """
+        Stop decoding.
+        """
+        self.stop_event.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class VideoWriter:
+    """
+    Encodes BGR frames to a video with the 'video_io' codec, preset, CRF and encoder
+    threads: with PyAV, the frames are encoded on a background thread fed through a bounded
+    queue; otherwise they are piped to an ffmpeg process.
+    """
+
+    def __init__(self, video_file, fps, size, video_io_configs=None):
+        """
+        Args:
+            video_file (str): The path of the video (its extension sets the container).
+            fps (float): The frame rate.
+            size (tuple): The (width, height) of the frames.
+            video_io_configs (dict, optional): The 'video_io' section of the config.
+        """
+        self.video_io_configs = get_video_io_configs() if video_io_configs is None else video_io_configs
+        self.backend = get_backend(self.video_io_configs)
+        self.size = tuple(size)
+        if self.size[0] % 2 or self.size[1] % 2:
+            raise ValueError(f"Cannot encode {video_file} with an odd size {self.size} in yuv420p.")
+        self.n_frames = 0
+        self.error = None
+        codec = self.video_io_configs.get('codec', 'libx264')
+        options = {"preset": self.video_io_configs.get('preset', 'medium'),
+                   "crf": str(self.video_io_configs.get('crf', 23))}
+        threads = self.video_io_configs.get('encode_threads', 0)
+        if self.backend == 'av':
+            import av  # deferred, av is slow to import
+
+            self.container = av.open(video_file, 'w')
+            self.stream = self.container.add_stream(codec, rate=fractions.Fraction(fps).limit_denominator(100000),
+                                                    options=options if codec.startswith('libx26') else {})
+            self.stream.width, self.stream.height = self.size
+            self.stream.pix_fmt = 'yuv420p'
+            self.stream.codec_context.thread_count = threads
+            self.frames = queue.Queue(maxsize=self.video_io_configs.get('queue_size', 8))
+            self.thread = threading.Thread(target=self.run, name='video-writer', daemon=True)
+            self.thread.start()
+        else:
+            command = [get_ffmpeg_executable(), '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+                       '-s', f"{self.size[0]}x{self.size[1]}", '-r', str(fps), '-i', '-', '-an', '-c:v', codec]
+            if codec.startswith('libx26'):
+                command += ['-preset', options['preset'], '-crf', options['crf']]
+            command += ['-threads', str(threads), '-pix_fmt', 'yuv420p', video_file]
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def run(self):
+        """
+        Encode the queued frames until None.
+        """
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                self.container.mux(self.stream.encode(frame))
+            except Exception as e:
+                self.error = e
+
+    def write(self, frame):
+        """
+        Write a BGR frame. The frame is copied, so its buffer can be reused right away.
+        """
+        if frame.shape[1::-1] != self.size:
+            raise ValueError(f"Frame of size {frame.shape[1::-1]} written to a video of size {self.size}.")
+        if self.error is not None:
+            raise self.error
+        if self.backend == 'av':
+            import av  # deferred, av is slow to import
+
+            video_frame = av.VideoFrame.from_ndarray(frame, format='bgr24')
+            video_frame.pts = self.n_frames
+            self.frames.put(video_frame)
+        else:
+            self.process.stdin.write(np.ascontiguousarray(frame).data)
+        self.n_frames += 1
+
+    def close(self):
+        """
+        Flush the encoder and close the video.
+
+        Raises:
+            IOError: If the encoding failed.
+        """
+        if self.backend == 'av':
+            self.frames.put(None)
+            self.thread.join()
+            try:
+                if self.error is None:
+                    self.container.mux(self.stream.encode(None))
+            finally:
+                self.container.close()
+            if self.error is not None:
+                raise IOError(f"Encoding failed: {self.error}")
+        else:
+            self.process.stdin.close()
+            error = self.process.stderr.read().decode(errors='replace').strip()
+            if self.process.wait() != 0:
+                raise IOError(f"Encoding failed: {error}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def transcode_video(video_file, output_file, start=0.0, end=None, fps=None, size=None, video_io_configs=None):
+    """
+    Write a subclip of a video, optionally resampled to another frame rate and resized,
+    without its audio. The decoding, conversion and encoding overlap on their own threads.
+
+    Args:
+        video_file (str): The path of the video.
+        output_file (str): The path of the output video.
+        start (float): The start time in seconds.
+        end (float, optional): The end time in seconds (excluded), the end of the video by default.
+        fps (float, optional): The output frame rate, the frame rate of the video by default.
+        size (tuple, optional): The output (width, height), the size of the video by default.
+        video_io_configs (dict, optional): The 'video_io' section of the config.
+
+    Returns:
+        int: The number of frames written.
+    """
+    with VideoReader(video_file, start, end, fps, size, video_io_configs=video_io_configs) as reader:
+        with VideoWriter(output_file, reader.fps, reader.size, video_io_configs) as writer:
+            for _, frame in reader:
+                writer.write(frame)
+    logging.debug(f"Wrote {writer.n_frames} frames of {video_file} to {output_file} ({reader.backend}).")
+    return writer.n_frames
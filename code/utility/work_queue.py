@@ -0,0 +1,474 @@
+"""
+Module description: This module contains the work queues shared by the coordinator and
+the workers of the distributed mode. The file queue only needs a filesystem shared by the
+nodes: items are claimed by creating their lease file exclusively, and the leases of dead
+workers expire. The memory queue has the same interface and replaces it in a single process.
+"""
+
+import logging
+import logging.handlers
+import os
+import json
+import time
+import uuid
+import hashlib
+import importlib
+import threading
+
+def get_function_name(func):
+    """
+    Get the importable name of a module-level function.
+
+    Args:
+        func (callable): The function.
+
+    Returns:
+        str: The name, as 'module:function'.
+    """
+    return f"{func.__module__}:{func.__qualname__}"
+
+def load_function(name):
+    """
+    Import a function from its name (see get_function_name).
+
+    Args:
+        name (str): The name, as 'module:function'.
+
+    Returns:
+        callable: The function.
+    """
+    module_name, function_name = name.split(':')
+    return getattr(importlib.import_module(module_name), function_name)
+
+def make_item(task_id, func, args=(), depends_on=(), stage=None):
+    """
+    Make a work item. The arguments must be JSON-serializable, and the function importable
+    on every node.
+
+    Args:
+        task_id (str): The unique id of the item.
+        func (callable): A module-level function to run.
+        args (tuple): The positional arguments passed to the function.
+        depends_on (iterable): The ids of the items that must succeed before this one. Their
+            results are passed to the function as the keyword argument 'dependencies'.
+        stage (str, optional): The stage of the item, for the progress reports.
+
+    Returns:
+        dict: The work item.
+    """
+    return {
+        "id": task_id,
+        "key": hashlib.sha1(task_id.encode('utf-8')).hexdigest()[:16],
+        "func": get_function_name(func),
+        "args": list(args),
+        "depends_on": list(depends_on),
+        "stage": stage,
+    }
+
+def write_json_atomically(file_path, content):
+    """
+    Write a JSON file through a temporary file and a rename.
+
+    Args:
+        file_path (str): The path of the file.
+        content: The JSON-serializable content.
+
+    Returns:
+        None
+    """
+    temp_file_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_file_path, 'w', encoding='utf-8') as f:
+        json.dump(content, f, default=str)
+    os.replace(temp_file_path, file_path)
+
+def read_json(file_path):
+    """
+    Read a JSON file, if it exists.
+
+    Args:
+        file_path (str): The path of the file.
+
+    Returns:
+        The content, or None if the file does not exist.
+    """
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+class FileQueue(object):
+    """
+    Work queue stored in a folder of a shared filesystem:
+    items/<key>.json (the items), leases/<key>.json (the claims, whose modification time
+    is refreshed by the worker), attempts/<key>.json, done/<key>.json and failed/<key>.json
+    (the outcomes), the id of the current run in run.json, written by reset, and a 'closed'
+    file holding the id of the run once the coordinator has no more items.
+
+    Attributes:
+        queue_dir (str): The folder of the queue.
+        lease_timeout (float): The time in seconds after which the lease of a silent worker expires.
+        max_attempts (int): The number of times an item is tried before being reported as failed.
+    """
+    FOLDERS = ('items', 'leases', 'attempts', 'done', 'failed')
+
+    def __init__(self, queue_dir, lease_timeout=600, max_attempts=3):
+        self.queue_dir = queue_dir
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        for folder in self.FOLDERS:
+            os.makedirs(os.path.join(queue_dir, folder), exist_ok=True)
+        self.cache_lock = threading.Lock()
+        self.clear_cache()
+
+    def clear_cache(self):
+        """
+        Forget the items and outcomes known by this instance (see refresh).
+        """
+        self.cache_run_id = None
+        self.items = {}
+        self.pending = set()
+        self.outcomes = {}
+
+    # Storage: the memory queue overrides these methods only
+
+    def get_path(self, folder, key):
+        return os.path.join(self.queue_dir, folder, f"{key}.json")
+
+    def read(self, folder, key):
+        return read_json(self.get_path(folder, key))
+
+    def write(self, folder, key, content):
+        write_json_atomically(self.get_path(folder, key), content)
+
+    def list_keys(self, folder):
+        return sorted(file_name[:-5] for file_name in os.listdir(os.path.join(self.queue_dir, folder))
+                      if file_name.endswith('.json'))
+
+    def remove(self, folder, key):
+        try:
+            os.remove(self.get_path(folder, key))
+        except FileNotFoundError:
+            pass
+
+    def acquire_lease(self, key, worker_id):
+        """
+        Create the lease of an item, unless it exists and has not expired.
+
+        Returns:
+            bool: True if the lease was acquired.
+        """
+        lease_file = self.get_path('leases', key)
+        try:
+            lease = os.stat(lease_file)
+        except FileNotFoundError:
+            lease = None
+        if lease is not None and time.time() - lease.st_mtime > self.lease_timeout:
+            # Only one worker can rename the lease away, but it may no longer be the expired
+            # one: another worker can have taken it over since it was checked
+            expired_file = f"{lease_file}.expired.{worker_id}"
+            try:
+                os.rename(lease_file, expired_file)
+            except FileNotFoundError:
+                return False
+            renamed = os.stat(expired_file)
+            if (renamed.st_ino, renamed.st_mtime_ns) != (lease.st_ino, lease.st_mtime_ns):
+                # A fresh lease, put it back unless yet another one was created
+                try:
+                    os.link(expired_file, lease_file)
+                except FileExistsError:
+                    pass
+                os.remove(expired_file)
+                return False
+            os.remove(expired_file)
+            logging.warning(f"The lease of item {key} expired, it is claimed again.")
+        try:
+            fd = os.open(lease_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(worker_id, f)
+        return True
+
+    def renew_lease(self, key):
+        try:
+            os.utime(self.get_path('leases', key))
+        except FileNotFoundError:
+            pass
+
+    def get_run_id(self):
+        """
+        Get the id of the current run, written by reset.
+
+        Returns:
+            str or None: The run id, or None if the queue was never reset.
+        """
+        return read_json(os.path.join(self.queue_dir, 'run.json'))
+
+    def set_run_id(self, run_id):
+        write_json_atomically(os.path.join(self.queue_dir, 'run.json'), run_id)
+
+    def close(self):
+        """
+        Tell the workers that no more items will be added to the current run.
+        """
+        write_json_atomically(os.path.join(self.queue_dir, 'closed'),
+                              {"run": self.get_run_id(), "time": time.strftime('%Y-%m-%dT%H:%M:%S')})
+
+    def get_closed_run(self):
+        """
+        Get the id of the run the queue was closed for.
+
+        Returns:
+            str or None: The run id ('' for a queue closed without run id), or None if the
+                queue is not closed.
+        """
+        try:
+            closed = read_json(os.path.join(self.queue_dir, 'closed'))
+        except ValueError:
+            # Written by a version without run ids
+            closed = {}
+        return None if closed is None else closed.get('run') or ''
+
+    def is_closed(self):
+        closed_run = self.get_closed_run()
+        return closed_run is not None and closed_run == (self.get_run_id() or '')
+
+    def reset(self):
+        """
+        Remove all the items and outcomes, to start a new run with a new id. The id is
+        written first, so that the closed file of the previous run is seen as stale.
+        """
+        self.set_run_id(f"{time.strftime('%Y%m%dT%H%M%S')}_{uuid.uuid4().hex[:8]}")
+        for folder in self.FOLDERS:
+            for key in self.list_keys(folder):
+                self.remove(folder, key)
+        if os.path.exists(os.path.join(self.queue_dir, 'closed')):
+            os.remove(os.path.join(self.queue_dir, 'closed'))
+
+    # Queue operations
+
+    def put(self, item):
+        """
+        Add a work item (see make_item).
+        """
+        self.write('items', item['key'], item)
+
+    def get_items(self):
+        items = [self.read('items', key) for key in self.list_keys('items')]
+        return [item for item in items if item is not None]
+
+    def get_outcome(self, item):
+        """
+        Get the outcome of an item, if it is finished.
+
+        Returns:
+            dict or None: The outcome (see utility.scheduler.execute_task).
+        """
+        return self.read('done', item['key']) or self.read('failed', item['key'])
+
+    def refresh(self):
+        """
+        Update the items and the pending keys known by this instance. The items and the
+        outcomes never change during a run, so only the new items are read and the finished
+        ones are found by listing the outcome folders; everything is forgotten when the run
+        changes.
+
+        Returns:
+            list: The sorted keys of the pending items.
+        """
+        with self.cache_lock:
+            run_id = self.get_run_id()
+            if run_id != self.cache_run_id:
+                self.clear_cache()
+                self.cache_run_id = run_id
+            for key in self.list_keys('items'):
+                if key not in self.items:
+                    item = self.read('items', key)
+                    if item is not None:
+                        self.items[key] = item
+                        self.pending.add(key)
+            self.pending -= set(self.list_keys('done')) | set(self.list_keys('failed'))
+            return sorted(self.pending)
+
+    def get_cached_outcome(self, item):
+        """
+        Get the outcome of an item, reading it only once it is finished (see get_outcome).
+        """
+        if item['key'] in self.outcomes:
+            return self.outcomes[item['key']]
+        outcome = self.get_outcome(item)
+        if outcome is not None:
+            self.outcomes[item['key']] = outcome
+        return outcome
+
+    def claim(self, worker_id):
+        """
+        Claim the first item that is not finished, not leased and whose dependencies
+        succeeded. The items whose dependencies failed are reported as skipped.
+
+        Args:
+            worker_id (str): The id of the worker.
+
+        Returns:
+            tuple or None: The item and the results of its dependencies (None if it has no
+                dependencies), or None if no item is ready.
+        """
+        pending = self.refresh()
+        items = {item['id']: item for item in list(self.items.values())}
+        for key in pending:
+            item = self.items[key]
+            if item['key'] not in self.pending:
+                continue
+            outcomes = {dependency: self.get_cached_outcome(items[dependency]) for dependency in item['depends_on']}
+            if any(outcome is None for outcome in outcomes.values()):
+                continue
+            failed = [dependency for dependency, outcome in outcomes.items() if outcome['status'] != 'succeeded']
+            if failed:
+                self.write('failed', item['key'], {
+                    "status": "skipped", "result": None, "traceback": None, "duration": 0.0, "worker": worker_id,
+                    "error": f"Dependencies did not succeed: {', '.join(failed)}"})
+                continue
+            if not self.acquire_lease(item['key'], worker_id):
+                continue
+            # The item may have finished between the outcome check and the lease
+            if self.get_outcome(item) is not None:
+                self.remove('leases', item['key'])
+                continue
+            attempts = (self.read('attempts', item['key']) or 0) + 1
+            if attempts > self.max_attempts:
+                self.write('failed', item['key'], {
+                    "status": "failed", "result": None, "traceback": None, "duration": 0.0, "worker": worker_id,
+                    "error": f"Gave up after {self.max_attempts} attempts"})
+                self.remove('leases', item['key'])
+                continue
+            self.write('attempts', item['key'], attempts)
+            dependencies = {dependency: outcome['result'] for dependency, outcome in outcomes.items()}
+            return item, dependencies or None
+        return None
+
+    def finish(self, item, outcome):
+        """
+        Record the outcome of a claimed item. A failed item is released to be tried
+        again, until max_attempts is reached.
+
+        Args:
+            item (dict): The item.
+            outcome (dict): The outcome (see utility.scheduler.execute_task).
+
+        Returns:
+            None
+        """
+        if outcome['status'] == 'succeeded':
+            self.write('done', item['key'], outcome)
+        elif (self.read('attempts', item['key']) or 0) >= self.max_attempts:
+            self.write('failed', item['key'], outcome)
+        else:
+            logging.warning(f"{item['id']} failed ({outcome['error']}), it will be tried again.")
+        self.remove('leases', item['key'])
+
+    def get_progress(self):
+        """
+        Count the items per stage and state.
+
+        Returns:
+            dict: For each stage, the number of 'pending', 'running', 'succeeded' and 'failed' items.
+        """
+        progress = {}
+        leases = set(self.list_keys('leases'))
+        for item in self.get_items():
+            counts = progress.setdefault(item['stage'], {"pending": 0, "running": 0, "succeeded": 0, "failed": 0})
+            outcome = self.get_outcome(item)
+            if outcome is not None:
+                counts['succeeded' if outcome['status'] == 'succeeded' else 'failed'] += 1
+            elif item['key'] in leases:
+                counts['running'] += 1
+            else:
+                counts['pending'] += 1
+        return progress
+
+class MemoryQueue(FileQueue):
+    """
+    Work queue held in memory, with the interface of FileQueue. It stands in for the file
+    queue when the coordinator and the workers are threads of a single process (e.g. in tests).
+    """
+    def __init__(self, lease_timeout=600, max_attempts=3):
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self.lock = threading.RLock()
+        self.documents = {folder: {} for folder in self.FOLDERS}
+        self.lease_times = {}
+        self.run_id = None
+        self.closed = None
+        self.cache_lock = threading.Lock()
+        self.clear_cache()
+
+    def read(self, folder, key):
+        with self.lock:
+            return json.loads(self.documents[folder][key]) if key in self.documents[folder] else None
+
+    def write(self, folder, key, content):
+        with self.lock:
+            self.documents[folder][key] = json.dumps(content, default=str)
+
+    def list_keys(self, folder):
+        with self.lock:
+            return sorted(self.documents[folder])
+
+    def remove(self, folder, key):
+        with self.lock:
+            self.documents[folder].pop(key, None)
+            if folder == 'leases':
+                self.lease_times.pop(key, None)
+
+    def acquire_lease(self, key, worker_id):
+        with self.lock:
+            if key in self.lease_times and time.time() - self.lease_times[key] <= self.lease_timeout:
+                return False
+            self.documents['leases'][key] = json.dumps(worker_id)
+            self.lease_times[key] = time.time()
+            return True
+
+    def renew_lease(self, key):
+        with self.lock:
+            if key in self.lease_times:
+                self.lease_times[key] = time.time()
+
+    def get_run_id(self):
+        return self.run_id
+
+    def set_run_id(self, run_id):
+        self.run_id = run_id
+
+    def close(self):
+        self.closed = self.run_id or ''
+
+    def get_closed_run(self):
+        return self.closed
+
+    def reset(self):
+        with self.lock:
+            self.set_run_id(f"{time.strftime('%Y%m%dT%H%M%S')}_{uuid.uuid4().hex[:8]}")
+            for documents in self.documents.values():
+                documents.clear()
+            self.lease_times.clear()
+            self.closed = None
+
+def get_queue(workspace, distributed_configs):
+    """
+    Get the work queue of a workspace.
+
+    Args:
+        workspace (str): The workspace directory.
+        distributed_configs (dict): The distributed configurations ('queue': 'file' or
+            'memory', 'queue_dir', 'lease_timeout' and 'max_attempts').
+
+    Returns:
+        FileQueue: The work queue.
+    """
+    lease_timeout = distributed_configs.get('lease_timeout', 600)
+    max_attempts = distributed_configs.get('max_attempts', 3)
+    if distributed_configs.get('queue', 'file') == 'memory':
+        return MemoryQueue(lease_timeout, max_attempts)
+    queue_dir = os.path.join(workspace, distributed_configs.get('queue_dir', 'work_queue'))
+    return FileQueue(queue_dir, lease_timeout, max_attempts)